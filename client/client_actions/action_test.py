@@ -9,6 +9,7 @@ import hashlib
 import os
 import platform
 import stat
+import struct
 
 import psutil
 
@@ -162,6 +163,75 @@ class ActionTest(test_lib.EmptyActionTest):
     self.assertEqual(result.data,
                      hashlib.sha256(open(path).read()).digest())
 
+  def testHashFileChunks(self):
+    """Can we hash a file in chunks?"""
+    path = os.path.join(self.base_path, "morenumbers.txt")
+    p = rdfvalue.PathSpec(path=path,
+                          pathtype=rdfvalue.PathSpec.PathType.OS)
+    data = open(path).read()
+
+    results = self.RunAction("HashFileChunks",
+                             rdfvalue.HashFileChunksRequest(
+                                 pathspec=p, offset=100, chunk_size=1000,
+                                 max_chunks_per_response=3))
+
+    # The digests are packed three at a time.
+    self.assertEqual(len(results), (len(data) - 100 + 2999) / 3000)
+    self.assertEqual(results[0].offset, 100)
+    self.assertEqual(results[0].length, 3000)
+    self.assertEqual(results[-1].offset + results[-1].length, len(data))
+
+    digests = "".join(x.data for x in results)
+    for i, offset in enumerate(range(100, len(data), 1000)):
+      self.assertEqual(digests[i * 32:(i + 1) * 32],
+                       hashlib.sha256(data[offset:offset + 1000]).digest())
+
+    # Hashing a range stops at its end.
+    results = self.RunAction("HashFileChunks",
+                             rdfvalue.HashFileChunksRequest(
+                                 pathspec=p, offset=0, length=1500,
+                                 chunk_size=1000))
+    self.assertEqual(len(results), 1)
+    self.assertEqual(results[0].length, 1500)
+    self.assertEqual(results[0].data,
+                     hashlib.sha256(data[:1000]).digest() +
+                     hashlib.sha256(data[1000:1500]).digest())
+
+  def testHashFileChunksContentDefined(self):
+    """Do content defined chunks survive inserting data?"""
+    data = "".join("Line %d of the log.\n" % i for i in range(2000))
+    edited = data[:5000] + "Inserted." + data[5000:]
+    digests = []
+    for i, content in enumerate([data, edited]):
+      path = os.path.join(self.temp_dir, "chunks%d.txt" % i)
+      with open(path, "wb") as fd:
+        fd.write(content)
+
+      p = rdfvalue.PathSpec(path=path,
+                            pathtype=rdfvalue.PathSpec.PathType.OS)
+      results = self.RunAction("HashFileChunks",
+                               rdfvalue.HashFileChunksRequest(
+                                   pathspec=p, chunk_size=1000,
+                                   content_defined=True))
+
+      # Every digest is preceded by the length of its chunk.
+      entries = "".join(x.data for x in results)
+      offset = 0
+      chunk_digests = []
+      for j in range(0, len(entries), 40):
+        length, = struct.unpack("<Q", entries[j:j + 8])
+        self.assertLessEqual(length, 1000)
+        chunk_digests.append(entries[j + 8:j + 40])
+        self.assertEqual(chunk_digests[-1], hashlib.sha256(
+            content[offset:offset + length]).digest())
+        offset += length
+
+      self.assertEqual(offset, len(content))
+      digests.append(chunk_digests)
+
+    # Only the chunks around the inserted data have changed.
+    self.assertLessEqual(len(set(digests[1]) - set(digests[0])), 2)
+
   def testEnumerateUsersLinux(self):
     """Enumerate users from the wtmp file."""
     # Linux only
@@ -6,6 +6,7 @@
 import hashlib
 
 from grr.parsers import fingerprint
+from grr.client import hash_cache
 from grr.client import vfs
 from grr.client.client_actions import standard
 from grr.lib import rdfvalue
@@ -32,9 +33,6 @@ class FingerprintFile(standard.ReadBuffer):
   def Run(self, args):
     """Fingerprint a file."""
     with vfs.VFSOpen(args.pathspec) as file_obj:
-      fingerprinter = fingerprint.Fingerprinter(file_obj)
-      response = rdfvalue.FingerprintResponse()
-      response.pathspec = file_obj.pathspec
       if args.tuples:
         tuples = args.tuples
       else:
@@ -43,6 +41,20 @@ class FingerprintFile(standard.ReadBuffer):
         for k in self._fingerprint_types.iterkeys():
           tuples.append(rdfvalue.FingerprintTuple(fp_type=k))
 
+      kind = "FingerprintFile:%s" % hashlib.sha1(
+          "".join(x.SerializeToString() for x in tuples)).hexdigest()
+      key = hash_cache.HASH_CACHE.Key(file_obj, kind)
+      cached = hash_cache.HASH_CACHE.Get(key)
+      if cached is not None:
+        response = rdfvalue.FingerprintResponse(cached)
+        response.pathspec = file_obj.pathspec
+        self.SendReply(response)
+        return
+
+      fingerprinter = fingerprint.Fingerprinter(file_obj)
+      response = rdfvalue.FingerprintResponse()
+      response.pathspec = file_obj.pathspec
+
       for finger in tuples:
         hashers = [self._hash_types[h] for h in finger.hashers] or None
         if finger.fp_type in self._fingerprint_types:
@@ -59,4 +71,6 @@ class FingerprintFile(standard.ReadBuffer):
       # and auxilliary data where present (e.g. signature blobs).
       # Also see Fingerprint:HashIt()
       response.results = fingerprinter.HashIt()
+      hash_cache.HASH_CACHE.Put(file_obj, kind, key,
+                                response.SerializeToString())
       self.SendReply(response)
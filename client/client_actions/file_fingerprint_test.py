@@ -8,13 +8,18 @@
 
 import hashlib
 import os
+import shutil
+import stat
 
 
 # Populate the action registry
 # pylint: disable=unused-import
 from grr.client import client_actions
 # pylint: enable=unused-import
+from grr.parsers import fingerprint
+from grr.client import hash_cache
 from grr.client import vfs
+from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import test_lib
@@ -49,6 +54,103 @@ class FilehashTest(test_lib.EmptyActionTest):
 
     self.assertEquals(result[0].pathspec.path, path)
 
+  def testHashCache(self):
+    """Are fingerprints of unchanged files cached?"""
+    config_lib.CONFIG.Set("Client.hash_cache_enabled", True)
+    config_lib.CONFIG.Set("Client.hash_cache_path",
+                          os.path.join(self.temp_dir, "hash_cache.db"))
+
+    path = os.path.join(self.temp_dir, "numbers.txt")
+    shutil.copy(os.path.join(self.base_path, "numbers.txt"), path)
+    p = rdfvalue.PathSpec(path=path,
+                          pathtype=rdfvalue.PathSpec.PathType.OS)
+    request = rdfvalue.FingerprintRequest(pathspec=p)
+
+    def HashIt(_):
+      raise RuntimeError("The file should not be hashed.")
+
+    try:
+      # The file was just written so it could still change unnoticed.
+      self.RunAction("FingerprintFile", request)
+      self.assertEqual(hash_cache.HASH_CACHE.size, 0)
+
+      with test_lib.Stubber(hash_cache.PersistentHashCache, "RACY_INTERVAL",
+                            -1):
+        result = self.RunAction("FingerprintFile", request)
+        self.assertEqual(hash_cache.HASH_CACHE.size, 1)
+
+        # The second time around the result comes from the cache.
+        with test_lib.Stubber(fingerprint.Fingerprinter, "HashIt", HashIt):
+          cached = self.RunAction("FingerprintFile", request)
+
+        self.assertProtoEqual(result[0], cached[0])
+
+        # Changing the file invalidates the cached result.
+        with open(path, "ab") as fd:
+          fd.write("More numbers")
+
+        result = self.RunAction("FingerprintFile", request)
+        fingers = dict((f["name"], f) for f in result[0].results)
+        self.assertEqual(fingers["generic"]["sha256"],
+                         hashlib.sha256(open(path).read()).digest())
+
+        # Results for a file which changes while it is hashed are not cached.
+        hash_it = fingerprint.Fingerprinter.HashIt
+
+        def ChangeAndHashIt(fingerprinter):
+          with open(path, "ab") as fd:
+            fd.write("Even more numbers")
+          return hash_it(fingerprinter)
+
+        size = hash_cache.HASH_CACHE.size
+        with test_lib.Stubber(fingerprint.Fingerprinter, "HashIt",
+                              ChangeAndHashIt):
+          self.RunAction("FingerprintFile", request)
+
+        self.assertEqual(hash_cache.HASH_CACHE.size, size)
+    finally:
+      hash_cache.HASH_CACHE.Close()
+
+  def testHashCacheUsesFileIndexWithoutInodes(self):
+    """Are files without inode numbers identified by their file index?"""
+    config_lib.CONFIG.Set("Client.hash_cache_enabled", True)
+    config_lib.CONFIG.Set("Client.hash_cache_path",
+                          os.path.join(self.temp_dir, "hash_cache.db"))
+
+    class FakeFile(object):
+      """A file with a Windows style stat entry."""
+      pathspec = rdfvalue.PathSpec(path="/C:/test.exe",
+                                   pathtype=rdfvalue.PathSpec.PathType.OS)
+      index = (1, 2)
+
+      def Stat(self):
+        return rdfvalue.StatEntry(st_mode=stat.S_IFREG | 0644, st_size=10,
+                                  st_mtime=1000, st_ctime=1000)
+
+      def GetFileIndex(self):
+        return self.index
+
+    fd = FakeFile()
+    cache = hash_cache.PersistentHashCache()
+    try:
+      key = cache.Key(fd, "sha256")
+      self.assertTrue(key)
+      cache.Put(fd, "sha256", key, "result")
+      self.assertEqual(cache.Get(cache.Key(fd, "sha256")), "result")
+
+      # Another file at the same path is not mistaken for the cached one.
+      fd.index = (1, 3)
+      self.assertIsNone(cache.Get(cache.Key(fd, "sha256")))
+
+      def GetFileIndex():
+        raise NotImplementedError
+
+      # Files which can not be identified are not cached at all.
+      fd.GetFileIndex = GetFileIndex
+      self.assertIsNone(cache.Key(fd, "sha256"))
+    finally:
+      cache.Close()
+
   def testMissingFile(self):
     """Fail on missing file?"""
     path = os.path.join(self.base_path, "this file does not exist")
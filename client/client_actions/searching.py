@@ -4,17 +4,413 @@
 """Client actions related to searching files and directories."""
 
 
+import array
 import functools
+import heapq
+import re
 import stat
+import threading
 
 import logging
 
 from grr.client import actions
 from grr.client import vfs
 from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
 from grr.lib import utils
 
 
+def FindRegex(regex, data, start, end):
+  """Search the data between start and end for regex hits."""
+  for match in regex.FindIter(data, start, end):
+    yield (match.start(), match.end())
+
+
+# Inline flags apply to the whole regex wherever they appear, so they would
+# change the meaning of the other patterns in an alternation.
+INLINE_FLAGS_RE = re.compile(r"\(\?[iLmsux]+\)")
+
+
+def CanCombineRegexes(regexes):
+  """Checks that regexes can be joined into a single alternation.
+
+  Groups are numbered across the whole alternation, so patterns with groups
+  could have their backreferences point at the wrong group or clash on group
+  names.
+
+  Args:
+    regexes: A list of rdfvalue.RegularExpressions.
+
+  Returns:
+    True if the regexes can be combined.
+  """
+  for regex in regexes:
+    if regex.HasGroups() or INLINE_FLAGS_RE.search(regex.SerializeToString()):
+      return False
+
+  return True
+
+
+def MergeHits(find_funcs, data, start, end):
+  """Search the data with several find functions, yielding hits by end."""
+  streams = [((hit_end, hit_start) for hit_start, hit_end in x(data, start, end))
+             for x in find_funcs]
+  for hit_end, hit_start in heapq.merge(*streams):
+    yield (hit_start, hit_end)
+
+
+class LiteralAutomaton(object):
+  """An Aho-Corasick automaton finding many literals in a single pass.
+
+  The literals are given XOR encoded and are never decoded into a string: the
+  automaton is compiled straight into a table of state transitions indexed by
+  the data bytes, so the patterns only exist in memory as that table.
+
+  Every state has a row of 256 transitions, so the table takes 512 bytes per
+  state (1KB past 65535 states) and there is about one state per byte of the
+  literals. Large literal sets therefore cost the client a lot of memory.
+  """
+
+  def __init__(self, literals, xor_key=0):
+    """Constructor.
+
+    Args:
+      literals: A list of XOR encoded literals to search for.
+      xor_key: The key the literals are encoded with.
+    """
+    # The trie of all literals: for each state a dict of byte -> next state and
+    # the lengths of the literals which end in that state.
+    children = [{}]
+    self.outputs = [[]]
+    for literal in literals:
+      state = 0
+      for char in bytearray(literal):
+        char ^= xor_key
+        if char not in children[state]:
+          children.append({})
+          self.outputs.append([])
+          children[state][char] = len(children) - 1
+
+        state = children[state][char]
+
+      if literal:
+        self.outputs[state].append(len(literal))
+
+    # Turn the trie into a deterministic automaton by filling in the failure
+    # transitions breadth first, so the states we fall back to are complete
+    # before they are needed.
+    # Use the smallest item type that can hold every state.
+    typecode = "H" if len(children) <= 0xFFFF else "I"
+    self.transitions = [None] * len(children)
+    self.transitions[0] = array.array(typecode, [0] * 256)
+    for char, child in children[0].iteritems():
+      self.transitions[0][char] = child
+
+    queue = [(child, 0) for child in children[0].itervalues()]
+    for state, failure in queue:
+      self.outputs[state].extend(self.outputs[failure])
+      self.transitions[state] = array.array(typecode,
+                                            self.transitions[failure])
+      for char, child in children[state].iteritems():
+        self.transitions[state][char] = child
+        queue.append((child, self.transitions[failure][char]))
+
+  def Search(self, data, start, end):
+    """Search the data between start and end for hits, yielded by end."""
+    transitions = self.transitions
+    outputs = self.outputs
+
+    state = 0
+    for i in xrange(start, end):
+      state = transitions[state][data[i]]
+      if outputs[state]:
+        for length in outputs[state]:
+          yield (i + 1 - length, i + 1)
+
+
+def PatternOverlap(max_length, limit):
+  """Returns the overlap needed to find matches up to max_length bytes long.
+
+  Args:
+    max_length: The length of the longest possible match, None if unbounded.
+    limit: The largest overlap we are prepared to keep.
+
+  Returns:
+    The number of bytes that must be kept from one buffer to the next.
+  """
+  if max_length is None:
+    return limit
+
+  return min(max(0, max_length - 1), limit)
+
+
+class StreamingMatcher(object):
+  """Scans a file for hits through a fixed size buffer.
+
+  The buffer is allocated once and reused for every file scanned. It holds a
+  window into the file:
+
+  ---------------------------------
+  | Overlap | Block     | Lookahead |
+  ---------------------------------
+  Hits must end in here:
+            <---------->
+
+  The overlap is carried over from the previous window so hits of up to
+  overlap + 1 bytes that straddle two blocks are still found. The lookahead is
+  read past the block so callers can return context trailing a hit. Hits
+  ending in the overlap were reported by the previous window and hits ending in
+  the lookahead are reported by the next one, so every hit is reported exactly
+  once.
+  """
+
+  def __init__(self, find_func, block_size=1024 * 1024, overlap=0,
+               lookahead=0, progress_callback=None):
+    """Constructor.
+
+    Args:
+      find_func: A function called with (data, start, end) which yields
+                 (start, end) tuples for the hits in data[start:end].
+      block_size: How much new data to search in each window.
+      overlap: How many bytes to keep from one window to the next.
+      lookahead: How many bytes to read past each block.
+      progress_callback: If set, called after every block is searched.
+    """
+    self.find_func = find_func
+    self.overlap = overlap
+    self.lookahead = lookahead
+    self.progress_callback = progress_callback
+    self.buffer = bytearray(overlap + block_size + lookahead)
+    self.fill = 0
+    self.bytes_scanned = 0
+
+  def Scan(self, fd, start_offset=0, length=None):
+    """Yields the hits in the file.
+
+    Args:
+      fd: The VFS handler to scan.
+      start_offset: The file offset to start scanning at.
+      length: Only report hits ending within this many bytes of start_offset.
+              If None we scan to the end of the file.
+
+    Yields:
+      (offset, start, end) tuples where offset is the file offset of the start
+      of self.buffer and start, end is the hit within self.buffer. The buffer
+      is only valid until the next hit is requested.
+    """
+    buf = self.buffer
+    fd.Seek(start_offset)
+
+    end_offset = None
+    if length is not None:
+      end_offset = start_offset + length
+
+    base_offset = start_offset
+    preamble_size = 0
+    self.fill = 0
+    exhausted = False
+
+    while True:
+      while not exhausted and self.fill < len(buf):
+        to_read = len(buf) - self.fill
+        if end_offset is not None:
+          to_read = min(to_read, end_offset + self.lookahead -
+                        base_offset - self.fill)
+
+        data = ""
+        if to_read > 0:
+          data = fd.Read(to_read)
+
+        if not data:
+          exhausted = True
+          break
+
+        buf[self.fill:self.fill + len(data)] = data
+        self.fill += len(data)
+
+      search_end = self.fill
+      if not exhausted:
+        search_end -= self.lookahead
+
+      if end_offset is not None:
+        search_end = min(search_end, end_offset - base_offset)
+
+      if search_end <= preamble_size:
+        return
+
+      for start, end in self.find_func(buf, 0, self.fill):
+        # Hits in the preamble were reported from the previous window, hits in
+        # the lookahead will be reported from the next.
+        if end <= preamble_size or end > search_end:
+          continue
+
+        yield base_offset, start, end
+
+      self.bytes_scanned += search_end - preamble_size
+      stats.STATS.IncrementCounter("grr_client_searched_bytes",
+                                   search_end - preamble_size)
+
+      if self.progress_callback:
+        self.progress_callback()
+
+      if exhausted:
+        return
+
+      # Move the overlap and the lookahead to the front of the buffer.
+      keep_from = max(0, search_end - self.overlap)
+      buf[0:self.fill - keep_from] = buf[keep_from:self.fill]
+      self.fill -= keep_from
+      base_offset += keep_from
+      preamble_size = search_end - keep_from
+
+  def Snippet(self, start, end, before=0, after=0):
+    """Returns the hit at start, end with some context from the buffer."""
+    return self.buffer[max(0, start - before):min(self.fill, end + after)]
+
+
+class DirectoryPrefetcher(object):
+  """Lists directories in background threads ahead of a traversal.
+
+  The traversal asks for the listings of subdirectories it will visit with
+  Prefetch() and later collects them with Get(). Each directory is keyed by
+  its position in the traversal so the workers always list the directory
+  which will be needed soonest. Listings are held until collected, and the
+  workers pause once max_entries directory entries are waiting. At most
+  max_queued directories wait to be listed, further directories are listed
+  by the traversal itself.
+  """
+
+  def __init__(self, threads=4, max_entries=10000, max_queued=10000):
+    self.max_entries = max_entries
+    self.max_queued = max_queued
+    self.lock = threading.Condition()
+
+    # A heap of (key, path, pathspec) to be listed.
+    self.queue = []
+    # Maps paths in the queue to their key, and paths being listed.
+    self.pending = {}
+    self.running = set()
+    # Maps paths to (files, error) listings which are yet to be collected.
+    self.results = {}
+    self.buffered_entries = 0
+    self.stopped = False
+
+    self.workers = []
+    for _ in range(threads):
+      worker = threading.Thread(target=self._Worker)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def _List(self, pathspec):
+    return list(vfs.VFSOpen(pathspec).ListFiles())
+
+  def _Worker(self):
+    """Lists queued directories until stopped."""
+    while True:
+      with self.lock:
+        while not self.stopped and (
+            not self.queue or self.buffered_entries >= self.max_entries):
+          self.lock.wait()
+
+        if self.stopped:
+          return
+
+        key, path, pathspec = heapq.heappop(self.queue)
+        # The traversal already listed this directory itself.
+        if self.pending.get(path) != key:
+          continue
+
+        del self.pending[path]
+        self.running.add(path)
+
+      files, error = [], None
+      try:
+        files = self._List(pathspec)
+      except (IOError, OSError) as e:
+        error = e
+
+      with self.lock:
+        self.running.discard(path)
+        if not self.stopped:
+          self.results[path] = (files, error)
+          self.buffered_entries += len(files)
+
+        self.lock.notify_all()
+
+  def Prefetch(self, key, pathspec):
+    """Queues a directory to be listed.
+
+    Args:
+      key: A tuple giving the position of the directory in the traversal.
+           Directories with smaller keys are listed first.
+      pathspec: The directory to list.
+    """
+    path = pathspec.CollapsePath()
+    with self.lock:
+      if path in self.pending or path in self.running or path in self.results:
+        return
+
+      if len(self.queue) >= self.max_queued:
+        return
+
+      self.pending[path] = key
+      heapq.heappush(self.queue, (key, path, pathspec))
+      self.lock.notify()
+
+  def Get(self, pathspec):
+    """Returns the listing of a directory.
+
+    If the directory has not been listed by a worker yet we list it here.
+
+    Args:
+      pathspec: The directory to list.
+
+    Returns:
+      A list of StatEntry objects.
+
+    Raises:
+      IOError, OSError: The directory could not be listed.
+    """
+    path = pathspec.CollapsePath()
+    with self.lock:
+      while path in self.running:
+        self.lock.wait()
+
+      if path in self.results:
+        files, error = self.results.pop(path)
+        self.buffered_entries -= len(files)
+        self.lock.notify_all()
+
+        if error is not None:
+          raise error
+
+        return files
+
+      # Workers will skip the stale queue entry.
+      self.pending.pop(path, None)
+
+    return self._List(pathspec)
+
+  def Stop(self):
+    with self.lock:
+      self.stopped = True
+      self.queue = []
+      self.pending = {}
+      self.results = {}
+      self.buffered_entries = 0
+      self.lock.notify_all()
+
+
+class SearchingInit(registry.InitHook):
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("grr_client_searched_bytes")
+
+
 class Find(actions.IteratedAction):
   """Recurses through a directory returning files which match conditions."""
   in_rdfvalue = rdfvalue.FindSpec
@@ -28,14 +424,29 @@ class Find(actions.IteratedAction):
   # The filesystem we are limiting ourselves to, if cross_devs is false.
   filesystem_id = None
 
-  def ListDirectory(self, pathspec, state, depth=0):
+  # How much of each file we search for data_regex at a time.
+  BLOCK_SIZE = 1024000
+
+  # The most context we keep between blocks to find data_regex hits spanning
+  # them. This only applies to regexes which can match unbounded lengths.
+  MAX_OVERLAP = 4096
+
+  matcher = None
+
+  # If set, a DirectoryPrefetcher listing the directories we will visit next.
+  prefetcher = None
+
+  def ListDirectory(self, pathspec, state, depth=0, key=()):
     """A Recursive generator of files."""
     # Limit recursion depth
     if depth >= self.request.max_depth: return
 
     try:
-      fd = vfs.VFSOpen(pathspec)
-      files = fd.ListFiles()
+      if depth > 0 and self.prefetcher is not None:
+        files = self.prefetcher.Get(pathspec)
+      else:
+        fd = vfs.VFSOpen(pathspec)
+        files = fd.ListFiles()
     except (IOError, OSError) as e:
       if depth == 0:
         # We failed to open the directory the server asked for because dir
@@ -58,16 +469,20 @@ class Find(actions.IteratedAction):
     # resume.
     start = state.get(pathspec.CollapsePath(), 0)
 
+    if self.prefetcher is not None and depth + 1 < self.request.max_depth:
+      files = list(files)
+      for i, file_stat in enumerate(files):
+        if i >= start and self._ShouldTraverse(file_stat):
+          self.prefetcher.Prefetch(key + (i,), file_stat.pathspec)
+
     for i, file_stat in enumerate(files):
       # Skip the files we already did before
       if i < start: continue
 
-      if stat.S_ISDIR(file_stat.st_mode):
-        # Do not traverse directories in a different filesystem.
-        if self.request.cross_devs or self.filesystem_id == file_stat.st_dev:
-          for child_stat in self.ListDirectory(file_stat.pathspec,
-                                               state, depth + 1):
-            yield child_stat
+      if self._ShouldTraverse(file_stat):
+        for child_stat in self.ListDirectory(file_stat.pathspec,
+                                             state, depth + 1, key + (i,)):
+          yield child_stat
 
       state[pathspec.CollapsePath()] = i + 1
       yield file_stat
@@ -78,6 +493,12 @@ class Find(actions.IteratedAction):
     except KeyError:
       pass
 
+  def _ShouldTraverse(self, file_stat):
+    """Is this a directory we should descend into?"""
+    # Do not traverse directories in a different filesystem.
+    return stat.S_ISDIR(file_stat.st_mode) and (
+        self.request.cross_devs or self.filesystem_id == file_stat.st_dev)
+
   def FilterFile(self, file_stat):
     """Tests a file for filters.
 
@@ -113,25 +534,20 @@ class Find(actions.IteratedAction):
 
   def TestFileContent(self, file_stat):
     """Checks the file for the presence of the regular expression."""
-    # Content regex check
-    try:
+    if self.matcher is None:
+      overlap = PatternOverlap(self.request.data_regex.MaxMatchLength(),
+                               self.MAX_OVERLAP)
+      self.matcher = StreamingMatcher(
+          functools.partial(FindRegex, self.request.data_regex),
+          block_size=min(self.BLOCK_SIZE, self.request.max_data),
+          overlap=overlap, progress_callback=self.Progress)
 
-      data = ""
+    try:
       with vfs.VFSOpen(file_stat.pathspec) as fd:
         # Only read this much data from the file.
-        while fd.Tell() < self.request.max_data:
-          data_read = fd.read(1024000)
-          if not data_read: break
-          data += data_read
-
+        for _ in self.matcher.Scan(fd, length=self.request.max_data):
           # Got it.
-          if self.request.data_regex.Search(data):
-            return True
-
-          # Keep a bit of context from the last buffer to ensure we dont miss a
-          # match broken by buffer. We do not expect regex's to match something
-          # larger than about 100 chars.
-          data = data[-100:]
+          return True
 
     except (IOError, KeyError):
       pass
@@ -144,20 +560,31 @@ class Find(actions.IteratedAction):
 
     limit = request.iterator.number
 
-    # TODO(user): What is a reasonable measure of work here?
-    for count, f in enumerate(
-        self.ListDirectory(request.pathspec, client_state)):
+    if request.prefetch_threads:
+      self.prefetcher = DirectoryPrefetcher(
+          threads=request.prefetch_threads,
+          max_entries=request.prefetch_max_entries)
 
-      # Only send the reply if the file matches all criteria
-      if self.FilterFile(f):
-        self.SendReply(rdfvalue.FindSpec(hit=f))
+    try:
+      # TODO(user): What is a reasonable measure of work here?
+      for count, f in enumerate(
+          self.ListDirectory(request.pathspec, client_state)):
+
+        # Only send the reply if the file matches all criteria
+        if self.FilterFile(f):
+          self.SendReply(rdfvalue.FindSpec(hit=f))
+
+        # We only check a limited number of files in each iteration. This
+        # might result in returning an empty response - but the iterator is
+        # not yet complete. Flows must check the state of the iterator
+        # explicitly.
+        if count >= limit - 1:
+          logging.debug("Processed %s entries, quitting", count)
+          return
 
-      # We only check a limited number of files in each iteration. This might
-      # result in returning an empty response - but the iterator is not yet
-      # complete. Flows must check the state of the iterator explicitly.
-      if count >= limit - 1:
-        logging.debug("Processed %s entries, quitting", count)
-        return
+    finally:
+      if self.prefetcher is not None:
+        self.prefetcher.Stop()
 
     # End this iterator
     request.iterator.state = rdfvalue.Iterator.State.FINISHED
@@ -168,65 +595,124 @@ class Grep(actions.ActionPlugin):
   in_rdfvalue = rdfvalue.GrepSpec
   out_rdfvalue = rdfvalue.BufferReference
 
-  def FindRegex(self, regex, data):
-    """Search the data for a hit."""
-    for match in regex.FindIter(data):
-      yield (match.start(), match.end())
+  # Up to this many literals are searched one by one with the builtin search,
+  # more are searched with a LiteralAutomaton.
+  MAX_SEPARATE_LITERALS = 16
 
-  def FindLiteral(self, pattern, data):
+  def FindLiteral(self, pattern, data, start, end):
     """Search the data for a hit."""
     utils.XorByteArray(pattern, self.xor_in_key)
 
-    offset = 0
-    while 1:
-      # We assume here that data.find does not make a copy of pattern.
-      offset = data.find(pattern, offset)
+    try:
+      offset = start
+      while 1:
+        # We assume here that data.find does not make a copy of pattern.
+        offset = data.find(pattern, offset, end)
 
-      if offset < 0:
-        break
+        if offset < 0:
+          break
 
-      yield (offset, offset + len(pattern))
+        yield (offset, offset + len(pattern))
 
-      offset += 1
+        offset += 1
 
-    utils.XorByteArray(pattern, self.xor_in_key)
+    finally:
+      # Make sure the pattern is encoded again even if we stop early.
+      utils.XorByteArray(pattern, self.xor_in_key)
+
+  def GetFindFunc(self, args):
+    """Compiles all the patterns in the request into a single find function.
+
+    A few literals are each searched with the builtin search, which is much
+    faster than an automaton stepping through the data in Python. Larger sets
+    of literals are searched with an Aho-Corasick automaton in a single pass.
+    Both report all hits including overlapping ones. Regexes are joined into a single
+    alternation where that does not change their meaning, so the data is only
+    scanned once for them. Hits of an alternation do not overlap: where the
+    hits of several regexes overlap only the first one found is reported.
+    Regexes with groups or inline flags are searched one by one instead, and
+    each reports its own hits.
+
+    Args:
+      args: A protobuf describing the grep request.
+
+    Returns:
+      A tuple of the find function and the length of the longest possible hit,
+      which is None if it is unbounded.
+
+    Raises:
+      RuntimeError: No search pattern has been given in the request.
+    """
+    literals = [x for x in args.literals if x]
+    if args.literal:
+      literals.append(args.literal)
+
+    regexes = [rdfvalue.RegularExpression(x) for x in args.regexes]
+    if args.regex:
+      regexes.append(args.regex)
+
+    find_funcs = []
+    max_lengths = []
+    if len(literals) <= self.MAX_SEPARATE_LITERALS:
+      for literal in literals:
+        find_funcs.append(functools.partial(self.FindLiteral,
+                                            bytearray(literal)))
+    else:
+      automaton = LiteralAutomaton(literals, xor_key=self.xor_in_key)
+      find_funcs.append(automaton.Search)
+
+    max_lengths.extend(len(x) for x in literals)
+
+    if len(regexes) > 1 and CanCombineRegexes(regexes):
+      regexes = [rdfvalue.RegularExpression(
+          "|".join("(?:%s)" % x.SerializeToString() for x in regexes))]
+
+    for regex in regexes:
+      find_funcs.append(functools.partial(FindRegex, regex))
+      max_lengths.append(regex.MaxMatchLength())
+
+    if not find_funcs:
+      raise RuntimeError("Grep needs a regex or a literal.")
+
+    max_length = None
+    if None not in max_lengths:
+      max_length = max(max_lengths)
+
+    if len(find_funcs) == 1:
+      return find_funcs[0], max_length
+
+    return functools.partial(MergeHits, find_funcs), max_length
 
   BUFF_SIZE = 1024 * 1024 * 10
   ENVELOPE_SIZE = 1000
   HIT_LIMIT = 10000
 
+  # The most context we keep between blocks to find regex hits spanning them.
+  # This only applies to regexes which can match unbounded lengths.
+  MAX_OVERLAP = 64 * 1024
+
   def Run(self, args):
     """Search the file for the pattern.
 
-    This implements the grep algorithm used to scan files. It reads
-    the data in chunks of BUFF_SIZE (10 MB currently) and can use
-    different functions to search for matching patterns. In every
-    step, a buffer that is a bit bigger than the block size is used in
-    order to return all the requested results. Specifically, a
-    preamble is used in order to not miss any patterns that start in
-    one block of data and end in the next and also a postscript buffer
-    is kept such that the algorithm can return bytes trailing the
-    pattern even if the pattern is at the end of one block.
+    This implements the grep algorithm used to scan files. The file
+    is streamed through a StreamingMatcher in blocks of BUFF_SIZE (10
+    MB currently) and all the literals and regexes in the request are
+    searched for in that single pass. Every block is preceded by a
+    preamble kept from the previous block, so patterns that start in
+    one block of data and end in the next are not missed, and
+    followed by a postscript so the bytes trailing a pattern can be
+    returned even if the pattern is at the end of one block.
 
     One block:
     -----------------------------
     | Pre | Data         | Post |
     -----------------------------
-    Searching the pattern is done here:
-    <------------------->
+    Hits must end here:
+          <-------------->
 
-    The following block is constructed like this:
-    -----------------------------
-    | Pre | Data         | Post |
-    -----------------------------
-                         |
-                   -----------------------------
-                   | Pre | Data         | Post |
-                   -----------------------------
-
-    The preamble is filled from Data so every hit that happens to fall
-    entirely into the preamble has to be discarded since it has
-    already been discovered in the step before.
+    Both the preamble and the postscript are at least ENVELOPE_SIZE
+    bytes long. The preamble grows to fit the longest possible hit if
+    the pattern is longer than that.
 
     Grepping for memory
 
@@ -236,8 +722,10 @@ class Grep(actions.ActionPlugin):
     itself. Therefore, if the input is a literal, it is XOR encoded
     and only visible in memory when the pattern is matched. This is
     done using bytearrays which guarantees in place updates and no
-    leaking patterns. Also the returned data is encoded using a
-    different XOR 'key'.
+    leaking patterns. When several literals are given they are
+    compiled into an automaton straight from their encoded form so
+    they are never decoded at all. Also the returned data is encoded
+    using a different XOR 'key'.
 
     This should guarantee that there are no hits when the pattern is
     not present in memory. However, since the data will be copied to
@@ -252,75 +740,38 @@ class Grep(actions.ActionPlugin):
 
     """
     fd = vfs.VFSOpen(args.target)
-    fd.Seek(args.start_offset)
-    base_offset = args.start_offset
 
     self.xor_in_key = args.xor_in_key
     self.xor_out_key = args.xor_out_key
 
-    if args.regex:
-      find_func = functools.partial(self.FindRegex, args.regex)
-    elif args.literal:
-      find_func = functools.partial(self.FindLiteral, bytearray(args.literal))
-    else:
-      raise RuntimeError("Grep needs a regex or a literal.")
-
-    preamble_size = 0
-    postscript_size = 0
-    hits = 0
-    data = ""
-    while fd.Tell() < args.start_offset + args.length:
-
-      # Base size to read is at most the buffer size.
-      to_read = min(args.length, self.BUFF_SIZE,
-                    args.start_offset + args.length - fd.Tell())
-      # Read some more data for the snippet.
-      to_read += self.ENVELOPE_SIZE - postscript_size
-      read_data = fd.Read(to_read)
+    find_func, max_length = self.GetFindFunc(args)
 
-      data = data[-postscript_size - self.ENVELOPE_SIZE:] + read_data
+    overlap = max(self.ENVELOPE_SIZE,
+                  PatternOverlap(max_length, self.MAX_OVERLAP))
+    matcher = StreamingMatcher(
+        find_func, block_size=min(args.length, self.BUFF_SIZE),
+        overlap=overlap, lookahead=self.ENVELOPE_SIZE,
+        progress_callback=self.Progress)
 
-      postscript_size = max(0, self.ENVELOPE_SIZE - (to_read - len(read_data)))
-      data_size = len(data) - preamble_size - postscript_size
-
-      if data_size == 0 and postscript_size == 0: break
-
-      for (start, end) in find_func(data):
-        # Ignore hits in the preamble.
-        if end <= preamble_size:
-          continue
-
-        # Ignore hits in the postscript.
-        if end > preamble_size+data_size:
-          continue
-
-        # Offset of file in the end after length.
-        if end + base_offset - preamble_size > args.start_offset + args.length:
-          break
-
-        out_data = ""
-        for i in xrange(max(0, start - args.bytes_before),
-                        min(len(data), end + args.bytes_after)):
-          out_data += chr(ord(data[i]) ^ self.xor_out_key)
-
-        hits += 1
-        self.SendReply(offset=base_offset + start - preamble_size,
-                       data=out_data, length=len(out_data),
-                       pathspec=fd.pathspec)
-
-        if args.mode == rdfvalue.GrepSpec.Mode.FIRST_HIT:
-          return
-
-        if hits >= self.HIT_LIMIT:
-          msg = utils.Xor("This Grep has reached the maximum number of hits"
-                          " (%d)." % self.HIT_LIMIT, self.xor_out_key)
-          self.SendReply(offset=0,
-                         data=msg, length=len(msg))
-          return
-
-      self.Progress()
-
-      base_offset += data_size
+    hits = 0
+    for offset, start, end in matcher.Scan(fd, args.start_offset,
+                                           args.length):
+      out_data = matcher.Snippet(start, end, args.bytes_before,
+                                 args.bytes_after)
+      utils.XorByteArray(out_data, self.xor_out_key)
+      out_data = str(out_data)
+
+      hits += 1
+      self.SendReply(offset=offset + start,
+                     data=out_data, length=len(out_data),
+                     pathspec=fd.pathspec)
+
+      if args.mode == rdfvalue.GrepSpec.Mode.FIRST_HIT:
+        return
 
-      # Allow for overlap with previous matches.
-      preamble_size = min(len(data), self.ENVELOPE_SIZE)
+      if hits >= self.HIT_LIMIT:
+        msg = utils.Xor("This Grep has reached the maximum number of hits"
+                        " (%d)." % self.HIT_LIMIT, self.xor_out_key)
+        self.SendReply(offset=0,
+                       data=msg, length=len(msg))
+        return
@@ -163,6 +163,46 @@ class FindTest(test_lib.EmptyActionTest):
     # Ensure we remove old states from client_state
     self.assertEqual(len(request.iterator.client_state.dat), 0)
 
+  def testFindActionPrefetch(self):
+    """Test that prefetching directories does not change the results."""
+    pathspec = rdfvalue.PathSpec(path="/mock2/",
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+    request = rdfvalue.FindSpec(pathspec=pathspec, path_regex=".",
+                                cross_devs=True)
+    request.iterator.number = 200
+    result = self.RunAction("Find", request)
+    all_files = [x.hit for x in result if isinstance(x, rdfvalue.FindSpec)]
+
+    # Ask for the files a few at a time, prefetching with a tiny buffer.
+    files = []
+    request = rdfvalue.FindSpec(pathspec=pathspec, path_regex=".",
+                                cross_devs=True, prefetch_threads=2,
+                                prefetch_max_entries=1)
+    request.iterator.number = 2
+
+    while request.iterator.state != rdfvalue.Iterator.State.FINISHED:
+      result = self.RunAction("Find", request)
+      files.extend(x.hit for x in result if isinstance(x, rdfvalue.FindSpec))
+      request.iterator = result[-1].Copy()
+
+    self.assertEqual(len(files), len(all_files))
+    for x, y in zip(all_files, files):
+      self.assertProtoEqual(x, y)
+
+    self.assertEqual(len(request.iterator.client_state.dat), 0)
+
+  def testPrefetchQueueIsBounded(self):
+    # Without threads nothing is taken off the queue.
+    prefetcher = searching.DirectoryPrefetcher(threads=0, max_queued=2)
+    for i in range(5):
+      prefetcher.Prefetch((i,), rdfvalue.PathSpec(
+          path="/mock2/directory%d" % i,
+          pathtype=rdfvalue.PathSpec.PathType.OS))
+
+    self.assertEqual([path for _, path, _ in sorted(prefetcher.queue)],
+                     ["/mock2/directory0", "/mock2/directory1"])
+    prefetcher.Stop()
+
   def testFindAction2(self):
     """Test the find action path regex."""
     pathspec = rdfvalue.PathSpec(path="/mock2/",
@@ -192,6 +232,24 @@ class FindTest(test_lib.EmptyActionTest):
     self.assertEqual(all_files[1].pathspec.Basename(),
                      "long_file.text")
 
+  def testFindLongDataRegex(self):
+    """Test that data_regex hits spanning blocks are found."""
+    pathspec = rdfvalue.PathSpec(path="/mock2/",
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+
+    # This regex matches 308 bytes which must straddle a block boundary.
+    request = rdfvalue.FindSpec(pathspec=pathspec,
+                                data_regex="(space ){50}A Secret",
+                                cross_devs=True)
+    request.iterator.number = 200
+
+    with test_lib.Stubber(searching.Find, "BLOCK_SIZE", 1000):
+      result = self.RunAction("Find", request)
+
+    all_files = [x.hit for x in result if isinstance(x, rdfvalue.FindSpec)]
+    self.assertEqual(len(all_files), 1)
+    self.assertEqual(all_files[0].pathspec.Basename(), "long_file.text")
+
   def testFindSizeLimits(self):
     """Test the find action size limits."""
     # First get all the files at once
@@ -480,6 +538,76 @@ class GrepTest(test_lib.EmptyActionTest):
       self.assertEqual(utils.Xor(result[0].data, self.XOR_OUT_KEY),
                        expected)
 
+  @SearchParams(100, 50)
+  def testGrepMultipleLiterals(self):
+    self._GrepMultipleLiterals()
+
+  @SearchParams(100, 50)
+  def testGrepMultipleLiteralsWithAutomaton(self):
+    with test_lib.Stubber(searching.Grep, "MAX_SEPARATE_LITERALS", 1):
+      self._GrepMultipleLiterals()
+
+  def _GrepMultipleLiterals(self):
+    literals = ["HIT", "SHIT", "ITS"]
+
+    for offset in xrange(0, 300, 7):
+      data = "X" * offset + "SHITS" + "X" * 100 + "HIT" + "X" * 10
+      MockVFSHandlerFind.filesystem[self.filename] = data
+
+      request = rdfvalue.GrepSpec(
+          literals=[utils.Xor(x, self.XOR_IN_KEY) for x in literals],
+          xor_in_key=self.XOR_IN_KEY,
+          xor_out_key=self.XOR_OUT_KEY)
+      request.target.path = self.filename
+      request.target.pathtype = rdfvalue.PathSpec.PathType.OS
+      request.bytes_before = 0
+      request.bytes_after = 0
+
+      result = self.RunAction("Grep", request)
+      hits = sorted((x.offset, utils.Xor(x.data, self.XOR_OUT_KEY))
+                    for x in result)
+      self.assertEqual(hits, [(offset, "SHIT"), (offset + 1, "HIT"),
+                              (offset + 2, "ITS"), (offset + 105, "HIT")])
+
+  def testGrepLiteralsAndRegexes(self):
+    data = "X" * 50 + "HIT" + "X" * 50 + "M123N" + "X" * 50 + "Q"
+    MockVFSHandlerFind.filesystem[self.filename] = data
+
+    request = rdfvalue.GrepSpec(
+        literal=utils.Xor("HIT", self.XOR_IN_KEY),
+        literals=[utils.Xor("Q", self.XOR_IN_KEY)],
+        regexes=["M[0-9]+N"],
+        xor_in_key=self.XOR_IN_KEY,
+        xor_out_key=self.XOR_OUT_KEY)
+    request.target.path = self.filename
+    request.target.pathtype = rdfvalue.PathSpec.PathType.OS
+    request.bytes_before = 0
+    request.bytes_after = 0
+
+    result = self.RunAction("Grep", request)
+    hits = [(x.offset, utils.Xor(x.data, self.XOR_OUT_KEY)) for x in result]
+    self.assertEqual(hits, [(50, "HIT"), (103, "M123N"), (158, "Q")])
+
+  def testGrepRegexesWithGroups(self):
+    data = "X" * 10 + "abab" + "X" * 10 + "cdcd"
+    MockVFSHandlerFind.filesystem[self.filename] = data
+
+    # The first two regexes use the same group name and backreference number.
+    # Hits of the last one overlap hits of the first.
+    request = rdfvalue.GrepSpec(
+        regexes=[r"(?P<x>ab)\1", r"(?P<x>cd)\1", "ba"],
+        xor_in_key=self.XOR_IN_KEY,
+        xor_out_key=self.XOR_OUT_KEY)
+    request.target.path = self.filename
+    request.target.pathtype = rdfvalue.PathSpec.PathType.OS
+    request.bytes_before = 0
+    request.bytes_after = 0
+
+    result = self.RunAction("Grep", request)
+    hits = sorted((x.offset, utils.Xor(x.data, self.XOR_OUT_KEY))
+                  for x in result)
+    self.assertEqual(hits, [(10, "abab"), (11, "ba"), (24, "cdcd")])
+
   def testHitLimit(self):
     limit = searching.Grep.HIT_LIMIT
 
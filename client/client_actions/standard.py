@@ -8,6 +8,7 @@ import hashlib
 import os
 import platform
 import socket
+import struct
 import sys
 import time
 import zlib
@@ -19,6 +20,7 @@ import logging
 
 from grr.client import actions
 from grr.client import client_utils_common
+from grr.client import hash_cache
 from grr.client import vfs
 from grr.client.client_actions import tempfiles
 from grr.lib import config_lib
@@ -44,12 +46,11 @@ class ReadBuffer(actions.ActionPlugin):
       raise RuntimeError("Can not read buffers this large.")
 
     try:
-      fd = vfs.VFSOpen(args.pathspec)
-
-      fd.Seek(args.offset)
-      offset = fd.Tell()
+      with vfs.CachedVFSOpen(args.pathspec) as fd:
+        fd.Seek(args.offset)
+        offset = fd.Tell()
 
-      data = fd.Read(args.length)
+        data = fd.Read(args.length)
 
     except (IOError, OSError), e:
       self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.IOERROR, e)
@@ -107,16 +108,245 @@ class HashBuffer(actions.ActionPlugin):
     if args.length > MAX_BUFFER_SIZE:
       raise RuntimeError("Can not read buffers this large.")
 
-    data = vfs.ReadVFS(args.pathspec, args.offset, args.length)
+    with vfs.CachedVFSOpen(args.pathspec) as fd:
+      kind = "HashBuffer:%d:%d" % (args.offset, args.length)
+      key = hash_cache.HASH_CACHE.Key(fd, kind)
+      result = hash_cache.HASH_CACHE.Get(key)
+      if result is None:
+        fd.Seek(args.offset)
+        data = fd.Read(args.length)
+        result = struct.pack("<Q", len(data)) + hashlib.sha256(data).digest()
+        hash_cache.HASH_CACHE.Put(fd, kind, key, result)
 
-    digest = hashlib.sha256(data).digest()
+    length, = struct.unpack("<Q", result[:8])
+    digest = result[8:]
 
     # Now report the hash of this blob to our flow as well as the offset and
     # length.
-    self.SendReply(offset=args.offset, length=len(data),
+    self.SendReply(offset=args.offset, length=length,
                    data=digest)
 
 
+class ContentDefinedChunker(object):
+  """Splits data into chunks at boundaries chosen by the content.
+
+  A boundary is placed wherever a gear hash of the preceding WINDOW bytes has
+  all its top bits clear (see "FastCDC", Xia et al., USENIX ATC 2016). Since
+  the boundaries only depend on the nearby data, inserting or removing some
+  bytes only changes the chunks around the edit and the rest of the data still
+  splits into the same chunks.
+  """
+
+  WINDOW = 32
+
+  # Every byte value is mapped to a fixed random 32 bit number. These must never
+  # change or the same data would be split differently.
+  GEAR = [struct.unpack("<I", hashlib.md5(chr(i)).digest()[:4])[0]
+          for i in range(256)]
+
+  def __init__(self, max_size):
+    """Constructor.
+
+    Args:
+      max_size: The maximum size of a chunk. Chunks are at least an eighth of
+                this, and on average about three eighths of this long.
+    """
+    self.max_size = max_size
+    self.min_size = max(max_size / 8, self.WINDOW)
+
+    # Past min_size there is a boundary every 2 ** bits bytes on average.
+    bits = min(max(1, (max_size / 4).bit_length() - 1), 31)
+    self.mask = ((1 << bits) - 1) << (32 - bits)
+
+  def FindBoundary(self, data, start, end):
+    """Returns the end of the chunk starting at start.
+
+    Args:
+      data: A bytearray.
+      start: The offset of the chunk in data.
+      end: The end of the data available for the chunk. If no boundary is
+           found, the chunk ends here or at its maximum size.
+
+    Returns:
+      The offset in data where the chunk ends.
+    """
+    limit = min(end, start + self.max_size)
+    offset = start + self.min_size
+    if offset >= limit:
+      return limit
+
+    gear = self.GEAR
+    mask = self.mask
+
+    # The hash only depends on the last WINDOW bytes, which we feed in first.
+    h = 0
+    for c in data[offset - self.WINDOW:offset]:
+      h = ((h << 1) + gear[c]) & 0xFFFFFFFF
+
+    for c in data[offset:limit]:
+      h = ((h << 1) + gear[c]) & 0xFFFFFFFF
+      offset += 1
+      if not h & mask:
+        return offset
+
+    return limit
+
+  def Split(self, fd, end=None):
+    """Yields the consecutive chunks of a file.
+
+    Args:
+      fd: The file to read from its current offset.
+      end: The offset to stop reading at, or None to read to the end.
+
+    Yields:
+      The data of each chunk.
+    """
+    offset = fd.Tell()
+    buf = bytearray()
+    eof = False
+    while True:
+      # We need a full chunk of data to be sure where the chunk ends.
+      while not eof and len(buf) < self.max_size:
+        to_read = self.max_size
+        if end is not None:
+          to_read = min(to_read, end - offset - len(buf))
+
+        data = fd.Read(to_read) if to_read > 0 else ""
+        if not data:
+          eof = True
+
+        buf.extend(data)
+
+      if not buf:
+        return
+
+      boundary = self.FindBoundary(buf, 0, len(buf))
+      yield str(buf[:boundary])
+
+      del buf[:boundary]
+      offset += boundary
+
+
+class HashFileChunks(actions.ActionPlugin):
+  """Hashes a range of a file chunk by chunk in a single pass.
+
+  The sha256 digests of consecutive chunks are packed into the data field of a
+  few large responses, instead of sending one HashBuffer response per chunk.
+  The offset and length of each response describe the range its chunks cover.
+
+  Chunks are either all chunk_size long, except for the last one, or split at
+  content defined boundaries. In the latter case every digest is preceded by
+  the length of its chunk.
+  """
+  in_rdfvalue = rdfvalue.HashFileChunksRequest
+  out_rdfvalue = rdfvalue.BufferReference
+
+  def Run(self, args):
+    """Hash the chunks and send the packed digests to the server."""
+    # Make sure we limit the size of our reads.
+    if args.chunk_size > MAX_BUFFER_SIZE:
+      raise RuntimeError("Can not hash chunks this large.")
+
+    try:
+      fd = vfs.VFSOpen(args.pathspec)
+
+      kind = "HashFileChunks:%d:%d:%d" % (args.offset, args.length,
+                                          args.chunk_size)
+      if args.content_defined:
+        kind += ":content_defined"
+
+      key = hash_cache.HASH_CACHE.Key(fd, kind)
+      cached = hash_cache.HASH_CACHE.Get(key)
+      if cached is not None:
+        self._SendChunks(args, args.offset, self._ParseCacheEntry(cached))
+        return
+
+      fd.Seek(args.offset)
+      start = fd.Tell()
+      cache_entry = self._SendChunks(args, start, self._HashChunks(fd, args))
+
+    except (IOError, OSError), e:
+      self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.IOERROR, e)
+      return
+
+    hash_cache.HASH_CACHE.Put(fd, kind, key, cache_entry)
+
+  def _HashChunks(self, fd, args):
+    """Yields the length and digest of the consecutive chunks of the range."""
+    end = args.offset + args.length if args.length else None
+    if args.content_defined:
+      chunks = ContentDefinedChunker(args.chunk_size).Split(fd, end)
+    else:
+      chunks = self._ReadFixedChunks(fd, args.chunk_size, end)
+
+    for data in chunks:
+      yield len(data), hashlib.sha256(data).digest()
+      self.Progress()
+
+  @staticmethod
+  def _ReadFixedChunks(fd, chunk_size, end):
+    offset = fd.Tell()
+    while end is None or offset < end:
+      to_read = chunk_size
+      if end is not None:
+        to_read = min(to_read, end - offset)
+
+      data = fd.Read(to_read)
+      if not data:
+        break
+
+      offset += len(data)
+      yield data
+
+  @staticmethod
+  def _ParseCacheEntry(cached):
+    entry_size = 8 + 32
+    for i in xrange(0, len(cached), entry_size):
+      length, = struct.unpack("<Q", cached[i:i + 8])
+      yield length, cached[i + 8:i + entry_size]
+
+  def _SendChunks(self, args, offset, chunks):
+    """Packs the chunk digests into responses and sends them.
+
+    Args:
+      args: The HashFileChunksRequest.
+      offset: The offset of the first chunk.
+      chunks: The (length, digest) tuples of consecutive chunks.
+
+    Returns:
+      The length and digest of every chunk, as cached in the hash cache.
+    """
+    cache_entry = []
+    packed = []
+    start = offset
+    for length, digest in chunks:
+      entry = struct.pack("<Q", length) + digest
+      cache_entry.append(entry)
+      packed.append(entry if args.content_defined else digest)
+      offset += length
+
+      if len(packed) >= args.max_chunks_per_response:
+        self.SendReply(offset=start, length=offset - start,
+                       data="".join(packed))
+        packed = []
+        start = offset
+
+    # An empty range is reported as a single empty chunk, just like HashBuffer
+    # does.
+    if not cache_entry:
+      digest = hashlib.sha256("").digest()
+      if args.content_defined:
+        digest = struct.pack("<Q", 0) + digest
+
+      packed.append(digest)
+
+    if packed:
+      self.SendReply(offset=start, length=offset - start,
+                     data="".join(packed))
+
+    return "".join(cache_entry)
+
+
 class CopyPathToFile(actions.ActionPlugin):
   """Copy contents of a pathspec to a file on disk."""
   in_rdfvalue = rdfvalue.CopyPathToFileRequest
@@ -254,18 +484,24 @@ class HashFile(ListDirectory):
     """Hash a file."""
     try:
       fd = vfs.VFSOpen(args.pathspec)
-      hasher = hashlib.sha256()
-      while True:
-        data = fd.Read(1024*1024)
-        if not data: break
+      key = hash_cache.HASH_CACHE.Key(fd, "HashFile")
+      digest = hash_cache.HASH_CACHE.Get(key)
+      if digest is None:
+        hasher = hashlib.sha256()
+        while True:
+          data = fd.Read(1024*1024)
+          if not data: break
+
+          hasher.update(data)
 
-        hasher.update(data)
+        digest = hasher.digest()
+        hash_cache.HASH_CACHE.Put(fd, "HashFile", key, digest)
 
     except (IOError, OSError), e:
       self.SetStatus(rdfvalue.GrrStatus.ReturnedStatus.IOERROR, e)
       return
 
-    self.SendReply(data=hasher.digest())
+    self.SendReply(data=digest)
 
 
 class ExecuteCommand(actions.ActionPlugin):
@@ -9,6 +9,7 @@ import time
 
 import psutil
 
+from grr.client import vfs
 from grr.lib import stats
 
 
@@ -31,6 +32,10 @@ class ClientStatsCollector(threading.Thread):
     stats.STATS.RegisterGaugeMetric("grr_client_io_usage", str)
     stats.STATS.SetGaugeCallback("grr_client_io_usage", self.PrintIOSample)
 
+    stats.STATS.RegisterGaugeMetric("grr_client_vfs_handler_cache", str)
+    stats.STATS.SetGaugeCallback("grr_client_vfs_handler_cache",
+                                 self.PrintVFSHandlerCacheStats)
+
   def run(self):
     while not self.exit:
       time.sleep(self.sleep_time)
@@ -61,6 +66,12 @@ class ClientStatsCollector(threading.Thread):
     samples = [str(sample[3]) for sample in self.cpu_samples[-20:]]
     return ", ".join(samples)
 
+  def PrintVFSHandlerCacheStats(self):
+    """Returns a string with the hit rate of the VFS handler cache."""
+    cache = vfs.HANDLER_CACHE
+    return "hits: %d, misses: %d, invalidations: %d, hit rate: %.2f" % (
+        cache.hits, cache.misses, cache.invalidations, cache.HitRate())
+
   def PrintIOSample(self):
     try:
       return str(self.proc.get_io_counters())
@@ -19,6 +19,7 @@ if sys.platform == "win32":
 
   KeepAlive = client_utils_windows.KeepAlive
   WinChmod = client_utils_windows.WinChmod
+  WinGetFileIndex = client_utils_windows.WinGetFileIndex
 
 elif sys.platform == "darwin":
   from grr.client import client_utils_osx
@@ -6,6 +6,7 @@
 import ctypes
 import exceptions
 import logging
+import msvcrt
 import os
 import re
 import time
@@ -118,6 +119,33 @@ def WinChmod(filename, acl_list, user=None):
                                 security_descriptor)
 
 
+def WinGetFileIndex(fd):
+  """Returns the volume serial number and file index of an open file.
+
+  Python 2.7's os.stat() always reports an st_ino of 0 on Windows, so this is
+  the only way to tell whether a path still refers to the same file.
+
+  Args:
+    fd: An open python file object.
+
+  Returns:
+    A (volume serial number, file index) tuple.
+
+  Raises:
+    IOError: If the file information could not be retrieved.
+  """
+  try:
+    info = win32file.GetFileInformationByHandle(
+        msvcrt.get_osfhandle(fd.fileno()))
+  except pywintypes.error as e:
+    raise IOError("Unable to get file information: %s" % e)
+
+  # The tuple is (attributes, creation time, access time, write time, volume
+  # serial number, size high, size low, number of links, index high, index
+  # low).
+  return info[4], (info[8] << 32) | info[9]
+
+
 def WinFindProxies():
   """Tries to find proxies by interrogating all the user's settings.
 
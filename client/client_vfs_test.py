@@ -116,6 +116,36 @@ class VFSTest(test_lib.GRRBaseTest):
     # Make sure we exceeded the size of the cache.
     self.assert_(fds > 20)
 
+  def testHandlerCache(self):
+    """Test that handlers are reused until their file changes."""
+    path = os.path.join(self.temp_dir, "cached.txt")
+    with open(path, "wb") as fd:
+      fd.write(self.GetNumbers())
+
+    pathspec = rdfvalue.PathSpec(path=path,
+                                 pathtype=rdfvalue.PathSpec.PathType.OS)
+
+    with test_lib.Stubber(vfs, "HANDLER_CACHE", vfs.VFSHandlerCache()):
+      self.assertEqual(vfs.ReadVFS(pathspec, 0, 4), "1\n2\n")
+      self.assertEqual(vfs.ReadVFS(pathspec, 4, 4), "3\n4\n")
+      self.assertEqual(vfs.HANDLER_CACHE.misses, 1)
+      self.assertEqual(vfs.HANDLER_CACHE.hits, 1)
+
+      # Changing the file invalidates the cached handler.
+      with open(path, "wb") as fd:
+        fd.write("hello world")
+      os.utime(path, (0, 0))
+
+      self.assertEqual(vfs.ReadVFS(pathspec, 0, 5), "hello")
+      self.assertEqual(vfs.HANDLER_CACHE.invalidations, 1)
+      self.assertEqual(vfs.HANDLER_CACHE.hits, 1)
+
+      # Expired handlers are closed and opened again when needed.
+      handler = vfs.HANDLER_CACHE.GetHandler(pathspec)
+      vfs.HANDLER_CACHE.ExpireObject(pathspec.SerializeToString())
+      self.assertTrue(handler.closed)
+      self.assertEqual(vfs.ReadVFS(pathspec, 0, 5), "hello")
+
   def testFileCasing(self):
     """Test our ability to read the correct casing from filesystem."""
     path = os.path.join(self.base_path, "numbers.txt")
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""A persistent cache of file hashes on the client.
+
+Repeated hunts often ask every client for the hashes of the same, unchanged
+system files. This cache keeps the results of hashing a file on disk so they
+can be returned without reading the file again.
+
+A file is identified by its pathspec together with its device, inode, size,
+modification and inode change times. Any change to any of these invalidates the
+cached results. Python 2.7 does not report inode numbers on Windows, where the
+VFS handler is asked for the volume serial number and file index instead;
+files from handlers which can provide neither are not cached. Only regular files are cached, and not if they changed so
+recently that a further change in the same second would go unnoticed.
+
+Callers take the key of a file before hashing it and hand it back with the
+results, which are only stored if the file did not change in the meantime:
+
+  key = HASH_CACHE.Key(fd, kind)
+  result = HASH_CACHE.Get(key)
+  if result is None:
+    result = Hash(fd)
+    HASH_CACHE.Put(fd, kind, key, result)
+"""
+
+
+import hashlib
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+import logging
+
+from grr.lib import config_lib
+
+
+class PersistentHashCache(object):
+  """A size bounded cache of hash results kept in an sqlite database."""
+
+  # Timestamps only have a resolution of a second, so a file changed within
+  # this many seconds may change again without its timestamps changing.
+  RACY_INTERVAL = 2
+
+  # The access times of entries read from the cache are written in batches of
+  # this size.
+  ACCESS_BATCH_SIZE = 100
+
+  # Changes are committed once this many were made or this many seconds have
+  # passed, and when the cache is closed. Losing the last few entries in a crash
+  # only costs hashing those files again.
+  COMMIT_BATCH_SIZE = 100
+  COMMIT_INTERVAL = 10
+
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.db = None
+    self.path = None
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    # Maps keys read from the cache to their access time, until written.
+    self.accessed = {}
+    self.uncommitted = 0
+    self.last_commit = time.time()
+
+  @property
+  def enabled(self):
+    return config_lib.CONFIG["Client.hash_cache_enabled"]
+
+  def _Open(self):
+    """Returns the database connection, or None if the cache is unusable."""
+    if not self.enabled:
+      return None
+
+    path = config_lib.CONFIG["Client.hash_cache_path"]
+    if self.db is not None and path == self.path:
+      return self.db
+
+    self.Close()
+    try:
+      dirname = os.path.dirname(path)
+      if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+      db = sqlite3.connect(path, check_same_thread=False)
+      # This is only a cache so we do not need to survive power failures.
+      db.execute("PRAGMA synchronous = OFF")
+      db.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                 "key TEXT PRIMARY KEY, value BLOB, last_used INTEGER)")
+      db.execute("CREATE INDEX IF NOT EXISTS hashes_last_used "
+                 "ON hashes (last_used)")
+      self.size = db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+    except (sqlite3.Error, IOError, OSError) as e:
+      logging.info("Unable to open hash cache %s: %s", path, e)
+      return None
+
+    self.db = db
+    self.path = path
+    return self.db
+
+  def _Reset(self, error):
+    """Throws the database away after it was found to be corrupt."""
+    logging.info("Resetting hash cache %s: %s", self.path, error)
+    path = self.path
+    self.Close()
+    try:
+      os.remove(path)
+    except (IOError, OSError):
+      pass
+
+  def Key(self, fd, kind):
+    """Returns the key for results of the given kind for an open file.
+
+    The key must be taken before the file is read, so a change while the file
+    is read is detected by Put().
+
+    Args:
+      fd: An open VFS handler.
+      kind: A string describing the results, e.g. the hash type and range.
+
+    Returns:
+      The key or None if results for this file must not be cached.
+    """
+    if not self.enabled:
+      return None
+
+    try:
+      stat_entry = fd.Stat()
+    except (IOError, OSError, NotImplementedError):
+      return None
+
+    if (not stat.S_ISREG(stat_entry.st_mode) or not stat_entry.st_mtime or
+        not stat_entry.st_ctime):
+      return None
+
+    st_dev, st_ino = stat_entry.st_dev, stat_entry.st_ino
+    if not st_ino:
+      try:
+        st_dev, st_ino = fd.GetFileIndex()
+      except (IOError, OSError, NotImplementedError):
+        return None
+
+    changed = max(int(stat_entry.st_mtime), int(stat_entry.st_ctime))
+    if time.time() - changed < self.RACY_INTERVAL:
+      return None
+
+    return "%s:%d:%d:%d:%d:%d:%s" % (
+        hashlib.sha1(fd.pathspec.SerializeToString()).hexdigest(),
+        st_dev, st_ino, stat_entry.st_size,
+        int(stat_entry.st_mtime), int(stat_entry.st_ctime), kind)
+
+  def Get(self, key):
+    """Returns the cached results for a key from Key(), or None."""
+    if key is None:
+      return None
+
+    with self.lock:
+      db = self._Open()
+      if db is None:
+        return None
+
+      try:
+        row = db.execute("SELECT value FROM hashes WHERE key = ?",
+                         (key,)).fetchone()
+        if row is None:
+          self.misses += 1
+          return None
+
+        self.accessed[key] = int(time.time())
+        if len(self.accessed) >= self.ACCESS_BATCH_SIZE:
+          self._WriteAccessTimes(db)
+          self._MaybeCommit(db)
+      except sqlite3.DatabaseError as e:
+        self._Reset(e)
+        return None
+
+      self.hits += 1
+      return str(row[0])
+
+  def Put(self, fd, kind, key, value):
+    """Caches the results of the given kind for fd.
+
+    Args:
+      fd: The open VFS handler the results were computed from.
+      kind: A string describing the results, as passed to Key().
+      key: The key returned by Key() before the results were computed.
+      value: The results.
+    """
+    if key is None:
+      return
+
+    with self.lock:
+      db = self._Open()
+      if db is None:
+        return
+
+      # The results may be for an older version of the file if it changed while
+      # it was read.
+      if self.Key(fd, kind) != key:
+        return
+
+      try:
+        db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                   (key, sqlite3.Binary(value), int(time.time())))
+        self.size += 1
+
+        max_size = config_lib.CONFIG["Client.hash_cache_max_entries"]
+        if self.size > max_size:
+          self._WriteAccessTimes(db)
+          self._Trim(db, max_size)
+
+        self._MaybeCommit(db)
+      except sqlite3.DatabaseError as e:
+        self._Reset(e)
+
+  def _MaybeCommit(self, db):
+    """Commits the pending changes if there are enough or they are too old."""
+    self.uncommitted += 1
+    now = time.time()
+    if (self.uncommitted >= self.COMMIT_BATCH_SIZE or
+        now - self.last_commit >= self.COMMIT_INTERVAL):
+      db.commit()
+      self.uncommitted = 0
+      self.last_commit = now
+
+  def _WriteAccessTimes(self, db):
+    db.executemany("UPDATE hashes SET last_used = ? WHERE key = ?",
+                   [(last_used, key)
+                    for key, last_used in self.accessed.iteritems()])
+    self.accessed = {}
+
+  def _Trim(self, db, max_size):
+    """Removes the least recently used entries to make some room."""
+    # Trim a bit more than needed so we do not trim on every Put.
+    keep = max_size * 9 / 10
+    db.execute("DELETE FROM hashes WHERE key IN ("
+               "SELECT key FROM hashes ORDER BY last_used LIMIT ("
+               "SELECT COUNT(*) FROM hashes) - ?)", (keep,))
+    self.size = db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+  def Close(self):
+    with self.lock:
+      if self.db is not None:
+        try:
+          self._WriteAccessTimes(self.db)
+          self.db.commit()
+          self.db.close()
+        except sqlite3.Error:
+          pass
+
+      self.db = None
+      self.path = None
+      self.size = 0
+      self.accessed = {}
+      self.uncommitted = 0
+
+
+# The cache shared by all hashing client actions.
+HASH_CACHE = PersistentHashCache()
@@ -2,6 +2,9 @@
 """This file implements a VFS abstraction on the client."""
 
 
+import threading
+
+
 from grr.client import client_utils
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -83,6 +86,13 @@ class VFSHandler(object):
     """Returns true if this object can contain other objects."""
     raise NotImplementedError
 
+  def GetFileIndex(self):
+    """Returns a (device, index) tuple identifying the file.
+
+    Only needed for handlers whose Stat() does not report an st_ino.
+    """
+    raise NotImplementedError
+
   def Tell(self):
     return self.offset
 
@@ -228,6 +238,9 @@ class VFSInit(registry.InitHook):
       if handler.auto_register:
         VFS_HANDLERS[handler.supported_pathtype] = handler
 
+    # Handlers opened by the previous handler registrations are stale.
+    HANDLER_CACHE.Flush()
+
 
 def VFSOpen(pathspec):
   """Expands pathspec to return an expanded Path.
@@ -314,6 +327,140 @@ def VFSOpen(pathspec):
   return fd
 
 
+class CachedHandler(object):
+  """An open handler in the VFSHandlerCache."""
+
+  def __init__(self, fd, mtime):
+    self.fd = fd
+    self.mtime = mtime
+    self.lock = threading.RLock()
+    # Set once the handler expired and was closed.
+    self.closed = False
+
+
+class VFSHandlerCache(utils.TimeBasedCache):
+  """A cache of open VFS handlers keyed by the requested pathspec.
+
+  Opening a pathspec expands it and opens every handler along the way, which is
+  expensive for e.g. TSK or registry paths. Consecutive reads of the same file
+  reuse the handler from this cache instead.
+
+  Handlers expire when they were not used for max_age seconds, or when the
+  modification time of the outermost file they were opened from or of the file
+  itself changed. Expired handlers are closed, until then they keep whatever
+  they opened (e.g. a TSK image or a registry key) open. Handlers nested in an
+  image, e.g. TSK files, report the times read when they were opened, so a
+  change to such a file is only noticed once the image file changes or the
+  handler expired.
+  """
+
+  def __init__(self, max_size=50, max_age=10):
+    super(VFSHandlerCache, self).__init__(max_size=max_size, max_age=max_age)
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  @staticmethod
+  def _GetMTime(fd):
+    """Returns the modification times of fd and the file it was opened from."""
+    outer_fd = fd
+    while outer_fd.base_fd is not None:
+      outer_fd = outer_fd.base_fd
+
+    mtimes = []
+    for stat_fd in [fd] if fd is outer_fd else [fd, outer_fd]:
+      try:
+        mtimes.append(stat_fd.Stat().st_mtime)
+      except (IOError, OSError, NotImplementedError):
+        mtimes.append(None)
+
+    return mtimes
+
+  def KillObject(self, obj):
+    """Closes an expired handler unless it is in use."""
+    # The housekeeper passes the handler, other expiries its [time, handler].
+    handler = obj[1] if isinstance(obj, list) else obj
+    # The cache lock is held here so we must not wait for a reader. A handler
+    # in use is left to be garbage collected.
+    if not handler.lock.acquire(False):
+      return
+
+    try:
+      handler.closed = True
+      handler.fd.Close()
+    except (IOError, OSError):
+      pass
+    finally:
+      handler.lock.release()
+
+  def GetHandler(self, pathspec):
+    """Returns the CachedHandler for pathspec, opening it if needed."""
+    key = pathspec.SerializeToString()
+    try:
+      handler = self.Get(key)
+      if self._GetMTime(handler.fd) == handler.mtime:
+        with self.lock:
+          self.hits += 1
+        return handler
+
+      # The file changed since we opened it.
+      self.ExpireObject(key)
+      with self.lock:
+        self.invalidations += 1
+    except KeyError:
+      with self.lock:
+        self.misses += 1
+
+    # Opening may be slow so we do not hold the lock here.
+    fd = VFSOpen(pathspec)
+    handler = CachedHandler(fd, self._GetMTime(fd))
+    self.Put(key, handler)
+
+    return handler
+
+  def HitRate(self):
+    lookups = self.hits + self.misses + self.invalidations
+    if not lookups:
+      return 0.0
+
+    return self.hits / float(lookups)
+
+
+# Open handlers used for reading buffers from files.
+HANDLER_CACHE = VFSHandlerCache()
+
+
+class CachedVFSOpen(object):
+  """Gives exclusive access to a cached handler for a pathspec.
+
+  Cached handlers are shared so callers must always seek before reading, and
+  must not close the handler:
+
+  with vfs.CachedVFSOpen(pathspec) as fd:
+    fd.Seek(offset)
+    data = fd.Read(length)
+  """
+
+  def __init__(self, pathspec):
+    self.pathspec = pathspec
+
+  def __enter__(self):
+    while True:
+      self.handler = HANDLER_CACHE.GetHandler(self.pathspec)
+
+      # Wait for exclusive access to this handler.
+      self.handler.lock.acquire()
+
+      # The handler may have expired since we got it.
+      if not self.handler.closed:
+        return self.handler.fd
+
+      self.handler.lock.release()
+
+  def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
+    self.handler.lock.release()
+
+
 def ReadVFS(pathspec, offset, length):
   """Read from the VFS and return the contents.
 
@@ -324,7 +471,7 @@ def ReadVFS(pathspec, offset, length):
   Returns:
     VFS file contents
   """
-  fd = VFSOpen(pathspec)
-  fd.Seek(offset)
-  return fd.Read(length)
+  with CachedVFSOpen(pathspec) as fd:
+    fd.Seek(offset)
+    return fd.Read(length)
 
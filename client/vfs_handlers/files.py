@@ -208,6 +208,14 @@ class File(vfs.VFSHandler):
   def ListNames(self):
     return self.files or []
 
+  def GetFileIndex(self):
+    """Returns the volume serial number and file index of the file."""
+    if sys.platform != "win32":
+      raise NotImplementedError("File indexes are only needed on Windows.")
+
+    with FileHandleManager(self.filename) as fd:
+      return client_utils.WinGetFileIndex(fd.fd)
+
   def Read(self, length):
     """Read from the file."""
     with FileHandleManager(self.filename) as fd:
@@ -5,6 +5,7 @@
 
 
 import stat
+import threading
 
 import pytsk3
 
@@ -15,11 +16,17 @@ from grr.lib import utils
 
 
 class CachedFilesystem(object):
-  """A container for the filesystem and image."""
+  """A container for the filesystem and image.
+
+  The filesystem is shared by all the handlers opened on the same device,
+  possibly from several threads (e.g. when Find prefetches directories). TSK
+  objects are not thread safe, so all access to them must hold the lock.
+  """
 
   def __init__(self, fs, img):
     self.fs = fs
     self.img = img
+    self.lock = threading.RLock()
 
 
 class MyImgInfo(pytsk3.Img_Info):
@@ -133,22 +140,23 @@ class TSKFile(vfs.VFSHandler):
 
       vfs.DEVICE_CACHE.Put(fd_hash, self.filesystem)
 
-    # We prefer to open the file based on the inode because that is more
-    # efficient.
-    if pathspec.HasField("inode"):
-      self.fd = self.fs.open_meta(pathspec.inode)
-      self.tsk_attribute = self.GetAttribute(
-          pathspec.ntfs_type, pathspec.ntfs_id)
-      if self.tsk_attribute:
-        self.size = self.tsk_attribute.info.size
+    with self.filesystem.lock:
+      # We prefer to open the file based on the inode because that is more
+      # efficient.
+      if pathspec.HasField("inode"):
+        self.fd = self.fs.open_meta(pathspec.inode)
+        self.tsk_attribute = self.GetAttribute(
+            pathspec.ntfs_type, pathspec.ntfs_id)
+        if self.tsk_attribute:
+          self.size = self.tsk_attribute.info.size
+        else:
+          self.size = self.fd.info.meta.size
+
       else:
+        # Does the filename exist in the image?
+        self.fd = self.fs.open(utils.SmartStr(self.pathspec.last.path))
         self.size = self.fd.info.meta.size
-
-    else:
-      # Does the filename exist in the image?
-      self.fd = self.fs.open(utils.SmartStr(self.pathspec.last.path))
-      self.size = self.fd.info.meta.size
-      self.pathspec.last.inode = self.fd.info.meta.addr
+        self.pathspec.last.inode = self.fd.info.meta.addr
 
   def GetAttribute(self, ntfs_type, ntfs_id):
     for attribute in self.fd:
@@ -162,12 +170,17 @@ class TSKFile(vfs.VFSHandler):
     return None
 
   def ListNames(self):
-    directory_handle = self.fd.as_directory()
-    for f in directory_handle:
-      # TSK only deals with utf8 strings, but path components are always unicode
-      # objects - so we convert to unicode as soon as we receive data from
-      # TSK. Prefer to compare unicode objects to guarantee they are normalized.
-      yield utils.SmartUnicode(f.info.name.name)
+    # The names are read under the lock so the filesystem is not used while
+    # the caller consumes them.
+    with self.filesystem.lock:
+      directory_handle = self.fd.as_directory()
+      # TSK only deals with utf8 strings, but path components are always
+      # unicode objects - so we convert to unicode as soon as we receive data
+      # from TSK. Prefer to compare unicode objects to guarantee they are
+      # normalized.
+      names = [utils.SmartUnicode(f.info.name.name) for f in directory_handle]
+
+    return iter(names)
 
   def MakeStatResponse(self, tsk_file, tsk_attribute=None, append_name=False):
     """Given a TSK info object make a StatResponse.
@@ -241,9 +254,10 @@ class TSKFile(vfs.VFSHandler):
     if available > 0:
       # This raises a RuntimeError in some situations.
       try:
-        data = self.fd.read_random(self.offset, available,
-                                   self.pathspec.last.ntfs_type,
-                                   self.pathspec.last.ntfs_id)
+        with self.filesystem.lock:
+          data = self.fd.read_random(self.offset, available,
+                                     self.pathspec.last.ntfs_type,
+                                     self.pathspec.last.ntfs_id)
       except RuntimeError as e:
         raise IOError(e)
 
@@ -254,39 +268,50 @@ class TSKFile(vfs.VFSHandler):
 
   def Stat(self):
     """Return a stat of the file."""
-    return self.MakeStatResponse(self.fd, tsk_attribute=self.tsk_attribute)
+    with self.filesystem.lock:
+      return self.MakeStatResponse(self.fd, tsk_attribute=self.tsk_attribute)
 
   def ListFiles(self):
     """List all the files in the directory."""
-    if self.IsDirectory():
-      dir_fd = self.fd.as_directory()
-      for f in dir_fd:
-        try:
-          name = f.info.name.name
-          # Drop these useless entries.
-          if name in [".", ".."] or name in self.BLACKLIST_FILES:
-            continue
-
-          # First we yield a standard response using the default attributes.
-          yield self.MakeStatResponse(f, tsk_attribute=None, append_name=name)
-
-          # Now send back additional named attributes for the ADS.
-          for attribute in f:
-            if attribute.info.type in [pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA,
-                                       pytsk3.TSK_FS_ATTR_TYPE_DEFAULT]:
-              if attribute.info.name:
-                yield self.MakeStatResponse(f, append_name=name,
-                                            tsk_attribute=attribute)
-        except AttributeError:
-          pass
-    else:
+    if not self.IsDirectory():
       raise IOError("%s is not a directory" % self.pathspec.CollapsePath())
 
+    # The whole directory is read under the lock so the filesystem is not used
+    # while the caller consumes the listing.
+    with self.filesystem.lock:
+      responses = list(self._ListFiles())
+
+    return iter(responses)
+
+  def _ListFiles(self):
+    dir_fd = self.fd.as_directory()
+    for f in dir_fd:
+      try:
+        name = f.info.name.name
+        # Drop these useless entries.
+        if name in [".", ".."] or name in self.BLACKLIST_FILES:
+          continue
+
+        # First we yield a standard response using the default attributes.
+        yield self.MakeStatResponse(f, tsk_attribute=None, append_name=name)
+
+        # Now send back additional named attributes for the ADS.
+        for attribute in f:
+          if attribute.info.type in [pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA,
+                                     pytsk3.TSK_FS_ATTR_TYPE_DEFAULT]:
+            if attribute.info.name:
+              yield self.MakeStatResponse(f, append_name=name,
+                                          tsk_attribute=attribute)
+      except AttributeError:
+        pass
+
   def IsDirectory(self):
-    return self.fd.info.meta.type == pytsk3.TSK_FS_META_TYPE_DIR
+    with self.filesystem.lock:
+      return self.fd.info.meta.type == pytsk3.TSK_FS_META_TYPE_DIR
 
   def IsFile(self):
-    return self.fd.info.meta.type == pytsk3.TSK_FS_META_TYPE_REG
+    with self.filesystem.lock:
+      return self.fd.info.meta.type == pytsk3.TSK_FS_META_TYPE_REG
 
   @classmethod
   def Open(cls, fd, component, pathspec):
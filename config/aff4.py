@@ -11,6 +11,25 @@ config_lib.DEFINE_integer(
     "AFF4.notification_rules_cache_age", 60,
     "The number of seconds AFF4 notification rules are cached.")
 
+config_lib.DEFINE_integer(
+    "AFF4.index_flush_interval", 1,
+    "The number of seconds between background writes of queued AFF4 index "
+    "updates.")
+
+config_lib.DEFINE_integer(
+    "AFF4.index_max_pending", 10000,
+    "The number of queued AFF4 index updates which triggers an immediate "
+    "write.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_open_chunk_size", 1000,
+    "MultiOpen reads the attributes of this many objects per data store "
+    "request.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_open_threads", 10,
+    "The number of MultiOpen chunks which are read concurrently.")
+
 config_lib.DEFINE_string(
     "AFF4.change_email", None,
     "Email used by AFF4NotificationEmailListener to notify "
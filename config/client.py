@@ -84,6 +84,19 @@ config_lib.DEFINE_string(
     help="Default temporary directory to use on the client.",
     default="/var/tmp/grr/")
 
+config_lib.DEFINE_bool(
+    "Client.hash_cache_enabled", False,
+    help="If set, the results of hashing files are cached on disk and reused "
+    "for as long as the file is unchanged.")
+
+config_lib.DEFINE_string(
+    "Client.hash_cache_path", "%(Client.tempdir)/hash_cache.db",
+    help="The file holding the client's hash cache.")
+
+config_lib.DEFINE_integer(
+    "Client.hash_cache_max_entries", 100000,
+    help="The maximum number of results kept in the client's hash cache.")
+
 config_lib.DEFINE_integer("Client.version_major", 0,
                           "Major version number of client binary.")
 
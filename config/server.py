@@ -31,6 +31,12 @@ config_lib.DEFINE_string("Worker.smtp_server", "localhost",
 
 config_lib.DEFINE_integer("Worker.smtp_port", 25, "The smtp server port.")
 
+config_lib.DEFINE_string("Worker.columnar_export_dir", "",
+                         "Directory the columnar hunt output plugin writes "
+                         "its files to. Any worker may run the plugin, so "
+                         "this should be shared by all the workers. The "
+                         "plugin can not be used while this is unset.")
+
 
 # Server Cryptographic settings.
 config_lib.DEFINE_semantic(
@@ -142,3 +148,29 @@ config_lib.DEFINE_string(
     "AdminUI.ssl_key_file", None,
     "The SSL key to use. The key may also be part of the cert file, in which "
     "case this can be omitted.")
+
+config_lib.DEFINE_integer(
+    "AdminUI.render_cache_size", 1000,
+    "The maximum number of results the GUI's render cache holds.")
+
+config_lib.DEFINE_integer(
+    "AdminUI.render_cache_age", 300,
+    "The maximum time in seconds a result is kept in the GUI's render cache.")
+
+config_lib.DEFINE_string(
+    "FileStore.existence_filter_path", "",
+    "Directory holding the memory mapped filter of the blobs and files which "
+    "exist in the filestore. All server processes of a deployment should use "
+    "the same directory. If empty, no filter is used.")
+
+config_lib.DEFINE_integer(
+    "FileStore.existence_filter_shards", 16,
+    "The number of shards the filestore existence filter is split into.")
+
+config_lib.DEFINE_integer(
+    "FileStore.existence_filter_shard_size", 16 * 1024 * 1024,
+    "The size in bytes of each shard of the filestore existence filter.")
+
+config_lib.DEFINE_integer(
+    "FileStore.existence_filter_hashes", 7,
+    "The number of hash functions used by the filestore existence filter.")
@@ -7,6 +7,7 @@
 import cgi
 import os
 import random
+import re
 import socket
 
 from django import http
@@ -667,7 +668,6 @@ class AbstractFileTable(renderers.TableRenderer):
 """)
 
   toolbar = None    # Toolbar class to render above table.
-  content_cache = None
   post_parameters = ["aff4_path"]
   root_path = "/"   # Paths will all be under this path.
 
@@ -675,12 +675,6 @@ class AbstractFileTable(renderers.TableRenderer):
   # list of types to show.
   visible_types = None
 
-  def __init__(self, **kwargs):
-    super(AbstractFileTable, self).__init__(**kwargs)
-
-    if AbstractFileTable.content_cache is None:
-      AbstractFileTable.content_cache = utils.TimeBasedCache()
-
   def Layout(self, request, response):
     """Populate the table state with the request."""
     # Draw the toolbar first
@@ -689,75 +683,55 @@ class AbstractFileTable(renderers.TableRenderer):
       tb_cls().Layout(request, response)
     return super(AbstractFileTable, self).Layout(request, response)
 
-  def BuildTable(self, start_row, end_row, request):
-    """Populate the table."""
-    # Default sort direction
-    sort = request.REQ.get("sort", "Name:asc")
-    try:
-      reverse_sort = sort.split(":")[1] == "desc"
-    except IndexError:
-      reverse_sort = False
-
+  def GetDataSource(self, request):
+    """Returns a data source listing the directory in the request."""
     filter_term = request.REQ.get("filter")
     aff4_path = request.REQ.get("aff4_path", self.root_path)
-    urn = rdfvalue.RDFURN(aff4_path)
 
-    filter_string = None
+    name_regex = None
     if filter_term:
-      column, regex = filter_term.split(":", 1)
+      _, regex = filter_term.split(":", 1)
 
-      escaped_regex = utils.EscapeRegex(aff4_path + "/")
       # The start anchor refers only to this directory.
       if regex.startswith("^"):
-        escaped_regex += utils.EscapeRegex(regex[1:])
+        name_regex = "^" + re.escape(regex[1:])
       else:
-        escaped_regex += ".*" + utils.EscapeRegex(regex)
-
-      filter_string = "subject matches '%s'" % escaped_regex
+        name_regex = re.escape(regex)
 
-    # For now we just list the directory
     try:
-      key = utils.SmartUnicode(urn)
-      if filter_string:
-        key += ":" + filter_string
       # Open the directory as a directory.
-      directory_node = aff4.FACTORY.Open(urn, token=request.token).Upgrade(
-          "VFSDirectory")
+      directory_node = aff4.FACTORY.Open(
+          aff4_path, token=request.token).Upgrade("VFSDirectory")
       if not directory_node:
         raise IOError()
+    except IOError:
+      return
 
-      key += str(directory_node.Get(directory_node.Schema.LAST))
-      key += ":" + str(request.token)
-      try:
-        children = self.content_cache.Get(key)
-      except KeyError:
-        # Only show the direct children.
-        children = sorted(directory_node.Query(filter_string=filter_string,
-                                               limit=100000))
-
-        # Filter the children according to types.
-        if self.visible_types:
-          children = [x for x in children
-                      if x.__class__.__name__ in self.visible_types]
-
-        self.content_cache.Put(key, children)
+    # Only the children on a page are opened, so deep pages of large
+    # directories are as quick to list as the first one.
+    return renderers.AFF4ChildrenDataSource(directory_node,
+                                            name_regex=name_regex,
+                                            visible_types=self.visible_types)
 
-        try:
-          self.message = "Directory Listing '%s' was taken on %s" % (
-              aff4_path, directory_node.Get(directory_node.Schema.TYPE.age))
-        except AttributeError:
-          pass
+  def BuildTable(self, start_row, end_row, request):
+    """Populate the table."""
+    data_source = self.GetDataSource(request)
+    if data_source is None:
+      return
 
-    except IOError:
-      children = []
+    directory_node = data_source.volume
+    try:
+      self.message = "Directory Listing '%s' was taken on %s" % (
+          directory_node.urn, directory_node.Get(
+              directory_node.Schema.TYPE.age))
+    except AttributeError:
+      pass
 
-    children.sort(reverse=reverse_sort)
-    row_index = start_row
+    self.columns[1].base_path = directory_node.urn
+    self.BuildTableFromDataSource(data_source, start_row, end_row, request)
 
-    # Make sure the table knows how large it is for paging.
-    self.size = len(children)
-    self.columns[1].base_path = urn
-    for fd in children[start_row:end_row]:
+  def AddRowsFromItems(self, start_row, items, request):
+    for row_index, fd in enumerate(items, start_row):
       # We use the timestamp on the TYPE as a proxy for the last update time
       # of this object - its only an estimate.
       fd_type = fd.Get(fd.Schema.TYPE)
@@ -779,9 +753,7 @@ class AbstractFileTable(renderers.TableRenderer):
         self.AddCell(row_index, "Icon", dict(icon="file",
                                              description="File Like Object"))
 
-      row_index += 1
-      if row_index > end_row:
-        return
+    return start_row + len(items)
 
 
 class FileTable(AbstractFileTable):
@@ -865,17 +837,17 @@ class FileSystemTree(renderers.TreeRenderer):
       directory = aff4.FACTORY.Open(urn, token=request.token).Upgrade(
           "VFSDirectory")
 
-      children = [ch for ch in directory.OpenChildren(limit=100000)
-                  if "Container" in ch.behaviours]
-
       try:
         self.message = "Directory %s Last retrieved %s" % (
             urn, directory.Get(directory.Schema.TYPE).age)
       except AttributeError:
         pass
 
-      for child in sorted(children):
-        self.AddElement(child.urn.RelativeName(urn))
+      # The summaries are read from the directory's own index so large
+      # directories are expanded without opening any of their children.
+      for summary in directory.ListChildSummaries(limit=100000):
+        if summary.has_children:
+          self.AddElement(summary.name)
 
     except IOError as e:
       self.message = "Error fetching %s: %s" % (urn, e)
@@ -5,7 +5,6 @@
 
 
 import collections as py_collections
-import operator
 import StringIO
 import urllib
 
@@ -255,66 +254,26 @@ class HuntTable(fileview.AbstractFileTable):
     return self.CallJavascript(response, "Layout")
 
   def BuildTable(self, start_row, end_row, request):
-    fd = aff4.FACTORY.Open("aff4:/hunts", mode="r", token=request.token)
-    try:
-      children = list(fd.ListChildren())
-
-      children.sort(key=operator.attrgetter("age"), reverse=True)
-      children = children[start_row:end_row]
-
-      hunt_list = []
-
-      for hunt in fd.OpenChildren(children=children):
-        # Skip hunts that could not be unpickled.
-        if not isinstance(hunt, hunts.GRRHunt) or not hunt.state:
-          continue
-
-        with hunt.GetRunner() as runner:
-          hunt.create_time = runner.context.create_time
-          hunt_list.append(hunt)
-
-      total_size = len(hunt_list)
-
-      hunt_list.sort(key=lambda x: x.create_time, reverse=True)
+    index = aff4.FACTORY.Create(hunts.implementation.HuntSummaryIndex.URN,
+                                "HuntSummaryIndex", mode="r",
+                                token=request.token)
+    total_size, summaries = index.ListHunts(offset=start_row,
+                                            count=end_row - start_row)
 
-      could_not_display = []
-      row_index = start_row
-      for hunt_obj in hunt_list:
-        if not isinstance(hunt_obj, hunts.GRRHunt):
-          could_not_display.append((hunt_obj, "Object is not a valid hunt."))
-          continue
-
-        if hunt_obj.state.Empty():
-          logging.error("Hunt without a valid state found: %s", hunt_obj)
-          could_not_display.append((hunt_obj,
-                                    "Hunt doesn't have a valid state."))
-          continue
-
-        runner = hunt_obj.GetRunner()
-        description = (runner.args.description or
-                       hunt_obj.__class__.__doc__.split("\n", 1)[0])
-
-        self.AddRow({"Hunt ID": hunt_obj.urn,
-                     "Name": hunt_obj.__class__.__name__,
-                     "Status": hunt_obj.Get(hunt_obj.Schema.STATE),
-                     "Start Time": runner.context.start_time,
-                     "Expires": runner.context.expires,
-                     "Client Limit": runner.args.client_limit,
-                     "Creator": runner.context.creator,
-                     "Description": description},
-                    row_index=row_index)
-        row_index += 1
-
-      for hunt_obj, reason in could_not_display:
-        self.AddRow({"Hunt ID": hunt_obj.urn,
-                     "Description": reason},
-                    row_index=row_index)
-        row_index += 1
-
-      self.size = total_size
+    row_index = start_row
+    for summary in summaries:
+      self.AddRow({"Hunt ID": summary.hunt_urn,
+                   "Name": summary.name,
+                   "Status": summary.state,
+                   "Start Time": summary.start_time,
+                   "Expires": summary.expires,
+                   "Client Limit": summary.client_limit,
+                   "Creator": summary.creator,
+                   "Description": summary.description},
+                  row_index=row_index)
+      row_index += 1
 
-    except IOError as e:
-      logging.error("Bad hunt %s", e)
+    self.size = total_size
 
 
 class HuntViewTabs(renderers.TabLayout):
@@ -395,6 +354,50 @@ class FloatRenderer(semantic.RDFValueRenderer):
     super(FloatRenderer, self).Layout(request, response)
 
 
+class HuntClientStatusDataSource(renderers.TableDataSource):
+  """Pages through the clients of a hunt in some statuses, sorted by id.
+
+  Items are (client urn, status) tuples. The cursor is the id of the last client
+  on the previous page, and the HuntClientStatusStore lists the clients after it
+  without reading the ones before it.
+  """
+
+  def __init__(self, client_status, statuses):
+    """Constructor.
+
+    Args:
+      client_status: The HuntClientStatusStore of the hunt.
+      statuses: The statuses of the clients to list.
+    """
+    self.client_status = client_status
+    self.statuses = statuses
+
+  def Fetch(self, cursor=None, count=50, sort_key=None, reverse=False):
+    start_after = self.DecodeCursor(cursor)
+    if not isinstance(start_after, basestring):
+      start_after = None
+
+    # Each status is listed in sorted order, so we never need more than a page
+    # of clients from any of them.
+    results = {}
+    for status in self.statuses:
+      for client in self.client_status.ListClients(
+          status, start_after=start_after, limit=count + 1):
+        results[client] = status
+
+    items = sorted(results.items())[:count]
+
+    next_cursor = None
+    if len(results) > count:
+      next_cursor = self.EncodeCursor(items[-1][0].Basename())
+
+    return items, next_cursor
+
+  def Size(self):
+    counts = self.client_status.GetCounts()
+    return sum(counts.get(status, 0) for status in self.statuses)
+
+
 class HuntClientTableRenderer(fileview.AbstractFileTable):
   """Displays the clients."""
 
@@ -439,6 +442,8 @@ back to hunt view</a>
 
   def __init__(self, **kwargs):
     super(HuntClientTableRenderer, self).__init__(**kwargs)
+    # The resource usage of the clients, read with the first page of rows.
+    self.resource_usage = None
     self.AddColumn(semantic.RDFValueColumn(
         "Client ID", width="20%", renderer=semantic.SubjectRenderer))
     self.AddColumn(semantic.RDFValueColumn("Hostname", width="10%"))
@@ -464,19 +469,37 @@ back to hunt view</a>
     self.hunt_hash = urllib.urlencode(sorted(h.items()))
     super(HuntClientTableRenderer, self).Layout(request, response)
 
-  def BuildTable(self, start_row, end_row, request):
-    """Called to fill in the data in the table."""
+  def GetDataSource(self, request):
+    """Returns a data source listing the clients of the hunt in the request."""
     hunt_id = request.REQ.get("hunt_id")
     completion_status_filter = request.REQ.get("completion_status", "ALL")
     if hunt_id is None:
       return
     try:
       self.hunt = aff4.FACTORY.Open(hunt_id, token=request.token,
-                                    aff4_type="GRRHunt", age=aff4.ALL_TIMES)
+                                    aff4_type="GRRHunt")
     except IOError:
       logging.error("Invalid hunt %s", hunt_id)
       return
 
+    if completion_status_filter == "ALL":
+      statuses = self.hunt.client_status.STATUSES
+    else:
+      statuses = [completion_status_filter]
+
+    return HuntClientStatusDataSource(self.hunt.client_status, statuses)
+
+  def BuildTable(self, start_row, end_row, request):
+    """Called to fill in the data in the table."""
+    data_source = self.GetDataSource(request)
+    if data_source is None:
+      return
+
+    return self.BuildTableFromDataSource(data_source, start_row, end_row,
+                                         request)
+
+  def _GetResourceUsage(self):
+    """Returns the resource usage of each client and the maximum usage."""
     resources = self.hunt.GetValuesForAttribute(self.hunt.Schema.RESOURCES)
     resource_usage = {}
     for resource in resources:
@@ -492,23 +515,22 @@ back to hunt view</a>
         if resource_max[i] < resource[i]:
           resource_max[i] = resource[i]
 
-    results = {}
-    for status, client_list in self.hunt.GetClientsByStatus().items():
-      if (completion_status_filter == "ALL" or
-          status == completion_status_filter):
-        for client in client_list:
-          results[client] = status
+    return resource_usage, resource_max
+
+  def AddRowsFromItems(self, start_row, items, request):
+    """Adds a row for each (client urn, status) item."""
+    if self.resource_usage is None:
+      self.resource_usage = self._GetResourceUsage()
+    resource_usage, resource_max = self.resource_usage
 
-    # Get the list of clients and sort so that we can page accurately.
-    client_list = results.keys()
-    client_list.sort()
-    client_list = client_list[start_row:end_row]
+    statuses = dict(items)
 
     row_index = start_row
-    for c_urn, cdict in self.hunt.GetClientStates(client_list):
+    for c_urn, cdict in self.hunt.GetClientStates(
+        [client for client, _ in items]):
       row = {"Client ID": c_urn,
              "Hostname": cdict.get("hostname"),
-             "Status": results[c_urn],
+             "Status": statuses[c_urn],
              "Last Checkin": searchclient.FormatLastSeenTime(
                  cdict.get("age") or 0),
             }
@@ -536,7 +558,8 @@ back to hunt view</a>
 
       self.AddRow(row, row_index)
       row_index += 1
-    self.size = len(results)
+
+    return row_index
 
 
 class AbstractLogRenderer(renderers.TemplateRenderer):
@@ -675,7 +698,7 @@ class HuntOverviewRenderer(AbstractLogRenderer):
     if self.hunt_id:
       try:
         self.hunt = aff4.FACTORY.Open(self.hunt_id, aff4_type="GRRHunt",
-                                      token=request.token, age=aff4.ALL_TIMES)
+                                      token=request.token)
 
         if self.hunt.state.Empty():
           raise IOError("No valid state could be found.")
@@ -881,9 +904,10 @@ No data to graph yet.
 
   def Layout(self, request, response):
     self.hunt_id = request.REQ.get("hunt_id")
-    hunt = aff4.FACTORY.Open(self.hunt_id, token=request.token)
+    hunt = aff4.FACTORY.Open(self.hunt_id, aff4_type="GRRHunt",
+                             token=request.token)
 
-    self.clients = bool(hunt.Get(hunt.Schema.CLIENTS))
+    self.clients = bool(hunt.NumClients())
     super(HuntClientGraphRenderer, self).Layout(request, response)
 
 
@@ -892,20 +916,14 @@ class HuntClientCompletionGraphRenderer(renderers.ImageDownloadRenderer):
   def Content(self, request, _):
     """Generates the actual image to display."""
     hunt_id = request.REQ.get("hunt_id")
-    hunt = aff4.FACTORY.Open(hunt_id, age=aff4.ALL_TIMES, token=request.token)
-    cl = hunt.GetValuesForAttribute(hunt.Schema.CLIENTS)
-    fi = hunt.GetValuesForAttribute(hunt.Schema.FINISHED)
-
-    cdict = {}
-    for c in cl:
-      cdict.setdefault(c, []).append(c.age)
+    hunt = aff4.FACTORY.Open(hunt_id, aff4_type="GRRHunt", token=request.token)
 
-    fdict = {}
-    for c in fi:
-      fdict.setdefault(c, []).append(c.age)
-
-    cl_age = [int(min(x)/1e6) for x in cdict.values()]
-    fi_age = [int(min(x)/1e6) for x in fdict.values()]
+    cl_age = []
+    fi_age = []
+    for _, start_time, completion_time in hunt.client_status.ListClientTimes():
+      cl_age.append(int(start_time.AsSecondsFromEpoch()))
+      if completion_time is not None:
+        fi_age.append(int(completion_time.AsSecondsFromEpoch()))
 
     cl_hist = {}
     fi_hist = {}
@@ -1056,6 +1074,19 @@ class HuntStatsRenderer(renderers.TemplateRenderer):
   </dd>
 </dl>
 
+{% if this.aggregates %}
+<h3>Results</h3>
+{% for aggregate in this.aggregates %}
+<h4>{{aggregate.description|escape}}</h4>
+<dl class="dl-horizontal">
+  {% for key, count in aggregate.top %}
+  <dt>{{count|escape}}</dt>
+  <dd>{{key|escape}}</dd>
+  {% endfor %}
+</dl>
+{% endfor %}
+{% endif %}
+
 <h3>Worst performers</h3>
 <div class="row">
 <div class="span8">
@@ -1151,6 +1182,9 @@ class HuntStatsRenderer(renderers.TemplateRenderer):
   error_template = renderers.Template(
       "No information available for this Hunt.")
 
+  # The number of most common values shown for each aggregate.
+  top_count = 10
+
   def _HistogramToJSON(self, histogram):
     hist_data = [(b.range_max_value, b.num) for b in histogram.bins]
     return renderers.JsonDumpForScriptContext(hist_data)
@@ -1163,7 +1197,7 @@ class HuntStatsRenderer(renderers.TemplateRenderer):
       try:
         hunt = aff4.FACTORY.Open(hunt_id,
                                  aff4_type="GRRHunt",
-                                 token=request.token, age=aff4.ALL_TIMES)
+                                 token=request.token)
         if hunt.state.Empty():
           raise IOError("No valid state could be found.")
 
@@ -1172,9 +1206,17 @@ class HuntStatsRenderer(renderers.TemplateRenderer):
         self.user_cpu_json_data = self._HistogramToJSON(
             self.stats.user_cpu_stats.histogram)
         self.system_cpu_json_data = self._HistogramToJSON(
-            self.stats.user_cpu_stats.histogram)
+            self.stats.system_cpu_stats.histogram)
         self.network_bytes_sent_json_data = self._HistogramToJSON(
             self.stats.network_bytes_sent_stats.histogram)
+
+        # Aggregates over the results are kept up to date by the hunt, so
+        # this does not depend on the number of results.
+        self.aggregates = [
+            dict(description=aggregate.description or aggregate.name,
+                 top=aggregate.GetTop(self.top_count))
+            for aggregate in hunt.results_aggregates.aggregates.aggregates
+            if aggregate.counts]
       except IOError:
         self.layout_template = self.error_template
 
@@ -1263,25 +1305,31 @@ class HuntOutstandingRenderer(renderers.TableRenderer):
         flow_requests.setdefault(flow_urn, []).append(msg)
     return flow_requests
 
-  def BuildTable(self, start_row, end_row, request):
-    """Renders the table."""
+  def GetDataSource(self, request):
+    """Returns a data source listing the outstanding clients of the hunt."""
     hunt_id = request.REQ.get("hunt_id")
-    token = request.token
-
     if hunt_id is None:
       return
 
-    hunt_id = rdfvalue.RDFURN(hunt_id)
-    hunt = aff4.FACTORY.Open(hunt_id, aff4_type="GRRHunt", age=aff4.ALL_TIMES,
-                             token=token)
+    hunt = aff4.FACTORY.Open(hunt_id, aff4_type="GRRHunt",
+                             token=request.token)
+    return HuntClientStatusDataSource(hunt.client_status,
+                                      [hunt.client_status.OUTSTANDING])
 
-    started = hunt.GetValuesForAttribute(hunt.Schema.CLIENTS)
-    finished = hunt.GetValuesForAttribute(hunt.Schema.FINISHED)
-    outstanding = set(started) - set(finished)
+  def BuildTable(self, start_row, end_row, request):
+    """Renders the table."""
+    data_source = self.GetDataSource(request)
+    if data_source is None:
+      return
 
-    self.size = len(outstanding)
+    return self.BuildTableFromDataSource(data_source, start_row, end_row,
+                                         request)
 
-    outstanding = sorted(outstanding)[start_row:end_row]
+  def AddRowsFromItems(self, start_row, items, request):
+    """Adds a row for each flow of the hunt on the outstanding clients."""
+    hunt_id = rdfvalue.RDFURN(request.REQ.get("hunt_id"))
+    token = request.token
+    outstanding = [client for client, _ in items]
 
     all_flow_urns = self.GetAllSubflows(hunt_id, outstanding, token)
 
@@ -1356,3 +1404,5 @@ class HuntOutstandingRenderer(renderers.TableRenderer):
 
       self.AddRow(row_data, row_index=row_index)
       row_index += 1
+
+    return row_index
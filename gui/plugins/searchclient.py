@@ -397,7 +397,10 @@ class HostTable(renderers.TableRenderer):
     result_urns = search.SearchClients(query_string, start=start,
                                        max_results=end-start,
                                        token=request.token)
-    result_set = aff4.FACTORY.MultiOpen(result_urns, token=request.token)
+    # MultiOpen returns the clients in no particular order.
+    result_set = sorted(aff4.FACTORY.MultiOpen(result_urns,
+                                               token=request.token),
+                        key=lambda fd: fd.urn)
 
     self.message = "Searched for %s" % query_string
 
@@ -5,7 +5,6 @@ Other files may also contain specialized renderers for semantic types relevant
 to their function, but here we include the most basic and common renderers.
 """
 
-import itertools
 import urllib
 
 import logging
@@ -462,8 +461,7 @@ class RDFValueCollectionRenderer(renderers.TableRenderer):
     super(RDFValueCollectionRenderer, self).__init__(**kwargs)
     self.AddColumn(RDFValueColumn("Value", width="100%"))
 
-  def BuildTable(self, start_row, end_row, request):
-    """Builds a table of rdfvalues."""
+  def GetDataSource(self, request):
     try:
       aff4_path = self.state.get("aff4_path") or request.REQ.get("aff4_path")
       collection = aff4.FACTORY.Open(aff4_path,
@@ -472,12 +470,19 @@ class RDFValueCollectionRenderer(renderers.TableRenderer):
     except IOError:
       return
 
-    self.size = len(collection)
+    return renderers.RDFValueCollectionDataSource(collection)
+
+  def BuildTable(self, start_row, end_row, request):
+    """Builds a table of rdfvalues."""
+    data_source = self.GetDataSource(request)
+    if data_source is not None:
+      self.BuildTableFromDataSource(data_source, start_row, end_row, request)
 
-    row_index = start_row
-    for value in itertools.islice(collection, start_row, end_row):
+  def AddRowsFromItems(self, start_row, items, request):
+    for row_index, value in enumerate(items, start_row):
       self.AddCell(row_index, "Value", value)
-      row_index += 1
+
+    return start_row + len(items)
 
   def Layout(self, request, response, aff4_path=None):
     if aff4_path:
@@ -594,8 +599,10 @@ class ClientURNRenderer(RDFValueRenderer):
   def RenderAjax(self, request, response):
     self.urn = request.REQ.get("urn")
     if self.urn:
-      fd = aff4.FACTORY.Open(self.urn, token=request.token)
-      self.summary = FindRendererForObject(fd.GetSummary()).RawHTML(request)
+      summary = self.GetCachedValue(
+          request, self.urn, lambda: aff4.FACTORY.Open(
+              self.urn, token=request.token).GetSummary())
+      self.summary = FindRendererForObject(summary).RawHTML(request)
 
     return super(ClientURNRenderer, self).RenderAjax(request, response)
 
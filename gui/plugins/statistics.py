@@ -118,19 +118,26 @@ class OSBreakdown(PieChart):
   description = "OS breakdown for clients that were active in the last day."
   active_day = 1
   attribute = aff4.ClientFleetStats.SchemaCls.OS_HISTOGRAM
+  DATA_URN = "aff4:/stats/ClientFleetStats"
+
+  def _GetData(self, token):
+    fd = aff4.FACTORY.Open(self.DATA_URN, token=token)
+    data = []
+    for graph in fd.Get(self.attribute):
+      # Find the correct graph and merge the OS categories together
+      if "%s day" % self.active_day in graph.title:
+        for sample in graph:
+          data.append(dict(label=sample.label, data=sample.y_value))
+        break
+
+    return data
 
   def Layout(self, request, response):
     """Extract only the operating system type from the active histogram."""
+    self.data = []
     try:
-      fd = aff4.FACTORY.Open("aff4:/stats/ClientFleetStats",
-                             token=request.token)
-      self.data = []
-      for graph in fd.Get(self.attribute):
-        # Find the correct graph and merge the OS categories together
-        if "%s day" % self.active_day in graph.title:
-          for sample in graph:
-            self.data.append(dict(label=sample.label, data=sample.y_value))
-          break
+      self.data = self.GetCachedValue(
+          request, self.DATA_URN, lambda: self._GetData(request.token))
     except (IOError, TypeError):
       pass
 
@@ -205,20 +212,23 @@ evolves over time.
           self.categories.setdefault(label, []).append(
               (graph_series.age/1000, sample.y_value))
 
+  def _GetGraphs(self, token):
+    fd = aff4.FACTORY.Open(self.DATA_URN, token=token,
+                           age=(self.start_time, self.end_time))
+    self.categories = {}
+    for graph_series in fd.GetValuesForAttribute(self.attribute):
+      self._ProcessGraphSeries(graph_series)
+
+    return [dict(label=k, data=v) for k, v in self.categories.items()]
+
   def Layout(self, request, response):
     """Show how the last active breakdown evolves over time."""
+    self.graphs = []
     try:
       self.start_time, self.end_time = GetAgeTupleFromRequest(request, 180)
-      fd = aff4.FACTORY.Open(self.DATA_URN, token=request.token,
-                             age=(self.start_time, self.end_time))
-      self.categories = {}
-      for graph_series in fd.GetValuesForAttribute(self.attribute):
-        self._ProcessGraphSeries(graph_series)
-
-      self.graphs = []
-      for k, v in self.categories.items():
-        graph = dict(label=k, data=v)
-        self.graphs.append(graph)
+      self.graphs = self.GetCachedValue(
+          request, self.DATA_URN, lambda: self._GetGraphs(request.token),
+          request.REQ.get("start_time"), request.REQ.get("end_time"))
     except IOError:
       pass
 
@@ -392,10 +402,19 @@ selectTab = function (tabid) {
     self.client_id = rdfvalue.ClientURN(request.REQ.get("client_id"))
 
     self.start_time, self.end_time = GetAgeTupleFromRequest(request, 90)
-    fd = aff4.FACTORY.Open(self.client_id.Add("stats"), token=request.token,
+    self.graphs = self.GetCachedValue(
+        request, self.client_id.Add("stats"),
+        lambda: self._GetGraphs(request.token),
+        request.REQ.get("start_time"), request.REQ.get("end_time"))
+
+    return super(AFF4ClientStats, self).Layout(request, response)
+
+  def _GetGraphs(self, token):
+    """Builds the graphs for the various client statistics."""
+    fd = aff4.FACTORY.Open(self.client_id.Add("stats"), token=token,
                            age=(self.start_time, self.end_time))
 
-    self.graphs = []
+    graphs = []
 
     stats = list(fd.GetValuesForAttribute(fd.Schema.STATS))
 
@@ -403,7 +422,7 @@ selectTab = function (tabid) {
     max_samples = 500
 
     if not stats:
-      return super(AFF4ClientStats, self).Layout(request, response)
+      return graphs
 
     # CPU usage graph.
     series = dict()
@@ -413,7 +432,7 @@ selectTab = function (tabid) {
     graph = StatGraph(name="CPU Usage", graph_id="cpu",
                       click_text="CPU usage on %date: %value")
     graph.AddSeries(series, "CPU Usage in %", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
     # IO graphs.
     series = dict()
@@ -424,7 +443,7 @@ selectTab = function (tabid) {
         name="IO Bytes Read", graph_id="io_read",
         click_text="Number of bytes received (IO) until %date: %value")
     graph.AddSeries(series, "IO Bytes Read in MB", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
     series = dict()
     for stat_entry in stats:
@@ -434,7 +453,7 @@ selectTab = function (tabid) {
         name="IO Bytes Written", graph_id="io_write",
         click_text="Number of bytes written (IO) until %date: %value")
     graph.AddSeries(series, "IO Bytes Written in MB", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
     # Memory usage graph.
     graph = StatGraph(
@@ -448,7 +467,7 @@ selectTab = function (tabid) {
     for stat_entry in stats:
       series[int(stat_entry.age/1e3)] = int(stat_entry.VMS_size/1024/1024)
     graph.AddSeries(series, "VMS size in MB", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
     # Network traffic graphs.
     graph = StatGraph(
@@ -459,7 +478,7 @@ selectTab = function (tabid) {
       series[int(stat_entry.age/1e3)] = int(
           stat_entry.bytes_received/1024/1024)
     graph.AddSeries(series, "Network Bytes Received in MB", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
     graph = StatGraph(
         name="Network Bytes Sent", graph_id="nw_sent",
@@ -468,9 +487,9 @@ selectTab = function (tabid) {
     for stat_entry in stats:
       series[int(stat_entry.age/1e3)] = int(stat_entry.bytes_sent/1024/1024)
     graph.AddSeries(series, "Network Bytes Sent in MB", max_samples)
-    self.graphs.append(graph)
+    graphs.append(graph)
 
-    return super(AFF4ClientStats, self).Layout(request, response)
+    return graphs
 
 
 def GetAgeTupleFromRequest(request, default_days=90):
@@ -494,20 +513,30 @@ class CustomXAxisChart(Report):
   def FormatLabel(self, value):
     return str(value)
 
+  def GetXValue(self, value):
+    return value
+
+  def _GetData(self, token):
+    fd = aff4.FACTORY.Open(self.data_urn, token=token)
+    graph = fd.Get(self.attribute)
+
+    data = []
+    xaxis_ticks = []
+    if graph:
+      for point in graph.data:
+        x_value = self.GetXValue(point.x_value)
+        data.append([[x_value, point.y_value]])
+        xaxis_ticks.append([x_value, self.FormatLabel(point.x_value)])
+
+    return data, xaxis_ticks
+
   def Layout(self, request, response):
     """Set X,Y values."""
+    self.data = []
+    self.xaxis_ticks = []
     try:
-      fd = aff4.FACTORY.Open(self.data_urn)
-      self.graph = fd.Get(self.attribute)
-
-      self.data = []
-      self.xaxis_ticks = []
-      if self.graph:
-        for point in self.graph.data:
-          self.data.append([[point.x_value, point.y_value]])
-          self.xaxis_ticks.append([point.x_value,
-                                   self.FormatLabel(point.x_value)])
-
+      self.data, self.xaxis_ticks = self.GetCachedValue(
+          request, self.data_urn, lambda: self._GetData(request.token))
     except (IOError, TypeError):
       pass
 
@@ -524,30 +553,12 @@ class LogXAxisChart(CustomXAxisChart):
     https://code.google.com/p/flot/issues/detail?id=26
   """
 
-  def Layout(self, request, response):
-    try:
-      fd = aff4.FACTORY.Open(self.data_urn)
-      self.graph = fd.Get(self.attribute)
-
-      self.data = []
-      self.xaxis_ticks = []
-      if self.graph:
-        for point in self.graph.data:
-          # Note 0 and 1 are collapsed into a single category
-          if point.x_value > 0:
-            x_value = math.log10(point.x_value)
-          else:
-            x_value = point.x_value
-          self.data.append([[x_value, point.y_value]])
-          self.xaxis_ticks.append([x_value, self.FormatLabel(point.x_value)])
-
-    except (IOError, TypeError):
-      pass
+  def GetXValue(self, value):
+    # Note 0 and 1 are collapsed into a single category
+    if value > 0:
+      return math.log10(value)
 
-    response = super(CustomXAxisChart, self).Layout(request, response)
-    return self.CallJavascript(response, "CustomXAxisChart.Layout",
-                               data=self.data,
-                               xaxis_ticks=self.xaxis_ticks)
+    return value
 
 
 class FileStoreFileTypes(PieChart):
@@ -555,17 +566,19 @@ class FileStoreFileTypes(PieChart):
   description = ""
   category = "/FileStore/FileTypes"
   attribute = aff4.FilestoreStats.SchemaCls.FILESTORE_FILETYPES
+  DATA_URN = "aff4:/stats/FileStoreStats"
+
+  def _GetData(self, token):
+    fd = aff4.FACTORY.Open(self.DATA_URN, token=token)
+    return [dict(label=sample.label, data=sample.y_value)
+            for sample in fd.Get(self.attribute)]
 
   def Layout(self, request, response):
     """Extract only the operating system type from the active histogram."""
+    self.data = []
     try:
-      fd = aff4.FACTORY.Open("aff4:/stats/FileStoreStats",
-                             token=request.token)
-      self.graph = fd.Get(self.attribute)
-
-      self.data = []
-      for sample in self.graph:
-        self.data.append(dict(label=sample.label, data=sample.y_value))
+      self.data = self.GetCachedValue(
+          request, self.DATA_URN, lambda: self._GetData(request.token))
     except (IOError, TypeError):
       pass
 
@@ -5,6 +5,9 @@
 import copy
 import csv
 import functools
+import heapq
+import inspect
+import itertools
 import json
 import os
 import re
@@ -18,6 +21,8 @@ from django import template
 import logging
 
 from grr.lib import access_control
+from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import registry
 from grr.lib import utils
@@ -29,6 +34,9 @@ COUNTER = 1
 # Maximum size of tables that can be downloaded
 MAX_ROW_LIMIT = 1000000
 
+# Number of rows read from a table's data source at a time when downloading.
+DOWNLOAD_BATCH_SIZE = 1000
+
 
 def GetNextId():
   """Generate a unique id."""
@@ -110,6 +118,45 @@ class Renderer(object):
 
   # pylint: enable=redefined-builtin
 
+  # Shared by all renderers, see GetCachedValue().
+  render_cache = None
+
+  def GetCachedValue(self, request, urn, compute, *args):
+    """Returns a value computed from an AFF4 object, caching the result.
+
+    Renderers which compute expensive data (e.g. graphs) from objects that
+    rarely change can use this so repeated requests do not recompute it. The
+    value is cached by renderer, arguments, user and the time the object was
+    last written. Checking that time reads a single cell, which also makes the
+    data store check the user may read the object.
+
+    Args:
+      request: The request object.
+      urn: The urn of the AFF4 object the value is computed from.
+      compute: A callable taking no arguments which computes the value.
+      *args: Further hashable arguments the value depends on (e.g. request
+             parameters).
+
+    Returns:
+      The value returned by compute.
+    """
+    if Renderer.render_cache is None:
+      Renderer.render_cache = utils.AgeBasedCache(
+          max_size=config_lib.CONFIG["AdminUI.render_cache_size"],
+          max_age=config_lib.CONFIG["AdminUI.render_cache_age"])
+
+    _, last = data_store.DB.Resolve(
+        urn, aff4.AFF4Object.SchemaCls.LAST.predicate, token=request.token)
+
+    key = (self.__class__.__name__, utils.SmartUnicode(urn), last,
+           request.token.username) + args
+    try:
+      return self.render_cache.Get(key)
+    except KeyError:
+      value = compute()
+      self.render_cache.Put(key, value)
+      return value
+
   def CallJavascript(self, response, method, **kwargs):
     """Inserts javascript call into the response.
 
@@ -378,6 +425,18 @@ class TableColumn(object):
   def GetElement(self, index):
     return self.rows[index]
 
+  def RenderValue(self, index):
+    """Returns the value stored at the index as plain text for downloads."""
+    value = self.rows.get(index)
+    if value is None:
+      return ""
+
+    # Cells holding renderer parameters (e.g. icons) only have a description.
+    if isinstance(value, dict):
+      value = value.get("description", "")
+
+    return utils.SmartStr(value)
+
   def AddElement(self, index, element):
     self.rows[index] = element
 
@@ -399,6 +458,220 @@ class TableColumn(object):
     return result
 
 
+class TableDataSource(object):
+  """A source of table rows with keyset (cursor based) pagination.
+
+  Paging by offset has to skip over all the items before the requested page,
+  so scrolling deep into a large table gets slower with every page. A data
+  source instead returns an opaque cursor with every page which records where
+  the page ended, and the next page is fetched starting from that cursor.
+  """
+
+  # The names of the columns this source can sort the items on.
+  sort_keys = []
+
+  def EncodeCursor(self, position):
+    return json.dumps(position)
+
+  def DecodeCursor(self, cursor):
+    """Decodes a cursor from the browser, returns None if it is invalid."""
+    if not cursor:
+      return None
+
+    try:
+      return json.loads(cursor)
+    except (TypeError, ValueError):
+      return None
+
+  def Fetch(self, cursor=None, count=50, sort_key=None, reverse=False):
+    """Fetches a page of items.
+
+    Args:
+      cursor: The cursor returned with the previous page, None for the first.
+      count: The maximum number of items to return.
+      sort_key: One of sort_keys or None for the natural order.
+      reverse: If True, sort in descending order.
+
+    Returns:
+      A tuple (items, next_cursor). next_cursor is None after the last page.
+    """
+    raise NotImplementedError()
+
+  def Size(self):
+    """Returns the total number of items, or None if it is not known."""
+    return None
+
+  def GenerateBatches(self, batch_size, sort_key=None, reverse=False):
+    """Yields all the items in lists of at most batch_size items.
+
+    This pages through Fetch. Data sources which can read all their items in
+    one pass more cheaply than page by page should override it.
+
+    Args:
+      batch_size: The maximum number of items in a batch.
+      sort_key: One of sort_keys or None for the natural order.
+      reverse: If True, sort in descending order.
+
+    Yields:
+      Lists of items.
+    """
+    cursor = None
+    while True:
+      items, cursor = self.Fetch(cursor=cursor, count=batch_size,
+                                 sort_key=sort_key, reverse=reverse)
+      yield items
+
+      if not cursor:
+        break
+
+
+class RDFValueCollectionDataSource(TableDataSource):
+  """Pages through an RDFValueCollection in the order the values were added.
+
+  The cursor is the offset of the next value in the collection's stream, so
+  a page is read without reading any of the values before it. Collections
+  which can not be read from an offset (e.g. versioned collections) are paged
+  by skipping over the values of the previous pages instead, and their cursor
+  is the number of values to skip.
+  """
+
+  def __init__(self, collection):
+    self.collection = collection
+    self.seekable = "offset" in inspect.getargspec(
+        collection.GenerateItems).args
+
+  def Fetch(self, cursor=None, count=50, sort_key=None, reverse=False):
+    offset = self.DecodeCursor(cursor) or 0
+
+    # Read one more value to find out where the next page starts.
+    if self.seekable:
+      items = list(itertools.islice(
+          self.collection.GenerateItems(offset=offset), count + 1))
+    else:
+      items = list(itertools.islice(
+          self.collection.GenerateItems(), offset, offset + count + 1))
+
+    next_cursor = None
+    if len(items) > count:
+      if self.seekable:
+        next_cursor = self.EncodeCursor(items[count].collection_offset)
+      else:
+        next_cursor = self.EncodeCursor(offset + count)
+
+    return items[:count], next_cursor
+
+  def Size(self):
+    # Only the plain collection keeps an accurate count of its values.
+    if self.seekable:
+      return len(self.collection)
+
+
+class AFF4ChildrenDataSource(TableDataSource):
+  """Pages through the children of an AFF4Volume.
+
+  Only the children on the requested page are opened. The cursor is the sort
+  key of the last child on the previous page.
+
+  The data store can not return the directory index in the order of our sort
+  keys, so every page still reads the whole index of the directory and filters
+  and sorts it in memory. Fetching a page is therefore linear in the number of
+  children, but this is a single read of one row and much cheaper than opening
+  the children, which is what used to make large directories slow. Downloads
+  read the index only once (see GenerateBatches).
+  """
+
+  sort_keys = ["Name", "Age"]
+
+  def __init__(self, volume, name_regex=None, visible_types=None):
+    """Constructor.
+
+    Args:
+      volume: The AFF4Volume to list.
+      name_regex: If set, only children whose basename matches this regex are
+                  listed.
+      visible_types: If set, only children of these AFF4 types are listed.
+    """
+    self.volume = volume
+    self.name_regex = name_regex and re.compile(name_regex)
+    self.visible_types = visible_types
+
+  def _SortKey(self, urn, sort_key):
+    name = utils.SmartUnicode(urn.Basename())
+    if sort_key == "Age":
+      return [int(urn.age), name]
+
+    return [name]
+
+  def _ListKeyedChildren(self, sort_key, reverse, position=None):
+    """Returns (sort key, urn) of the matching children after position."""
+    keyed_children = []
+    for urn in self.volume.ListChildren():
+      if self.name_regex and not self.name_regex.search(
+          utils.SmartUnicode(urn.Basename())):
+        continue
+
+      key = self._SortKey(urn, sort_key)
+      if position is not None and (key <= position if not reverse else
+                                   key >= position):
+        continue
+
+      keyed_children.append((key, urn))
+
+    return keyed_children
+
+  def _OpenChildren(self, urns):
+    """Opens the children in the order given, skipping invisible types."""
+    fds = dict((utils.SmartUnicode(fd.urn), fd) for fd in
+               self.volume.OpenChildren(children=urns))
+
+    # Symlinks are opened as their targets so they come last.
+    page_fds = [fds.pop(utils.SmartUnicode(urn), None) for urn in urns]
+
+    items = []
+    for fd in page_fds + fds.values():
+      if fd is None:
+        continue
+
+      if (self.visible_types and
+          fd.__class__.__name__ not in self.visible_types):
+        continue
+
+      items.append(fd)
+
+    return items
+
+  def Fetch(self, cursor=None, count=50, sort_key=None, reverse=False):
+    position = self.DecodeCursor(cursor)
+    keyed_children = self._ListKeyedChildren(sort_key, reverse,
+                                             position=position)
+
+    select = heapq.nlargest if reverse else heapq.nsmallest
+
+    items = []
+    while keyed_children and len(items) < count:
+      page = select(count - len(items), keyed_children,
+                    key=lambda (key, _): key)
+      position = page[-1][0]
+      keyed_children = [x for x in keyed_children if
+                        (x[0] > position if not reverse else x[0] < position)]
+
+      items.extend(self._OpenChildren([urn for _, urn in page]))
+
+    next_cursor = None
+    if keyed_children:
+      next_cursor = self.EncodeCursor(position)
+
+    return items, next_cursor
+
+  def GenerateBatches(self, batch_size, sort_key=None, reverse=False):
+    # The directory index is listed and sorted once, not once per batch.
+    keyed_children = sorted(self._ListKeyedChildren(sort_key, reverse),
+                            key=lambda (key, _): key, reverse=reverse)
+
+    for batch in utils.Grouper(keyed_children, batch_size):
+      yield self._OpenChildren([urn for _, urn in batch])
+
+
 class TableRenderer(TemplateRenderer):
   """A renderer for tables.
 
@@ -423,6 +696,8 @@ class TableRenderer(TemplateRenderer):
     # Number of rows
     self.size = 0
     self.message = ""
+    # The cursor of the next page when the table is built from a data source.
+    self.next_cursor = None
     # Make a copy of the table options so they can be mutated.
     self.table_options = copy.deepcopy(self.table_options)
     self.table_options["iDisplayLength"] = 50
@@ -542,7 +817,8 @@ class TableRenderer(TemplateRenderer):
 {% endfor %}
 {% if this.additional_rows %}
 <tr>
-  <td id="{{unique|escape}}" colspan="200" class="table_loading">
+  <td id="{{unique|escape}}" colspan="200" class="table_loading"
+    {% if this.next_cursor %}cursor="{{this.next_cursor|escape}}"{% endif %}>
     Loading...
   </td>
 </tr>
@@ -604,6 +880,83 @@ class TableRenderer(TemplateRenderer):
       request: The request object.
     """
 
+  def GetDataSource(self, request):
+    """Returns the TableDataSource this table is built from.
+
+    Tables built from a data source are downloaded by streaming the data
+    source in batches rather than building the whole table in memory.
+
+    Args:
+      request: The request object.
+
+    Returns:
+      A TableDataSource or None if the table is not built from one.
+    """
+    _ = request
+
+  def _GetSortOrder(self, data_source, request):
+    """Returns the sort key and direction requested for the data source."""
+    sort = request.REQ.get("sort")
+    if sort:
+      column, _, direction = sort.rpartition(":")
+      if column in data_source.sort_keys:
+        return column, direction == "desc"
+
+    return None, False
+
+  def BuildTableFromDataSource(self, data_source, start_row, end_row,
+                               request):
+    """Populates the table with a page of items from a TableDataSource.
+
+    The page starts at the cursor sent by the browser with the request, so
+    BuildTable implementations can call this to page through large tables
+    without skipping over start_row items first.
+
+    Args:
+      data_source: The TableDataSource to read from.
+      start_row: The index of the first row to populate.
+      end_row: The suggested index of the last row.
+      request: The request object.
+
+    Returns:
+      The index after the last row populated.
+    """
+    sort_key, reverse = self._GetSortOrder(data_source, request)
+    items, self.next_cursor = data_source.Fetch(
+        cursor=request.REQ.get("cursor"), count=max(end_row - start_row, 1),
+        sort_key=sort_key, reverse=reverse)
+
+    row_index = self.AddRowsFromItems(start_row, items, request)
+
+    # Most data sources do not know how many rows there are, the table then
+    # only shows the rows read so far and RenderAjax uses the cursor to ask for
+    # more.
+    size = data_source.Size()
+    if size is None:
+      size = row_index
+    self.size = max(size, row_index)
+
+    return row_index
+
+  def AddRowsFromItems(self, start_row, items, request):
+    """Adds rows for a page of items from a TableDataSource.
+
+    By default every item is an AFF4 object which is added as a single row.
+
+    Args:
+      start_row: The index of the first row to add.
+      items: The list of items.
+      request: The request object.
+
+    Returns:
+      The index after the last row added.
+    """
+    _ = request
+    for row_index, item in enumerate(items, start_row):
+      self.AddRowFromFd(row_index, item)
+
+    return start_row + len(items)
+
   def RenderAjax(self, request, response):
     """Responds to an AJAX request.
 
@@ -636,7 +989,7 @@ class TableRenderer(TemplateRenderer):
 
       self.rows.append((row, row_options.items()))
 
-    self.additional_rows = self.size > end_row
+    self.additional_rows = self.size > end_row or bool(self.next_cursor)
 
     # If we did not write any additional rows in this round trip we ensure the
     # table does not try to fetch more rows. This is a safety check in case
@@ -648,10 +1001,37 @@ class TableRenderer(TemplateRenderer):
     return super(TableRenderer, self).Layout(request, response,
                                              apply_template=self.ajax_template)
 
+  def _GenerateDataSourceRows(self, data_source, request):
+    """Yields the plain text rows of the table from its data source."""
+    sort_key, reverse = self._GetSortOrder(data_source, request)
+    for items in data_source.GenerateBatches(
+        DOWNLOAD_BATCH_SIZE, sort_key=sort_key, reverse=reverse):
+
+      # Only hold a single batch of rows at a time.
+      for column in self.columns:
+        column.rows = {}
+
+      end_row = self.AddRowsFromItems(0, items, request)
+      for i in xrange(end_row):
+        yield [c.RenderValue(i) for c in self.columns]
+
+  def _GenerateTableRows(self, request):
+    """Yields the plain text rows of a table built by BuildTable."""
+    self.BuildTable(0, MAX_ROW_LIMIT, request)
+
+    def RemoveTags(string):
+      """Very simple for now - remove any html from output."""
+      return re.sub("(?ims)<[^>]+>", "", utils.SmartStr(string)).strip()
+
+    for i in xrange(0, self.size):
+      yield [RemoveTags(c.RenderRow(i, request)) for c in self.columns]
+
   def Download(self, request, _):
-    """Export the table in CSV.
+    """Export the table in CSV or JSON.
 
-    This streams the entire table (after suitable filtering).
+    This streams the entire table (after suitable filtering). Tables built from
+    a data source are read from it in batches of plain values, so memory use
+    does not grow with the size of the table.
 
     Args:
       request: The request object.
@@ -659,38 +1039,57 @@ class TableRenderer(TemplateRenderer):
     Returns:
        A streaming response object.
     """
-    self.BuildTable(0, MAX_ROW_LIMIT, request)
+    data_source = self.GetDataSource(request)
+    if data_source is not None:
+      rows = self._GenerateDataSourceRows(data_source, request)
+    else:
+      rows = self._GenerateTableRows(request)
 
-    def RemoveTags(string):
-      """Very simple for now - remove any html from output."""
-      return re.sub("(?ims)<[^>]+>", "", utils.SmartStr(string)).strip()
+    header = [c.name for c in self.columns]
 
-    def Generator():
+    def CSVGenerator():
       """Generates the CSV for streaming."""
       fd = StringIO.StringIO()
       writer = csv.writer(fd)
 
       # Write the headers
-      writer.writerow([c.name for c in self.columns])
+      writer.writerow(header)
 
       # Send 1000 rows at a time
-      for i in xrange(0, self.size):
+      for i, row in enumerate(rows):
         if i % 1000 == 0:
           # Flush the buffer
           yield fd.getvalue()
           fd.truncate(size=0)
 
-        writer.writerow(
-            [RemoveTags(c.RenderRow(i, request)) for c in self.columns])
+        writer.writerow(row)
 
       # The last chunk
       yield fd.getvalue()
 
-    response = http.HttpResponse(content=Generator(),
-                                 content_type="binary/x-csv")
+    def JSONGenerator():
+      """Generates a JSON list of rows for streaming."""
+      yield "["
+      separator = "\n"
+      for row in rows:
+        yield separator + json.dumps(
+            dict(zip(header, [utils.SmartUnicode(x) for x in row])))
+        separator = ",\n"
+
+      yield "\n]\n"
+
+    # StreamingHttpResponse was added in Django 1.5, older versions also
+    # stream a HttpResponse built from a generator.
+    response_cls = getattr(http, "StreamingHttpResponse", http.HttpResponse)
+    if request.REQ.get("format") == "json":
+      response = response_cls(JSONGenerator(), content_type="application/json")
+      filename = "table.json"
+    else:
+      response = response_cls(CSVGenerator(), content_type="binary/x-csv")
+      filename = "table.csv"
 
     # This must be a string.
-    response["Content-Disposition"] = ("attachment; filename=table.csv")
+    response["Content-Disposition"] = ("attachment; filename=%s" % filename)
 
     return response
 
@@ -519,6 +519,7 @@ grr.table.scrollHandler = function(renderer, tbody, opt_state) {
   var value = loading.attr('data');
   var depth = loading.attr('depth');
   var start_row = loading.attr('start_row');
+  var cursor = loading.attr('cursor');
 
   $('.table_loading', tbody).each(function() {
     loading_offset = $(this).offset();
@@ -549,6 +550,12 @@ grr.table.scrollHandler = function(renderer, tbody, opt_state) {
         state.sort = sort.text() + ':' + sort.attr('sort');
       }
 
+      // Tables built from a data source continue from the cursor of the
+      // previous page.
+      if (cursor != undefined) {
+        state.cursor = cursor;
+      }
+
       // Insert the new data after the table loading message, and wipe it.
       grr.update(renderer, loading_id, state,
         function(data) {
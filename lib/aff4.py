@@ -6,7 +6,11 @@ This contains an AFF4 data model implementation.
 
 import __builtin__
 import abc
+import atexit
+import itertools
+import Queue
 import StringIO
+import threading
 import time
 import zlib
 
@@ -19,6 +23,7 @@ from grr.lib import data_store
 from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import grr_rdf
@@ -50,6 +55,234 @@ class InstantiationError(Error, IOError):
   pass
 
 
+class IndexWriter(object):
+  """Maintains attribute and child indexes off the critical path.
+
+  Index updates for many objects are collected here, deduplicated and written
+  to the data store in bulk, either periodically by a background thread or when
+  too many updates are pending. Callers which need to read an index they have
+  just written must call Flush() first. The factory does this before listing
+  children or querying an AFF4Index.
+  """
+
+  def __init__(self, factory, flush_interval=1, max_pending=10000):
+    self.factory = factory
+    self.max_pending = max_pending
+
+    # Protects the pending updates.
+    self.lock = threading.RLock()
+    # Ensures only one flush writes at a time so Flush() acts as a barrier.
+    self.flush_lock = threading.RLock()
+
+    # Updates are grouped by token. Keys are serialized tokens, values are
+    # (token, {index urn: set of (urn, attribute, value)}).
+    self.attribute_updates = {}
+
+    # Keys are serialized tokens, values are (token, {dirname: set(basenames)}).
+    self.child_updates = {}
+
+    # Keys are serialized tokens, values are (token, {dirname: {basename:
+    # (serialized AFF4ObjectSummary, merge with the stored summary)}}).
+    self.summary_updates = {}
+    self.pending = 0
+
+    self.flusher_thread = utils.InterruptableThread(
+        target=self._PeriodicFlush, sleep_time=flush_interval)
+    self.flusher_thread.start()
+
+  def Add(self, urn, attributes, token):
+    """Queues the index updates needed for the attributes of urn."""
+    with self.lock:
+      token_key = utils.SmartStr(token)
+      _, indexes = self.attribute_updates.setdefault(token_key, (token, {}))
+      for attribute, values in attributes.items():
+        if attribute.index:
+          for value, _ in values:
+            indexes.setdefault(attribute.index, set()).add(
+                (urn, attribute, value))
+            self.pending += 1
+
+      # Create navigation aids by touching intermediate subject names.
+      _, children = self.child_updates.setdefault(token_key, (token, {}))
+      while urn.Path() != "/":
+        try:
+          self.factory.intermediate_cache.Get(urn.Path())
+          break
+        except KeyError:
+          dirname = rdfvalue.RDFURN(urn.Dirname())
+          children.setdefault(dirname, set()).add(urn.Basename())
+          self.factory.intermediate_cache.Put(urn.Path(), 1)
+          self.pending += 1
+
+          urn = dirname
+
+      pending = self.pending
+
+    if pending >= self.max_pending:
+      self.Flush()
+
+  def AddSummary(self, urn, summary, token, merge=False):
+    """Queues an update of the summary of urn kept in its parent's index.
+
+    Args:
+      urn: The urn of the object.
+      summary: The AFF4ObjectSummary of the object.
+      token: An ACL token.
+      merge: If True, the summary is incomplete (e.g. from a blind write) and
+             fields it does not have are kept from the stored summary.
+    """
+    with self.lock:
+      _, summaries = self.summary_updates.setdefault(
+          utils.SmartStr(token), (token, {}))
+      dirname = rdfvalue.RDFURN(urn.Dirname())
+      children = summaries.setdefault(dirname, {})
+
+      queued = children.get(urn.Basename())
+      if merge and queued is not None:
+        serialized_summary, merge = queued
+        summary = self._MergeSummary(serialized_summary, summary)
+
+      children[urn.Basename()] = (summary.SerializeToString(), merge)
+      self.pending += 1
+      pending = self.pending
+
+    if pending >= self.max_pending:
+      self.Flush()
+
+  def _PeriodicFlush(self):
+    """Flushes from the background thread, which must survive any error."""
+    try:
+      self.Flush()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Failed to write AFF4 indexes, will retry: %s", e)
+
+  def Flush(self):
+    """Writes all pending index updates to the data store.
+
+    If a write fails, the updates which were being written are queued again
+    and the error is raised. All index writes are idempotent so the next flush
+    can safely write them again.
+    """
+    with self.flush_lock:
+      # Writing the indexes may queue further updates (e.g. the child index of
+      # a new AFF4Index) so we keep going until everything is written.
+      while True:
+        with self.lock:
+          if not self.pending:
+            return
+
+          attribute_updates = self.attribute_updates
+          child_updates = self.child_updates
+          summary_updates = self.summary_updates
+          self.attribute_updates = {}
+          self.child_updates = {}
+          self.summary_updates = {}
+          self.pending = 0
+
+        try:
+          for token, indexes in attribute_updates.itervalues():
+            self._WriteAttributeIndexes(indexes, token)
+
+          for token, children in child_updates.itervalues():
+            self._WriteChildIndexes(children, token)
+
+          for token, summaries in summary_updates.itervalues():
+            self._WriteChildSummaries(summaries, token)
+        except Exception:
+          self._Requeue(attribute_updates, child_updates, summary_updates)
+          raise
+
+  def _Requeue(self, attribute_updates, child_updates, summary_updates):
+    """Queues updates which could not be written again."""
+    with self.lock:
+      for token_key, (token, indexes) in attribute_updates.iteritems():
+        _, pending = self.attribute_updates.setdefault(token_key, (token, {}))
+        for index_urn, entries in indexes.iteritems():
+          pending.setdefault(index_urn, set()).update(entries)
+          self.pending += len(entries)
+
+      for token_key, (token, children) in child_updates.iteritems():
+        _, pending = self.child_updates.setdefault(token_key, (token, {}))
+        for dirname, basenames in children.iteritems():
+          pending.setdefault(dirname, set()).update(basenames)
+          self.pending += len(basenames)
+
+      for token_key, (token, summaries) in summary_updates.iteritems():
+        _, pending = self.summary_updates.setdefault(token_key, (token, {}))
+        for dirname, children in summaries.iteritems():
+          pending_children = pending.setdefault(dirname, {})
+          for basename, summary in children.iteritems():
+            # A summary queued since the failed flush is newer than ours.
+            pending_children.setdefault(basename, summary)
+            self.pending += 1
+
+  def _WriteAttributeIndexes(self, indexes, token):
+    for index_urn, entries in indexes.iteritems():
+      aff4index = self.factory.Create(index_urn, "AFF4Index", mode="w",
+                                      token=token)
+      for urn, attribute, value in entries:
+        aff4index.Add(urn, attribute, value)
+      aff4index.Close()
+
+  def _WriteChildIndexes(self, children, token):
+    """Writes the index:dir/ attributes, one MultiSet per directory."""
+    now = rdfvalue.RDFDatetime().Now().SerializeToDataStore()
+    for dirname, basenames in children.iteritems():
+      values = {AFF4Object.SchemaCls.LAST: [now]}
+      for basename in basenames:
+        # This updates the directory index.
+        values["index:dir/%s" % utils.SmartStr(basename)] = [EMPTY_DATA]
+
+      try:
+        data_store.DB.MultiSet(dirname, values, token=token, replace=True,
+                               sync=False)
+      except access_control.UnauthorizedAccess:
+        pass
+
+
+  @staticmethod
+  def _MergeSummary(serialized_summary, summary):
+    """Fills in the fields summary does not have from an older summary."""
+    old_summary = rdfvalue.AFF4ObjectSummary(serialized_summary)
+    for field in ("size", "mtime"):
+      if old_summary.HasField(field) and not summary.HasField(field):
+        setattr(summary, field, getattr(old_summary, field))
+
+    return summary
+
+  def _WriteChildSummaries(self, summaries, token):
+    """Writes the index:summary/ attributes, one MultiSet per directory."""
+    for dirname, children in summaries.iteritems():
+      predicates = dict((basename, "index:summary/%s" % utils.SmartStr(
+          basename)) for basename in children)
+
+      try:
+        # Incomplete summaries are merged with the stored ones.
+        stored_summaries = {}
+        to_merge = [predicates[basename]
+                    for basename, (_, merge) in children.iteritems() if merge]
+        if to_merge:
+          for predicate, value, _ in data_store.DB.ResolveMulti(
+              dirname, to_merge, token=token,
+              timestamp=data_store.DB.NEWEST_TIMESTAMP):
+            stored_summaries[predicate] = value
+
+        values = {}
+        for basename, (summary, merge) in children.iteritems():
+          predicate = predicates[basename]
+          if merge and predicate in stored_summaries:
+            summary = self._MergeSummary(
+                stored_summaries[predicate],
+                rdfvalue.AFF4ObjectSummary(summary)).SerializeToString()
+
+          values[predicate] = [summary]
+
+        data_store.DB.MultiSet(dirname, values, token=token, replace=True,
+                               sync=False)
+      except access_control.UnauthorizedAccess:
+        pass
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
@@ -60,6 +293,11 @@ class Factory(object):
         max_age=config_lib.CONFIG["AFF4.cache_age"])
     self.intermediate_cache = utils.FastStore(2000)
 
+    # Index updates are batched and written in the background.
+    self.index_writer = IndexWriter(
+        self, flush_interval=config_lib.CONFIG["AFF4.index_flush_interval"],
+        max_pending=config_lib.CONFIG["AFF4.index_max_pending"])
+
     # Create a token for system level actions:
     self.root_token = rdfvalue.ACLToken(username="system",
                                         reason="Maintenance").SetUID()
@@ -130,71 +368,17 @@ class Factory(object):
     data_store.DB.MultiSet(urn, attributes, token=token,
                            replace=False, sync=sync, to_delete=to_delete)
 
-    # TODO(user): This can run in the thread pool since its not time
-    # critical.
-    self._UpdateIndex(urn, attributes, token)
-
-  def _UpdateIndex(self, urn, attributes, token):
-    """Updates any indexes we need."""
-    index = {}
-    for attribute, values in attributes.items():
-      if attribute.index:
-        for value, _ in values:
-          index.setdefault(attribute.index, []).append((attribute, value))
-
-    if index:
-      for index_urn, index_data in index.items():
-        aff4index = self.Create(index_urn, "AFF4Index", mode="w", token=token)
-        for attribute, value in index_data:
-          aff4index.Add(urn, attribute, value)
-        aff4index.Close()
-
-    self._UpdateChildIndex(urn, token)
-
-  def _UpdateChildIndex(self, urn, token):
-    """Update the child indexes.
-
-    This function maintains the index for direct child relations. When we set
-    an AFF4 path, we always add an attribute like
-    index:dir/%(childname)s to its parent. This is written
-    asynchronously to its parent.
-
-    In order to query for all direct children of an AFF4 object, we then simple
-    get the attributes which match the regex index:dir/.+ which are the
-    direct children.
-
-    Args:
-      urn: The AFF4 object for which we update the index.
-
-      token: The token to use.
-    """
-    try:
-      # Create navigation aids by touching intermediate subject names.
-      while urn.Path() != "/":
-        basename = urn.Basename()
-        dirname = rdfvalue.RDFURN(urn.Dirname())
-
-        try:
-          self.intermediate_cache.Get(urn.Path())
-          return
-        except KeyError:
-          data_store.DB.MultiSet(dirname, {
-              AFF4Object.SchemaCls.LAST: [
-                  rdfvalue.RDFDatetime().Now().SerializeToDataStore()],
+    # Indexes are not time critical so they are written in the background.
+    self.index_writer.Add(urn, attributes, token)
 
-              # This updates the directory index.
-              "index:dir/%s" % utils.SmartStr(basename): [EMPTY_DATA],
-              },
-                                 token=token, replace=True, sync=False)
-
-          self.intermediate_cache.Put(urn.Path(), 1)
-
-          urn = dirname
-
-    except access_control.UnauthorizedAccess:
-      pass
+  def FlushIndexes(self):
+    """Blocks until all queued index updates are written to the data store."""
+    self.index_writer.Flush()
 
   def _DeleteChildFromIndex(self, urn, token):
+    # Make sure a queued update does not resurrect the entry we remove.
+    self.FlushIndexes()
+
     try:
       # Create navigation aids by touching intermediate subject names.
       basename = urn.Basename()
@@ -206,8 +390,9 @@ class Factory(object):
         pass
 
       data_store.DB.DeleteAttributes(
-          dirname, ["index:dir/%s" % utils.SmartStr(basename)], token=token,
-          sync=False)
+          dirname, ["index:dir/%s" % utils.SmartStr(basename),
+                    "index:summary/%s" % utils.SmartStr(basename)],
+          token=token, sync=False)
       data_store.DB.MultiSet(dirname, {
           AFF4Object.SchemaCls.LAST: [
               rdfvalue.RDFDatetime().Now().SerializeToDataStore()],
@@ -423,31 +608,156 @@ class Factory(object):
 
   def MultiOpen(self, urns, mode="rw", token=None, aff4_type=None,
                 age=NEWEST_TIME):
-    """Opens a bunch of urns efficiently."""
+    """Opens a bunch of urns efficiently.
+
+    Large sets of urns are split into chunks which are read from the data store
+    concurrently. Objects are yielded as soon as their chunk arrives, so the
+    order of the results is not defined. Symlinks are collected from all chunks
+    and resolved together at the end.
+
+    Args:
+      urns: An iterable of urns to open.
+      mode: The mode to open the objects with.
+      token: The Security Token to use for opening these items.
+      aff4_type: If set, only objects of this type are returned.
+      age: The age policy used to build the objects.
+
+    Yields:
+      AFF4Object instances.
+
+    Raises:
+      RuntimeError: If the mode is invalid.
+    """
     if token is None:
       token = data_store.default_token
 
     if mode not in ["w", "r", "rw"]:
       raise RuntimeError("Invalid mode %s" % mode)
 
+    required_cls = None
+    if aff4_type is not None:
+      required_cls = AFF4Object.classes[aff4_type]
+
+    symlink_predicate = AFF4Symlink.SchemaCls.SYMLINK_TARGET.predicate
     symlinks = []
-    for urn, values in self.GetAttributes(urns, token=token, age=age):
+    for urn, values in self._MultiGetAttributes(urns, token=token, age=age):
+      # Symlinks are detected from the raw attributes without building them.
+      target = None
+      for predicate, value, _ in values:
+        if predicate == symlink_predicate:
+          target = rdfvalue.RDFURN(value)
+          break
+
+      if target is not None:
+        symlinks.append(target)
+        continue
+
       try:
-        obj = self.Open(urn, mode=mode, token=token, local_cache={urn: values},
-                        aff4_type=aff4_type, age=age, follow_symlinks=False)
-        target = obj.Get(obj.Schema.SYMLINK_TARGET)
-        if target is not None:
-          symlinks.append(target)
-        else:
-          yield obj
+        obj = self._InstantiateFromAttributes(urn, values, mode=mode,
+                                              token=token, age=age)
       except IOError:
-        pass
+        continue
+
+      if required_cls is None or isinstance(obj, required_cls):
+        yield obj
 
     if symlinks:
       for obj in self.MultiOpen(symlinks, mode=mode, token=token,
                                 aff4_type=aff4_type, age=age):
         yield obj
 
+  def _InstantiateFromAttributes(self, urn, values, mode="r", token=None,
+                                 age=NEWEST_TIME):
+    """Builds an object of the right type from prefetched attributes.
+
+    Unlike Open() this instantiates the final class directly rather than
+    building an AFF4Object and upgrading it. Attribute values are only decoded
+    when they are first accessed.
+
+    Args:
+      urn: The urn of the object.
+      values: A list of (predicate, value, timestamp) as returned by
+              GetAttributes(), newest first.
+      mode: The mode to open the object with.
+      token: The Security Token to use.
+      age: The age policy used to build this object.
+
+    Returns:
+      An AFF4Object instance.
+
+    Raises:
+      InstantiationError: If the stored type is unknown.
+    """
+    aff4_type = "AFF4Volume"
+    type_predicate = AFF4Object.SchemaCls.TYPE.predicate
+    for predicate, value, _ in values:
+      if predicate == type_predicate:
+        aff4_type = value
+        break
+
+    cls = AFF4Object.classes.get(utils.SmartStr(aff4_type))
+    if cls is None:
+      raise InstantiationError("Could not instantiate %s" % aff4_type)
+
+    return cls(urn, mode=mode, token=token, local_cache={urn: values},
+               age=age, follow_symlinks=False)
+
+  def _MultiGetAttributes(self, urns, token=None, age=NEWEST_TIME):
+    """Like GetAttributes() but reads large sets of urns concurrently.
+
+    Args:
+      urns: An iterable of urns.
+      token: The Security Token to use.
+      age: The age policy of the attributes to fetch.
+
+    Yields:
+      Tuples of (subject, attributes) in the order the chunks are read.
+
+    Raises:
+      Exception: Any error raised while reading a chunk is re-raised here.
+    """
+    urns = list(urns)
+    chunk_size = config_lib.CONFIG["AFF4.multi_open_chunk_size"]
+    max_threads = config_lib.CONFIG["AFF4.multi_open_threads"]
+
+    if len(urns) <= chunk_size or max_threads <= 1:
+      for item in self.GetAttributes(urns, token=token, age=age):
+        yield item
+      return
+
+    pool = threadpool.ThreadPool.Factory("aff4_multi_open", max_threads)
+    pool.Start()
+
+    results = Queue.Queue()
+
+    def FetchChunk(chunk):
+      try:
+        results.put(list(self.GetAttributes(chunk, token=token, age=age)))
+      except Exception as e:  # pylint: disable=broad-except
+        results.put(e)
+
+    # Only keep a limited number of chunks in flight so memory stays bounded
+    # when the caller consumes the objects slower than we read them.
+    chunks = utils.Grouper(urns, chunk_size)
+    in_flight = 0
+    for chunk in itertools.islice(chunks, max_threads):
+      pool.AddTask(target=FetchChunk, args=(chunk,), name="MultiOpen")
+      in_flight += 1
+
+    while in_flight:
+      result = results.get()
+      in_flight -= 1
+
+      for chunk in itertools.islice(chunks, 1):
+        pool.AddTask(target=FetchChunk, args=(chunk,), name="MultiOpen")
+        in_flight += 1
+
+      if isinstance(result, Exception):
+        raise result
+
+      for item in result:
+        yield item
+
   def OpenDiscreteVersions(self, urn, mode="r", ignore_cache=False, token=None,
                            local_cache=None, age=ALL_TIMES,
                            follow_symlinks=True):
@@ -617,6 +927,8 @@ class Factory(object):
 
     # Get all the children of this URN and delete them all.
     logging.info(u"Recursively removing AFF4 Object %s", urn)
+    self.Open(urn, token=token, follow_symlinks=False).OnDelete()
+
     fd = FACTORY.Create(urn, "AFF4Volume", mode="rw", token=token)
     count = 0
     for child in fd.ListChildren():
@@ -684,6 +996,8 @@ class Factory(object):
     Yields:
        Tuples of Subjects and a list of children urns of a given subject.
     """
+    self.FlushIndexes()
+
     index_prefix = "index:dir/"
     for subject, values in data_store.DB.MultiResolveRegex(
         urns, index_prefix + ".+", token=token,
@@ -699,6 +1013,7 @@ class Factory(object):
       yield subject, subject_result
 
   def Flush(self):
+    self.FlushIndexes()
     data_store.DB.Flush()
     self.cache.Flush()
     self.intermediate_cache.Flush()
@@ -1000,6 +1315,10 @@ class AFF4Object(object):
   # values as needed. Behaviours are read only and set in the class definition.
   _behaviours = frozenset()
 
+  # If set, a summary of this object (see GetIndexSummary) is kept in the index
+  # of its parent so the parent can be listed without opening its children.
+  index_summary = False
+
   # Should this object be synced back to the data store.
   _dirty = False
 
@@ -1267,6 +1586,13 @@ class AFF4Object(object):
     # we remove all mode permissions from this object.
     self.mode = ""
 
+  def OnDelete(self):
+    """Called by Factory.Delete() before this object is removed.
+
+    Objects keeping data outside of their own row and their children should
+    remove it here.
+    """
+
   @utils.Synchronized
   def _WriteAttributes(self, sync=True):
     """Write the dirty attributes to the data store."""
@@ -1298,6 +1624,13 @@ class AFF4Object(object):
       FACTORY.SetAttributes(self.urn, to_set, self._to_delete, sync=sync,
                             token=self.token)
 
+      # Blind writes only know the attributes they set, so they only update
+      # the summary when they create a new version of the object, and the
+      # fields they do not know are kept from the stored summary.
+      if self.index_summary and ("r" in self.mode or self._new_version):
+        FACTORY.index_writer.AddSummary(self.urn, self.GetIndexSummary(),
+                                        self.token, merge="r" not in self.mode)
+
       # Notify the factory that this object got updated.
       FACTORY.NotifyWriteObject(self)
 
@@ -1509,6 +1842,28 @@ class AFF4Object(object):
   def Update(self, attribute=None, user=None, priority=None):
     """Requests the object refresh an attribute from the Schema."""
 
+  def GetIndexSummary(self):
+    """Returns the AFF4ObjectSummary of this object kept in its parent."""
+    summary = rdfvalue.AFF4ObjectSummary(
+        name=self.urn.Basename(), aff4_type=self.__class__.__name__,
+        has_children="Container" in self.behaviours)
+
+    stat_attribute = getattr(self.Schema, "STAT", None)
+    if stat_attribute and self.IsAttributeSet(stat_attribute):
+      stat = self.Get(stat_attribute)
+      if stat.HasField("st_size"):
+        summary.size = stat.st_size
+      if stat.HasField("st_mtime"):
+        summary.mtime = stat.st_mtime
+
+    # Streams without a stat report the size of their data.
+    size_attribute = getattr(self.Schema, "SIZE", None)
+    if (not summary.HasField("size") and size_attribute and
+        self.IsAttributeSet(size_attribute)):
+      summary.size = int(self.Get(size_attribute))
+
+    return summary
+
   def Upgrade(self, aff4_class):
     """Upgrades this object to the type specified.
 
@@ -1705,6 +2060,8 @@ class AFF4Volume(AFF4Object):
     Returns:
       A generator over the children.
     """
+    FACTORY.FlushIndexes()
+
     direct_child_urns = []
     for entry in data_store.DB.ResolveRegex(self.urn, "index:dir/.*",
                                             token=self.token):
@@ -1764,6 +2121,8 @@ class AFF4Volume(AFF4Object):
     Yields:
       RDFURNs instances of each child.
     """
+    FACTORY.FlushIndexes()
+
     # Just grab all the children from the index.
     index_prefix = "index:dir/"
     for predicate, _, timestamp in data_store.DB.ResolveRegex(
@@ -1773,6 +2132,43 @@ class AFF4Volume(AFF4Object):
       urn.age = rdfvalue.RDFDatetime(timestamp)
       yield urn
 
+  def ListChildSummaries(self, limit=1000000):
+    """Returns the AFF4ObjectSummary of each of our direct children.
+
+    The summaries are read from our own index, so no child is opened unless it
+    was written before summaries were kept. Such children are opened once and
+    their summaries added to the index.
+
+    Args:
+      limit: Total number of children we will attempt to retrieve.
+
+    Returns:
+      A list of AFF4ObjectSummary instances sorted by name.
+    """
+    FACTORY.FlushIndexes()
+
+    index_prefix = "index:summary/"
+    summaries = {}
+    for predicate, value, _ in data_store.DB.ResolveRegex(
+        self.urn, index_prefix + ".+", token=self.token, limit=limit):
+      summaries[utils.SmartStr(predicate[len(index_prefix):])] = (
+          rdfvalue.AFF4ObjectSummary(value))
+
+    missing = [urn for urn in self.ListChildren(limit=limit)
+               if utils.SmartStr(urn.Basename()) not in summaries]
+    if missing:
+      for child in self.OpenChildren(children=missing):
+        # Symlinks are opened as their targets elsewhere in the tree.
+        if rdfvalue.RDFURN(child.urn.Dirname()) != self.urn:
+          continue
+
+        summary = child.GetIndexSummary()
+        summaries[utils.SmartStr(summary.name)] = summary
+        if child.index_summary:
+          FACTORY.index_writer.AddSummary(child.urn, summary, self.token)
+
+    return [summary for _, summary in sorted(summaries.items())]
+
   def OpenChildren(self, children=None, mode="r", limit=1000000,
                    chunk_limit=100000, age=NEWEST_TIME):
     """Yields AFF4 Objects of all our direct children.
@@ -2141,12 +2537,15 @@ class AFF4Image(AFF4Stream):
 
     return fd
 
+  def _LocateChunk(self, offset):
+    """Returns the chunk holding offset, the offset in it and its length."""
+    return offset / self.chunksize, offset % self.chunksize, self.chunksize
+
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
-    chunk = self.offset / self.chunksize
-    chunk_offset = self.offset % self.chunksize
+    chunk, chunk_offset, chunk_length = self._LocateChunk(self.offset)
 
-    available_to_read = min(length, self.chunksize - chunk_offset)
+    available_to_read = min(length, chunk_length - chunk_offset)
 
     retries = 0
     while retries < self.NUM_RETRIES:
@@ -2263,6 +2662,9 @@ class AFF4InitHook(registry.InitHook):
     FACTORY = Factory()  # pylint: disable=g-bad-name
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
 
+    # Queued index updates must reach the data store before it is flushed.
+    atexit.register(FACTORY.FlushIndexes)
+
 
 class AFF4Filter(object):
   """A simple filtering system to be used with Query()."""
@@ -146,6 +146,10 @@ class VFSGRRClient(standard.VFSDirectory):
   # Valid client ids
   CLIENT_ID_RE = re.compile(r"^C\.[0-9a-fA-F]{16}$")
 
+  # The frontend writes the client on every message it receives, a summary in
+  # aff4:/ would make that row a write hot spot.
+  index_summary = False
+
   def Initialize(self):
     # Our URN must be a valid client.id.
     self.client_id = rdfvalue.ClientURN(self.urn)
@@ -283,6 +287,8 @@ class UpdateVFSFile(flow.GRRFlow):
 class VFSFile(aff4.AFF4Image):
   """A VFSFile object."""
 
+  index_summary = True
+
   class SchemaCls(aff4.AFF4Image.SchemaCls):
     """The schema for AFF4 files in the GRR VFS."""
     STAT = standard.VFSDirectory.SchemaCls.STAT
@@ -339,6 +345,8 @@ class MemoryImage(VFSFile):
 class VFSMemoryFile(aff4.AFF4MemoryStream):
   """A VFS file under a VFSDirectory node which does not have storage."""
 
+  index_summary = True
+
   class SchemaCls(aff4.AFF4MemoryStream.SchemaCls):
     """The schema for AFF4 files in the GRR VFS."""
     # Support also VFSFile attributes.
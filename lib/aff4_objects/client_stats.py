@@ -4,13 +4,118 @@
 
 
 from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib.aff4_objects import standard
 
 
+config_lib.DEFINE_integer(
+    "ClientFleetStats.refresh_interval", 3600,
+    "How often (in seconds) the fleet statistics index entry of a client is "
+    "refreshed while the client keeps polling.")
+
+
 class ClientStats(standard.VFSDirectory):
   """A container for all client statistics."""
 
   class SchemaCls(standard.VFSDirectory.SchemaCls):
     STATS = aff4.Attribute("aff4:stats", rdfvalue.ClientStats,
                            "Client Stats.", "Client stats")
+
+
+class ClientFleetStatsIndex(aff4.AFF4Object):
+  """An index of client summaries used to compute fleet statistics.
+
+  Each client has a single cell in this object holding a small ClientSummary,
+  whose timestamp is the last time the client was seen. The fleet statistics
+  crons read this single row instead of opening every client. Cells are blindly
+  overwritten so front ends and workers can update them concurrently.
+  """
+
+  URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStatsIndex")
+  PREFIX = "index:client/"
+
+  def __init__(self, urn, **kwargs):
+    # Never read anything directly from the table by forcing an empty clone.
+    kwargs["clone"] = {}
+    super(ClientFleetStatsIndex, self).__init__(urn, **kwargs)
+
+    # We collect index data here until we flush.
+    self.to_set = {}
+    self.to_delete = set()
+
+  @staticmethod
+  def BuildSummary(client):
+    """Builds the summary we keep for a VFSGRRClient."""
+    summary = rdfvalue.ClientSummary(client_id=client.urn)
+    ping = client.Get(client.Schema.PING)
+    if ping:
+      summary.timestamp = ping
+
+    summary.system_info.system = str(client.Get(client.Schema.SYSTEM, ""))
+    summary.system_info.release = str(client.Get(client.Schema.OS_RELEASE, ""))
+    summary.system_info.version = str(client.Get(client.Schema.OS_VERSION, ""))
+
+    client_info = client.Get(client.Schema.CLIENT_INFO)
+    if client_info:
+      summary.client_info = client_info
+
+    return summary
+
+  @classmethod
+  def ClientSeen(cls, client, previous_ping, token=None):
+    """Refreshes the entry for a client which just contacted us.
+
+    The entry is only written when the client is first seen in a new
+    ClientFleetStats.refresh_interval window, so a polling client causes a
+    bounded number of writes.
+
+    Args:
+      client: The VFSGRRClient with its PING attribute already updated.
+      previous_ping: The PING attribute before it was updated.
+      token: The ACL token to use.
+    """
+    interval = config_lib.CONFIG["ClientFleetStats.refresh_interval"] * 1e6
+    ping = client.Get(client.Schema.PING)
+    if previous_ping and int(previous_ping) // interval == int(ping) // interval:
+      return
+
+    with aff4.FACTORY.Create(cls.URN, "ClientFleetStatsIndex", mode="w",
+                             token=token, force_new_version=False) as index:
+      index.AddClient(cls.BuildSummary(client))
+
+  def AddClient(self, summary):
+    """Adds or replaces the summary for the client summary.client_id."""
+    predicate = self.PREFIX + summary.client_id.Basename()
+    self.to_set[predicate] = summary.SerializeToString()
+    self.to_delete.discard(predicate)
+
+  def RemoveClient(self, client_id):
+    predicate = self.PREFIX + rdfvalue.ClientURN(client_id).Basename()
+    self.to_set.pop(predicate, None)
+    self.to_delete.add(predicate)
+
+  def Flush(self, sync=False):
+    """Flush the data to the index."""
+    super(ClientFleetStatsIndex, self).Flush(sync=sync)
+
+    if self.to_set or self.to_delete:
+      data_store.DB.MultiSet(
+          self.urn, dict((k, [v]) for k, v in self.to_set.iteritems()),
+          to_delete=list(self.to_delete), token=self.token, replace=True,
+          sync=sync)
+
+    self.to_set = {}
+    self.to_delete = set()
+
+  def Close(self, sync=False):
+    self.Flush(sync=sync)
+    super(ClientFleetStatsIndex, self).Close(sync=sync)
+
+  def ListClients(self, limit=10000000):
+    """Yields the ClientSummary of every indexed client."""
+    for _, value, _ in data_store.DB.ResolveRegex(
+        self.urn, self.PREFIX + ".+", token=self.token,
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, limit=limit):
+      yield rdfvalue.ClientSummary(value)
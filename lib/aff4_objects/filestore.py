@@ -5,14 +5,155 @@ Filestore allows for multiple different filestore modules to register URNs
 under aff4:/files to handle new file hash and new file creations.
 """
 
+import hashlib
+import os
+import Queue
+
 import logging
 
 from grr.parsers import fingerprint
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import bloom_filter
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import registry
+from grr.lib import stats
+from grr.lib import threadpool
+from grr.lib import utils
+
+
+class ExistenceFilter(object):
+  """Remembers which blobs and filestore files exist in the data store.
+
+  The filter answers "definitely absent" for most urns we have never stored
+  without a data store round trip, so only possible positives are looked up.
+  Negative answers are only trusted once the filter has been populated from
+  the data store, until then all urns are looked up.
+  """
+
+  def __init__(self, path="", shards=16, shard_size=16 * 1024 * 1024,
+               num_hashes=7):
+    """Constructor.
+
+    Args:
+      path: The directory holding the filter. If empty the filter is disabled
+            and all urns are looked up in the data store.
+      shards: The number of filter shards.
+      shard_size: The size of each shard in bytes.
+      num_hashes: The number of hash functions of the filter.
+    """
+    self.filter = None
+    self.complete = False
+    self.complete_marker = None
+
+    if path:
+      self.filter = bloom_filter.ShardedBloomFilter(
+          path=path, shards=shards, shard_size=shard_size,
+          num_hashes=num_hashes)
+      self.complete_marker = os.path.join(path, "complete")
+
+  def IsComplete(self):
+    """Can we trust negative answers from the filter?"""
+    # Another process may have populated the filter in the meantime.
+    if (not self.complete and self.complete_marker and
+        os.path.exists(self.complete_marker)):
+      self.complete = True
+
+    return self.complete
+
+  def Add(self, urn):
+    if self.filter is not None:
+      self.filter.Add(utils.SmartStr(urn))
+
+  def Populate(self, urns):
+    """Adds all existing urns and starts trusting negative answers."""
+    if self.filter is None:
+      return
+
+    for urn in urns:
+      self.Add(urn)
+
+    self.filter.Flush()
+    open(self.complete_marker, "w").close()
+    self.complete = True
+
+    stats.STATS.SetGaugeValue("filestore_filter_estimated_false_positive_rate",
+                              self.filter.EstimateFalsePositiveRate())
+
+  def FilterAbsent(self, urns):
+    """Drops the urns which definitely do not exist.
+
+    Args:
+      urns: The urns to check.
+
+    Returns:
+      A list of the urns which may exist.
+    """
+    urns = list(urns)
+    if self.filter is None or not self.IsComplete():
+      return urns
+
+    result = [urn for urn in urns if utils.SmartStr(urn) in self.filter]
+
+    stats.STATS.IncrementCounter("filestore_filter_lookups", len(urns))
+    stats.STATS.IncrementCounter("filestore_filter_negatives",
+                                 len(urns) - len(result))
+    return result
+
+  def Stat(self, urns, token=None):
+    """Like aff4.FACTORY.Stat() but skips urns which definitely do not exist."""
+    candidates = self.FilterAbsent(urns)
+
+    found = 0
+    for metadata in aff4.FACTORY.Stat(candidates, token=token):
+      found += 1
+      yield metadata
+
+    if self.filter is not None and self.IsComplete():
+      stats.STATS.IncrementCounter("filestore_filter_false_positives",
+                                   len(candidates) - found)
+
+
+# The existence filter of the blobs and filestore files, set up at init time.
+EXISTENCE_FILTER = ExistenceFilter()
+
+
+class ExistenceFilterInit(registry.InitHook):
+  """Maps the filestore existence filter."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    """Register the filter metrics and map the filter."""
+    stats.STATS.RegisterCounterMetric("filestore_filter_lookups")
+    stats.STATS.RegisterCounterMetric("filestore_filter_negatives")
+    stats.STATS.RegisterCounterMetric("filestore_filter_false_positives")
+    stats.STATS.RegisterGaugeMetric("filestore_filter_size_bytes", int)
+    stats.STATS.RegisterGaugeMetric(
+        "filestore_filter_estimated_false_positive_rate", float)
+
+    global EXISTENCE_FILTER  # pylint: disable=global-statement
+    EXISTENCE_FILTER = ExistenceFilter(
+        path=config_lib.CONFIG["FileStore.existence_filter_path"],
+        shards=config_lib.CONFIG["FileStore.existence_filter_shards"],
+        shard_size=config_lib.CONFIG["FileStore.existence_filter_shard_size"],
+        num_hashes=config_lib.CONFIG["FileStore.existence_filter_hashes"])
+
+    if EXISTENCE_FILTER.filter is not None:
+      stats.STATS.SetGaugeValue("filestore_filter_size_bytes",
+                                EXISTENCE_FILTER.filter.size)
+
+
+class HashFileStoreInit(registry.InitHook):
+  """Registers the hash file store metrics."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("filestore_fingerprinted_files")
+    stats.STATS.RegisterCounterMetric("filestore_deduplicated_files")
 
 
 class FileStoreInit(registry.InitHook):
@@ -105,6 +246,60 @@ class FileStore(aff4.AFF4Volume):
       if new_file:
         files_for_write.append(new_file)
 
+    self._WriteContent(blob_fd, files_for_write, sync=sync)
+
+  def AddFiles(self, blob_fds, sync=False, external=True):
+    """Create a batch of new files in the file store.
+
+    Like AddFile() but each contained implementation is handed the whole batch
+    through its AddBlobImages() method, so it can share work between the files.
+
+    Args:
+      blob_fds: A list of VFSBlobImages open for read/write.
+      sync: Should the files be synced immediately.
+      external: If true, attempt to add files to stores defined as EXTERNAL.
+    """
+    files_for_write = {}
+    for sub_store in self.GetChildrenByPriority(allow_external=external):
+      for blob_fd, new_file in sub_store.AddBlobImages(blob_fds, sync=sync):
+        files_for_write.setdefault(blob_fd, []).append(new_file)
+
+    for blob_fd, new_files in files_for_write.iteritems():
+      try:
+        self._WriteContent(blob_fd, new_files, sync=sync)
+      except IOError as e:
+        logging.error("Unable to write %s to the file store: %s", blob_fd.urn,
+                      e)
+
+  def AddBlobImages(self, blob_fds, sync=False):
+    """Adds a batch of blob images to this store.
+
+    By default the blob images are added one at a time with AddFile(). Blob
+    images which can not be added are logged and skipped.
+
+    Args:
+      blob_fds: A list of VFSBlobImages open for reading.
+      sync: Should the files be synced immediately.
+
+    Returns:
+      A list of (blob_fd, file) tuples for the files which need the content of
+      blob_fd written to them.
+    """
+    result = []
+    for blob_fd in blob_fds:
+      try:
+        new_file = self.AddFile(blob_fd, sync=sync)
+      except IOError as e:
+        logging.error("Unable to add %s to %s: %s", blob_fd.urn, self.urn, e)
+        continue
+
+      if new_file:
+        result.append((blob_fd, new_file))
+
+    return result
+
+  def _WriteContent(self, blob_fd, files_for_write, sync=False):
+    """Copies the content of blob_fd to all the files and closes them."""
     blob_fd.Seek(0)
     while files_for_write:
       # If we got filehandles back, send them the data.
@@ -131,6 +326,7 @@ class HashFileStore(FileStore):
   EXTERNAL = False
   FINGERPRINT_TYPES = ["generic", "pecoff"]
   HASH_TYPES = ["md5", "sha1", "sha256", "SignedData"]
+  FINGERPRINT_THREADS = 10
 
   def CheckHashes(self, hashes, hash_type="sha256"):
     """Check hashes against the filestore.
@@ -151,7 +347,7 @@ class HashFileStore(FileStore):
       hash_map[aff4.ROOT_URN.Add("files/hash/generic").Add(hash_type).Add(
           str(digest))] = digest
 
-    for metadata in aff4.FACTORY.Stat(list(hash_map), token=self.token):
+    for metadata in EXISTENCE_FILTER.Stat(list(hash_map), token=self.token):
       yield metadata["urn"], hash_map[metadata["urn"]]
 
   def AddFile(self, blob_fd, sync=False):
@@ -177,25 +373,182 @@ class HashFileStore(FileStore):
     buffer sizes because the authenticode hashes need to track hashing of
     different-sized regions based on the signature information.
 
+    Errors are logged rather than raised, see AddBlobImages().
+
     Args:
       blob_fd: VFSBlobImage open for reading.
       sync: Should the file be synced immediately.
+    """
+    self.AddBlobImages([blob_fd], sync=sync)
+
+    # We do not want to be externally written here.
+    return None
+
+  def AddBlobImages(self, blob_fds, sync=False):
+    """Adds a batch of blob images to the store, see AddFile().
+
+    Blob images are grouped by their chunk index, which lists the hashes of
+    their blobs, so each distinct content is only read once. Unlike the hashes
+    reported by the client, the blob hashes are calculated by the server and
+    can be trusted. If the sha256 reported by the client names a file in the
+    store with the same chunk index, we reuse its hashes without reading the
+    content at all. The remaining contents are fingerprinted in parallel and
+    the index entries of all the blob images of a file are written with a
+    single MultiSet().
+
+    Files which are not VFSBlobImages or can not be added are logged and
+    skipped, the rest of the batch is still added.
+
+    Args:
+      blob_fds: A list of VFSBlobImages open for reading.
+      sync: Should the files be synced immediately.
+
+    Returns:
+      An empty list, since we do not want to be externally written.
+    """
+    groups = {}
+    for blob_fd in blob_fds:
+      if not isinstance(blob_fd, aff4.VFSBlobImage):
+        logging.error("Only adding VFSBlobImage to file store supported, "
+                      "skipping %s.", blob_fd.urn)
+        continue
+
+      groups.setdefault(self._GetContentKey(blob_fd), []).append(blob_fd)
+
+    stored_hashes = self._GetStoredHashes(groups)
+    unknown = dict((key, group[0]) for key, group in groups.iteritems()
+                   if key not in stored_hashes)
+    new_hashes = self._FingerprintAll(unknown)
+
+    stats.STATS.IncrementCounter("filestore_fingerprinted_files", len(unknown))
+    stats.STATS.IncrementCounter("filestore_deduplicated_files",
+                                 len(blob_fds) - len(unknown))
 
-    Raises:
-      IOError: If there was an error writing the file.
+    for key, group in groups.iteritems():
+      hashes = stored_hashes.get(key) or new_hashes.get(key)
+      if hashes is None:
+        continue
+
+      try:
+        self._AddGroup(group, hashes, key not in stored_hashes, sync=sync)
+      except IOError as e:
+        logging.error("Unable to add %s to the file store: %s",
+                      [str(blob_fd.urn) for blob_fd in group], e)
+
+    return []
+
+  def _AddGroup(self, group, hashes, create, sync=False):
+    """Indexes blob images with the same content under their hashes.
+
+    Args:
+      group: A list of VFSBlobImages with the same content.
+      hashes: The hashes of the content.
+      create: If True, the files in the store are created from the first blob
+              image, otherwise they already exist.
+      sync: Should the files be synced immediately.
     """
-    if not isinstance(blob_fd, aff4.VFSBlobImage):
-      raise IOError("Only adding VFSBlobImage to file store supported.")
+    targets = [blob_fd.urn for blob_fd in group]
+    for file_store_urn in self._GetFileStoreUrns(hashes):
+      if create:
+        # These files are all created through async write so they should be
+        # fast.
+        file_store_fd = aff4.FACTORY.Create(file_store_urn, "FileStoreImage",
+                                            mode="w", token=self.token)
+        file_store_fd.FromBlobImage(group[0])
+        file_store_fd.Set(hashes)
+        file_store_fd.Close(sync=sync)
+        EXISTENCE_FILTER.Add(file_store_urn)
+
+      FileStoreImage.AddIndexes(file_store_urn, targets, token=self.token)
+
+    for blob_fd in group:
+      blob_fd.Set(hashes)
+
+  @staticmethod
+  def _GetContentKey(blob_fd):
+    """Identifies the content of a blob image without reading it."""
+    return hashlib.sha256("%d:%s" % (blob_fd.size,
+                                     blob_fd.index.getvalue())).digest()
+
+  def _GetStoredHashes(self, groups):
+    """Finds the files in the store which have the content of the blob images.
 
-    # Currently we only handle blob images.
+    Args:
+      groups: A dict mapping content keys to lists of blob images with this
+              content.
+
+    Returns:
+      A dict mapping content keys to the hashes of the stored file with this
+      content.
+    """
+    candidates = {}
+    for key, group in groups.iteritems():
+      for blob_fd in group:
+        client_hash = blob_fd.Get(blob_fd.Schema.HASH)
+        if client_hash and client_hash.HasField("sha256"):
+          urn = self.PATH.Add("generic/sha256").Add(str(client_hash.sha256))
+          candidates.setdefault(urn, set()).add(key)
+
+    existing = [metadata["urn"] for metadata in EXISTENCE_FILTER.Stat(
+        list(candidates), token=self.token)]
+
+    result = {}
+    for fd in aff4.FACTORY.MultiOpen(existing, mode="r", token=self.token):
+      key = self._GetContentKey(fd)
+      hashes = fd.Get(fd.Schema.HASH)
+      if key in candidates[fd.urn] and hashes and hashes.HasField("sha256"):
+        result[key] = hashes
+
+    return result
+
+  def _FingerprintAll(self, blob_fds):
+    """Fingerprints blob images in parallel.
+
+    Args:
+      blob_fds: A dict mapping content keys to blob images.
+
+    Returns:
+      A dict mapping content keys to the hashes of the content. Blob images
+      which could not be fingerprinted are left out.
+    """
+    if not blob_fds:
+      return {}
+
+    pool = threadpool.ThreadPool.Factory("filestore_fingerprinter",
+                                         self.FINGERPRINT_THREADS)
+    pool.Start()
+
+    results = Queue.Queue()
+    for key, blob_fd in blob_fds.iteritems():
+      # If the pool is busy the task runs inline so we always make progress.
+      pool.AddTask(target=self._FingerprintInto, args=(key, blob_fd, results),
+                   name="Fingerprint")
+
+    hashes = {}
+    for _ in blob_fds:
+      key, result = results.get()
+      if result is not None:
+        hashes[key] = result
+
+    return hashes
+
+  def _FingerprintInto(self, key, blob_fd, results):
+    """Fingerprints a blob image and puts the result on the results queue."""
+    hashes = None
+    try:
+      hashes = self._Fingerprint(blob_fd)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Unable to fingerprint %s: %s", blob_fd.urn, e)
+
+    results.put((key, hashes))
+
+  def _Fingerprint(self, blob_fd):
+    """Reads the content of a blob image and returns its hashes."""
     fingerprinter = fingerprint.Fingerprinter(blob_fd)
     fingerprinter.EvalGeneric()
     fingerprinter.EvalPecoff()
 
     hashes = blob_fd.Schema.HASH()
-    signed_data = None
-    file_store_files = []
-
     for result in fingerprinter.HashIt():
       fingerprint_type = result["name"]
       for hash_type in self.HASH_TYPES:
@@ -210,7 +563,6 @@ class HashFileStore(FileStore):
                                       certificate=signed_data[2])
           continue
 
-        # Set the hashes in the original object
         if fingerprint_type == "generic":
           hashes.Set(hash_type, result[hash_type])
 
@@ -220,28 +572,19 @@ class HashFileStore(FileStore):
         else:
           logging.error("Unknown fingerprint_type %s.", fingerprint_type)
 
-        # These files are all created through async write so they should be
-        # fast.
-        hash_digest = result[hash_type].encode("hex")
-        file_store_urn = self.PATH.Add(fingerprint_type).Add(
-            hash_type).Add(hash_digest)
-
-        file_store_fd = aff4.FACTORY.Create(file_store_urn, "FileStoreImage",
-                                            mode="w", token=self.token)
-        file_store_fd.FromBlobImage(blob_fd)
-        file_store_fd.AddIndex(blob_fd.urn)
-
-        file_store_files.append(file_store_fd)
-
-    # Write the hashes attribute to all the created files..
-    for fd in file_store_files:
-      fd.Set(hashes)
-      fd.Close(sync=sync)
+    return hashes
 
-    blob_fd.Set(hashes)
+  def _GetFileStoreUrns(self, hashes):
+    """Yields the urns of the files in the store named after the hashes."""
+    for fingerprint_type, prefix in (("generic", ""), ("pecoff", "pecoff_")):
+      for hash_type in self.HASH_TYPES:
+        if hash_type == "SignedData":
+          continue
 
-    # We do not want to be externally written here.
-    return None
+        field_name = prefix + hash_type
+        if hashes.HasField(field_name):
+          yield self.PATH.Add(fingerprint_type).Add(hash_type).Add(
+              str(hashes.Get(field_name)))
 
   @staticmethod
   def ListHashes(token=None):
@@ -323,9 +666,14 @@ class FileStoreImage(aff4.VFSBlobImage):
 
   def AddIndex(self, target):
     """Adds an indexed reference to the target URN."""
-    predicate = ("index:target:%s" % target).lower()
-    data_store.DB.MultiSet(self.urn, {predicate: target}, token=self.token,
-                           replace=True, sync=False)
+    self.AddIndexes(self.urn, [target], token=self.token)
+
+  @staticmethod
+  def AddIndexes(urn, targets, token=None):
+    """Adds indexed references to all the targets with a single MultiSet."""
+    values = dict((("index:target:%s" % target).lower(), target)
+                  for target in targets)
+    data_store.DB.MultiSet(urn, values, token=token, replace=True, sync=False)
 
   def Query(self, target_regex=".", limit=100):
     """Search the index for matches to the file specified by the regex.
@@ -8,6 +8,7 @@ import StringIO
 from grr.lib import aff4
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib.aff4_objects import filestore
 
@@ -99,7 +100,7 @@ class HashFileStoreTest(test_lib.GRRBaseTest):
     client_ids = self.SetupClients(1)
     self.client_id = client_ids[0]
 
-  def AddFileToFileStore(self, path):
+  def DownloadFile(self, path):
     pathspec = rdfvalue.PathSpec(
         pathtype=rdfvalue.PathSpec.PathType.OS,
         path=os.path.join(self.base_path, "winexec_img.dd"))
@@ -113,14 +114,35 @@ class HashFileStoreTest(test_lib.GRRBaseTest):
         client_id=self.client_id, pathspec=pathspec):
       pass
 
+    return urn
+
+  def CopyBlobImage(self, src_urn, path, copy_hash=True):
+    src_fd = aff4.FACTORY.Open(src_urn, token=self.token)
+    urn = self.client_id.Add("fs/os").Add(path)
+    with aff4.FACTORY.Create(urn, "VFSBlobImage", mode="w",
+                             token=self.token) as fd:
+      fd.FromBlobImage(src_fd)
+      if copy_hash:
+        fd.Set(src_fd.Get(src_fd.Schema.HASH))
+
+    return urn
+
+  def PublishAddFileEvents(self, urns):
     auth_state = rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED
-    flow.Events.PublishEvent(
-        "FileStore.AddFileToStore",
-        rdfvalue.GrrMessage(payload=urn, auth_state=auth_state),
-        token=self.token)
+    for urn in urns:
+      flow.Events.PublishEvent(
+          "FileStore.AddFileToStore",
+          rdfvalue.GrrMessage(payload=urn, auth_state=auth_state),
+          token=self.token)
+
     worker = test_lib.MockWorker(token=self.token)
     worker.Simulate()
 
+  def AddFileToFileStore(self, path):
+    urn = self.DownloadFile(path)
+    self.PublishAddFileEvents([urn])
+    return urn
+
   def testListHashes(self):
     self.AddFileToFileStore("/Ext2IFS_1_10b.exe")
     hashes = list(aff4.HashFileStore.ListHashes(token=self.token))
@@ -171,3 +193,105 @@ class HashFileStoreTest(test_lib.GRRBaseTest):
         "fs/tsk").Add(self.base_path).Add("winexec_img.dd/Ext2IFS_1_10b.exe")])
     self.assertListEqual(hits[hash2], [self.client_id.Add(
         "fs/tsk").Add(self.base_path).Add("winexec_img.dd/idea.dll")])
+
+
+  def testAddFilesFingerprintsContentOnce(self):
+    urn = self.DownloadFile("/Ext2IFS_1_10b.exe")
+    copies = [self.CopyBlobImage(urn, "copy%d.exe" % i, copy_hash=False)
+              for i in range(3)]
+
+    fingerprinted = stats.STATS.GetMetricValue("filestore_fingerprinted_files")
+    fs = aff4.FACTORY.Open(filestore.FileStore.PATH, "FileStore",
+                           token=self.token)
+    blob_fds = list(aff4.FACTORY.MultiOpen(copies, mode="rw",
+                                           token=self.token))
+    fs.AddFiles(blob_fds)
+    for blob_fd in blob_fds:
+      blob_fd.Close()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_fingerprinted_files"),
+        fingerprinted + 1)
+
+    pecoff_sha1 = rdfvalue.FileStoreHash(
+        fingerprint_type="pecoff", hash_type="sha1",
+        hash_value="019bddad9cac09f37f3941a7f285c79d3c7e7801")
+    hits = list(aff4.HashFileStore.GetHitsForHash(pecoff_sha1,
+                                                  token=self.token))
+    self.assertItemsEqual(hits, copies)
+
+    for copy_urn in copies:
+      fd = aff4.FACTORY.Open(copy_urn, token=self.token)
+      self.assertEqual(str(fd.Get(fd.Schema.HASH).md5),
+                       "bb0a15eefe63fd41f8dc9dee01c5cf9a")
+
+  def testAddFilesSkipsBadFiles(self):
+    urn = self.DownloadFile("/Ext2IFS_1_10b.exe")
+    copy_urn = self.CopyBlobImage(urn, "copy.exe", copy_hash=False)
+
+    # Not a blob image, so it can not be added.
+    bad_urn = self.client_id.Add("fs/os/bad.exe")
+    aff4.FACTORY.Create(bad_urn, "VFSFile", token=self.token).Close()
+
+    self.PublishAddFileEvents([bad_urn, copy_urn])
+
+    hits = list(aff4.HashFileStore.GetHitsForHash(rdfvalue.FileStoreHash(
+        fingerprint_type="generic", hash_type="md5",
+        hash_value="bb0a15eefe63fd41f8dc9dee01c5cf9a"), token=self.token))
+    self.assertItemsEqual(hits, [copy_urn])
+
+  def testAddFileReusesStoredHashes(self):
+    urn = self.AddFileToFileStore("/Ext2IFS_1_10b.exe")
+    copy_urn = self.CopyBlobImage(urn, "copy.exe")
+
+    fingerprinted = stats.STATS.GetMetricValue("filestore_fingerprinted_files")
+    self.PublishAddFileEvents([copy_urn])
+
+    # The content is already in the store so it is not read again.
+    self.assertEqual(
+        stats.STATS.GetMetricValue("filestore_fingerprinted_files"),
+        fingerprinted)
+
+    hits = list(aff4.HashFileStore.GetHitsForHash(rdfvalue.FileStoreHash(
+        fingerprint_type="generic", hash_type="md5",
+        hash_value="bb0a15eefe63fd41f8dc9dee01c5cf9a"), token=self.token))
+    self.assertItemsEqual(hits, [urn, copy_urn])
+
+
+class ExistenceFilterTest(test_lib.GRRBaseTest):
+  """Tests for the filestore existence filter."""
+
+  def testExistenceFilter(self):
+    path = os.path.join(self.temp_dir, "existence_filter")
+    existing = [rdfvalue.RDFURN("aff4:/blobs/%064x" % i) for i in range(100)]
+    missing = [rdfvalue.RDFURN("aff4:/blobs/%064x" % i)
+               for i in range(100, 200)]
+
+    existence_filter = filestore.ExistenceFilter(
+        path=path, shards=4, shard_size=4096, num_hashes=5)
+
+    # Before the filter is populated every urn may exist.
+    self.assertEqual(existence_filter.FilterAbsent(existing + missing),
+                     existing + missing)
+
+    existence_filter.Populate(existing[:50])
+    for urn in existing[50:]:
+      existence_filter.Add(urn)
+
+    # There are no false negatives, and few false positives.
+    candidates = existence_filter.FilterAbsent(existing + missing)
+    self.assertEqual(candidates[:100], existing)
+    self.assertLess(len(candidates), 110)
+
+    # The filter is persistent and shared with other instances.
+    other_filter = filestore.ExistenceFilter(
+        path=path, shards=4, shard_size=4096, num_hashes=5)
+    self.assertTrue(other_filter.IsComplete())
+    self.assertEqual(other_filter.FilterAbsent(existing), existing)
+
+  def testDisabledExistenceFilter(self):
+    existence_filter = filestore.ExistenceFilter()
+    urns = [rdfvalue.RDFURN("aff4:/blobs/%064x" % i) for i in range(10)]
+    existence_filter.Populate(urns[:5])
+
+    self.assertEqual(existence_filter.FilterAbsent(urns), urns)
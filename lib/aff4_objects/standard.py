@@ -2,8 +2,10 @@
 """These are standard aff4 objects."""
 
 
+import bisect
 import hashlib
 import StringIO
+import struct
 
 from grr.lib import aff4
 from grr.lib import data_store
@@ -19,6 +21,9 @@ class VFSDirectory(aff4.AFF4Volume):
   # We contain other objects within the tree.
   _behaviours = frozenset(["Container"])
 
+  # Keep a summary in the parent so the tree lists us without opening us.
+  index_summary = True
+
   def Update(self, attribute=None, priority=None):
     """Refresh an old attribute.
 
@@ -111,6 +116,10 @@ class BlobImage(aff4.AFF4Image):
 
   The hash stream is kept within an AFF4 Attribute, instead of another stream
   making it more efficient for smaller files.
+
+  Normally all chunks but the last are chunksize long. Images using variable
+  chunks (e.g. split at content defined boundaries) also keep the end offset
+  of every chunk, and their chunks may differ in size.
   """
   # Size of a sha256 hash
   _HASH_SIZE = 32
@@ -121,6 +130,8 @@ class BlobImage(aff4.AFF4Image):
   def Initialize(self):
     super(BlobImage, self).Initialize()
     self.content_dirty = False
+    # The end offsets of the chunks, or None if they are all chunksize long.
+    self.chunk_ends = None
     if self.mode == "w":
       self.index = StringIO.StringIO("")
       self.finalized = False
@@ -128,12 +139,43 @@ class BlobImage(aff4.AFF4Image):
       self.index = StringIO.StringIO(self.Get(self.Schema.HASHES, ""))
       self.finalized = self.Get(self.Schema.FINALIZED, False)
 
+      # Images with fixed size chunks store no chunk ends.
+      chunk_ends = str(self.Get(self.Schema.CHUNK_ENDS, ""))
+      if chunk_ends:
+        self.chunk_ends = self._UnpackChunkEnds(chunk_ends)
+
+  @staticmethod
+  def _UnpackChunkEnds(packed):
+    return list(struct.unpack("<%dQ" % (len(packed) / 8), packed))
+
+  def UseVariableChunks(self):
+    """Allows adding blobs of any size.
+
+    Must be called before any blobs are added.
+    """
+    self.chunk_ends = []
+    self.content_dirty = True
+
   def Truncate(self, offset=0):
     if offset != 0:
       raise IOError("Non-zero truncation not supported for BlobImage")
     super(BlobImage, self).Truncate(0)
     self.index = StringIO.StringIO("")
     self.finalized = False
+    if self.chunk_ends is not None:
+      self.chunk_ends = []
+
+  def _LocateChunk(self, offset):
+    if self.chunk_ends is None:
+      return super(BlobImage, self)._LocateChunk(offset)
+
+    chunk = bisect.bisect_right(self.chunk_ends, offset)
+    if chunk >= len(self.chunk_ends):
+      raise IOError("Offset %d is past the last chunk." % offset)
+
+    chunk_start = self.chunk_ends[chunk - 1] if chunk else 0
+    return (chunk, offset - chunk_start,
+            self.chunk_ends[chunk] - chunk_start)
 
   def _GetChunkForWriting(self, chunk):
     """Chunks must be added using the AddBlob() method."""
@@ -178,12 +220,20 @@ class BlobImage(aff4.AFF4Image):
     self.SetChunksize(fd.chunksize)
     self.index = StringIO.StringIO(fd.index.getvalue())
     self.size = fd.size
+    self.chunk_ends = None
+    if fd.chunk_ends is not None:
+      self.chunk_ends = list(fd.chunk_ends)
 
   def Flush(self, sync=True):
     if self.content_dirty:
       self.Set(self.Schema.SIZE(self.size))
       self.Set(self.Schema.HASHES(self.index.getvalue()))
       self.Set(self.Schema.FINALIZED(self.finalized))
+      # Always written, since blind writes do not remove the chunk ends of
+      # variable chunked content this image may replace.
+      chunk_ends = self.chunk_ends or []
+      self.Set(self.Schema.CHUNK_ENDS(struct.pack(
+          "<%dQ" % len(chunk_ends), *chunk_ends)))
     super(BlobImage, self).Flush(sync)
 
   def AppendContent(self, src_fd):
@@ -198,6 +248,11 @@ class BlobImage(aff4.AFF4Image):
     Raises:
       IOError: if blob has already been finalized.
     """
+    # The filestore module subclasses objects defined after this module.
+    # pylint: disable=g-import-not-at-top
+    from grr.lib.aff4_objects import filestore
+    # pylint: enable=g-import-not-at-top
+
     while 1:
       blob = src_fd.read(self.chunksize)
       if not blob:
@@ -213,6 +268,7 @@ class BlobImage(aff4.AFF4Image):
                                  token=self.token)
         fd.Write(blob)
         fd.Close(sync=True)
+        filestore.EXISTENCE_FILTER.Add(blob_urn)
 
       self.AddBlob(blob_hash, len(blob))
 
@@ -223,6 +279,7 @@ class BlobImage(aff4.AFF4Image):
 
     Once a blob is added that is smaller than the chunksize we finalize the
     file, since handling adding more blobs makes the code much more complex.
+    Images using variable chunks are not finalized.
 
     Args:
       blob_hash: sha256 binary digest
@@ -238,7 +295,9 @@ class BlobImage(aff4.AFF4Image):
     self.index.write(blob_hash)
     self.size += length
 
-    if length < self.chunksize:
+    if self.chunk_ends is not None:
+      self.chunk_ends.append(self.size)
+    elif length < self.chunksize:
       self.finalized = True
 
   class SchemaCls(aff4.AFF4Image.SchemaCls):
@@ -257,6 +316,10 @@ class BlobImage(aff4.AFF4Image):
                                "Once a blobimage is finalized, further writes"
                                " will raise exceptions.")
 
+    CHUNK_ENDS = aff4.Attribute("aff4:chunk_ends", rdfvalue.RDFBytes,
+                                "The end offsets of variable sized chunks, "
+                                "packed as little endian uint64s.")
+
 
 class HashImage(aff4.AFF4Image):
   """An AFF4 Image which refers to chunks by their hash.
@@ -435,6 +498,7 @@ class AFF4Index(aff4.AFF4Object):
       length = limit
 
     # Get all the hits
+    aff4.FACTORY.FlushIndexes()
 
     index_hits = set()
     for col, _, _ in data_store.DB.ResolveRegex(
@@ -454,6 +518,7 @@ class AFF4Index(aff4.AFF4Object):
     return hits
 
   def _QueryRaw(self, regex):
+    aff4.FACTORY.FlushIndexes()
     return set([(x, y) for (y, x, _) in data_store.DB.ResolveRegex(
         self.urn, regex, token=self.token,
         timestamp=data_store.DB.ALL_TIMESTAMPS)])
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 """Tests for grr.lib.aff4_objects.standard."""
 
+import hashlib
 import StringIO
 
 
 from grr.lib import aff4
 from grr.lib import test_lib
+from grr.lib.aff4_objects import filestore
 
 
 class BlobImageTest(test_lib.GRRBaseTest):
@@ -25,6 +27,18 @@ class BlobImageTest(test_lib.GRRBaseTest):
     src_fd.seek(0)
     self.assertRaises(IOError, dest_fd.AppendContent, src_fd)
 
+  def testAppendContentAddsBlobsToExistenceFilter(self):
+    added = []
+    with test_lib.Stubber(filestore.EXISTENCE_FILTER, "Add", added.append):
+      dest_fd = aff4.FACTORY.Create(aff4.ROOT_URN.Add("temp"),
+                                    "BlobImage", token=self.token, mode="rw")
+      dest_fd.SetChunksize(7)
+      dest_fd.AppendContent(StringIO.StringIO("ABCDEFG" * 2 + "HIJ"))
+
+    self.assertEqual(added, [
+        aff4.ROOT_URN.Add("blobs").Add(hashlib.sha256(x).hexdigest())
+        for x in ["ABCDEFG", "HIJ"]])
+
   def testAppendContent(self):
     """Test writing content where content length % chunksize == 0."""
     src_content = "ABCDEFG" * 10  # 10 chunksize blobs
@@ -51,6 +65,31 @@ class BlobImageTest(test_lib.GRRBaseTest):
     dest_fd.Seek(0)
     self.assertEqual(dest_fd.Read(5000), src_content+src_content)
 
+  def testRewriteVariableChunksWithFixedChunks(self):
+    """Test that fixed size chunks replace previous variable chunk ends."""
+    urn = aff4.ROOT_URN.Add("temp")
+    src_content = "ABCDEFG" * 10
+
+    dest_fd = aff4.FACTORY.Create(urn, "BlobImage", token=self.token,
+                                  mode="w")
+    dest_fd.SetChunksize(3)
+    dest_fd.UseVariableChunks()
+    dest_fd.AppendContent(StringIO.StringIO(src_content))
+    dest_fd.Close()
+
+    dest_fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual(dest_fd.Read(5000), src_content)
+
+    dest_fd = aff4.FACTORY.Create(urn, "BlobImage", token=self.token,
+                                  mode="w")
+    dest_fd.SetChunksize(7)
+    dest_fd.AppendContent(StringIO.StringIO(src_content[::-1]))
+    dest_fd.Close()
+
+    dest_fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual(dest_fd.chunk_ends, None)
+    self.assertEqual(dest_fd.Read(5000), src_content[::-1])
+
 
 class IndexTest(test_lib.AFF4ObjectTest):
 
@@ -15,6 +15,7 @@ from grr.lib.aff4_objects import tests
 
 from grr.lib import aff4
 from grr.lib import config_lib
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
@@ -678,6 +679,29 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertListEqual(sorted([x.urn for x in all_children]),
                          [root_urn.Add("some1"), root_urn.Add("some2")])
 
+  def testMultiOpenInParallelChunks(self):
+    root_urn = aff4.ROOT_URN.Add("path")
+    urns = [root_urn.Add("some%d" % i) for i in range(10)]
+    for urn in urns:
+      aff4.FACTORY.Create(urn, "AFF4Volume", token=self.token).Close()
+
+    # Make one of them a symlink to the first object.
+    with aff4.FACTORY.Create(root_urn.Add("link"), "AFF4Symlink",
+                             token=self.token) as symlink:
+      symlink.Set(symlink.Schema.SYMLINK_TARGET(urns[0]))
+
+    config_lib.CONFIG.Set("AFF4.multi_open_chunk_size", 3)
+    try:
+      all_children = list(aff4.FACTORY.MultiOpen(
+          urns + [root_urn.Add("link")], mode="r", token=self.token))
+    finally:
+      config_lib.CONFIG.Set("AFF4.multi_open_chunk_size", 1000)
+
+    self.assertEqual(sorted(x.urn for x in all_children),
+                     sorted(urns + [urns[0]]))
+    for child in all_children:
+      self.assertTrue(isinstance(child, aff4.AFF4Volume))
+
   def testListChildren(self):
     root_urn = aff4.ROOT_URN.Add("path")
 
@@ -695,6 +719,120 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertListEqual(sorted(all_children),
                          [root_urn.Add("some1"), root_urn.Add("some2")])
 
+  def testListChildSummaries(self):
+    root_urn = aff4.ROOT_URN.Add("summaries")
+
+    fd = aff4.FACTORY.Create(root_urn.Add("dir"), "VFSDirectory",
+                             token=self.token)
+    fd.Close()
+
+    fd = aff4.FACTORY.Create(root_urn.Add("file"), "VFSFile", mode="w",
+                             token=self.token)
+    fd.Set(fd.Schema.STAT(rdfvalue.StatEntry(st_size=100, st_mtime=1000)))
+    fd.Close()
+
+    # Objects without summaries are opened when listed.
+    fd = aff4.FACTORY.Create(root_urn.Add("volume"), "AFF4Volume",
+                             token=self.token)
+    fd.Close()
+
+    root = aff4.FACTORY.Open(root_urn, token=self.token)
+    summaries = root.ListChildSummaries()
+
+    self.assertEqual([x.name for x in summaries], ["dir", "file", "volume"])
+    self.assertEqual([x.has_children for x in summaries], [True, False, True])
+    self.assertEqual(summaries[1].aff4_type, "VFSFile")
+    self.assertEqual(summaries[1].size, 100)
+    self.assertEqual(summaries[1].mtime.AsSecondsFromEpoch(), 1000)
+
+    # The summaries are read from the directory's index.
+    aff4.FACTORY.FlushIndexes()
+    self.assertEqual(len(list(data_store.DB.ResolveRegex(
+        root_urn, "index:summary/.+", token=self.token))), 2)
+
+    # Deleting a child removes its summary.
+    aff4.FACTORY.Delete(root_urn.Add("file"), token=self.token)
+    root = aff4.FACTORY.Open(root_urn, token=self.token)
+    self.assertEqual([x.name for x in root.ListChildSummaries()],
+                     ["dir", "volume"])
+
+  def testBlindWritesKeepTheStoredSummary(self):
+    root_urn = aff4.ROOT_URN.Add("blind_summaries")
+
+    fd = aff4.FACTORY.Create(root_urn.Add("dir"), "VFSDirectory",
+                             token=self.token)
+    fd.Set(fd.Schema.STAT(rdfvalue.StatEntry(st_mtime=1000)))
+    fd.Close()
+    aff4.FACTORY.FlushIndexes()
+
+    # A blind write of a new version which does not know the stat.
+    fd = aff4.FACTORY.Create(root_urn.Add("dir"), "VFSDirectory", mode="w",
+                             token=self.token)
+    fd.Close()
+
+    root = aff4.FACTORY.Open(root_urn, token=self.token)
+    summaries = root.ListChildSummaries()
+    self.assertEqual([x.name for x in summaries], ["dir"])
+    self.assertEqual(summaries[0].mtime.AsSecondsFromEpoch(), 1000)
+
+  def testClientsDoNotKeepSummaries(self):
+    client = aff4.FACTORY.Create("C.%016X" % 0, "VFSGRRClient",
+                                 token=self.token)
+    client.Close()
+    aff4.FACTORY.FlushIndexes()
+
+    self.assertEqual(list(data_store.DB.ResolveRegex(
+        aff4.ROOT_URN, "index:summary/.+", token=self.token)), [])
+
+  def testChildIndexIsWrittenInBatches(self):
+    root_urn = aff4.ROOT_URN.Add("batched")
+
+    # Do not let the background thread write the indexes for us.
+    aff4.FACTORY.FlushIndexes()
+    with aff4.FACTORY.index_writer.flush_lock:
+      for i in range(5):
+        f = aff4.FACTORY.Create(root_urn.Add("dir").Add("some%d" % i),
+                                "AFF4Volume", token=self.token)
+        f.Close()
+
+      # Nothing has been written to the directory index yet and the shared
+      # path components were only queued once.
+      self.assertEqual(list(data_store.DB.ResolveRegex(
+          root_urn.Add("dir"), "index:dir/.+", token=self.token)), [])
+      self.assertEqual(aff4.FACTORY.index_writer.pending, 7)
+
+    # Listing children is a read-after-write barrier.
+    root = aff4.FACTORY.Open(root_urn.Add("dir"), token=self.token)
+    self.assertListEqual(sorted(root.ListChildren()),
+                         [root_urn.Add("dir").Add("some%d" % i)
+                          for i in range(5)])
+    self.assertEqual(aff4.FACTORY.index_writer.pending, 0)
+
+  def testFailedIndexWritesAreRetried(self):
+    root_urn = aff4.ROOT_URN.Add("retried")
+    index_writer = aff4.FACTORY.index_writer
+
+    def Fail(*_):
+      raise IOError("Data store unavailable.")
+
+    aff4.FACTORY.FlushIndexes()
+    with index_writer.flush_lock:
+      for i in range(3):
+        aff4.FACTORY.Create(root_urn.Add("some%d" % i), "AFF4Volume",
+                            token=self.token).Close()
+
+      # The background flush logs the error and keeps the updates queued.
+      with test_lib.Stubber(index_writer, "_WriteChildIndexes", Fail):
+        index_writer._PeriodicFlush()
+
+      self.assertEqual(index_writer.pending, 4)
+      self.assertTrue(index_writer.flusher_thread.is_alive())
+
+    root = aff4.FACTORY.Open(root_urn, token=self.token)
+    self.assertListEqual(sorted(root.ListChildren()),
+                         [root_urn.Add("some%d" % i) for i in range(3)])
+    self.assertEqual(index_writer.pending, 0)
+
   def testMultiListChildren(self):
     client1 = "C.%016X" % 0
     client2 = "C.%016X" % 1
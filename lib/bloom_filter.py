@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Persistent, memory mapped Bloom filters.
+
+A Bloom filter answers set membership queries with no false negatives and a
+tunable rate of false positives, using a small fixed amount of memory. The bits
+are kept in memory mapped files so all the processes on a host which map the
+same files share the filter, and it survives restarts.
+"""
+
+
+import binascii
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+
+class BloomFilter(object):
+  """A Bloom filter backed by a memory mapped file.
+
+  Members can not be removed. Setting bits is a read-modify-write of a byte so
+  two processes adding members at the same time may rarely lose a bit. Callers
+  must therefore treat a negative answer as a hint which is only ever wrong in
+  the expensive direction (i.e. the member is looked up elsewhere).
+  """
+
+  def __init__(self, path=None, size=16 * 1024 * 1024, num_hashes=7):
+    """Constructor.
+
+    Args:
+      path: The file holding the bits. If None the bits are kept in anonymous
+            memory and are lost when the process exits.
+      size: The size of the filter in bytes.
+      num_hashes: The number of bits set for each member.
+    """
+    self.size = size
+    self.num_bits = size * 8
+    self.num_hashes = num_hashes
+    self.lock = threading.Lock()
+
+    if path is None:
+      self.bits = mmap.mmap(-1, size)
+    else:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+      try:
+        if os.fstat(fd).st_size < size:
+          os.ftruncate(fd, size)
+
+        self.bits = mmap.mmap(fd, size)
+      finally:
+        os.close(fd)
+
+  def _Positions(self, key):
+    """Yields the bit positions of key.
+
+    We derive all the positions from a single digest by double hashing, see
+    Kirsch and Mitzenmacher, "Less Hashing, Same Performance".
+
+    Args:
+      key: The string to hash.
+    """
+    h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+    for i in xrange(self.num_hashes):
+      yield (h1 + i * h2) % self.num_bits
+
+  def Add(self, key):
+    with self.lock:
+      for position in self._Positions(key):
+        index = position >> 3
+        self.bits[index] = chr(ord(self.bits[index]) | (1 << (position & 7)))
+
+  def __contains__(self, key):
+    for position in self._Positions(key):
+      if not ord(self.bits[position >> 3]) & (1 << (position & 7)):
+        return False
+
+    return True
+
+  def CountSetBits(self, block_size=64 * 1024):
+    """Returns the number of bits set in the filter."""
+    count = 0
+    for offset in xrange(0, self.size, block_size):
+      block = self.bits[offset:offset + block_size]
+      count += bin(int(binascii.hexlify(block), 16)).count("1")
+
+    return count
+
+  def Flush(self):
+    self.bits.flush()
+
+  def Close(self):
+    self.bits.close()
+
+
+class ShardedBloomFilter(object):
+  """A Bloom filter split into several independently locked shards.
+
+  Every key is routed to a single shard, so concurrent writers mostly contend on
+  different locks, and each shard maps a modestly sized file.
+  """
+
+  def __init__(self, path=None, shards=16, shard_size=16 * 1024 * 1024,
+               num_hashes=7):
+    """Constructor.
+
+    Args:
+      path: The directory holding one file per shard. If None the filter is
+            kept in memory.
+      shards: The number of shards.
+      shard_size: The size of each shard in bytes.
+      num_hashes: The number of bits set for each member.
+    """
+    if path is not None and not os.path.isdir(path):
+      os.makedirs(path)
+
+    self.path = path
+    self.num_hashes = num_hashes
+    self.shards = []
+    for i in range(shards):
+      shard_path = None
+      if path is not None:
+        shard_path = os.path.join(path, "shard_%04d" % i)
+
+      self.shards.append(BloomFilter(path=shard_path, size=shard_size,
+                                     num_hashes=num_hashes))
+
+  def _Shard(self, key):
+    return self.shards[int(hashlib.sha1(key).hexdigest()[:8], 16) %
+                       len(self.shards)]
+
+  def Add(self, key):
+    self._Shard(key).Add(key)
+
+  def __contains__(self, key):
+    return key in self._Shard(key)
+
+  @property
+  def size(self):
+    """The total size of the filter in bytes."""
+    return sum(shard.size for shard in self.shards)
+
+  def EstimateFalsePositiveRate(self):
+    """Estimates the current false positive rate from the fill ratio."""
+    if not self.shards:
+      return 0.0
+
+    rate = 0.0
+    for shard in self.shards:
+      fill_ratio = shard.CountSetBits() / float(shard.num_bits)
+      rate += fill_ratio ** self.num_hashes
+
+    return rate / len(self.shards)
+
+  def Flush(self):
+    for shard in self.shards:
+      shard.Flush()
+
+  def Close(self):
+    for shard in self.shards:
+      shard.Close()
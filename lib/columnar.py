@@ -0,0 +1,591 @@
+#!/usr/bin/env python
+"""Typed columnar files for exported RDFValues.
+
+Exported values (ExportedFile, ExportedProcess, ...) are flat records of
+simple typed fields. Storing many of them as a sequence of protobufs forces
+every reader to parse every field of every record, even to sum a single
+column. This module stores them column by column instead, in the spirit of
+Parquet and Arrow, so a reader only touches the columns it needs.
+
+A file holds the values of a single RDFValue type. Embedded structures are
+flattened into dotted column names (e.g. "metadata.hostname"). Rows are
+written in row groups. Every row group holds one compressed chunk per column
+which consists of a validity bitmap followed by the values:
+
+  bool:          A bitmap.
+  int64/uint64:  Little endian 8 byte integers.
+  double:        Little endian IEEE 754 doubles.
+  string/bytes:  N + 1 little endian 4 byte offsets followed by the data.
+                 Strings are UTF-8 encoded.
+
+The file ends with a JSON footer describing the schema and the location,
+null count and range of every chunk, followed by the footer length and a
+magic number. Files are grown incrementally as results arrive: appending
+writes the new row groups and a new footer after the current footer, which
+stays valid until the append completes. If an append is interrupted, readers
+use the last complete footer and the next writer drops the partial append.
+
+A footer only describes the row groups written since the previous footer and
+records where the previous footer ends, so appends write a footer of constant
+size and readers follow the chain of footers back to the first one.
+"""
+
+
+import json
+import os
+import struct
+import zlib
+
+from grr.lib import rdfvalue
+from grr.lib import type_info
+from grr.lib import utils
+
+
+MAGIC = "GRRCOL1\x00"
+FORMAT_VERSION = 2
+
+# Version 1 footers describe all the row groups of the file.
+SUPPORTED_VERSIONS = [1, 2]
+
+# The length of the trailer which follows the footer.
+TRAILER_SIZE = 8 + len(MAGIC)
+
+# Embedded structures are flattened up to this depth.
+MAX_NESTING_DEPTH = 4
+
+_INTEGER_TYPES = {"int32": "int64", "int64": "int64", "sint32": "int64",
+                  "sint64": "int64", "sfixed32": "int64", "sfixed64": "int64",
+                  "uint32": "uint64", "uint64": "uint64", "fixed32": "uint64",
+                  "fixed64": "uint64"}
+
+_STRUCT_FORMATS = {"int64": "q", "uint64": "Q", "double": "d"}
+
+
+class Error(Exception):
+  """Base error class."""
+
+
+class ColumnarFormatError(Error):
+  """Raised when a file is not a valid columnar file."""
+
+
+class SchemaMismatchError(Error):
+  """Raised when appending values with a different schema to a file."""
+
+
+class Column(object):
+  """A single column of a columnar file."""
+
+  def __init__(self, name, column_type, path=None):
+    self.name = name
+    self.column_type = column_type
+    self.path = path or name.split(".")
+
+  def ToDict(self):
+    return dict(name=self.name, type=self.column_type)
+
+  def __eq__(self, other):
+    return (self.name == other.name and
+            self.column_type == other.column_type)
+
+  def __ne__(self, other):
+    return not self == other
+
+
+def _GetColumnType(type_descriptor):
+  """Returns the column type for a field or None if it can't be stored."""
+  if isinstance(type_descriptor, type_info.ProtoBoolean):
+    return "bool"
+
+  # Enums are stored by name which is much friendlier to analysts.
+  if isinstance(type_descriptor, type_info.ProtoEnum):
+    return "string"
+
+  proto_type_name = type_descriptor.proto_type_name
+  if proto_type_name in ["float", "double"]:
+    return "double"
+
+  if proto_type_name in ["string", "bytes"]:
+    return proto_type_name
+
+  return _INTEGER_TYPES.get(proto_type_name)
+
+
+def GetColumnsForType(rdf_type, prefix="", depth=0):
+  """Derives the columns for an RDFProtoStruct class.
+
+  Repeated and dynamically typed fields have no fixed column type and are
+  skipped.
+
+  Args:
+    rdf_type: An RDFProtoStruct subclass.
+    prefix: Prefix for the names of the columns.
+    depth: The current nesting depth.
+
+  Returns:
+    A list of Column objects.
+  """
+  columns = []
+  for type_descriptor in rdf_type.type_infos:
+    name = prefix + type_descriptor.name
+
+    if isinstance(type_descriptor, type_info.ProtoNested):
+      if depth < MAX_NESTING_DEPTH and type_descriptor.type is not None:
+        columns.extend(GetColumnsForType(type_descriptor.type,
+                                         prefix=name + ".", depth=depth + 1))
+      continue
+
+    if isinstance(type_descriptor, (type_info.ProtoList,
+                                    type_info.ProtoDynamicEmbedded)):
+      continue
+
+    column_type = _GetColumnType(type_descriptor)
+    if column_type is not None:
+      columns.append(Column(name, column_type))
+
+  return columns
+
+
+def _GetColumnValue(value, column):
+  """Extracts the value of a column from an RDFValue, None if it is unset."""
+  for field_name in column.path:
+    if not value.HasField(field_name):
+      return None
+
+    value = value.Get(field_name)
+
+  column_type = column.column_type
+  if column_type == "bool":
+    return bool(value)
+
+  elif column_type in ["int64", "uint64"]:
+    if isinstance(value, rdfvalue.RDFValue):
+      value = value.SerializeToDataStore()
+    return int(value)
+
+  elif column_type == "double":
+    return float(value)
+
+  elif column_type == "string":
+    return utils.SmartStr(value)
+
+  elif isinstance(value, rdfvalue.RDFValue):
+    return value.SerializeToString()
+
+  return str(value)
+
+
+def _EncodeChunk(column_type, values):
+  """Encodes a list of values of a column into a chunk.
+
+  Args:
+    column_type: The type of the column.
+    values: A list of values, None for null values.
+
+  Returns:
+    A tuple (data, stats) where stats is a dict with the null count and for
+    numeric columns the range of values.
+  """
+  validity = bytearray((len(values) + 7) / 8)
+  present = []
+  for i, value in enumerate(values):
+    if value is not None:
+      validity[i >> 3] |= 1 << (i & 7)
+      present.append(value)
+
+  stats = dict(null_count=len(values) - len(present))
+
+  if column_type == "bool":
+    bits = bytearray(len(validity))
+    for i, value in enumerate(values):
+      if value:
+        bits[i >> 3] |= 1 << (i & 7)
+    encoded = str(bits)
+
+  elif column_type in _STRUCT_FORMATS:
+    default = 0.0 if column_type == "double" else 0
+    encoded = struct.pack(
+        "<%d%s" % (len(values), _STRUCT_FORMATS[column_type]),
+        *[default if value is None else value for value in values])
+
+    if present:
+      stats["min"] = min(present)
+      stats["max"] = max(present)
+
+  else:
+    offsets = [0]
+    for value in values:
+      offsets.append(offsets[-1] + len(value or ""))
+
+    encoded = (struct.pack("<%dI" % len(offsets), *offsets) +
+               "".join(value or "" for value in values))
+
+  return zlib.compress(str(validity) + encoded), stats
+
+
+def _DecodeChunk(column_type, data, num_rows):
+  """Decodes a chunk written by _EncodeChunk into a list of values."""
+  data = zlib.decompress(data)
+  validity_size = (num_rows + 7) / 8
+  validity = bytearray(data[:validity_size])
+  data = data[validity_size:]
+
+  if column_type == "bool":
+    bits = bytearray(data)
+    values = [bool(bits[i >> 3] & (1 << (i & 7))) for i in xrange(num_rows)]
+
+  elif column_type in _STRUCT_FORMATS:
+    values = list(struct.unpack(
+        "<%d%s" % (num_rows, _STRUCT_FORMATS[column_type]),
+        data[:num_rows * 8]))
+
+  else:
+    offsets_size = (num_rows + 1) * 4
+    offsets = struct.unpack("<%dI" % (num_rows + 1), data[:offsets_size])
+    data = data[offsets_size:]
+    values = [data[offsets[i]:offsets[i + 1]] for i in xrange(num_rows)]
+    if column_type == "string":
+      values = [value.decode("utf-8") for value in values]
+
+  for i in xrange(num_rows):
+    if not validity[i >> 3] & (1 << (i & 7)):
+      values[i] = None
+
+  return values
+
+
+def _ParseFooter(fd, end):
+  """Parses the footer whose trailer ends at offset end.
+
+  Args:
+    fd: A file object open for reading.
+    end: The offset of the end of the trailer.
+
+  Returns:
+    A tuple (footer, footer_offset).
+
+  Raises:
+    ColumnarFormatError: If there is no valid footer there.
+  """
+  if end < len(MAGIC) + TRAILER_SIZE:
+    raise ColumnarFormatError("File is too short.")
+
+  fd.seek(end - TRAILER_SIZE)
+  trailer = fd.read(TRAILER_SIZE)
+  if trailer[8:] != MAGIC:
+    raise ColumnarFormatError("Bad magic at the end of the file.")
+
+  footer_size = struct.unpack("<Q", trailer[:8])[0]
+  footer_offset = end - TRAILER_SIZE - footer_size
+  if footer_offset < len(MAGIC):
+    raise ColumnarFormatError("Bad footer size.")
+
+  fd.seek(footer_offset)
+  try:
+    footer = json.loads(fd.read(footer_size))
+  except ValueError as e:
+    raise ColumnarFormatError("Unable to parse footer: %s" % e)
+
+  if not isinstance(footer, dict):
+    raise ColumnarFormatError("Footer is not an object.")
+
+  return footer, footer_offset
+
+
+def _FindMagicEnds(fd, end, block_size=1024 * 1024):
+  """Yields the end offsets of magic numbers before end, last first.
+
+  The magic number at the start of the file is not included.
+
+  Args:
+    fd: A file object open for reading.
+    end: The offset to search backwards from.
+    block_size: How much of the file to read at once.
+  """
+  position = end
+  while position > len(MAGIC):
+    start = max(len(MAGIC), position - block_size)
+    fd.seek(start)
+    # Overlap with the previous block so magic numbers spanning blocks are
+    # found too.
+    block = fd.read(min(end, position + len(MAGIC) - 1) - start)
+
+    index = block.rfind(MAGIC)
+    while index != -1:
+      yield start + index + len(MAGIC)
+      index = block.rfind(MAGIC, 0, index + len(MAGIC) - 1)
+
+    position = start
+
+
+def _ReadFooter(fd):
+  """Reads the last complete footer of a columnar file.
+
+  Args:
+    fd: A file object open for reading.
+
+  Returns:
+    A tuple (footer, footer_offset, end) where end is the offset of the end of
+    the footer's trailer. Any data after end was left by an interrupted
+    append.
+
+  Raises:
+    ColumnarFormatError: If the file is not a valid columnar file.
+  """
+  fd.seek(0, 2)
+  end = fd.tell()
+
+  try:
+    footer, footer_offset = _ParseFooter(fd, end)
+  except ColumnarFormatError as e:
+    # An append may have been interrupted, look for the previous footer.
+    for end in _FindMagicEnds(fd, end):
+      try:
+        footer, footer_offset = _ParseFooter(fd, end)
+        break
+      except ColumnarFormatError:
+        pass
+    else:
+      raise e
+
+  if footer.get("version") not in SUPPORTED_VERSIONS:
+    raise ColumnarFormatError("Unsupported version %s." % footer.get("version"))
+
+  return footer, footer_offset, end
+
+
+def _ReadRowGroups(fd, footer, footer_offset):
+  """Follows the chain of footers and returns all the row groups.
+
+  Args:
+    fd: A file object open for reading.
+    footer: The last footer of the file.
+    footer_offset: The offset of the last footer.
+
+  Returns:
+    A list of row groups in the order they were written.
+
+  Raises:
+    ColumnarFormatError: If a footer in the chain is invalid.
+  """
+  footers = [footer]
+  while footers[-1].get("previous") is not None:
+    previous_end = footers[-1]["previous"]
+    # Each footer must point before itself or the chain never ends.
+    if (not isinstance(previous_end, (int, long)) or
+        previous_end > footer_offset):
+      raise ColumnarFormatError("Bad previous footer offset.")
+
+    footer, footer_offset = _ParseFooter(fd, previous_end)
+    footers.append(footer)
+
+  row_groups = []
+  for footer in reversed(footers):
+    row_groups.extend(footer["row_groups"])
+
+  return row_groups
+
+
+class ColumnarWriter(object):
+  """Writes RDFValues of a single type into a columnar file.
+
+  If the file already exists, new row groups are appended to it. Values are
+  buffered in memory until a row group is full or Flush() is called, so the
+  row group size bounds the memory used by the writer.
+  """
+
+  def __init__(self, path, rdf_type, row_group_size=10000):
+    """Constructor.
+
+    Args:
+      path: The file to write to.
+      rdf_type: The RDFProtoStruct class of the values which will be written.
+      row_group_size: The maximum number of rows in a row group.
+
+    Raises:
+      SchemaMismatchError: If the file holds values with a different schema.
+    """
+    self.path = path
+    self.rdf_type = rdf_type
+    self.row_group_size = row_group_size
+    self.columns = GetColumnsForType(rdf_type)
+    self.rows = []
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+
+    if os.path.exists(path):
+      self.fd = open(path, "r+b")
+      footer, footer_offset, end = _ReadFooter(self.fd)
+      if (footer["rdf_type"] != rdf_type.__name__ or
+          [c.ToDict() for c in self.columns] != footer["columns"]):
+        self.fd.close()
+        raise SchemaMismatchError("%s holds values of a different schema." %
+                                  path)
+
+      # The current footer is kept intact until the new one is written, new
+      # data goes after it. Drop anything left by an interrupted append.
+      self.fd.truncate(end)
+      self.data_end = end
+      self.row_groups = _ReadRowGroups(self.fd, footer, footer_offset)
+      self.footer_end = end
+    else:
+      self.fd = open(path, "w+b")
+      self.fd.write(MAGIC)
+      self.data_end = len(MAGIC)
+      self.row_groups = []
+      self.footer_end = None
+
+    # The row groups which are not described by a footer yet.
+    self.new_row_groups = []
+
+  @property
+  def num_rows(self):
+    return (sum(row_group["num_rows"] for row_group in self.row_groups) +
+            len(self.rows))
+
+  def Write(self, value):
+    """Buffers a single value, writing a row group when enough are buffered."""
+    self.rows.append([_GetColumnValue(value, column)
+                      for column in self.columns])
+
+    if len(self.rows) >= self.row_group_size:
+      self._WriteRowGroup()
+
+  def WriteMany(self, values):
+    for value in values:
+      self.Write(value)
+
+  def _WriteRowGroup(self):
+    """Writes the buffered rows as a single row group."""
+    if not self.rows:
+      return
+
+    self.fd.seek(self.data_end)
+    chunks = []
+    for index, column in enumerate(self.columns):
+      data, stats = _EncodeChunk(column.column_type,
+                                 [row[index] for row in self.rows])
+      stats.update(offset=self.data_end, length=len(data))
+      self.fd.write(data)
+      self.data_end += len(data)
+      chunks.append(stats)
+
+    row_group = dict(num_rows=len(self.rows), chunks=chunks)
+    self.row_groups.append(row_group)
+    self.new_row_groups.append(row_group)
+    self.rows = []
+
+  def Flush(self):
+    """Writes the buffered rows and a footer describing the new row groups."""
+    self._WriteRowGroup()
+    if self.new_row_groups or self.footer_end is None:
+      self._WriteFooter()
+
+  def _WriteFooter(self):
+    """Writes a footer for the new row groups which links to the last one."""
+    footer = json.dumps(dict(version=FORMAT_VERSION,
+                             rdf_type=self.rdf_type.__name__,
+                             columns=[c.ToDict() for c in self.columns],
+                             row_groups=self.new_row_groups,
+                             previous=self.footer_end))
+
+    self.fd.seek(self.data_end)
+    self.fd.write(footer)
+    self.fd.write(struct.pack("<Q", len(footer)))
+
+    # The magic number completes the new footer, so everything before it must
+    # be on disk first.
+    self.fd.flush()
+    os.fsync(self.fd.fileno())
+    self.fd.write(MAGIC)
+    self.fd.flush()
+
+    # Later row groups are written after this footer.
+    self.data_end += len(footer) + TRAILER_SIZE
+    self.footer_end = self.data_end
+    self.new_row_groups = []
+
+  def Close(self):
+    if self.fd is not None:
+      self.Flush()
+      self.fd.close()
+      self.fd = None
+
+
+class ColumnarReader(object):
+  """Reads columnar files written by the ColumnarWriter."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as fd:
+      footer, footer_offset, _ = _ReadFooter(fd)
+      self.row_groups = _ReadRowGroups(fd, footer, footer_offset)
+
+    self.rdf_type = footer["rdf_type"]
+    self.columns = [Column(c["name"], c["type"]) for c in footer["columns"]]
+
+  @property
+  def num_rows(self):
+    return sum(row_group["num_rows"] for row_group in self.row_groups)
+
+  @property
+  def column_names(self):
+    return [column.name for column in self.columns]
+
+  def _ColumnIndex(self, name):
+    for index, column in enumerate(self.columns):
+      if column.name == name:
+        return index
+
+    raise KeyError("No column %s in %s." % (name, self.path))
+
+  def GetColumnStats(self, name):
+    """Returns the stats of every chunk of a column, one per row group."""
+    index = self._ColumnIndex(name)
+    return [row_group["chunks"][index] for row_group in self.row_groups]
+
+  def ReadColumns(self, names=None, row_groups=None):
+    """Reads whole columns.
+
+    Only the chunks of the requested columns are read from the file.
+
+    Args:
+      names: Names of the columns to read, all columns if None.
+      row_groups: Indexes of the row groups to read, all if None. Callers can
+                  select row groups using the stats from GetColumnStats().
+
+    Returns:
+      A dict mapping column names to lists of values.
+    """
+    if names is None:
+      names = self.column_names
+
+    indexes = [self._ColumnIndex(name) for name in names]
+    if row_groups is None:
+      row_groups = range(len(self.row_groups))
+
+    result = dict((name, []) for name in names)
+    with open(self.path, "rb") as fd:
+      for row_group_index in row_groups:
+        row_group = self.row_groups[row_group_index]
+        for name, index in zip(names, indexes):
+          chunk = row_group["chunks"][index]
+          fd.seek(chunk["offset"])
+          result[name].extend(_DecodeChunk(
+              self.columns[index].column_type, fd.read(chunk["length"]),
+              row_group["num_rows"]))
+
+    return result
+
+  def ReadColumn(self, name, row_groups=None):
+    return self.ReadColumns([name], row_groups=row_groups)[name]
+
+  def __iter__(self):
+    """Yields every row as a dict mapping column names to values."""
+    names = self.column_names
+    for index in range(len(self.row_groups)):
+      columns = self.ReadColumns(names, row_groups=[index])
+      for row in zip(*[columns[name] for name in names]):
+        yield dict(zip(names, row))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Tests for the columnar file format."""
+
+
+import os
+import StringIO
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import columnar
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+class ColumnarTest(test_lib.GRRBaseTest):
+  """Tests for the columnar writer and reader."""
+
+  def setUp(self):
+    super(ColumnarTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "test.grrcol")
+
+  def _WriteAndRead(self, rdf_type, values, **kwargs):
+    writer = columnar.ColumnarWriter(self.path, rdf_type, **kwargs)
+    writer.WriteMany(values)
+    writer.Close()
+
+    return columnar.ColumnarReader(self.path)
+
+  def testChunkEncodings(self):
+    values = {"bool": [True, None, False, True, False, False, True, True, None],
+              "int64": [-5, None, 1 << 40],
+              "uint64": [0, (1 << 64) - 1, None],
+              "double": [1.5, None, -0.25],
+              "bytes": ["\x00\xff", None, "", "abc"]}
+
+    for column_type, column_values in values.iteritems():
+      data, stats = columnar._EncodeChunk(column_type, column_values)
+      self.assertEqual(columnar._DecodeChunk(column_type, data,
+                                             len(column_values)),
+                       column_values)
+      self.assertEqual(stats["null_count"], column_values.count(None))
+
+    # Strings are written UTF-8 encoded and read back as unicode.
+    data, _ = columnar._EncodeChunk("string", [u"\xe9t\xe9".encode("utf-8"),
+                                               None, ""])
+    self.assertEqual(columnar._DecodeChunk("string", data, 3),
+                     [u"\xe9t\xe9", None, u""])
+
+  def testBoolColumns(self):
+    reader = self._WriteAndRead(rdfvalue.ExportOptions, [
+        rdfvalue.ExportOptions(follow_urns=True),
+        rdfvalue.ExportOptions(follow_urns=False, export_files_hashes=True),
+        rdfvalue.ExportOptions()])
+
+    self.assertEqual(reader.ReadColumn("follow_urns"), [True, False, None])
+    self.assertEqual(reader.ReadColumn("export_files_hashes"),
+                     [None, True, None])
+
+  def testDoubleColumnsAndStats(self):
+    reader = self._WriteAndRead(rdfvalue.ExportedProcess, [
+        rdfvalue.ExportedProcess(pid=i, cpu_percent=i * 0.5)
+        for i in range(10)] + [rdfvalue.ExportedProcess(pid=10)],
+                                row_group_size=4)
+
+    self.assertEqual(reader.ReadColumn("cpu_percent"),
+                     [i * 0.5 for i in range(10)] + [None])
+
+    stats = reader.GetColumnStats("cpu_percent")
+    self.assertEqual([(s["min"], s["max"]) for s in stats],
+                     [(0.0, 1.5), (2.0, 3.5), (4.0, 4.5)])
+    self.assertEqual([s["null_count"] for s in stats], [0, 0, 1])
+
+    stats = reader.GetColumnStats("pid")
+    self.assertEqual([(s["min"], s["max"]) for s in stats],
+                     [(0, 3), (4, 7), (8, 10)])
+
+    # Columns without any values have no range.
+    stats = reader.GetColumnStats("rss_size")
+    self.assertEqual([s["null_count"] for s in stats], [4, 4, 3])
+    self.assertFalse("min" in stats[0])
+
+    # Row groups can be selected by their stats.
+    self.assertEqual(reader.ReadColumn("pid", row_groups=[2]), [8, 9, 10])
+
+  def testBytesColumns(self):
+    contents = ["\x00\x01\x02", "", None, "\xff" * 1000]
+    reader = self._WriteAndRead(rdfvalue.ExportedFile, [
+        rdfvalue.ExportedFile(basename="file%d" % i, content=content)
+        for i, content in enumerate(contents)])
+
+    self.assertEqual(reader.ReadColumn("content"), contents)
+    self.assertEqual(reader.ReadColumn("basename"),
+                     [u"file%d" % i for i in range(4)])
+
+    rows = list(reader)
+    self.assertEqual(len(rows), 4)
+    self.assertEqual(rows[3]["content"], "\xff" * 1000)
+    self.assertEqual(rows[2]["content"], None)
+
+  def testNullBitmapsAcrossBytes(self):
+    # More than eight rows so the validity bitmap spans several bytes.
+    values = [rdfvalue.ExportedProcess(pid=i) if i % 3 else
+              rdfvalue.ExportedProcess(name="process")
+              for i in range(20)]
+    reader = self._WriteAndRead(rdfvalue.ExportedProcess, values)
+
+    self.assertEqual(reader.ReadColumn("pid"),
+                     [i if i % 3 else None for i in range(20)])
+    self.assertEqual(reader.ReadColumn("name"),
+                     [None if i % 3 else u"process" for i in range(20)])
+
+  def testSchemaMismatch(self):
+    self._WriteAndRead(rdfvalue.ExportedProcess,
+                       [rdfvalue.ExportedProcess(pid=1)])
+
+    self.assertRaises(columnar.SchemaMismatchError, columnar.ColumnarWriter,
+                      self.path, rdfvalue.ExportedFile)
+
+    # The file is left intact.
+    self.assertEqual(columnar.ColumnarReader(self.path).num_rows, 1)
+
+  def testAppendsWriteConstantSizeFooters(self):
+    sizes = []
+    for i in range(10):
+      writer = columnar.ColumnarWriter(self.path, rdfvalue.ExportedProcess)
+      writer.Write(rdfvalue.ExportedProcess(pid=i))
+      writer.Close()
+      sizes.append(os.path.getsize(self.path))
+
+    # Footers which listed every row group would grow by the description of a
+    # row group (hundreds of bytes) with every append.
+    growth = [b - a for a, b in zip(sizes, sizes[1:])]
+    self.assertLess(max(growth) - min(growth), 16)
+
+    reader = columnar.ColumnarReader(self.path)
+    self.assertEqual(len(reader.row_groups), 10)
+    self.assertEqual(reader.ReadColumn("pid"), range(10))
+
+  def testFindMagicEndsAcrossBlocks(self):
+    magic = columnar.MAGIC
+    data = magic + "a" * 10 + magic + "b" * 7 + magic + "c" * 3
+    ends = [len(magic) + 10 + len(magic),
+            len(magic) * 3 + 10 + 7]
+
+    # Every block size puts the magic numbers at a different position relative
+    # to the block boundaries, including spanning them.
+    for block_size in range(1, len(data) + 1):
+      fd = StringIO.StringIO(data)
+      self.assertEqual(
+          list(columnar._FindMagicEnds(fd, len(data), block_size=block_size)),
+          ends[::-1])
+
+    # Only magic numbers ending before the end offset are found.
+    fd = StringIO.StringIO(data)
+    self.assertEqual(list(columnar._FindMagicEnds(fd, ends[1] - 1,
+                                                  block_size=4)),
+                     ends[:1])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
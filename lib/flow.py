@@ -94,47 +94,22 @@ class Responses(object):
       self.request_data = rdfvalue.Dict(request.data)
     self._responses = []
     self._dropped_responses = []
+    # The number of streamed responses, counted when first needed.
+    self._length = None
 
-    if responses:
+    # The iterator that was returned as part of these responses. This should
+    # be passed back to actions that expect an iterator.
+    self.iterator = rdfvalue.Iterator()
+
+    if isinstance(responses, queue_manager.ResponsePager):
+      self._InitFromPager(responses)
+
+    elif responses:
       # This may not be needed if we can assume that responses are
       # returned in lexical order from the data_store.
       responses.sort(key=operator.attrgetter("response_id"))
 
-      # The iterator that was returned as part of these responses. This should
-      # be passed back to actions that expect an iterator.
-      self.iterator = rdfvalue.Iterator()
-
-      # Filter the responses by authorized states
-      for msg in responses:
-        # Check if the message is authenticated correctly.
-        if msg.auth_state == msg.AuthorizationState.DESYNCHRONIZED or (
-            self._auth_required and
-            msg.auth_state != msg.AuthorizationState.AUTHENTICATED):
-          logging.info("%s: Messages must be authenticated (Auth state %s)",
-                       msg.session_id, msg.auth_state)
-          self._dropped_responses.append(msg)
-          # Skip this message - it is invalid
-          continue
-
-        # Check for iterators
-        if msg.type == msg.Type.ITERATOR:
-          self.iterator.ParseFromString(msg.args)
-          continue
-
-        # Look for a status message
-        if msg.type == msg.Type.STATUS:
-          # Our status is set to the first status message that we see in
-          # the responses. We ignore all other messages after that.
-          self.status = rdfvalue.GrrStatus(msg.args)
-
-          # Check this to see if the call succeeded
-          self.success = self.status.status == self.status.ReturnedStatus.OK
-
-          # Ignore all other messages
-          break
-
-        # Use this message
-        self._responses.append(msg)
+      self._responses = list(self._FilterMessages(responses))
 
       if self.status is None:
         # This is a special case of de-synchronized messages.
@@ -147,10 +122,85 @@ class Responses(object):
     # This is the raw message accessible while going through the iterator
     self.message = None
 
+  def _InitFromPager(self, pager):
+    """Prepares to stream the responses from a queue_manager.ResponsePager.
+
+    The status is taken from the status message the pager was created with so
+    it is available before any responses are read. Responses themselves are
+    only fetched from the data store when this object is iterated over.
+
+    Args:
+      pager: A queue_manager.ResponsePager.
+
+    Raises:
+      FlowError: If the status message is not valid.
+    """
+    if not self._IsAuthorized(pager.status):
+      raise FlowError("No valid Status message.")
+
+    self._SetStatus(pager.status)
+
+    # Iterators are sent just before the status so flows can inspect them
+    # before iterating over the responses.
+    last = pager.GetResponse(pager.status.response_id - 1)
+    if (last is not None and last.type == last.Type.ITERATOR and
+        self._IsAuthorized(last)):
+      self.iterator.ParseFromString(last.args)
+
+    self._responses = pager
+
+  def _IsAuthorized(self, msg):
+    """Check if the message is authenticated correctly."""
+    if msg.auth_state == msg.AuthorizationState.DESYNCHRONIZED or (
+        self._auth_required and
+        msg.auth_state != msg.AuthorizationState.AUTHENTICATED):
+      logging.info("%s: Messages must be authenticated (Auth state %s)",
+                   msg.session_id, msg.auth_state)
+      return False
+
+    return True
+
+  def _SetStatus(self, msg):
+    self.status = rdfvalue.GrrStatus(msg.args)
+
+    # Check this to see if the call succeeded
+    self.success = self.status.status == self.status.ReturnedStatus.OK
+
+  def _FilterMessages(self, messages):
+    """Yields the authorized messages up to the first status message."""
+    for msg in messages:
+      if not self._IsAuthorized(msg):
+        self._dropped_responses.append(msg)
+        # Skip this message - it is invalid
+        continue
+
+      # Check for iterators
+      if msg.type == msg.Type.ITERATOR:
+        self.iterator.ParseFromString(msg.args)
+        continue
+
+      # Look for a status message
+      if msg.type == msg.Type.STATUS:
+        # Our status is set to the first status message that we see in
+        # the responses. We ignore all other messages after that.
+        if self.status is None:
+          self._SetStatus(msg)
+
+        # Ignore all other messages
+        break
+
+      # Use this message
+      yield msg
+
   def __iter__(self):
     """An iterator which returns all the responses in order."""
+    messages = self._responses
+    if isinstance(messages, queue_manager.ResponsePager):
+      # Streamed responses are only filtered as they are read.
+      messages = self._FilterMessages(messages)
+
     old_response_id = None
-    for message in self._responses:
+    for message in messages:
       self.message = rdfvalue.GrrMessage(message)
 
       # Handle retransmissions
@@ -187,9 +237,48 @@ class Responses(object):
       return x
 
   def __len__(self):
+    if isinstance(self._responses, queue_manager.ResponsePager):
+      if self._length is None:
+        self._length = self._CountStreamedResponses()
+
+      return self._length
+
     return len(self._responses)
 
+  def _CountStreamedResponses(self):
+    """Counts the responses __iter__ yields by paging through them once."""
+    return sum(1 for _ in self._StreamedResponses())
+
+  def _StreamedResponses(self):
+    """Yields the streamed messages __iter__ turns into responses.
+
+    The pager also holds the status, iterator and unauthorized messages, so
+    its length is not the number of responses.
+
+    Yields:
+      The GrrMessages of the responses.
+    """
+    old_response_id = None
+    for msg in self._responses:
+      if msg.type == msg.Type.STATUS:
+        break
+
+      if (msg.type == msg.Type.MESSAGE and self._IsAuthorized(msg) and
+          msg.response_id != old_response_id):
+        old_response_id = msg.response_id
+        yield msg
+
   def __nonzero__(self):
+    if isinstance(self._responses, queue_manager.ResponsePager):
+      if self._length is not None:
+        return self._length > 0
+
+      # Only page in as far as the first response.
+      for _ in self._StreamedResponses():
+        return True
+
+      return False
+
     return bool(self._responses)
 
 
@@ -998,6 +1087,19 @@ class WellKnownFlow(GRRFlow):
 
   def ProcessRequests(self, thread_pool):
     """For WellKnownFlows we receive these messages directly."""
+    for msg in self.FetchMessages():
+      thread_pool.AddTask(target=self._SafeProcessMessage,
+                          args=(msg,), name=self.__class__.__name__)
+
+  def FetchMessages(self):
+    """Yields the messages sent to this flow and removes them from the queue.
+
+    If there are more messages than we can fetch at once, the worker is
+    notified to come back for the rest.
+
+    Yields:
+      GrrMessages.
+    """
     try:
       priority = rdfvalue.GrrMessage.Priority.MEDIUM_PRIORITY
       with queue_manager.WellKnownQueueManager(
@@ -1005,13 +1107,13 @@ class WellKnownFlow(GRRFlow):
         for request, responses in manager.FetchRequestsAndResponses(
             self.session_id):
           for msg in responses:
-            # Even though we use the thread pool here, it may be exhausted so we
-            # end up running inline. We still need to heartbeat here so the
-            # lease on the well known flow does not expire.
+            # Even though we use the thread pool for the messages, it may be
+            # exhausted so we end up running inline. We still need to
+            # heartbeat here so the lease on the well known flow does not
+            # expire.
             self.HeartBeat()
             priority = msg.priority
-            thread_pool.AddTask(target=self._SafeProcessMessage,
-                                args=(msg,), name=self.__class__.__name__)
+            yield msg
 
           manager.DeleteFlowRequestStates(self.session_id, request)
 
@@ -1418,9 +1520,14 @@ class ServerCommunicator(communicator.Communicator):
           stats.STATS.IncrementCounter("grr_authenticated_messages")
 
           # Update the client and server timestamps.
+          previous_ping = client.Get(client.Schema.PING)
           client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
           client.Set(client.Schema.PING, rdfvalue.RDFDatetime().Now())
 
+          # Keep the fleet statistics up to date without opening every client.
+          aff4.AFF4Object.ClientFleetStatsIndex.ClientSeen(
+              client, previous_ping, token=self.token)
+
         else:
           logging.debug("Message desynchronized: %s > %s", int(client_time),
                         long(remote_time))
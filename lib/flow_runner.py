@@ -350,7 +350,7 @@ class FlowRunner(object):
 
           # Do we have all the responses here? This can happen if some of the
           # responses were lost.
-          if len(responses) != responses[-1].response_id:
+          if not self._ResponsesComplete(responses):
             # If we can retransmit do so. Note, this is different from the
             # automatic retransmission facilitated by the task scheduler (the
             # Task.task_ttl field) which would happen regardless of these.
@@ -411,6 +411,14 @@ class FlowRunner(object):
         for event in processing:
           event.wait()
 
+  def _ResponsesComplete(self, responses):
+    """Checks that no responses were lost before the status message."""
+    if isinstance(responses, queue_manager.ResponsePager):
+      # Large replies are streamed so we can not count them in memory.
+      return responses.IsComplete()
+
+    return len(responses) == responses[-1].response_id
+
   def _Process(self, request, responses, **_):
     """Flows process responses serially in the same thread."""
     self.RunStateMethod(request.next_state, request, responses, event=None)
@@ -428,7 +436,8 @@ class FlowRunner(object):
 
       request: A RequestState protobuf.
 
-      responses: A list of GrrMessages responding to the request.
+      responses: A list of GrrMessages responding to the request, or a
+        queue_manager.ResponsePager for large replies.
 
       event: A threading.Event() instance to signal completion of this request.
 
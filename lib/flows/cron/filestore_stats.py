@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 """Filestore stats crons."""
 
+import threading
+import logging
+
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import rdfvalue
 from grr.lib import stats as stats_lib
+from grr.lib import threadpool
 from grr.lib import utils
 
 from grr.lib.aff4_objects import cronjobs
+from grr.lib.aff4_objects import filestore
 from grr.lib.rdfvalues import stats
 
 
@@ -32,23 +38,74 @@ class FilestoreStats(aff4.AFF4Object):
         "aff4:stats/filestore/clientcount", stats.Graph,
         "File distribution across clients")
 
+    LAST_COMPLETED_RUN = aff4.Attribute(
+        "aff4:stats/filestore/last_completed_run", rdfvalue.RDFDatetime,
+        "Files added to the filestore before this time have been counted.")
+
+
+class FilestoreStatsShard(FilestoreStats):
+  """Partial filestore statistics for a single shard of the filestore.
+
+  Besides the partial histograms, each shard records which files have already
+  been counted, so reruns only process files which were added since.
+  """
+
+  COUNTED_PREFIX = "index:counted/"
+
+  def __init__(self, urn, **kwargs):
+    super(FilestoreStatsShard, self).__init__(urn, **kwargs)
+    self.to_mark = set()
+
+  def FilterCounted(self, urns):
+    """Returns the urns which were not counted in this shard yet."""
+    predicates = dict((self.COUNTED_PREFIX + urn.Basename(), urn)
+                      for urn in urns)
+    for predicate, _, _ in data_store.DB.ResolveMulti(
+        self.urn, predicates.keys(), token=self.token):
+      predicates.pop(predicate, None)
+
+    return predicates.values()
+
+  def MarkCounted(self, urns):
+    self.to_mark.update(urn.Basename() for urn in urns)
+
+  def Flush(self, sync=True):
+    # The partial histograms must be written before the files are marked
+    # so a failure in between can not lose the counts of these files.
+    super(FilestoreStatsShard, self).Flush(sync=sync)
+
+    if self.to_mark:
+      data_store.DB.MultiSet(
+          self.urn, dict((self.COUNTED_PREFIX + name, [""])
+                         for name in self.to_mark),
+          token=self.token, replace=True, sync=sync)
+
+    self.to_mark = set()
+
 
 class ClassCounter(object):
   """Populates a stats.Graph with counts of each object class."""
 
   def __init__(self, attribute, title):
     self.attribute = attribute
+    self.title = title
     self.value_dict = {}
-    self.graph = self.attribute(title=title)
 
   def ProcessFile(self, fd):
     classname = fd.__class__.__name__
     self.value_dict[classname] = self.value_dict.get(classname, 0) + 1
 
+  def Load(self, fd):
+    """Adds the counts previously saved in fd to this counter."""
+    for point in fd.Get(self.attribute, []):
+      self.value_dict[point.label] = (self.value_dict.get(point.label, 0) +
+                                      point.y_value)
+
   def Save(self, fd):
+    graph = self.attribute(title=self.title)
     for classname, count in self.value_dict.items():
-      self.graph.Append(label=classname, y_value=count)
-    fd.Set(self.attribute, self.graph)
+      graph.Append(label=classname, y_value=count)
+    fd.Set(self.attribute, graph)
 
 
 class ClassFileSizeCounter(ClassCounter):
@@ -61,10 +118,16 @@ class ClassFileSizeCounter(ClassCounter):
     self.value_dict[classname] = self.value_dict.get(classname, 0) + fd.Get(
         fd.Schema.SIZE)
 
+  def Load(self, fd):
+    for point in fd.Get(self.attribute, []):
+      self.value_dict[point.label] = (self.value_dict.get(point.label, 0) +
+                                      point.y_value * self.GB)
+
   def Save(self, fd):
+    graph = self.attribute(title=self.title)
     for classname, count in self.value_dict.items():
-      self.graph.Append(label=classname, y_value=count/float(self.GB))
-    fd.Set(self.attribute, self.graph)
+      graph.Append(label=classname, y_value=count/float(self.GB))
+    fd.Set(self.attribute, graph)
 
 
 class GraphDistribution(stats_lib.Distribution):
@@ -74,18 +137,25 @@ class GraphDistribution(stats_lib.Distribution):
 
   def __init__(self, attribute, title):
     self.attribute = attribute
-    self.graph = self.attribute(title=title)
+    self.title = title
     super(GraphDistribution, self).__init__(self._bins)
 
   def ProcessFile(self, fd):
     raise NotImplementedError()
 
+  def Load(self, fd):
+    """Adds the bin heights previously saved in fd to this histogram."""
+    for point in fd.Get(self.attribute, []):
+      self.bins_heights[point.x_value] = (
+          self.bins_heights.get(point.x_value, 0) + point.y_value)
+
   def Save(self, fd):
+    graph = self.attribute(title=self.title)
     for x, y in sorted(self.bins_heights.items()):
       if x >= 0:
-        self.graph.Append(x_value=int(x), y_value=y)
+        graph.Append(x_value=int(x), y_value=y)
 
-    fd.Set(self.attribute, self.graph)
+    fd.Set(self.attribute, graph)
 
 
 class FileSizeHistogram(GraphDistribution):
@@ -114,47 +184,173 @@ class ClientCountHistogram(GraphDistribution):
     self.Record(len(clients))
 
 
+class _FilestoreStatsShardCounter(threadpool.BatchConverter):
+  """Counts the new files of filestore shards into their partial histograms.
+
+  Every batch holds a single (shard_urn, file_urns) pair. Shards are updated
+  concurrently by the pool threads and each shard is checkpointed after every
+  chunk of files it processes.
+  """
+
+  def __init__(self, flow_obj, **kwargs):
+    super(_FilestoreStatsShardCounter, self).__init__(
+        batch_size=1, threadpool_prefix="filestore_stats", **kwargs)
+    self.flow_obj = flow_obj
+    self.lock = threading.Lock()
+    self.counted = 0
+    self.failed = False
+
+  def ConvertBatch(self, batch):
+    for shard_urn, urns in batch:
+      try:
+        self.CountShard(shard_urn, urns)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error counting filestore shard %s: %s", shard_urn, e)
+        with self.lock:
+          self.failed = True
+
+  def CountShard(self, shard_urn, urns):
+    """Counts the files in urns which this shard has not counted yet."""
+    token = self.flow_obj.token
+    shard = aff4.FACTORY.Create(shard_urn, "FilestoreStatsShard", mode="rw",
+                                token=token)
+    consumers = self.flow_obj.CreateConsumers()
+    for consumer in consumers:
+      consumer.Load(shard)
+
+    for chunk in utils.Grouper(urns, self.flow_obj.OPEN_FILES_LIMIT):
+      chunk = shard.FilterCounted(chunk)
+      for fd in aff4.FACTORY.MultiOpen(chunk, mode="r", token=token,
+                                       age=aff4.NEWEST_TIME):
+        for consumer in consumers:
+          consumer.ProcessFile(fd)
+
+      for consumer in consumers:
+        consumer.Save(shard)
+
+      shard.MarkCounted(chunk)
+      shard.Flush()
+
+      with self.lock:
+        self.counted += len(chunk)
+
+      # This flow is not dead: we don't want to run out of lease time.
+      self.flow_obj.HeartBeat()
+
+    shard.Close()
+
+
 class FilestoreStatsCronFlow(cronjobs.SystemCronFlow):
-  """Build statistics about the filestore."""
+  """Build statistics about the filestore.
+
+  The filestore is split into shards by the leading characters of the file
+  hashes. Each shard keeps partial histograms of the files it has counted so
+  far, so a run only needs to count the files added since the last completed
+  run and then merge the partial histograms of all the shards.
+  """
   frequency = rdfvalue.Duration("1w")
   lifetime = rdfvalue.Duration("1d")
   HASH_PATH = "aff4:/files/hash/generic/sha256"
   FILESTORE_STATS_URN = rdfvalue.RDFURN("aff4:/stats/FileStoreStats")
+  SHARDS_URN = FILESTORE_STATS_URN.Add("shards")
   OPEN_FILES_LIMIT = 500
+  SHARD_PREFIX_LENGTH = 2
+  THREADPOOL_SIZE = 10
+
+  def CreateConsumers(self):
+    return [ClassCounter(FilestoreStats.SchemaCls.FILESTORE_FILETYPES,
+                         "Number of files in the filestore by type"),
+            ClassFileSizeCounter(
+                FilestoreStats.SchemaCls.FILESTORE_FILETYPES_SIZE,
+                "Total filesize (GB) files in the filestore by type"),
+            FileSizeHistogram(
+                FilestoreStats.SchemaCls.FILESTORE_FILESIZE_HISTOGRAM,
+                "Filesize distribution in bytes"),
+            ClientCountHistogram(
+                FilestoreStats.SchemaCls.FILESTORE_CLIENTCOUNT_HISTOGRAM,
+                "Number of files found on X clients")]
+
+  def _ListNewFiles(self, last_run, now):
+    """Groups the files added since the last completed run by shard."""
+    shards = {}
+    for urn in aff4.FACTORY.Open(self.HASH_PATH, token=self.token).ListChildren(
+        age=(last_run, now)):
+      shard = urn.Basename()[:self.SHARD_PREFIX_LENGTH]
+      shards.setdefault(self.SHARDS_URN.Add(shard), []).append(urn)
+
+    return shards
 
-  def _CreateConsumers(self):
-    self.consumers = [ClassCounter(self.stats.Schema.FILESTORE_FILETYPES,
-                                   "Number of files in the filestore by type"),
-                      ClassFileSizeCounter(
-                          self.stats.Schema.FILESTORE_FILETYPES_SIZE,
-                          "Total filesize (GB) files in the filestore by type"),
-                      FileSizeHistogram(
-                          self.stats.Schema.FILESTORE_FILESIZE_HISTOGRAM,
-                          "Filesize distribution in bytes"),
-                      ClientCountHistogram(
-                          self.stats.Schema.FILESTORE_CLIENTCOUNT_HISTOGRAM,
-                          "Number of files found on X clients")]
+  @flow.StateHandler()
+  def Start(self):
+    """Count the new files of every shard and merge the shard histograms."""
+    stats_fd = aff4.FACTORY.Create(self.FILESTORE_STATS_URN, "FilestoreStats",
+                                   mode="r", token=self.token)
+    last_run = stats_fd.Get(stats_fd.Schema.LAST_COMPLETED_RUN,
+                            rdfvalue.RDFDatetime(0))
+
+    now = rdfvalue.RDFDatetime().Now()
+    shards = self._ListNewFiles(last_run, now)
+    logging.info("Found new files in %d filestore shards.", len(shards))
+
+    counter = _FilestoreStatsShardCounter(
+        self, threadpool_size=self.THREADPOOL_SIZE)
+    counter.Convert(shards.items())
+    self.Log("Counted %d new files.", counter.counted)
+
+    # Merge the partial histograms of all the shards.
+    consumers = self.CreateConsumers()
+    shard_urns = list(aff4.FACTORY.Open(self.SHARDS_URN,
+                                        token=self.token).ListChildren())
+    for shard in aff4.FACTORY.MultiOpen(shard_urns, mode="r",
+                                        aff4_type="FilestoreStatsShard",
+                                        token=self.token):
+      for consumer in consumers:
+        consumer.Load(shard)
+
+    with aff4.FACTORY.Create(self.FILESTORE_STATS_URN, "FilestoreStats",
+                             mode="w", token=self.token) as stats_fd:
+      for consumer in consumers:
+        consumer.Save(stats_fd)
+
+      # Only move the checkpoint when all shards are complete, otherwise the
+      # files of the failed shards would never be counted. Files which were
+      # counted already are skipped by their shards on the next run.
+      if counter.failed:
+        stats_fd.Set(stats_fd.Schema.LAST_COMPLETED_RUN(last_run))
+      else:
+        stats_fd.Set(stats_fd.Schema.LAST_COMPLETED_RUN(now))
+
+
+class FileStoreExistenceFilterCronFlow(cronjobs.SystemCronFlow):
+  """Populates the filestore existence filter from the data store.
+
+  New blobs and files are added to the filter as they are written. This adds
+  everything which is already stored, and anything a writer may have missed.
+  """
+  frequency = rdfvalue.Duration("1w")
+  lifetime = rdfvalue.Duration("1d")
+
+  def _ListExisting(self):
+    urns = [rdfvalue.RDFURN("aff4:/blobs")]
+    for fingerprint_type in filestore.HashFileStore.FINGERPRINT_TYPES:
+      for hash_type in filestore.HashFileStore.HASH_TYPES:
+        urns.append(filestore.HashFileStore.PATH.Add(fingerprint_type).Add(
+            hash_type))
+
+    count = 0
+    for _, children in aff4.FACTORY.MultiListChildren(urns, token=self.token):
+      for child in children:
+        yield child
+
+        count += 1
+        if count % 100000 == 0:
+          # This flow is not dead: we don't want to run out of lease time.
+          self.HeartBeat()
 
   @flow.StateHandler()
   def Start(self):
-    """Retrieve all the clients for the AbstractClientStatsCollectors."""
-    self.stats = aff4.FACTORY.Create(self.FILESTORE_STATS_URN, "FilestoreStats",
-                                     mode="w", token=self.token)
-
-    self._CreateConsumers()
-    hashes = list(aff4.FACTORY.Open(self.HASH_PATH,
-                                    token=self.token).ListChildren())
-
-    try:
-      for urns in utils.Grouper(hashes, self.OPEN_FILES_LIMIT):
-        for fd in aff4.FACTORY.MultiOpen(urns, mode="r", token=self.token,
-                                         age=aff4.NEWEST_TIME):
-
-          for consumer in self.consumers:
-            consumer.ProcessFile(fd)
-        self.HeartBeat()
-
-    finally:
-      for consumer in self.consumers:
-        consumer.Save(self.stats)
-      self.stats.Close()
+    if filestore.EXISTENCE_FILTER.filter is None:
+      self.Log("The filestore existence filter is not configured.")
+      return
+
+    filestore.EXISTENCE_FILTER.Populate(self._ListExisting())
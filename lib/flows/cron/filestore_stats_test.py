@@ -69,3 +69,38 @@ class FilestoreStatsCronFlowTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(clientcount.data[2].x_value, 5)
     self.assertEqual(clientcount.data[2].y_value, 5)
 
+  def testRerunOnlyCountsNewFiles(self):
+    for _ in test_lib.TestFlowHelper("FilestoreStatsCronFlow",
+                                     token=self.token):
+      pass
+
+    newfd = aff4.FACTORY.Create("aff4:/files/hash/generic/sha256/fsinew",
+                                "FileStoreImage", token=self.token)
+    newfd.size = 3e6
+    newfd.AddIndex("aff4:/C.0000000000000001/fs/os/new")
+    newfd.Close()
+
+    # Recreating a file which is already in the filestore must not count it
+    # again.
+    newfd = aff4.FACTORY.Create("aff4:/files/hash/generic/sha256/blobtiny",
+                                "FileStoreImage", token=self.token)
+    newfd.size = 12
+    newfd.Close()
+
+    for _ in test_lib.TestFlowHelper("FilestoreStatsCronFlow",
+                                     token=self.token):
+      pass
+
+    fd = aff4.FACTORY.Open(
+        filestore_stats.FilestoreStatsCronFlow.FILESTORE_STATS_URN,
+        token=self.token)
+
+    filetypes = fd.Get(fd.Schema.FILESTORE_FILETYPES)
+    self.assertEqual(filetypes.data[0].label, "FileStoreImage")
+    self.assertEqual(filetypes.data[0].y_value, 13)
+
+    filesizes = fd.Get(fd.Schema.FILESTORE_FILESIZE_HISTOGRAM)
+    self.assertEqual(filesizes.data[0].y_value, 1)
+    self.assertEqual(filesizes.data[1].y_value, 1)
+    self.assertEqual(filesizes.data[8].x_value, 1000000)
+    self.assertEqual(filesizes.data[8].y_value, 5)
@@ -13,6 +13,7 @@ from grr.lib import export_utils
 from grr.lib import flow
 from grr.lib import hunts
 from grr.lib import rdfvalue
+from grr.lib import threadpool
 from grr.lib import utils
 from grr.lib.aff4_objects import cronjobs
 from grr.lib.rdfvalues import stats
@@ -99,10 +100,104 @@ class ClientFleetStats(aff4.AFF4Object):
                                               "Last contacted time")
 
 
+class _ClientFleetStatsIndexer(threadpool.BatchConverter):
+  """Recounts batches of clients into the ClientFleetStatsIndex.
+
+  Each batch of clients is opened and written to the index by a pool thread, so
+  a full recount reads many shards of the fleet concurrently.
+  """
+
+  def __init__(self, flow_obj, **kwargs):
+    super(_ClientFleetStatsIndexer, self).__init__(
+        threadpool_prefix="client_fleet_stats_indexer", **kwargs)
+    self.flow_obj = flow_obj
+
+  def ConvertBatch(self, batch):
+    token = self.flow_obj.token
+    with aff4.FACTORY.Create(
+        aff4.AFF4Object.ClientFleetStatsIndex.URN, "ClientFleetStatsIndex",
+        mode="w", token=token, force_new_version=False) as index:
+      for client in aff4.FACTORY.MultiOpen(batch, mode="r", token=token,
+                                           aff4_type="VFSGRRClient"):
+        index.AddClient(index.BuildSummary(client))
+
+    # This flow is not dead: we don't want to run out of lease time.
+    self.flow_obj.HeartBeat()
+
+
+def RebuildClientFleetStatsIndex(flow_obj, batch_size=1000, threads=10):
+  """Recounts every client in the system into the ClientFleetStatsIndex.
+
+  Args:
+    flow_obj: The flow running the recount. Its token is used and its lease is
+              extended as batches complete.
+    batch_size: The number of clients each shard processes.
+    threads: The number of shards processed concurrently.
+
+  Returns:
+    The number of clients found.
+  """
+  root = aff4.FACTORY.Open(aff4.ROOT_URN, token=flow_obj.token)
+  client_urns = [urn for urn in root.ListChildren()
+                 if aff4.AFF4Object.VFSGRRClient.CLIENT_ID_RE.match(
+                     urn.Basename())]
+  logging.info("Found %d clients.", len(client_urns))
+
+  _ClientFleetStatsIndexer(
+      flow_obj, batch_size=batch_size, threadpool_size=threads).Convert(
+          client_urns)
+
+  # Drop the entries of clients which are gone.
+  client_ids = set(urn.Basename() for urn in client_urns)
+  with aff4.FACTORY.Create(
+      aff4.AFF4Object.ClientFleetStatsIndex.URN, "ClientFleetStatsIndex",
+      mode="rw", token=flow_obj.token, force_new_version=False) as index:
+    for summary in index.ListClients():
+      if summary.client_id.Basename() not in client_ids:
+        index.RemoveClient(summary.client_id)
+
+  return len(client_urns)
+
+
+class ClientFleetStatsIndexCronFlow(cronjobs.SystemCronFlow):
+  """Periodically recounts the whole fleet into the ClientFleetStatsIndex.
+
+  Between recounts the index is kept up to date incrementally by the front ends
+  whenever clients poll, and by the ClientFleetStatsListener whenever a client
+  is interrogated.
+  """
+
+  frequency = rdfvalue.Duration("1d")
+
+  @flow.StateHandler()
+  def Start(self):
+    count = RebuildClientFleetStatsIndex(self)
+    self.Log("Indexed %d clients.", count)
+
+
+class ClientFleetStatsListener(flow.EventListener):
+  """Updates the ClientFleetStatsIndex entry of newly interrogated clients."""
+  EVENTS = ["Discovery"]
+  well_known_session_id = rdfvalue.SessionID(
+      "aff4:/flows/W:ClientFleetStatsListener")
+
+  @flow.EventHandler(auth_required=True)
+  def ProcessMessage(self, message=None, event=None):
+    _ = message
+    client = aff4.FACTORY.Open(event.client_id, aff4_type="VFSGRRClient",
+                               mode="r", token=self.token)
+
+    with aff4.FACTORY.Create(
+        aff4.AFF4Object.ClientFleetStatsIndex.URN, "ClientFleetStatsIndex",
+        mode="w", token=self.token, force_new_version=False) as index:
+      index.AddClient(index.BuildSummary(client))
+
+
 class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
-  """A cron job which opens every client in the system.
+  """A cron job which computes statistics over every client in the system.
 
-  We feed all the client objects to the AbstractClientStatsCollector instances.
+  Clients are not opened here. Instead we feed the ClientSummary of every client
+  in the ClientFleetStatsIndex to ProcessClient().
   """
 
   CLIENT_STATS_URN = rdfvalue.RDFURN("aff4:/stats/ClientFleetStats")
@@ -110,7 +205,7 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
   def BeginProcessing(self):
     pass
 
-  def ProcessClient(self, client):
+  def ProcessClient(self, summary):
     raise NotImplementedError()
 
   def FinishProcessing(self):
@@ -118,27 +213,28 @@ class AbstractClientStatsCronFlow(cronjobs.SystemCronFlow):
 
   @flow.StateHandler()
   def Start(self):
-    """Retrieve all the clients for the AbstractClientStatsCollectors."""
+    """Feed all the client summaries to ProcessClient."""
     try:
       self.stats = aff4.FACTORY.Create(self.CLIENT_STATS_URN,
                                        "ClientFleetStats",
                                        mode="w", token=self.token)
       self.BeginProcessing()
 
-      root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
-      children_urns = list(root.ListChildren())
-      logging.info("Found %d children.", len(children_urns))
+      index = aff4.FACTORY.Create(
+          aff4.AFF4Object.ClientFleetStatsIndex.URN, "ClientFleetStatsIndex",
+          mode="r", token=self.token)
 
       processed_count = 0
-      for child in aff4.FACTORY.MultiOpen(
-          children_urns, mode="r", token=self.token, age=aff4.NEWEST_TIME):
-        if isinstance(child, aff4.AFF4Object.VFSGRRClient):
-          self.ProcessClient(child)
+      for summary in index.ListClients():
+        self.ProcessClient(summary)
+        processed_count += 1
+
+      # The index has not been built yet - do a full recount now.
+      if not processed_count and RebuildClientFleetStatsIndex(self):
+        for summary in index.ListClients():
+          self.ProcessClient(summary)
           processed_count += 1
 
-        # This flow is not dead: we don't want to run out of lease time.
-        self.HeartBeat()
-
       self.FinishProcessing()
       self.stats.Close()
 
@@ -159,14 +255,13 @@ class GRRVersionBreakDown(AbstractClientStatsCronFlow):
   def FinishProcessing(self):
     self.counter.Save(self.stats)
 
-  def ProcessClient(self, client):
-    ping = client.Get(client.Schema.PING)
-    c_info = client.Get(client.Schema.CLIENT_INFO)
-    if c_info and ping:
+  def ProcessClient(self, summary):
+    if summary.HasField("client_info") and summary.HasField("timestamp"):
+      c_info = summary.client_info
       category = " ".join([c_info.client_description or c_info.client_name,
                            str(c_info.client_version)])
 
-      self.counter.Add(category, ping)
+      self.counter.Add(category, summary.timestamp)
 
 
 class OSBreakDown(AbstractClientStatsCronFlow):
@@ -184,20 +279,21 @@ class OSBreakDown(AbstractClientStatsCronFlow):
     for counter in self.counters:
       counter.Save(self.stats)
 
-  def ProcessClient(self, client):
+  def ProcessClient(self, summary):
     """Update counters for system, version and release attributes."""
-    ping = client.Get(client.Schema.PING)
-    if not ping:
+    if not summary.HasField("timestamp"):
       return
-    system = client.Get(client.Schema.SYSTEM, "Unknown")
+
+    ping = summary.timestamp
+    system = summary.system_info.system or "Unknown"
     # Windows, Linux, Darwin
     self.counters[0].Add(system, ping)
 
-    version = client.Get(client.Schema.VERSION, "Unknown")
+    version = summary.system_info.version or "Unknown"
     # Windows XP, Linux Ubuntu, Darwin OSX
     self.counters[1].Add("%s %s" % (system, version), ping)
 
-    release = client.Get(client.Schema.OS_RELEASE, "Unknown")
+    release = summary.system_info.release or "Unknown"
     # Windows XP 5.1.2600 SP3, Linux Ubuntu 12.04, Darwin OSX 10.8.2
     self.counters[2].Add("%s %s %s" % (system, version, release), ping)
 
@@ -224,12 +320,11 @@ class LastAccessStats(AbstractClientStatsCronFlow):
 
     self.stats.AddAttribute(graph)
 
-  def ProcessClient(self, client):
+  def ProcessClient(self, summary):
     now = rdfvalue.RDFDatetime().Now()
 
-    ping = client.Get(client.Schema.PING)
-    if ping:
-      time_ago = now - ping
+    if summary.HasField("timestamp"):
+      time_ago = now - summary.timestamp
       pos = bisect.bisect(self._bins, time_ago.microseconds)
 
       # If clients are older than the last bin forget them.
@@ -35,6 +35,32 @@ class SystemCronFlowTest(test_lib.FlowTestsBaseclass):
   def tearDown(self):
     time.time = self.old_time
 
+  def testClientFleetStatsIndex(self):
+    """Check that the index is rebuilt and updated when clients poll."""
+    for _ in test_lib.TestFlowHelper("ClientFleetStatsIndexCronFlow",
+                                     token=self.token):
+      pass
+
+    index = aff4.FACTORY.Create(
+        aff4.AFF4Object.ClientFleetStatsIndex.URN, "ClientFleetStatsIndex",
+        mode="r", token=self.token)
+    summaries = dict((x.client_id.Basename(), x) for x in index.ListClients())
+    self.assertEqual(len(summaries), 20)
+    self.assertEqual(summaries["C.1000000000000000"].system_info.system,
+                     "Linux")
+
+    # A client polling in a new refresh window updates its entry.
+    client = aff4.FACTORY.Open("C.1000000000000000", mode="rw",
+                               token=self.token)
+    previous_ping = client.Get(client.Schema.PING)
+    client.Set(client.Schema.PING(int(self.now * 1e6)))
+    index.ClientSeen(client, previous_ping, token=self.token)
+
+    summaries = dict((x.client_id.Basename(), x) for x in index.ListClients())
+    self.assertEqual(len(summaries), 20)
+    self.assertEqual(summaries["C.1000000000000000"].timestamp,
+                     int(self.now * 1e6))
+
   def testGRRVersionBreakDown(self):
     """Check that all client stats cron jobs are run."""
     for _ in test_lib.TestFlowHelper("GRRVersionBreakDown", token=self.token):
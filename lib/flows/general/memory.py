@@ -457,6 +457,10 @@ class ScanMemory(flow.GRRFlow):
       self.args.grep.literal = utils.Xor(
           self.args.grep.literal, self.XOR_IN_KEY)
 
+    literals = [utils.Xor(literal, self.XOR_IN_KEY)
+                for literal in self.args.grep.literals]
+    self.args.grep.literals = literals
+
     self.CallFlow("LoadMemoryDriver", next_state="Grep")
 
   @flow.StateHandler(next_state="Done")
@@ -146,6 +146,48 @@ class TestMemoryAnalysis(test_lib.FlowTestsBaseclass):
     self.assertEqual(fd[0].offset, 252)
     self.assertEqual(fd[0].data, "\n85\n86\n87\n88\n89\n90\n91\n")
 
+  def testScanMemoryForLiterals(self):
+    # Use a file in place of a memory image for simplicity
+    image_path = os.path.join(self.base_path, "numbers.txt")
+
+    self.CreateClient()
+    self.CreateSignedDriver()
+
+    class ClientMock(test_lib.MemoryClientMock):
+      """A mock which returns the image as the driver path."""
+
+      def GetMemoryInformation(self, _):
+        """Mock out the driver loading code to pass the memory image."""
+        reply = rdfvalue.MemoryInformation(
+            device=rdfvalue.PathSpec(
+                path=image_path,
+                pathtype=rdfvalue.PathSpec.PathType.OS))
+
+        reply.runs.Append(offset=0, length=1000000000)
+
+        return [reply]
+
+    args = dict(grep=rdfvalue.BareGrepSpec(
+        literals=["88", "77"],
+        mode="ALL_HITS",
+        ),
+                output="analysis/grep/testing")
+
+    # Run the flow.
+    for _ in test_lib.TestFlowHelper(
+        "ScanMemory", ClientMock("Grep"), client_id=self.client_id,
+        token=self.token, **args):
+      pass
+
+    fd = aff4.FACTORY.Open(
+        rdfvalue.RDFURN(self.client_id).Add("/analysis/grep/testing"),
+        token=self.token)
+
+    # Both literals are found.
+    self.assertEqual(len(fd), 40)
+    self.assertEqual(fd[0].offset, 219)
+    self.assertEqual(fd[0].data, "\n74\n75\n76\n77\n78\n79\n80\n")
+
 
 class ListVADBinariesActionMock(test_lib.ActionMock):
   """Client with real file actions and mocked-out VolatilityAction."""
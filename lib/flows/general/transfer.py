@@ -3,6 +3,7 @@
 
 
 import hashlib
+import struct
 import time
 import zlib
 
@@ -10,6 +11,8 @@ import logging
 from grr.lib import aff4
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.aff4_objects import filestore
 from grr.proto import flows_pb2
 
@@ -180,6 +183,8 @@ class FileTracker(object):
     self.stat_entry = stat_entry
     self.digest = None
     self.hash_list = []
+    # The end of the chunks to fetch, if they are of variable size.
+    self.fetch_end = None
     self.pathspec = stat_entry.pathspec
     self.urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(
         self.pathspec, client_id)
@@ -216,6 +221,15 @@ class FileTracker(object):
 class MultiGetFileArgs(rdfvalue.RDFProtoStruct):
   protobuf = flows_pb2.MultiGetFileArgs
 
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoBoolean(
+          name="content_defined_chunking", field_number=4, default=False,
+          description="If true, files are split into chunks at content defined "
+          "boundaries, so only the changed regions of files we fetched before "
+          "are transferred again.",
+          labels=[rdfvalue.SemanticDescriptor.Labels.ADVANCED]),
+      )
+
 
 class MultiGetFile(flow.GRRFlow):
   """A flow to effectively retrieve a number of files."""
@@ -228,9 +242,28 @@ class MultiGetFile(flow.GRRFlow):
   # allows us to amortize file store round trips and increases throughput.
   MIN_CALL_TO_FILE_STORE = 200
 
+  # Clients from this version on support the HashFileChunks action.
+  HASH_FILE_CHUNKS_MIN_CLIENT_VERSION = 2921
+
+  # Clients from this version on can split files at content defined boundaries.
+  # Older clients ignore the content_defined field of HashFileChunksRequest.
+  CONTENT_DEFINED_CHUNKS_MIN_CLIENT_VERSION = 2922
+
+  # The size of the sha256 digests HashFileChunks packs into its responses.
+  DIGEST_SIZE = 32
+
   @flow.StateHandler(next_state=["ReceiveFileHash", "StoreStat"])
   def Start(self):
     """Start state of the flow."""
+    client = aff4.FACTORY.Open(self.client_id, mode="r", token=self.token)
+    client_info = client.Get(client.Schema.CLIENT_INFO)
+    client_version = client_info and client_info.client_version or 0
+    self.state.Register("use_hash_file_chunks", (
+        client_version >= self.HASH_FILE_CHUNKS_MIN_CLIENT_VERSION))
+    self.state.Register("use_content_defined_chunks", bool(
+        self.args.content_defined_chunking and client_version >=
+        self.CONTENT_DEFINED_CHUNKS_MIN_CLIENT_VERSION))
+
     self.state.Register("files_hashed", 0)
     self.state.Register("files_to_fetch", 0)
     self.state.Register("files_fetched", 0)
@@ -276,7 +309,7 @@ class MultiGetFile(flow.GRRFlow):
     vfs_urn = responses.request_data["vfs_urn"]
     self.state.pending_hashes[vfs_urn] = FileTracker(stat_entry, self.client_id)
 
-  @flow.StateHandler(next_state="CheckHash")
+  @flow.StateHandler(next_state=["CheckHash", "CheckHashChunks"])
   def ReceiveFileHash(self, responses):
     """Add hash digest to tracker and check with filestore."""
     vfs_urn = responses.request_data["vfs_urn"]
@@ -381,6 +414,8 @@ class MultiGetFile(flow.GRRFlow):
       # Create the VFS file for this file tracker.
       file_tracker.CreateVFSFile("VFSBlobImage", token=self.token,
                                  chunksize=self.CHUNK_SIZE)
+      if self.state.use_content_defined_chunks:
+        file_tracker.fd.UseVariableChunks()
 
       # We do not have the file here yet - we need to retrieve it.
       expected_number_of_hashes = (file_tracker.stat_entry.st_size /
@@ -390,6 +425,17 @@ class MultiGetFile(flow.GRRFlow):
       # VFS cache hit rate and is far more efficient than launching multiple
       # GetFile flows.
       self.state.files_to_fetch += 1
+      if self.state.use_hash_file_chunks:
+        # Newer clients hash all the chunks in a single request.
+        self.CallClient("HashFileChunks", pathspec=file_tracker.pathspec,
+                        offset=0,
+                        length=expected_number_of_hashes * self.CHUNK_SIZE,
+                        chunk_size=self.CHUNK_SIZE,
+                        content_defined=self.state.use_content_defined_chunks,
+                        next_state="CheckHashChunks",
+                        request_data=dict(urn=vfs_urn))
+        continue
+
       for i in range(expected_number_of_hashes):
         self.CallClient("HashBuffer", pathspec=file_tracker.pathspec,
                         offset=i * self.CHUNK_SIZE,
@@ -416,14 +462,90 @@ class MultiGetFile(flow.GRRFlow):
       del self.state.pending_files[vfs_urn]
       return
 
-    hash_tracker = HashTracker(hash_response)
-    file_tracker.hash_list.append(hash_tracker)
+    self._AddBlockHash(file_tracker, hash_response)
 
-    self.state.blobs_we_need.add(hash_tracker.blob_urn)
+    if len(self.state.blobs_we_need) > self.MIN_CALL_TO_FILE_STORE:
+      self.FetchFileContent()
+
+  @flow.StateHandler(next_state="WriteBuffer")
+  def CheckHashChunks(self, responses):
+    """Adds all the block hashes sent by HashFileChunks to the file tracker."""
+    vfs_urn = responses.request_data["urn"]
+    file_tracker = self.state.pending_files[vfs_urn]
+
+    if not responses.success:
+      self.Log("Failed to read %s: %s" % (file_tracker.urn, responses.status))
+      del self.state.pending_files[vfs_urn]
+      return
+
+    offset = 0
+    for response in responses:
+      chunks = None
+      if self.state.use_content_defined_chunks:
+        chunks = self._ParseContentDefinedChunks(response)
+
+      if chunks is None:
+        chunks = self._ParseFixedSizeChunks(response)
+
+      offset = response.offset
+      for length, digest in chunks:
+        self._AddBlockHash(file_tracker, rdfvalue.BufferReference(
+            offset=offset, length=length, data=digest))
+        offset += length
+
+    if self.state.use_content_defined_chunks:
+      file_tracker.fetch_end = offset
 
     if len(self.state.blobs_we_need) > self.MIN_CALL_TO_FILE_STORE:
       self.FetchFileContent()
 
+  def _ParseFixedSizeChunks(self, response):
+    """Returns the lengths and digests of a response with bare digests."""
+    # Every chunk but the last one in the range is CHUNK_SIZE long.
+    chunks = []
+    offset = response.offset
+    end = response.offset + response.length
+    for i in range(0, len(response.data), self.DIGEST_SIZE):
+      length = min(self.CHUNK_SIZE, end - offset)
+      chunks.append((length, response.data[i:i + self.DIGEST_SIZE]))
+      offset += length
+
+    return chunks
+
+  def _ParseContentDefinedChunks(self, response):
+    """Returns the lengths and digests of a content defined response.
+
+    Every digest is preceded by the length of its chunk. A client which did not
+    understand the request sends bare digests instead, which is detected by the
+    chunk lengths not adding up to the length of the response.
+
+    Args:
+      response: A BufferReference sent by HashFileChunks.
+
+    Returns:
+      A list of (length, digest) tuples or None if the response does not hold
+      content defined chunks.
+    """
+    entry_size = self.DIGEST_SIZE + 8
+    if len(response.data) % entry_size:
+      return None
+
+    chunks = []
+    for i in range(0, len(response.data), entry_size):
+      length, = struct.unpack("<Q", response.data[i:i + 8])
+      chunks.append((length, response.data[i + 8:i + entry_size]))
+
+    if sum(length for length, _ in chunks) != response.length:
+      return None
+
+    return chunks
+
+  def _AddBlockHash(self, file_tracker, hash_response):
+    hash_tracker = HashTracker(hash_response)
+    file_tracker.hash_list.append(hash_tracker)
+
+    self.state.blobs_we_need.add(hash_tracker.blob_urn)
+
   def FetchFileContent(self):
     """Fetch as much as the file's content as possible.
 
@@ -434,7 +556,8 @@ class MultiGetFile(flow.GRRFlow):
       return
 
     # Check if we have all the blobs in the blob AFF4 namespace..
-    stats = aff4.FACTORY.Stat(self.state.blobs_we_need, token=self.token)
+    stats = filestore.EXISTENCE_FILTER.Stat(self.state.blobs_we_need,
+                                            token=self.token)
     blobs_we_have = set([x["urn"] for x in stats])
     self.state.blobs_we_need = set()
 
@@ -477,8 +600,15 @@ class MultiGetFile(flow.GRRFlow):
     if file_tracker:
       file_tracker.fd.AddBlob(response.data, response.length)
 
-      if (response.length < file_tracker.fd.chunksize or
-          response.offset + response.length >= file_tracker.stat_entry.st_size):
+      if file_tracker.fetch_end is not None:
+        # Variable sized chunks may be short anywhere in the file.
+        done = response.offset + response.length >= file_tracker.fetch_end
+      else:
+        done = (response.length < file_tracker.fd.chunksize or
+                response.offset + response.length >=
+                file_tracker.stat_entry.st_size)
+
+      if done:
         # File done, remove from the store and close it.
         self.RemoveInFlightFile(vfs_urn)
 
@@ -502,7 +632,8 @@ class MultiGetFile(flow.GRRFlow):
     if file_tracker:
       self.SendReply(file_tracker.stat_entry)
 
-  @flow.StateHandler(next_state=["CheckHash", "WriteBuffer"])
+  @flow.StateHandler(next_state=["CheckHash", "CheckHashChunks",
+                                 "WriteBuffer"])
   def End(self):
     # There are some files still in flight.
     if self.state.pending_hashes or self.state.pending_files:
@@ -530,21 +661,72 @@ class FileStoreCreateFile(flow.EventListener):
 
   CHUNK_SIZE = 512 * 1024
 
+  # The maximum number of files added to the file store at once.
+  BATCH_SIZE = 100
+
   def UpdateIndex(self, target_urn, src_urn):
     """Update the index from the source to the target."""
     idx = aff4.FACTORY.Create(src_urn, "AFF4Index", mode="w", token=self.token)
     idx.Add(target_urn, "", target_urn)
 
+  def ProcessRequests(self, thread_pool):
+    """Adds the files of all the pending events to the file store in batches."""
+    for messages in utils.Grouper(self.FetchMessages(), self.BATCH_SIZE):
+      thread_pool.AddTask(target=self._SafeProcessMessages,
+                          args=(messages,), name=self.__class__.__name__)
+
+  def _SafeProcessMessages(self, messages):
+    try:
+      self.ProcessMessages(messages)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error in FileStoreCreateFile.ProcessMessages: %s", e)
+
+      # Retry the files one at a time so a single bad file does not drop the
+      # rest of the batch.
+      if len(messages) > 1:
+        for message in messages:
+          self._SafeProcessMessages([message])
+
+  def ProcessMessages(self, messages):
+    """Adds the files of a batch of events to the file store."""
+    vfs_urns = []
+    for message in messages:
+      try:
+        vfs_urns.append(self._GetFileUrn(message))
+      except RuntimeError as e:
+        logging.error("Rejected FileStore.AddFileToStore event: %s", e)
+
+    self.AddFiles(vfs_urns)
+
+  @flow.EventHandler()
+  def _GetFileUrn(self, message=None, event=None):
+    _ = message
+    return event
+
   @flow.EventHandler()
   def ProcessMessage(self, message=None, event=None):
     """Process the new file and add to the file store."""
-    _ = event
-    vfs_urn = message.payload
-    with aff4.FACTORY.Open(vfs_urn, mode="rw", token=self.token) as vfs_fd:
-      filestore_fd = aff4.FACTORY.Create(filestore.FileStore.PATH, "FileStore",
-                                         mode="w", token=self.token)
-      filestore_fd.AddFile(vfs_fd)
-      vfs_fd.Flush(sync=False)
+    _ = message
+    self.AddFiles([event])
+
+  def AddFiles(self, vfs_urns):
+    """Adds the files to the file store.
+
+    Args:
+      vfs_urns: The urns of the VFSBlobImages to add. The same file may be
+                listed several times.
+    """
+    if not vfs_urns:
+      return
+
+    vfs_fds = list(aff4.FACTORY.MultiOpen(set(vfs_urns), mode="rw",
+                                          token=self.token))
+    filestore_fd = aff4.FACTORY.Create(filestore.FileStore.PATH, "FileStore",
+                                       mode="w", token=self.token)
+    filestore_fd.AddFiles(vfs_fds)
+
+    for vfs_fd in vfs_fds:
+      vfs_fd.Close(sync=False)
 
 
 class GetMBRArgs(rdfvalue.RDFProtoStruct):
@@ -633,6 +815,7 @@ class TransferStore(flow.WellKnownFlow):
       fd.Set(fd.Schema.CONTENT(cdata))
       fd.Set(fd.Schema.SIZE(len(data)))
       super(aff4.AFF4MemoryStream, fd).Close(sync=True)
+      filestore.EXISTENCE_FILTER.Add(urn)
 
       logging.info("Got blob %s (length %s)", digest.encode("hex"),
                    len(cdata))
@@ -115,6 +115,125 @@ class TestTransfer(test_lib.FlowTestsBaseclass):
     fd = aff4.FACTORY.Open(urn, token=self.token)
     self.assertEqual(fd.size, 2*1024*1024 + 5)
 
+  def testMultiGetFileWithHashFileChunks(self):
+    """Test that MultiGetFile hashes files in one request on new clients."""
+    version = transfer.MultiGetFile.HASH_FILE_CHUNKS_MIN_CLIENT_VERSION
+    client = aff4.FACTORY.Open(self.client_id, mode="rw", token=self.token)
+    client.Set(client.Schema.CLIENT_INFO(client_name="GRR Monitor",
+                                         client_version=version))
+    client.Close()
+
+    client_mock = test_lib.ActionMock("TransferBuffer", "StatFile", "HashFile",
+                                      "HashFileChunks")
+    pathspec = rdfvalue.PathSpec(
+        pathtype=rdfvalue.PathSpec.PathType.OS,
+        path=os.path.join(self.base_path, "test_img.dd"))
+
+    # Use small chunks so the file spans many of them.
+    with test_lib.Stubber(transfer.MultiGetFile, "CHUNK_SIZE", 16 * 1024):
+      with test_lib.Instrument(
+          standard.HashBuffer, "Run") as hash_buffer_instrument:
+        for _ in test_lib.TestFlowHelper("MultiGetFile", client_mock,
+                                         token=self.token,
+                                         client_id=self.client_id,
+                                         pathspecs=[pathspec]):
+          pass
+
+    # The file was never hashed chunk by chunk.
+    self.assertEqual(len(hash_buffer_instrument.args), 0)
+
+    # Fix path for Windows testing.
+    pathspec.path = pathspec.path.replace("\\", "/")
+    # Test the AFF4 file that was created.
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec, self.client_id)
+    fd1 = aff4.FACTORY.Open(urn, token=self.token)
+    fd2 = open(pathspec.path)
+    fd2.seek(0, 2)
+
+    self.assertEqual(fd2.tell(), int(fd1.Get(fd1.Schema.SIZE)))
+    self.CompareFDs(fd1, fd2)
+
+  def testMultiGetFileWithContentDefinedChunks(self):
+    """Test that only the changed regions of a file are fetched again."""
+    version = transfer.MultiGetFile.CONTENT_DEFINED_CHUNKS_MIN_CLIENT_VERSION
+    client = aff4.FACTORY.Open(self.client_id, mode="rw", token=self.token)
+    client.Set(client.Schema.CLIENT_INFO(client_name="GRR Monitor",
+                                         client_version=version))
+    client.Close()
+
+    client_mock = test_lib.ActionMock("TransferBuffer", "StatFile", "HashFile",
+                                      "HashFileChunks")
+    pathspec = rdfvalue.PathSpec(
+        pathtype=rdfvalue.PathSpec.PathType.OS,
+        path=os.path.join(self.temp_dir, "growing.log"))
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec, self.client_id)
+
+    data = "".join("Line %d of the log.\n" % i for i in range(10000))
+    transferred = []
+    for content in [data, "Inserted line.\n" + data]:
+      with open(pathspec.path, "wb") as fd:
+        fd.write(content)
+
+      with test_lib.Stubber(transfer.MultiGetFile, "CHUNK_SIZE", 16 * 1024):
+        with test_lib.Instrument(
+            standard.TransferBuffer, "Run") as transfer_buffer_instrument:
+          for _ in test_lib.TestFlowHelper("MultiGetFile", client_mock,
+                                           token=self.token,
+                                           client_id=self.client_id,
+                                           pathspecs=[pathspec],
+                                           content_defined_chunking=True):
+            pass
+
+      transferred.append(len(transfer_buffer_instrument.args))
+
+      fd = aff4.FACTORY.Open(urn, token=self.token)
+      self.assertEqual(fd.size, len(content))
+      self.assertEqual(fd.Read(len(content)), content)
+
+    # The second time only the chunk with the inserted line was transferred.
+    self.assertGreater(transferred[0], 10)
+    self.assertLessEqual(transferred[1], 2)
+
+  def testMultiGetFileWithClientIgnoringContentDefinedChunks(self):
+    """Test that bare digests are accepted when content defined are expected."""
+    version = transfer.MultiGetFile.CONTENT_DEFINED_CHUNKS_MIN_CLIENT_VERSION
+    client = aff4.FACTORY.Open(self.client_id, mode="rw", token=self.token)
+    client.Set(client.Schema.CLIENT_INFO(client_name="GRR Monitor",
+                                         client_version=version))
+    client.Close()
+
+    client_mock = test_lib.ActionMock("TransferBuffer", "StatFile", "HashFile",
+                                      "HashFileChunks")
+    pathspec = rdfvalue.PathSpec(
+        pathtype=rdfvalue.PathSpec.PathType.OS,
+        path=os.path.join(self.temp_dir, "old_client.log"))
+    urn = aff4.AFF4Object.VFSGRRClient.PathspecToURN(pathspec, self.client_id)
+
+    content = "".join("Line %d of the log.\n" % i for i in range(10000))
+    with open(pathspec.path, "wb") as fd:
+      fd.write(content)
+
+    # Clients before content defined chunking ignore the request field.
+    run = standard.HashFileChunks.Run
+
+    def RunWithoutContentDefined(action, args):
+      args.content_defined = False
+      return run(action, args)
+
+    with test_lib.Stubber(transfer.MultiGetFile, "CHUNK_SIZE", 16 * 1024):
+      with test_lib.Stubber(standard.HashFileChunks, "Run",
+                            RunWithoutContentDefined):
+        for _ in test_lib.TestFlowHelper("MultiGetFile", client_mock,
+                                         token=self.token,
+                                         client_id=self.client_id,
+                                         pathspecs=[pathspec],
+                                         content_defined_chunking=True):
+          pass
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    self.assertEqual(fd.size, len(content))
+    self.assertEqual(fd.Read(len(content)), content)
+
   def CompareFDs(self, fd1, fd2):
     ranges = [
         # Start of file
@@ -14,13 +14,16 @@ from grr.lib.hunts import tests
 # pylint: enable=unused-import,g-bad-import-order
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 
 # These imports populate the GRRHunt registry.
 from grr.lib import hunts
+from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import test_lib
+from grr.lib.hunts import aggregates
 
 
 class TestHuntListener(flow.EventListener):
@@ -65,6 +68,31 @@ class DummyHunt(hunts.GRRHunt):
       self.MarkClientDone(client_id)
 
 
+class LargeReplyHunt(hunts.GRRHunt):
+  """Hunt that stores the responses it receives in a class variable."""
+
+  responses = []
+
+  @flow.StateHandler()
+  def StoreResponses(self, responses):
+    LargeReplyHunt.responses.extend(responses)
+
+
+class DeferredThreadPool(object):
+  """A thread pool which only runs its tasks when asked to."""
+
+  def __init__(self):
+    self.tasks = []
+
+  def AddTask(self, target, args, name="Unnamed task"):
+    _ = name
+    self.tasks.append((target, args))
+
+  def RunTasks(self):
+    for target, args in self.tasks:
+      target(*args)
+
+
 class HuntTest(test_lib.FlowTestsBaseclass):
   """Tests the Hunt."""
 
@@ -206,6 +234,108 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     with hunt.GetRunner() as runner:
       self.assertFalse(runner.IsHuntStarted())
 
+  def testHuntSummaryIndex(self):
+    """Check that hunts keep their summaries up to date."""
+    hunt_urns = []
+    for i in range(3):
+      with test_lib.Stubber(time, "time", lambda: 1000 + i):
+        with hunts.GRRHunt.StartHunt(
+            hunt_name="SampleHunt", description="Hunt %d" % i,
+            client_rate=0, token=self.token) as hunt:
+          hunt_urns.append(hunt.urn)
+
+    index = aff4.FACTORY.Create(hunts.implementation.HuntSummaryIndex.URN,
+                                "HuntSummaryIndex", mode="r",
+                                token=self.token)
+
+    # Hunts are listed newest first.
+    total, summaries = index.ListHunts()
+    self.assertEqual(total, 3)
+    self.assertEqual([x.hunt_urn for x in summaries], hunt_urns[::-1])
+
+    total, summaries = index.ListHunts(offset=1, count=1)
+    self.assertEqual(total, 3)
+    self.assertEqual(len(summaries), 1)
+
+    summary = summaries[0]
+    self.assertEqual(summary.hunt_urn, hunt_urns[1])
+    self.assertEqual(summary.name, "SampleHunt")
+    self.assertEqual(summary.description, "Hunt 1")
+    self.assertEqual(summary.creator, self.token.username)
+    self.assertEqual(summary.state, "PAUSED")
+
+    with aff4.FACTORY.Open(hunt_urns[1], mode="rw",
+                           token=self.token) as hunt:
+      with hunt.GetRunner() as runner:
+        runner.Start()
+
+    total, summaries = index.ListHunts(offset=1, count=1)
+    self.assertEqual(total, 3)
+    self.assertEqual(summaries[0].state, "STARTED")
+
+  def testHuntSummaryIndexIsRebuiltAndUpdatedOnDelete(self):
+    """Check that old hunts are listed and deleted hunts are not."""
+    hunt_urns = []
+    for i in range(3):
+      with test_lib.Stubber(time, "time", lambda: 1000 + i):
+        with hunts.GRRHunt.StartHunt(hunt_name="SampleHunt", client_rate=0,
+                                     token=self.token) as hunt:
+          hunt_urns.append(hunt.urn)
+
+    # Hunts created before the index existed are not in it.
+    index_urn = hunts.implementation.HuntSummaryIndex.URN
+    data_store.DB.DeleteSubject(index_urn, token=self.token)
+
+    index = aff4.FACTORY.Create(index_urn, "HuntSummaryIndex", mode="r",
+                                token=self.token)
+    total, summaries = index.ListHunts()
+    self.assertEqual(total, 3)
+    self.assertEqual([x.hunt_urn for x in summaries], hunt_urns[::-1])
+
+    aff4.FACTORY.Delete(hunt_urns[1], token=self.token)
+
+    total, summaries = index.ListHunts()
+    self.assertEqual(total, 2)
+    self.assertEqual([x.hunt_urn for x in summaries],
+                     [hunt_urns[2], hunt_urns[0]])
+
+  def testResultsAggregates(self):
+    """Check that the aggregators keep their aggregates up to date."""
+    aggregators = [
+        aggregates.CountAggregator(
+            "names", rdf_type="Process", key="name", max_keys=2),
+        aggregates.CountAggregator(
+            "clients", rdf_type="Process", key="name", per_client=True),
+        aggregates.DistributionAggregator(
+            "sizes", rdf_type="StatEntry", key="st_size", bins=[10, 100])]
+
+    urn = rdfvalue.RDFURN("aff4:/hunts/W:123456/ResultsAggregates")
+    with aff4.FACTORY.Create(urn, "HuntResultsAggregates", mode="rw",
+                             token=self.token) as fd:
+      fd.Update(aggregators, [rdfvalue.Process(name="a"),
+                              rdfvalue.Process(name="a"),
+                              rdfvalue.Process(name="b"),
+                              rdfvalue.StatEntry(st_size=5)])
+      fd.Update(aggregators, [rdfvalue.Process(name="a"),
+                              rdfvalue.Process(name="c"),
+                              rdfvalue.StatEntry(st_size=50)])
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+
+    # Only two names are kept so "c" replaced "b" and inherited its count.
+    names = fd.GetAggregate("names")
+    self.assertEqual(names.GetTop(), [("a", 3), ("c", 2)])
+    self.assertEqual(names.counts[1].error, 1)
+    self.assertEqual(names.num_values, 5)
+
+    clients = fd.GetAggregate("clients")
+    self.assertEqual(clients.GetTop(), [("a", 2), ("b", 1), ("c", 1)])
+
+    sizes = fd.GetAggregate("sizes").distribution
+    self.assertEqual(sizes.num, 2)
+    self.assertAlmostEqual(sizes.mean, 27.5)
+    self.assertEqual([b.num for b in sizes.histogram.bins], [1, 1])
+
   def testInvalidRules(self):
     """Tests the behavior when a wrong attribute name is passed in a rule."""
 
@@ -314,14 +444,112 @@ class HuntTest(test_lib.FlowTestsBaseclass):
         hunt.session_id, mode="r", age=aff4.ALL_TIMES,
         aff4_type="SampleHunt", token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     self.assertEqual(len(set(started)), 10)
     self.assertEqual(len(set(finished)), 10)
 
     self.DeleteClients(10)
 
+  def testClientStatusStore(self):
+    """Check that client status is counted and paged correctly."""
+    store = hunts.implementation.HuntClientStatusStore(
+        "aff4:/hunts/W:123456", token=self.token)
+
+    # These clients are spread over many rows of the store.
+    client_ids = ["C.%02x%014x" % (i, i) for i in range(0, 256, 8)]
+    for client_id in reversed(client_ids):
+      self.assertTrue(store.AddClient(client_id))
+
+    # Adding a client twice is ignored.
+    self.assertFalse(store.AddClient(client_ids[0]))
+
+    for client_id in client_ids[:10]:
+      self.assertTrue(store.MarkCompleted(client_id))
+
+    self.assertFalse(store.MarkCompleted(client_ids[0]))
+    self.assertFalse(store.AddClient(client_ids[0]))
+
+    self.assertEqual(store.GetCounts(), {store.OUTSTANDING: 22,
+                                         store.COMPLETED: 10})
+    self.assertEqual(store.GetStatus(client_ids[0]), store.COMPLETED)
+    self.assertEqual(store.GetStatus(client_ids[10]), store.OUTSTANDING)
+    self.assertEqual(store.GetStatus("C.1000000000000001"), None)
+
+    # Page through the outstanding clients.
+    pages = []
+    start_after = None
+    while True:
+      page = list(store.ListClients(store.OUTSTANDING, start_after=start_after,
+                                    limit=5))
+      if not page:
+        break
+
+      pages.append(page)
+      start_after = page[-1]
+
+    self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 2])
+    self.assertEqual([x.Basename() for page in pages for x in page],
+                     client_ids[10:])
+
+    completed = list(store.ListClients(store.COMPLETED))
+    self.assertEqual([x.Basename() for x in completed], client_ids[:10])
+
+  def testClientStatusStoreIsDeletedWithHunt(self):
+    """Check that deleting a hunt removes the rows of its status store."""
+    with hunts.GRRHunt.StartHunt(hunt_name="SampleHunt", client_rate=0,
+                                 token=self.token) as hunt:
+      pass
+
+    store = hunts.implementation.HuntClientStatusStore(hunt.urn,
+                                                       token=self.token)
+    for i in range(5):
+      store.AddClient("C.1%015d" % i)
+    store.MarkCompleted("C.1%015d" % 0)
+
+    aff4.FACTORY.Delete(hunt.urn, token=self.token)
+
+    deleted = hunts.implementation.HuntClientStatusStore(hunt.urn,
+                                                         token=self.token)
+    self.assertEqual(deleted.GetCounts(), {deleted.OUTSTANDING: 0,
+                                           deleted.COMPLETED: 0})
+    for row in [deleted.urn] + [deleted.urn.Add(bucket)
+                                for bucket in deleted.BUCKETS]:
+      self.assertEqual(list(data_store.DB.ResolveRegex(
+          row, ".*", token=self.token)), [])
+
+  def testClientStatusStoreReadsLegacyAttributes(self):
+    """Check that hunts which kept clients in attributes are still counted."""
+    hunt_urn = rdfvalue.RDFURN("aff4:/hunts/W:654321")
+    store = hunts.implementation.HuntClientStatusStore
+    client_ids = ["C.1%015d" % i for i in range(4)]
+
+    data_store.DB.MultiSet(hunt_urn, {
+        store.LEGACY_CLIENTS: [("aff4:/%s" % x, 1000) for x in client_ids],
+        store.LEGACY_FINISHED: [("aff4:/%s" % client_ids[1], 2000)]},
+                           replace=False, token=self.token)
+
+    legacy = store(hunt_urn, token=self.token)
+    self.assertEqual(legacy.GetCounts(), {store.OUTSTANDING: 3,
+                                          store.COMPLETED: 1})
+    self.assertEqual(legacy.GetStatus(client_ids[1]), store.COMPLETED)
+    self.assertEqual([x.Basename() for x in legacy.ListClients(
+        store.OUTSTANDING, start_after=client_ids[0])],
+                     [client_ids[2], client_ids[3]])
+
+    # The first update imports the legacy clients.
+    self.assertFalse(legacy.AddClient(client_ids[0]))
+    self.assertTrue(legacy.MarkCompleted(client_ids[0]))
+
+    imported = store(hunt_urn, token=self.token)
+    self.assertEqual(imported.GetCounts(), {store.OUTSTANDING: 2,
+                                            store.COMPLETED: 2})
+    completed = list(imported.ListClients(store.COMPLETED))
+    self.assertEqual([x.Basename() for x in completed], client_ids[:2])
+    self.assertEqual(int(completed[1].age), 2000)
+    self.assertEqual(imported.legacy_clients, {})
+
   def testHangingClients(self):
     """This tests if the hunt completes when some clients hang or raise."""
     # Set up 10 clients.
@@ -349,8 +577,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     # We started the hunt on 10 clients.
     self.assertEqual(len(set(started)), 10)
@@ -427,8 +655,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.urn, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
 
     # We limited here to 5 clients.
     self.assertEqual(len(set(started)), 5)
@@ -464,8 +692,8 @@ class HuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, mode="rw",
                                  age=aff4.ALL_TIMES, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
     errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
     self.assertEqual(len(set(started)), 10)
@@ -554,6 +782,48 @@ class HuntTest(test_lib.FlowTestsBaseclass):
         worker_mock.Simulate()
         self.assertEqual(len(DummyHunt.client_ids), i + 1)
 
+  def testLargeReplies(self):
+    """Check that all the responses of a large reply are processed."""
+    LargeReplyHunt.responses = []
+    with hunts.GRRHunt.StartHunt(hunt_name="LargeReplyHunt",
+                                 token=self.token) as hunt:
+      session_id = hunt.session_id
+
+    num_responses = queue_manager.QueueManager.response_window_size + 500
+    authenticated = rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.QueueRequest(session_id, rdfvalue.RequestState(
+          id=1, client_id=self.client_id, next_state="StoreResponses",
+          session_id=session_id))
+
+      for response_id in range(1, num_responses + 1):
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            session_id=session_id, request_id=1, response_id=response_id,
+            payload=rdfvalue.RDFInteger(response_id),
+            auth_state=authenticated))
+
+      manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+          session_id=session_id, request_id=1,
+          response_id=num_responses + 1, payload=rdfvalue.GrrStatus(),
+          type=rdfvalue.GrrMessage.Type.STATUS, auth_state=authenticated))
+
+    # A busy thread pool only runs the task after the request and its
+    # responses have been deleted.
+    thread_pool = DeferredThreadPool()
+    with aff4.FACTORY.Open(session_id, mode="rw", token=self.token) as hunt:
+      runner = hunt.GetRunner()
+      for request, responses in runner.queue_manager.FetchCompletedResponses(
+          session_id):
+        self.assertTrue(isinstance(responses, queue_manager.ResponsePager))
+        runner._Process(request, responses, thread_pool=thread_pool,
+                        events=[])
+        runner.queue_manager.DeleteFlowRequestStates(session_id, request)
+
+      thread_pool.RunTasks()
+
+    self.assertEqual(LargeReplyHunt.responses,
+                     range(1, num_responses + 1))
+
 
 class FlowTestLoader(test_lib.GRRTestLoader):
   base_class = test_lib.FlowTestsBaseclass
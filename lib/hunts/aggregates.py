@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Aggregates over hunt results, maintained as the results arrive.
+
+Hunts declare the aggregates they keep in their result_aggregators class
+attribute. Every batch of results a hunt receives from a client is handed to
+these aggregators, which update their aggregate in place. The aggregates are
+stored in a single HuntResultsAggregates object next to the hunt's results, so
+histograms and other statistics are read without touching the results.
+
+Only the worker holding the lease on the hunt updates the aggregates, so they
+are read, updated in memory and written back when the hunt is saved.
+"""
+
+
+import threading
+
+from grr.lib import aff4
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+class ResultAggregator(object):
+  """The base class for aggregators over hunt results."""
+
+  def __init__(self, name, rdf_type=None, key=None, description=""):
+    """Constructor.
+
+    Args:
+      name: The name of the aggregate.
+      rdf_type: The name of the RDFValue class of the results aggregated. If
+                None all results are aggregated.
+      key: Either a callable returning the value to aggregate for a result, or
+           the name of a (possibly dotted) attribute of the result. If None the
+           result itself is aggregated. If the callable returns None, the
+           result is skipped.
+      description: A description of the aggregate.
+    """
+    self.name = name
+    self.rdf_type = rdf_type
+    self.key = key
+    self.description = description
+
+  def GetValue(self, result):
+    if self.key is None:
+      return result
+
+    if callable(self.key):
+      return self.key(result)
+
+    value = result
+    for attribute in self.key.split("."):
+      value = getattr(value, attribute)
+
+    return value
+
+  def GetValues(self, results):
+    """Returns the values to aggregate for a batch of results."""
+    values = []
+    for result in results:
+      if (self.rdf_type is not None and
+          result.__class__.__name__ != self.rdf_type):
+        continue
+
+      value = self.GetValue(result)
+      if value is not None:
+        values.append(value)
+
+    return values
+
+  def Update(self, aggregate, results):
+    """Updates the aggregate with a batch of results from a single client.
+
+    Args:
+      aggregate: The rdfvalue.HuntResultAggregate to update.
+      results: The list of results.
+    """
+    raise NotImplementedError()
+
+
+class CountAggregator(ResultAggregator):
+  """Counts the results by value, keeping the most common values.
+
+  Only max_keys values are kept. Once that many values are known, a new value
+  replaces the least common one and inherits its count (the "Space-Saving"
+  algorithm of Metwally et al.). The counts of the most common values remain
+  accurate while the memory used is bounded, and every count records how much
+  it may overestimate the true count.
+  """
+
+  def __init__(self, name, per_client=False, max_keys=1000, **kwargs):
+    """Constructor.
+
+    Args:
+      name: The name of the aggregate.
+      per_client: If True, count the clients which returned each value instead
+                  of the results.
+      max_keys: The maximum number of values to keep counts for.
+      **kwargs: Passthrough to ResultAggregator.
+    """
+    super(CountAggregator, self).__init__(name, **kwargs)
+    self.per_client = per_client
+    self.max_keys = max_keys
+
+  def Update(self, aggregate, results):
+    keys = [utils.SmartUnicode(value) for value in self.GetValues(results)]
+    if self.per_client:
+      keys = set(keys)
+
+    if not keys:
+      return
+
+    counts = dict((c.key, [c.count, c.error]) for c in aggregate.counts)
+    for key in keys:
+      entry = counts.get(key)
+      if entry is not None:
+        entry[0] += 1
+      elif len(counts) < self.max_keys:
+        counts[key] = [1, 0]
+      else:
+        least_common = min(counts, key=lambda k: counts[k][0])
+        count, _ = counts.pop(least_common)
+        counts[key] = [count + 1, count]
+
+    aggregate.num_values += len(keys)
+    aggregate.counts = [
+        rdfvalue.HuntResultAggregateCount(key=key, count=count, error=error)
+        for key, (count, error) in sorted(
+            counts.iteritems(), key=lambda (k, v): (-v[0], k))]
+
+
+class DistributionAggregator(ResultAggregator):
+  """Keeps the mean, standard deviation and histogram of numeric values."""
+
+  def __init__(self, name, bins=None, **kwargs):
+    """Constructor.
+
+    Args:
+      name: The name of the aggregate.
+      bins: The upper bounds of the histogram bins.
+      **kwargs: Passthrough to ResultAggregator.
+    """
+    super(DistributionAggregator, self).__init__(name, **kwargs)
+    self.bins = bins or []
+
+  def Update(self, aggregate, results):
+    values = self.GetValues(results)
+    if not values:
+      return
+
+    if not aggregate.HasField("distribution"):
+      aggregate.distribution = rdfvalue.RunningStats(
+          histogram=rdfvalue.StatsHistogram(self.bins))
+
+    for value in values:
+      aggregate.distribution.RegisterValue(float(value))
+
+    aggregate.num_values += len(values)
+
+
+class HuntResultsAggregates(aff4.AFF4Object):
+  """The aggregates over the results of a hunt."""
+
+  class SchemaCls(aff4.AFF4Object.SchemaCls):
+    AGGREGATES = aff4.Attribute(
+        "aff4:hunt_results_aggregates", rdfvalue.HuntResultAggregates,
+        "The current value of the aggregates.", versioned=False,
+        creates_new_object_version=False)
+
+  def Initialize(self):
+    super(HuntResultsAggregates, self).Initialize()
+    self.lock = threading.RLock()
+    self.aggregates = self.Get(self.Schema.AGGREGATES)
+    if self.aggregates is None:
+      self.aggregates = rdfvalue.HuntResultAggregates()
+
+  def GetAggregate(self, name):
+    return self.aggregates.GetAggregate(name)
+
+  def Update(self, aggregators, results):
+    """Updates the aggregates with a batch of results from a single client.
+
+    Args:
+      aggregators: A list of ResultAggregator instances.
+      results: A list of results.
+    """
+    with self.lock:
+      for aggregator in aggregators:
+        aggregate = self.aggregates.GetAggregate(aggregator.name)
+        if aggregate is None:
+          aggregate = rdfvalue.HuntResultAggregate(
+              name=aggregator.name, description=aggregator.description)
+          self.aggregates.aggregates.Append(aggregate)
+          # Make sure we update the instance held by the list.
+          aggregate = self.aggregates.GetAggregate(aggregator.name)
+
+        aggregator.Update(aggregate, results)
+
+      self.Set(self.Schema.AGGREGATES, self.aggregates)
@@ -30,6 +30,7 @@ from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import type_info
 from grr.lib import utils
+from grr.lib.hunts import aggregates
 from grr.lib.rdfvalues import flows
 from grr.proto import flows_pb2
 
@@ -72,8 +73,7 @@ class HuntRunner(flow_runner.FlowRunner):
       self._RegisterAndRunClient(client_id)
 
   def _RegisterAndRunClient(self, client_id):
-    self.flow_obj.AddAttribute(
-        self.flow_obj.Schema.CLIENTS(client_id))
+    self.flow_obj.client_status.AddClient(client_id)
     self.RunStateMethod("RunClient", direct_response=[client_id])
 
   def _Process(self, request, responses, thread_pool=None, events=None):
@@ -113,6 +113,12 @@ class HuntRunner(flow_runner.FlowRunner):
       self._RegisterAndRunClient(request.client_id)
       return
 
+    # The request and its responses are deleted from the data store as soon
+    # as this method returns, so responses paged by a ResponsePager must be
+    # read before the request is handed to the thread pool.
+    if isinstance(responses, queue_manager.ResponsePager):
+      responses = list(responses)
+
     event = threading.Event()
     events.append(event)
     # In a hunt, all requests are independent and can be processed
@@ -388,6 +394,461 @@ class HuntRunner(flow_runner.FlowRunner):
     self.QueueNotification(self.session_id, timestamp=start_time)
 
 
+class HuntClientStatusStore(object):
+  """Keeps track of the progress of every client of a hunt.
+
+  The clients are kept in rows next to the hunt object. Each row holds the
+  clients whose ids start with the same two hex digits, so no row grows too
+  large and reading the rows in order lists the clients sorted by id. A client
+  is a single cell named after its status, so moving it to another status is a
+  single write to its row. The number of clients in each status is maintained
+  in its own row so counting them takes a single read.
+
+  The counters are updated in a data store transaction, so workers processing
+  different clients of the same hunt do not lose each other's updates.
+
+  Hunts created before this store existed kept their clients in the versioned
+  aff4:clients and aff4:finished attributes of the hunt. While nothing has been
+  written to the store for such a hunt, these attributes are read instead, and
+  the first update imports them into the store.
+  """
+
+  OUTSTANDING = "OUTSTANDING"
+  COMPLETED = "COMPLETED"
+  STATUSES = [OUTSTANDING, COMPLETED]
+
+  PREFIX = "index:client/"
+  COUNT_PREFIX = "index:count/"
+
+  LEGACY_CLIENTS = "aff4:clients"
+  LEGACY_FINISHED = "aff4:finished"
+
+  BUCKETS = ["%02x" % i for i in range(256)]
+
+  # The number of rows fetched from the data store at once while listing.
+  ROWS_PER_READ = 16
+
+  def __init__(self, hunt_urn, token=None):
+    self.hunt_urn = rdfvalue.RDFURN(hunt_urn)
+    self.urn = self.hunt_urn.Add("ClientStatus")
+    self.token = token
+    self.lock = threading.RLock()
+
+    # The clients found in the legacy attributes, read on first use.
+    self.legacy_clients = None
+
+  def _Row(self, bucket):
+    return self.urn.Add(bucket)
+
+  def _ClientRow(self, client_id):
+    return self._Row(client_id[2:4].lower())
+
+  def _Predicate(self, status, client_id):
+    return "%s%s/%s" % (self.PREFIX, status, client_id)
+
+  def _ReadCounts(self):
+    """Returns the stored counts, or None if nothing was stored yet."""
+    counts = None
+    for predicate, value, _ in data_store.DB.ResolveRegex(
+        self.urn, self.COUNT_PREFIX + ".+",
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+      if counts is None:
+        counts = dict.fromkeys(self.STATUSES, 0)
+
+      status = predicate[len(self.COUNT_PREFIX):]
+      if status in counts:
+        counts[status] = int(value)
+
+    return counts
+
+  def _UpdateCounts(self, transaction, deltas=None):
+    """Adds the deltas to the counters, called in a transaction."""
+    counts = dict.fromkeys(self.STATUSES, 0)
+    for predicate, value, _ in transaction.ResolveRegex(
+        self.COUNT_PREFIX + ".+", timestamp=data_store.DB.NEWEST_TIMESTAMP):
+      status = predicate[len(self.COUNT_PREFIX):]
+      if status in counts:
+        counts[status] = int(value)
+
+    for status in self.STATUSES:
+      transaction.Set(self.COUNT_PREFIX + status,
+                      counts[status] + deltas.get(status, 0))
+
+  def _AddToCounts(self, deltas):
+    data_store.DB.RetryWrapper(self.urn, self._UpdateCounts, deltas=deltas,
+                               token=self.token)
+
+  def _GetLegacyClients(self):
+    """Returns the clients kept in the legacy attributes of the hunt.
+
+    Returns:
+      A dict mapping client ids to (status, start time, status time). It is
+      empty if the store is in use.
+    """
+    with self.lock:
+      if self.legacy_clients is not None:
+        return self.legacy_clients
+
+      self.legacy_clients = {}
+      if self._ReadCounts() is not None:
+        return self.legacy_clients
+
+      started = {}
+      finished = {}
+      for predicate, value, timestamp in data_store.DB.ResolveMulti(
+          self.hunt_urn, [utils.EscapeRegex(self.LEGACY_CLIENTS),
+                          utils.EscapeRegex(self.LEGACY_FINISHED)],
+          timestamp=data_store.DB.ALL_TIMESTAMPS, token=self.token):
+        times = started if predicate == self.LEGACY_CLIENTS else finished
+        client_id = rdfvalue.ClientURN(value).Basename()
+        times[client_id] = min(timestamp, times.get(client_id, timestamp))
+
+      for client_id, start_time in started.iteritems():
+        self.legacy_clients[client_id] = (self.OUTSTANDING, start_time,
+                                          start_time)
+
+      for client_id, finish_time in finished.iteritems():
+        start_time = started.get(client_id, finish_time)
+        self.legacy_clients[client_id] = (self.COMPLETED, start_time,
+                                          finish_time)
+
+      return self.legacy_clients
+
+  def _ImportLegacyClients(self):
+    """Writes the clients kept in the legacy attributes to the store."""
+    with self.lock:
+      legacy_clients = self._GetLegacyClients()
+      if not legacy_clients:
+        return
+
+      rows = {}
+      counts = dict.fromkeys(self.STATUSES, 0)
+      for client_id, (status, start_time, timestamp) in (
+          legacy_clients.iteritems()):
+        rows.setdefault(self._ClientRow(client_id), {})[
+            self._Predicate(status, client_id)] = [(start_time, timestamp)]
+        counts[status] += 1
+
+      for row, values in rows.iteritems():
+        data_store.DB.MultiSet(row, values, replace=True, token=self.token)
+
+      self._AddToCounts(counts)
+
+      self.legacy_clients = {}
+
+  def _Lookup(self, client_id):
+    """Returns the status and start time of a client or (None, None)."""
+    legacy_clients = self._GetLegacyClients()
+    if legacy_clients:
+      status, start_time, _ = legacy_clients.get(client_id,
+                                                 (None, None, None))
+      return status, start_time
+
+    for predicate, start_time, _ in data_store.DB.ResolveRegex(
+        self._ClientRow(client_id),
+        self.PREFIX + "[^/]+/" + utils.EscapeRegex(client_id),
+        timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+      return predicate[len(self.PREFIX):].split("/")[0], start_time
+
+    return None, None
+
+  def GetStatus(self, client_id):
+    status, _ = self._Lookup(rdfvalue.ClientURN(client_id).Basename())
+    return status
+
+  def GetCounts(self):
+    """Returns a dict with the number of clients in each status."""
+    counts = self._ReadCounts()
+    if counts is None:
+      counts = dict.fromkeys(self.STATUSES, 0)
+      for status, _, _ in self._GetLegacyClients().itervalues():
+        counts[status] += 1
+
+    return counts
+
+  def _SetStatus(self, client_id, status, start_time, old_status=None):
+    """Moves a client into a status and updates the counters."""
+    with self.lock:
+      self._ImportLegacyClients()
+
+      deltas = {status: 1}
+      to_delete = []
+      if old_status is not None:
+        to_delete.append(self._Predicate(old_status, client_id))
+        deltas[old_status] = -1
+
+      data_store.DB.MultiSet(
+          self._ClientRow(client_id),
+          {self._Predicate(status, client_id): [start_time]},
+          to_delete=to_delete, replace=True, token=self.token)
+
+      self._AddToCounts(deltas)
+
+  def AddClient(self, client_id):
+    """Records that the hunt was started on a client.
+
+    Args:
+      client_id: The client the hunt was started on.
+
+    Returns:
+      False if the client was already known to the hunt, True otherwise.
+    """
+    client_id = rdfvalue.ClientURN(client_id).Basename()
+    with self.lock:
+      status, _ = self._Lookup(client_id)
+      if status is not None:
+        return False
+
+      self._SetStatus(client_id, self.OUTSTANDING,
+                      int(rdfvalue.RDFDatetime().Now()))
+      return True
+
+  def MarkCompleted(self, client_id):
+    """Records that the hunt has completed on a client.
+
+    Args:
+      client_id: The client the hunt has completed on.
+
+    Returns:
+      False if the client was already completed, True otherwise.
+    """
+    client_id = rdfvalue.ClientURN(client_id).Basename()
+    with self.lock:
+      status, start_time = self._Lookup(client_id)
+      if status == self.COMPLETED:
+        return False
+
+      if start_time is None:
+        start_time = int(rdfvalue.RDFDatetime().Now())
+
+      self._SetStatus(client_id, self.COMPLETED, start_time,
+                      old_status=status)
+      return True
+
+  def _ListEntries(self, status, start_after=None):
+    """Yields (client_id, start time, status time) in client id order."""
+    buckets = self.BUCKETS
+    if start_after is not None:
+      start_after = rdfvalue.ClientURN(start_after).Basename().lower()
+      buckets = [b for b in buckets if b >= start_after[2:4]]
+
+    legacy_clients = self._GetLegacyClients()
+    if legacy_clients:
+      entries = []
+      for client_id, (client_status, start_time, timestamp) in (
+          legacy_clients.iteritems()):
+        if client_status == status and (start_after is None or
+                                        client_id.lower() > start_after):
+          entries.append((client_id, start_time, timestamp))
+
+      for entry in sorted(entries, key=lambda x: x[0].lower()):
+        yield entry
+
+      return
+
+    prefix = self._Predicate(status, "")
+    for group in utils.Grouper(buckets, self.ROWS_PER_READ):
+      rows = {}
+      for subject, values in data_store.DB.MultiResolveRegex(
+          [self._Row(bucket) for bucket in group],
+          utils.EscapeRegex(prefix) + ".+",
+          timestamp=data_store.DB.NEWEST_TIMESTAMP, token=self.token):
+        rows[utils.SmartStr(subject)] = values
+
+      for bucket in group:
+        entries = []
+        for predicate, start_time, timestamp in rows.get(
+            utils.SmartStr(self._Row(bucket)), []):
+          client_id = predicate[len(prefix):]
+          if start_after is None or client_id.lower() > start_after:
+            entries.append((client_id, start_time, timestamp))
+
+        for entry in sorted(entries, key=lambda x: x[0].lower()):
+          yield entry
+
+  def ListClients(self, status, start_after=None, limit=None):
+    """Lists the clients in a status, sorted by client id.
+
+    Args:
+      status: The status of the clients to list.
+      start_after: If set, only clients with an id sorting after this one are
+        listed. Passing the last client of a page fetches the next page.
+      limit: The maximum number of clients to list.
+
+    Yields:
+      ClientURNs, with the age set to the time the client entered the status.
+    """
+    for count, (client_id, _, timestamp) in enumerate(
+        self._ListEntries(status, start_after=start_after)):
+      if limit is not None and count >= limit:
+        break
+
+      yield rdfvalue.ClientURN(client_id, age=timestamp)
+
+  def ListClientTimes(self):
+    """Yields (client urn, start time, completion time or None) tuples."""
+    for client_id, start_time, _ in self._ListEntries(self.OUTSTANDING):
+      yield (rdfvalue.ClientURN(client_id),
+             rdfvalue.RDFDatetime(start_time), None)
+
+    for client_id, start_time, timestamp in self._ListEntries(self.COMPLETED):
+      yield (rdfvalue.ClientURN(client_id), rdfvalue.RDFDatetime(start_time),
+             rdfvalue.RDFDatetime(timestamp))
+
+  def Delete(self):
+    """Removes every row of the store."""
+    with self.lock:
+      for row in [self.urn] + [self._Row(bucket) for bucket in self.BUCKETS]:
+        data_store.DB.DeleteSubject(row, token=self.token)
+
+      self.legacy_clients = None
+
+
+class HuntSummaryIndex(aff4.AFF4Object):
+  """An index of hunt summaries used to list the hunts.
+
+  Each hunt has two cells in this object: a small key cell whose name starts
+  with the hunt's create time, and a cell holding its HuntSummary. The list of
+  hunts is sorted and paged on the key cells alone and only the summaries on
+  the requested page are read. Hunts refresh their summary whenever they are
+  saved and remove their cells when they are deleted.
+
+  Hunts created before this index existed are added by Rebuild(), which
+  ListHunts() runs once if the index was never rebuilt.
+  """
+
+  URN = rdfvalue.RDFURN("aff4:/index/hunts")
+  PREFIX = "index:hunt/"
+  SUMMARY_PREFIX = "index:hunt_summary/"
+  REBUILT = "index:rebuilt"
+
+  def __init__(self, urn, **kwargs):
+    # Never read anything directly from the table by forcing an empty clone.
+    kwargs["clone"] = {}
+    super(HuntSummaryIndex, self).__init__(urn, **kwargs)
+
+    # We collect index data here until we flush.
+    self.to_set = {}
+
+  def AddHunt(self, summary):
+    """Adds or replaces the summary for the hunt summary.hunt_urn."""
+    hunt_id = summary.hunt_urn.Basename()
+    key = "%s%020d/%s" % (self.PREFIX, int(summary.create_time), hunt_id)
+    self.to_set[key] = aff4.EMPTY_DATA
+    self.to_set[self.SUMMARY_PREFIX + hunt_id] = summary.SerializeToString()
+
+  def RemoveHunt(self, hunt_urn):
+    """Removes a hunt from the index."""
+    hunt_id = rdfvalue.RDFURN(hunt_urn).Basename()
+    for predicate in self.to_set.keys():
+      if predicate.endswith("/" + hunt_id):
+        del self.to_set[predicate]
+
+    data_store.DB.DeleteAttributesRegex(
+        self.urn, [self.PREFIX + "[0-9]+/" + utils.EscapeRegex(hunt_id),
+                   utils.EscapeRegex(self.SUMMARY_PREFIX + hunt_id)],
+        token=self.token)
+
+  def Flush(self, sync=False):
+    """Flush the data to the index."""
+    super(HuntSummaryIndex, self).Flush(sync=sync)
+
+    if self.to_set:
+      data_store.DB.MultiSet(
+          self.urn, dict((k, [v]) for k, v in self.to_set.iteritems()),
+          token=self.token, replace=True, sync=sync)
+
+    self.to_set = {}
+
+  def Close(self, sync=False):
+    self.Flush(sync=sync)
+    super(HuntSummaryIndex, self).Close(sync=sync)
+
+  def _ListKeys(self):
+    """Returns the sorted key cells and whether the index was rebuilt."""
+    keys = []
+    rebuilt = False
+    for predicate, _, _ in data_store.DB.ResolveRegex(
+        self.urn, "%s.+|%s" % (self.PREFIX, utils.EscapeRegex(self.REBUILT)),
+        token=self.token, timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        limit=10000000):
+      if predicate == self.REBUILT:
+        rebuilt = True
+      else:
+        keys.append(predicate)
+
+    return sorted(keys), rebuilt
+
+  def Rebuild(self):
+    """Adds every existing hunt to the index and drops deleted hunts.
+
+    Returns:
+      The number of hunts indexed.
+    """
+    start_time = rdfvalue.RDFDatetime().Now()
+    hunt_ids = set()
+
+    hunts_root = aff4.FACTORY.Open("aff4:/hunts", token=self.token)
+    for hunt in hunts_root.OpenChildren():
+      # Skip hunts that could not be unpickled.
+      if not isinstance(hunt, GRRHunt) or not hunt.state.get("context"):
+        logging.info("Skipping %s which is not a valid hunt.", hunt.urn)
+        continue
+
+      hunt_ids.add(hunt.urn.Basename())
+      self.AddHunt(hunt.BuildSummary())
+
+    # Hunts created while we were listing may be missing from hunt_ids.
+    keys, _ = self._ListKeys()
+    for key in keys:
+      create_time, hunt_id = key[len(self.PREFIX):].split("/", 1)
+      if hunt_id not in hunt_ids and int(create_time) < int(start_time):
+        self.RemoveHunt(hunts_root.urn.Add(hunt_id))
+
+    self.to_set[self.REBUILT] = aff4.EMPTY_DATA
+    self.Flush(sync=True)
+
+    return len(hunt_ids)
+
+  def ListHunts(self, offset=0, count=None):
+    """Lists the hunts, newest first.
+
+    Only the key cells of all the hunts and the summaries of the listed hunts
+    are read.
+
+    Args:
+      offset: The number of hunts to skip.
+      count: The maximum number of hunts to return, or None for all.
+
+    Returns:
+      A tuple of the total number of hunts and a list of HuntSummary objects.
+    """
+    keys, rebuilt = self._ListKeys()
+    if not rebuilt:
+      self.Rebuild()
+      keys, _ = self._ListKeys()
+
+    keys.reverse()
+
+    end = None
+    if count is not None:
+      end = offset + count
+
+    predicates = [self.SUMMARY_PREFIX + key.rsplit("/", 1)[1]
+                  for key in keys[offset:end]]
+
+    summaries = {}
+    if predicates:
+      for predicate, value, _ in data_store.DB.ResolveMulti(
+          self.urn, predicates, token=self.token,
+          timestamp=data_store.DB.NEWEST_TIMESTAMP):
+        summaries[predicate] = value
+
+    # A hunt deleted since we listed the keys has no summary.
+    return len(keys), [rdfvalue.HuntSummary(summaries[predicate])
+                       for predicate in predicates if predicate in summaries]
+
+
 class GRRHunt(flow.GRRFlow):
   """The GRR Hunt class."""
 
@@ -405,19 +866,11 @@ class GRRHunt(flow.GRRFlow):
     This object stores the persistent information for the hunt.
     """
 
-    CLIENTS = aff4.Attribute("aff4:clients", rdfvalue.RDFURN,
-                             "The list of clients this hunt was run against.",
-                             creates_new_object_version=False)
-
     CLIENT_COUNT = aff4.Attribute("aff4:client_count", rdfvalue.RDFInteger,
                                   "The total number of clients scheduled.",
                                   versioned=False,
                                   creates_new_object_version=False)
 
-    FINISHED = aff4.Attribute("aff4:finished", rdfvalue.RDFURN,
-                              "The list of clients the hunt has completed on.",
-                              creates_new_object_version=False)
-
     ERRORS = aff4.Attribute("aff4:errors", rdfvalue.HuntError,
                             "The list of clients that returned an error.",
                             creates_new_object_version=False)
@@ -437,14 +890,95 @@ class GRRHunt(flow.GRRFlow):
 
   runner_cls = HuntRunner
 
+  # The aggregates kept over the results of this hunt, a list of
+  # aggregates.ResultAggregator instances.
+  result_aggregators = []
+
   def Initialize(self):
     super(GRRHunt, self).Initialize()
     # Hunts run in multiple threads so we need to protect access.
     self.lock = threading.RLock()
 
+    self._client_status = None
+    self._results_aggregates = None
+
     if "r" in self.mode:
       self.client_count = self.Get(self.Schema.CLIENT_COUNT)
 
+  @property
+  def client_status(self):
+    """The store keeping track of the progress of each client."""
+    with self.lock:
+      # Hunts only get their urn once the runner is created.
+      if self._client_status is None:
+        self._client_status = HuntClientStatusStore(self.urn, token=self.token)
+
+      return self._client_status
+
+  def OnDelete(self):
+    super(GRRHunt, self).OnDelete()
+    self.client_status.Delete()
+
+    with aff4.FACTORY.Create(HuntSummaryIndex.URN, "HuntSummaryIndex",
+                             mode="w", token=self.token,
+                             force_new_version=False) as index:
+      index.RemoveHunt(self.urn)
+
+  @property
+  def results_aggregates(self):
+    """The HuntResultsAggregates object of this hunt."""
+    with self.lock:
+      if self._results_aggregates is None:
+        self._results_aggregates = aff4.FACTORY.Create(
+            self.urn.Add("ResultsAggregates"), "HuntResultsAggregates",
+            mode="rw" if "w" in self.mode else "r", token=self.token,
+            force_new_version=False)
+
+      return self._results_aggregates
+
+  def AggregateResults(self, results):
+    """Updates the result aggregates with a batch of results from a client."""
+    if self.result_aggregators and results:
+      self.results_aggregates.Update(self.result_aggregators, list(results))
+
+  def GetResultsAggregate(self, name):
+    """Returns the current rdfvalue.HuntResultAggregate with the given name."""
+    return self.results_aggregates.GetAggregate(name)
+
+  def Save(self):
+    """Saves the result aggregates and refreshes the HuntSummaryIndex."""
+    with self.lock:
+      if self._results_aggregates is not None and "w" in self.mode:
+        self._results_aggregates.Flush(sync=True)
+
+    if "w" in self.mode and self.state.get("context"):
+      with aff4.FACTORY.Create(HuntSummaryIndex.URN, "HuntSummaryIndex",
+                               mode="w", token=self.token,
+                               force_new_version=False) as index:
+        index.AddHunt(self.BuildSummary())
+
+    super(GRRHunt, self).Save()
+
+  def BuildSummary(self):
+    """Builds the summary of this hunt kept in the HuntSummaryIndex."""
+    context = self.state.context
+    description = (context.args.description or
+                   (self.__class__.__doc__ or "").split("\n", 1)[0])
+
+    return rdfvalue.HuntSummary(
+        hunt_urn=self.urn,
+        name=self.__class__.__name__,
+        state=utils.SmartUnicode(self.Get(self.Schema.STATE)),
+        creator=context.creator,
+        description=description,
+        create_time=context.create_time,
+        start_time=context.start_time,
+        expires=context.expires,
+        client_limit=context.args.client_limit,
+        client_count=int(self.Get(self.Schema.CLIENT_COUNT, 0)),
+        completed_count=self.NumCompleted(),
+        result_count=self.NumResults())
+
   @flow.StateHandler()
   def RunClient(self, client_id):
     """This method runs the hunt on a specific client.
@@ -681,7 +1215,7 @@ class GRRHunt(flow.GRRFlow):
 
   def MarkClientDone(self, client_id):
     """Adds a client_id to the list of completed tasks."""
-    self.MarkClient(client_id, self.SchemaCls.FINISHED)
+    self.client_status.MarkCompleted(client_id)
 
     if self.state.context.args.notification_event:
       status = rdfvalue.HuntNotification(session_id=self.session_id,
@@ -709,10 +1243,6 @@ class GRRHunt(flow.GRRFlow):
       log_entry.urn = utils.SmartUnicode(urn)
     self.AddAttribute(log_entry)
 
-  def MarkClient(self, client_id, attribute):
-    """Adds a client to the list indicated by attribute."""
-    self.AddAttribute(attribute(client_id))
-
   def ProcessClientResourcesStats(self, client_id, status):
     """Process status message from a client and update the stats.
 
@@ -724,20 +1254,23 @@ class GRRHunt(flow.GRRFlow):
       status: Status returned from the client.
     """
 
-  def _Num(self, attribute):
-    return len(set(self.GetValuesForAttribute(attribute)))
-
   def NumClients(self):
-    return self._Num(self.Schema.CLIENTS)
+    return sum(self.client_status.GetCounts().values())
 
   def NumCompleted(self):
-    return self._Num(self.Schema.FINISHED)
+    return self.client_status.GetCounts()[HuntClientStatusStore.COMPLETED]
 
   def NumOutstanding(self):
-    return self.NumClients() - self.NumCompleted()
+    return self.client_status.GetCounts()[HuntClientStatusStore.OUTSTANDING]
+
+  def NumResults(self):
+    """The number of results collected, for hunts which collect results."""
+    return 0
 
   def _List(self, attribute):
-    items = self.GetValuesForAttribute(attribute)
+    self._PrintItems(self.GetValuesForAttribute(attribute))
+
+  def _PrintItems(self, items):
     if items:
       print len(items), "items:"
       for item in items:
@@ -745,19 +1278,22 @@ class GRRHunt(flow.GRRFlow):
     else:
       print "Nothing found."
 
+  def GetClients(self):
+    return sorted(self.GetCompletedClients() + self.GetOutstandingClients())
+
   def ListClients(self):
-    self._List(self.Schema.CLIENTS)
+    self._PrintItems(self.GetClients())
 
   def GetCompletedClients(self):
-    return sorted(self.GetValuesForAttribute(self.Schema.FINISHED))
+    return list(self.client_status.ListClients(
+        HuntClientStatusStore.COMPLETED))
 
   def ListCompletedClients(self):
-    self._List(self.Schema.FINISHED)
+    self._PrintItems(self.GetCompletedClients())
 
   def GetOutstandingClients(self):
-    started = self.GetValuesForAttribute(self.Schema.CLIENTS)
-    done = self.GetValuesForAttribute(self.Schema.FINISHED)
-    return sorted(list(set(started) - set(done)))
+    return list(self.client_status.ListClients(
+        HuntClientStatusStore.OUTSTANDING))
 
   def ListOutstandingClients(self):
     outstanding = self.GetOutstandingClients()
@@ -771,9 +1307,7 @@ class GRRHunt(flow.GRRFlow):
 
   def GetClientsByStatus(self):
     """Get all the clients in a dict of {status: [client_list]}."""
-    completed = set(self.GetCompletedClients())
-
-    return {"COMPLETED": sorted(completed),
+    return {"COMPLETED": self.GetCompletedClients(),
             "OUTSTANDING": self.GetOutstandingClients()}
 
   def GetClientStates(self, client_list, client_chunk=50):
@@ -3,15 +3,22 @@
 
 
 
+import os
+import re
 import threading
 import urllib
 
+import logging
+
 from grr.lib import aff4
+from grr.lib import columnar
 from grr.lib import config_lib
 from grr.lib import email_alerts
+from grr.lib import export
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import rendering
+from grr.lib import type_info
 from grr.lib import utils
 from grr.proto import flows_pb2
 
@@ -207,6 +214,102 @@ class EmailPlugin(HuntOutputPlugin):
       self.ProcessResponse(response)
 
 
+class ColumnarPluginArgs(rdfvalue.RDFProtoStruct):
+  # Field 1 held a user supplied output directory which is no longer
+  # supported, the directory is only set in the server configuration.
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoUnsignedInteger(
+          name="row_group_size", field_number=2, default=10000,
+          description="Maximum number of rows in a row group.",
+          labels=[rdfvalue.SemanticDescriptor.Labels.ADVANCED]),
+      type_info.ProtoEmbedded(
+          name="export_options", field_number=3, nested="ExportOptions",
+          labels=[rdfvalue.SemanticDescriptor.Labels.ADVANCED]),
+      )
+
+
+class ColumnarPlugin(HuntOutputPlugin):
+  """An output plugin that writes exported results into columnar files.
+
+  Results are converted with the export converters and every resulting
+  Exported* type is written into its own file, in a directory named after the
+  results collection. See lib/columnar.py for the file format.
+
+  The files are written below Worker.columnar_export_dir. Since any worker
+  may run the plugin, this should be storage shared by all the workers.
+  """
+
+  name = "columnar"
+  description = "Write exported results as typed columnar files."
+  args_type = ColumnarPluginArgs
+
+  def __init__(self, *args, **kwargs):
+    super(ColumnarPlugin, self).__init__(*args, **kwargs)
+    # Writers hold open files so they are not part of the pickled state.
+    self.writers = {}
+
+  def Initialize(self):
+    if not config_lib.CONFIG["Worker.columnar_export_dir"]:
+      raise RuntimeError("Worker.columnar_export_dir must be configured to use "
+                         "the columnar output plugin.")
+
+    if self.state.args is None:
+      self.state.args = ColumnarPluginArgs()
+
+    self.state.Register("rows_written", {})
+    super(ColumnarPlugin, self).Initialize()
+
+  @property
+  def output_dir(self):
+    output_dir = config_lib.CONFIG["Worker.columnar_export_dir"]
+    collection_path = rdfvalue.RDFURN(self.state.collection_urn).Path()
+    return os.path.join(output_dir,
+                        re.sub(r"[^\w.-]", "_", collection_path.strip("/")))
+
+  def _GetWriter(self, rdf_type):
+    try:
+      return self.writers[rdf_type.__name__]
+    except KeyError:
+      writer = columnar.ColumnarWriter(
+          os.path.join(self.output_dir, "%s.grrcol" % rdf_type.__name__),
+          rdf_type, row_group_size=self.args.row_group_size)
+      self.writers[rdf_type.__name__] = writer
+      return writer
+
+  def _ConvertResponses(self, responses):
+    """Converts GrrMessages, grouped by payload type, into exported values."""
+    metadata = rdfvalue.ExportedMetadata(
+        source_urn=self.state.collection_urn)
+
+    for _, group in utils.GroupBy(
+        responses, lambda msg: msg.payload.__class__.__name__).iteritems():
+      try:
+        for value in export.ConvertValues(metadata, group, token=self.token,
+                                          options=self.args.export_options):
+          yield value
+      except export.NoConverterFound as e:
+        logging.debug("Not exporting values: %s", e)
+
+  def ProcessResponses(self, responses):
+    # Conversion may need to open clients so it is done outside of the lock.
+    values = list(self._ConvertResponses(responses))
+
+    with self.lock:
+      for value in values:
+        self._GetWriter(value.__class__).Write(value)
+        rdf_type_name = value.__class__.__name__
+        self.state.rows_written[rdf_type_name] = (
+            self.state.rows_written.get(rdf_type_name, 0) + 1)
+
+  def Flush(self):
+    # The files are closed so the plugin can be pickled and the next run
+    # appends to them.
+    for writer in self.writers.values():
+      writer.Close()
+
+    self.writers = {}
+
+
 class OutputPlugin(rdfvalue.RDFProtoStruct):
   """A proto describing the output plugin to create."""
   protobuf = flows_pb2.OutputPlugin
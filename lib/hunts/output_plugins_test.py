@@ -2,6 +2,7 @@
 """Tests for hunts output plugins."""
 
 
+import os
 
 
 # pylint: disable=unused-import,g-bad-import-order
@@ -9,12 +10,14 @@ from grr.lib import server_plugins
 # pylint: enable=unused-import,g-bad-import-order
 
 from grr.lib import aff4
+from grr.lib import columnar
 from grr.lib import config_lib
 from grr.lib import email_alerts
 from grr.lib import flags
 from grr.lib import hunts
 from grr.lib import rdfvalue
 from grr.lib import test_lib
+from grr.lib.hunts import output_plugins
 
 
 class OutputPluginsTest(test_lib.FlowTestsBaseclass):
@@ -96,8 +99,8 @@ class OutputPluginsTest(test_lib.FlowTestsBaseclass):
       hunt_obj = aff4.FACTORY.Open(hunt_urn, age=aff4.ALL_TIMES,
                                    token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 40)
@@ -122,6 +125,93 @@ class OutputPluginsTest(test_lib.FlowTestsBaseclass):
       self.assertTrue("sending of emails will be disabled now"
                       in self.email_messages[-1]["message"])
 
+  def testHuntResultsBeingProcessedAreSkipped(self):
+    def SendEmail(address, sender, title, message, **_):
+      self.email_messages.append(dict(address=address, sender=sender,
+                                      title=title, message=message))
+
+    open_with_lock = aff4.FACTORY.OpenWithLock
+
+    def OpenWithLock(urn, **kwargs):
+      if rdfvalue.RDFURN(urn).Basename() == "ResultsMetadata":
+        raise aff4.LockError("%s is locked." % urn)
+
+      return open_with_lock(urn, **kwargs)
+
+    with test_lib.Stubber(email_alerts, "SendEmail", SendEmail):
+      self.email_messages = []
+      email_address = "notify@%s" % config_lib.CONFIG["Logging.domain"]
+
+      # Another run is still processing the results of the hunt.
+      with test_lib.Stubber(aff4.FACTORY, "OpenWithLock", OpenWithLock):
+        self.RunHunt("EmailPlugin", rdfvalue.EmailPluginArgs(
+            email=email_address, email_limit=10))
+
+      self.assertEqual(self.email_messages, [])
+
+      # The results are left for the next run.
+      for _ in test_lib.TestFlowHelper("ProcessHuntResultsCronFlow",
+                                       token=self.token):
+        pass
+
+      self.assertEqual(len(self.email_messages), 10)
+
+  def testColumnarPlugin(self):
+    # The plugin can only be used once its directory is configured.
+    self.assertRaises(RuntimeError, output_plugins.ColumnarPlugin,
+                      "aff4:/hunts/W:123456/Results",
+                      args=rdfvalue.ColumnarPluginArgs(), token=self.token)
+
+    output_dir = os.path.join(self.temp_dir, "columnar")
+    config_lib.CONFIG.Set("Worker.columnar_export_dir", output_dir)
+    hunt_urn = self.RunHunt("ColumnarPlugin", rdfvalue.ColumnarPluginArgs(
+        row_group_size=7))
+
+    collection_dir = hunt_urn.Add("Results").Path().strip("/")
+    path = os.path.join(output_dir,
+                        collection_dir.replace("/", "_").replace(":", "_"),
+                        "ExportedFile.grrcol")
+
+    reader = columnar.ColumnarReader(path)
+    self.assertEqual(reader.rdf_type, "ExportedFile")
+    self.assertEqual(reader.num_rows, 20)
+    # 20 rows in row groups of at most 7 rows.
+    self.assertEqual([g["num_rows"] for g in reader.row_groups], [7, 7, 6])
+
+    columns = reader.ReadColumns(["urn", "metadata.client_urn", "st_mode"])
+    self.assertEqual(len(set(columns["metadata.client_urn"])), 20)
+    for urn in columns["urn"]:
+      self.assertTrue(urn.endswith("fs/os/tmp/evil.txt"))
+
+    # Files are appended to by later runs of the plugin.
+    writer = columnar.ColumnarWriter(path, rdfvalue.ExportedFile)
+    writer.Write(rdfvalue.ExportedFile(basename="extra"))
+    writer.Close()
+
+    reader = columnar.ColumnarReader(path)
+    self.assertEqual(reader.num_rows, 21)
+    basenames = reader.ReadColumn("basename", row_groups=[3])
+    self.assertEqual(basenames, [u"extra"])
+    self.assertEqual(reader.ReadColumn("st_mode", row_groups=[3]), [None])
+
+    # An interrupted append leaves the file readable up to the last footer.
+    writer = columnar.ColumnarWriter(path, rdfvalue.ExportedFile)
+    writer.Write(rdfvalue.ExportedFile(basename="lost"))
+    writer._WriteRowGroup()
+    writer.fd.close()
+
+    self.assertEqual(columnar.ColumnarReader(path).num_rows, 21)
+
+    # The next append replaces the partial one.
+    writer = columnar.ColumnarWriter(path, rdfvalue.ExportedFile)
+    writer.Write(rdfvalue.ExportedFile(basename="appended"))
+    writer.Close()
+
+    reader = columnar.ColumnarReader(path)
+    self.assertEqual(reader.num_rows, 22)
+    self.assertEqual(reader.ReadColumn("basename", row_groups=[3, 4]),
+                     [u"extra", u"appended"])
+
 
 class FlowTestLoader(test_lib.GRRTestLoader):
   base_class = test_lib.FlowTestsBaseclass
@@ -5,8 +5,11 @@
 
 
 
+import itertools
+import Queue
 import re
 import stat
+import threading
 
 import logging
 
@@ -14,8 +17,11 @@ from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import threadpool
+from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.aff4_objects import cronjobs
+from grr.lib.hunts import aggregates
 from grr.lib.hunts import implementation
 from grr.proto import flows_pb2
 
@@ -286,6 +292,16 @@ class RegistryFileHunt(implementation.GRRHunt):
 class ProcessesHunt(implementation.GRRHunt):
   """A hunt that downloads process lists."""
 
+  result_aggregators = [
+      aggregates.CountAggregator(
+          "process_cmdline", rdf_type="Process",
+          key=lambda process: " ".join(process.cmdline),
+          description="Number of processes by command line."),
+      aggregates.CountAggregator(
+          "process_name", rdf_type="Process", key="name",
+          description="Number of processes by name."),
+      ]
+
   @flow.StateHandler(next_state=["StoreResults"])
   def RunClient(self, responses):
     for client_id in responses:
@@ -299,6 +315,7 @@ class ProcessesHunt(implementation.GRRHunt):
     if responses.success:
       self.LogResult(client_id, "Got process listing.",
                      aff4.ROOT_URN.Add(client_id).Add("processes"))
+      self.AggregateResults(responses)
     else:
       self.LogClientError(client_id, log_message=responses.status)
 
@@ -321,12 +338,39 @@ class ProcessesHunt(implementation.GRRHunt):
           print process
 
   def ProcessHistogram(self, full_path=True):
-    """This generates a histogram of all the processes found."""
+    """This generates a histogram of all the processes found.
+
+    The histogram is read from the results aggregate, which only keeps the
+    1000 most common values and approximates their counts (see
+    aggregates.CountAggregator). Hunts which ran before results were
+    aggregated have no aggregate, their listings are read and counted exactly.
+
+    Args:
+      full_path: Count command lines if True, process names otherwise.
+
+    Returns:
+      A dict of number of processes, keyed by command line or name.
+    """
+    aggregate = self.GetResultsAggregate(
+        "process_cmdline" if full_path else "process_name")
+    if aggregate is None:
+      proc_list = sorted(self._ScanProcesses(full_path).iteritems(),
+                         reverse=True, key=lambda (k, v): v)
+    else:
+      proc_list = aggregate.GetTop()
 
     hist = {}
+    for proc, freq in proc_list:
+      print "%d  %s" % (freq, proc)
+      hist[proc] = freq
 
-    hunt = aff4.FACTORY.Open(self.args.urn,
-                             age=aff4.ALL_TIMES, token=self.token)
+    return hist
+
+  def _ScanProcesses(self, full_path):
+    """Counts the processes in all the logged process listings."""
+    hist = {}
+
+    hunt = aff4.FACTORY.Open(self.urn, age=aff4.ALL_TIMES, token=self.token)
     log = hunt.GetValuesForAttribute(hunt.Schema.LOG)
 
     for log_entry in log:
@@ -341,10 +385,6 @@ class ProcessesHunt(implementation.GRRHunt):
         hist.setdefault(cmd, 0)
         hist[cmd] += 1
 
-    proc_list = sorted(hist.iteritems(), reverse=True, key=lambda (k, v): v)
-    for proc, freq in proc_list:
-      print "%d  %s" % (freq, proc)
-
     return hist
 
 
@@ -352,11 +392,28 @@ class MBRHuntArgs(rdfvalue.RDFProtoStruct):
   protobuf = flows_pb2.MBRHuntArgs
 
 
+def _MBRKey(mbr):
+  """Returns the hex encoded start of an MBR without the partition table."""
+  mbr_data = str(mbr)[:MBRHunt.MAX_HISTOGRAM_LENGTH]
+  # Skip over the table of primary partitions.
+  mbr_data = mbr_data[:440] + "\x00"*70 + mbr_data[440+70:]
+  return mbr_data.encode("hex")
+
+
 class MBRHunt(implementation.GRRHunt):
   """A hunt that downloads MBRs."""
 
   args_type = MBRHuntArgs
 
+  # Only the start of the MBRs is aggregated to keep the aggregate small.
+  MAX_HISTOGRAM_LENGTH = 512
+
+  result_aggregators = [
+      aggregates.CountAggregator(
+          "mbr", rdf_type="RDFBytes", key=_MBRKey, per_client=True,
+          max_keys=100, description="Number of clients by MBR."),
+      ]
+
   @flow.StateHandler(next_state=["StoreResults"])
   def RunClient(self, responses):
     for client_id in responses:
@@ -369,6 +426,7 @@ class MBRHunt(implementation.GRRHunt):
     client_id = responses.request.client_id
     if responses.success:
       self.LogResult(client_id, "Got MBR.", client_id.Add("mbr"))
+      self.AggregateResults(responses)
     else:
       self.LogClientError(client_id, log_message=utils.SmartStr(
           responses.status))
@@ -376,31 +434,49 @@ class MBRHunt(implementation.GRRHunt):
     self.MarkClientDone(client_id)
 
   def MBRHistogram(self, length=512):
-    """Prints a histogram of the MBRs found."""
+    """Prints a histogram of the MBRs found.
+
+    Args:
+      length: The number of bytes of the MBRs to compare, at most
+              MAX_HISTOGRAM_LENGTH.
+
+    Returns:
+      A list of (hex encoded MBR, number of clients), most common first.
+    """
+    aggregate = self.GetResultsAggregate("mbr")
+    if aggregate is None:
+      # The hunt ran before its results were aggregated.
+      counts = self._ScanMBRs()
+    else:
+      counts = aggregate.GetTop()
 
     hist = {}
+    for key, count in counts:
+      key = key[:length * 2]
+      hist[key] = hist.get(key, 0) + count
 
-    hunt = aff4.FACTORY.Open(self.args.urn,
-                             age=aff4.ALL_TIMES, token=self.token)
+    mbr_list = sorted(hist.iteritems(), reverse=True, key=lambda (k, v): v)
+    for mbr, freq in mbr_list:
+      print "%d  %s" % (freq, mbr)
+
+    return mbr_list
 
+  def _ScanMBRs(self):
+    """Returns a list of (MBR key, number of clients) of the logged MBRs."""
+    hist = {}
+
+    hunt = aff4.FACTORY.Open(self.urn, age=aff4.ALL_TIMES, token=self.token)
     log = hunt.GetValuesForAttribute(hunt.Schema.LOG)
 
     for log_entry in log:
       try:
         mbr = aff4.FACTORY.Open(log_entry.urn, token=self.token)
-        mbr_data = mbr.Read(length)
-        # Skip over the table of primary partitions.
-        mbr_data = mbr_data[:440] + "\x00"*70 + mbr_data[440+70:]
-        key = mbr_data.encode("hex")
-        hist.setdefault(key, []).append(log_entry.client_id)
+        key = _MBRKey(mbr.Read(self.MAX_HISTOGRAM_LENGTH))
+        hist.setdefault(key, set()).add(log_entry.client_id)
       except AttributeError:
         print "Error for urn %s" % log_entry.urn
 
-    mbr_list = sorted(hist.iteritems(), reverse=True, key=lambda (k, v): len(v))
-    for mbr, freq in mbr_list:
-      print "%d  %s" % (len(freq), mbr)
-
-    return mbr_list
+    return [(key, len(clients)) for key, clients in hist.iteritems()]
 
 
 class MatchRegistryHunt(implementation.GRRHunt):
@@ -504,9 +580,21 @@ class MatchRegistryHunt(implementation.GRRHunt):
         print "Match: %s: %s" % (key, value)
 
 
+def _RunKeyPath(runkey):
+  """Returns the file path of a run key with user names replaced by USER."""
+  key = runkey.filepath.replace("\"", "")
+  return re.sub(r"Users\\[^\\]+\\", r"Users\\USER\\", key)
+
+
 class RunKeysHunt(implementation.GRRHunt):
   """A hunt for the RunKey collection."""
 
+  result_aggregators = [
+      aggregates.CountAggregator(
+          "runkey_filepath", rdf_type="RunKey", key=_RunKeyPath,
+          per_client=True, description="Number of clients by run key path."),
+      ]
+
   @flow.StateHandler(next_state="StoreResults")
   def Start(self, responses):
     client_id = responses.request.client_id
@@ -520,6 +608,7 @@ class RunKeysHunt(implementation.GRRHunt):
     if responses.success:
       self.LogResult(client_id, "Downloaded RunKeys",
                      aff4.ROOT_URN.Add(client_id).Add("analysis/RunKeys"))
+      self.AggregateResults(responses)
     else:
       self.LogClientError(client_id, log_message=utils.SmartStr(
           responses.status))
@@ -527,13 +616,29 @@ class RunKeysHunt(implementation.GRRHunt):
     self.MarkClientDone(client_id)
 
   def Histogram(self):
-    """Creates a histogram of all the filenames found in the RunKeys."""
+    """Creates a histogram of all the filenames found in the RunKeys.
 
-    hist = {}
+    Returns:
+      A list of (file path, number of clients), most common first.
+    """
+    aggregate = self.GetResultsAggregate("runkey_filepath")
+    if aggregate is None:
+      # The hunt ran before its results were aggregated.
+      rk_list = sorted(self._ScanRunKeys().iteritems(), reverse=True,
+                       key=lambda (k, v): v)
+    else:
+      rk_list = aggregate.GetTop()
 
-    hunt = aff4.FACTORY.Open("aff4:/hunts/%s" % self.session_id,
-                             age=aff4.ALL_TIMES, token=self.token)
+    for rk, freq in rk_list:
+      print "%d  %s" % (freq, rk)
 
+    return rk_list
+
+  def _ScanRunKeys(self):
+    """Counts the clients by run key path in all the run key collections."""
+    hist = {}
+
+    hunt = aff4.FACTORY.Open(self.urn, age=aff4.ALL_TIMES, token=self.token)
     log = hunt.GetValuesForAttribute(hunt.Schema.LOG)
 
     client_ids = [l.client_id for l in log]
@@ -542,7 +647,8 @@ class RunKeysHunt(implementation.GRRHunt):
 
     while client_ids:
       clients = aff4.FACTORY.MultiOpen(
-          ["aff4:/%s" % client_id for client_id in client_ids[:1000]])
+          ["aff4:/%s" % client_id for client_id in client_ids[:1000]],
+          token=self.token)
       client_ids = client_ids[1000:]
 
       for client in clients:
@@ -556,31 +662,20 @@ class RunKeysHunt(implementation.GRRHunt):
         to_read.append("aff4:/%s/analysis/RunKeys/System/Run" %
                        client.client_id)
 
-    print "Processing %d collections." % len(to_read)
-    collections_done = 0
-
     while to_read:
       # Only do 1000 at a time.
-      collections_done += len(to_read[:1000])
       collections = aff4.FACTORY.MultiOpen(to_read[:1000], token=self.token)
       to_read = to_read[1000:]
 
       for collection in collections:
         try:
           for runkey in collection:
-            key = runkey.filepath.replace("\"", "")
-            key = re.sub(r"Users\\[^\\]+\\", r"Users\\USER\\", key)
-            hist.setdefault(key, set()).add(str(collection.urn)[6:6+18])
+            hist.setdefault(_RunKeyPath(runkey), set()).add(
+                str(collection.urn)[6:6+18])
         except AttributeError:
           pass
 
-      print "%d collections done." % collections_done
-
-    rk_list = sorted(hist.iteritems(), reverse=True, key=lambda (k, v): len(v))
-    for rk, freq in rk_list:
-      print "%d  %s" % (len(freq), rk)
-
-    return rk_list
+    return dict((key, len(clients)) for key, clients in hist.iteritems())
 
 
 class HuntResultsMetadata(aff4.AFF4Object):
@@ -610,22 +705,169 @@ class HuntResultsMetadata(aff4.AFF4Object):
 class ProcessHuntResultsCronFlowArgs(rdfvalue.RDFProtoStruct):
   protobuf = flows_pb2.ProcessHuntResultsCronFlowArgs
 
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoUnsignedInteger(
+          name="num_threads", field_number=3,
+          description="The number of hunts processed concurrently. The output "
+          "plugins of each hunt also process every batch concurrently.",
+          labels=[rdfvalue.SemanticDescriptor.Labels.ADVANCED]),
+
+      type_info.ProtoRDFValue(
+          name="max_hunt_running_time", field_number=4, rdf_type="Duration",
+          description="The results of a single hunt are processed for not "
+          "much longer than this, so a hunt with many results can not keep "
+          "the other hunts waiting. Its remaining results are processed by "
+          "the next run.",
+          labels=[rdfvalue.SemanticDescriptor.Labels.ADVANCED]),
+      )
+
 
 class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
-  """Periodic cron flow that processes hunts results with output plugins."""
+  """Periodic cron flow that processes hunts results with output plugins.
+
+  Hunts are processed concurrently on a thread pool. Each batch of results is
+  read once and handed to all the output plugins of the hunt, which process it
+  concurrently.
+  """
   frequency = rdfvalue.Duration("5m")
   lifetime = rdfvalue.Duration("40m")
 
   args_type = ProcessHuntResultsCronFlowArgs
 
   DEFAULT_BATCH_SIZE = 1000
+  DEFAULT_NUM_THREADS = 10
+  DEFAULT_MAX_HUNT_RUNNING_TIME = rdfvalue.Duration("10m")
+
+  # How often we extend our lease while waiting for hunts to be processed.
+  HEARTBEAT_INTERVAL = 10
+
+  # The results of a hunt are processed while holding a lease on its
+  # ResultsMetadata, which is renewed for this many seconds before every batch.
+  # A run which gave up waiting for a hunt can therefore not start processing
+  # it again until its previous run stopped or lost the lease. A batch taking
+  # longer than this may be processed twice.
+  BATCH_LEASE_TIME = 600
+
+  def Initialize(self):
+    super(ProcessHuntResultsCronFlow, self).Initialize()
+    # Hunts are processed in multiple threads so we need to protect the log.
+    self.lock = threading.RLock()
+
+  def _Log(self, format_str, *args):
+    with self.lock:
+      self.Log(format_str, *args)
+
+  def _GetPluginPool(self):
+    pool = threadpool.ThreadPool.Factory("hunt_output_plugins",
+                                         self._GetNumThreads())
+    pool.Start()
+    return pool
+
+  def _GetNumThreads(self):
+    return self.state.args.num_threads or self.DEFAULT_NUM_THREADS
+
+  def _ProcessBatchInto(self, plugin_name, plugin, batch, batch_index,
+                        session_id, results):
+    """Runs a single plugin on a batch and puts any error on results."""
+    logging.info("Processing hunt %s with %s, batch %d", session_id,
+                 plugin_name, batch_index)
+
+    error = None
+    try:
+      plugin.ProcessResponses(batch)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing hunt results: hunt %s, "
+                        "plugin %s, batch %d", session_id, plugin_name,
+                        batch_index)
+      self._Log("Error processing hunt results (hunt %s, "
+                "plugin %s, batch %d): %s" %
+                (session_id, plugin_name, batch_index, e))
+      error = e
+
+    results.put(error)
+
+  def _ProcessBatch(self, used_plugins, batch, batch_index, session_id):
+    """Hands a batch to all the plugins at once and waits for them.
+
+    Args:
+      used_plugins: A dict mapping plugin names to output plugins.
+      batch: The list of results. It is shared by all the plugins which must
+             not modify it.
+      batch_index: The index of this batch.
+      session_id: The hunt the results belong to.
+
+    Returns:
+      The last exception raised by a plugin or None.
+    """
+    pool = self._GetPluginPool()
+    results = Queue.Queue()
+    for plugin_name, plugin in used_plugins.iteritems():
+      # If the pool is busy the task runs inline so we always make progress.
+      pool.AddTask(target=self._ProcessBatchInto,
+                   args=(plugin_name, plugin, batch, batch_index, session_id,
+                         results),
+                   name="ProcessHuntResults")
+
+    last_exception = None
+    for _ in used_plugins:
+      error = results.get()
+      if error is not None:
+        last_exception = error
+
+    return last_exception
+
+  def _IsPastMaxRunningTime(self):
+    """Checks if this flow has been running for longer than it may."""
+    now = rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch()
+    return bool(self.state.args.max_running_time and
+                now - self.start_time.AsSecondsFromEpoch() >
+                self.state.args.max_running_time)
+
+  def _IsOverdue(self, hunt_start_time, session_id):
+    """Checks the deadlines of this flow and of the hunt being processed."""
+    if self._IsPastMaxRunningTime():
+      self._Log("Running for too long, skipping rest of batches for %s.",
+                session_id)
+      return True
+
+    now = rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch()
+    max_hunt_running_time = (self.state.args.max_hunt_running_time or
+                             self.DEFAULT_MAX_HUNT_RUNNING_TIME)
+    if now - hunt_start_time.AsSecondsFromEpoch() > max_hunt_running_time:
+      self._Log("Hunt %s is taking too long, skipping rest of batches.",
+                session_id)
+      return True
+
+    return False
 
   def ProcessHunt(self, session_id):
+    """Processes the new results of a hunt with its output plugins.
+
+    Args:
+      session_id: The urn of the hunt.
+
+    Returns:
+      True if all the results were processed, False if we ran out of time or
+      another run is still processing the hunt.
+
+    Raises:
+      aff4.LockError: If the lease on the hunt's results expired.
+    """
     metadata_urn = session_id.Add("ResultsMetadata")
     last_exception = None
+    finished = True
+    hunt_start_time = rdfvalue.RDFDatetime().Now()
 
-    with aff4.FACTORY.Open(
-        metadata_urn, mode="rw", token=self.token) as metadata_obj:
+    try:
+      metadata_obj = aff4.FACTORY.OpenWithLock(
+          metadata_urn, blocking=False, lease_time=self.BATCH_LEASE_TIME,
+          token=self.token)
+    except aff4.LockError:
+      self._Log("Results of hunt %s are still being processed, skipping.",
+                session_id)
+      return False
+
+    with metadata_obj:
 
       output_plugins = metadata_obj.Get(metadata_obj.Schema.OUTPUT_PLUGINS)
       num_processed = int(metadata_obj.Get(
@@ -646,43 +888,33 @@ class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
                             state) in output_plugins.data.iteritems():
             used_plugins[plugin_name] = plugin_def.GetPluginForState(state)
 
-        # If this flow is working for more than max_running_time - stop
+        # If this flow or this hunt is working for too long - stop
         # processing.
-        if self.state.args.max_running_time:
-          elapsed = (rdfvalue.RDFDatetime().Now().AsSecondsFromEpoch() -
-                     self.start_time.AsSecondsFromEpoch())
-          if elapsed > self.state.args.max_running_time:
-            self.Log("Running for too long, skipping rest of batches for %s.",
-                     session_id)
-            break
+        if self._IsOverdue(hunt_start_time, session_id):
+          finished = False
+          break
+
+        # Raises if another run may have taken over the hunt, in which case
+        # nothing more is processed or written.
+        metadata_obj.UpdateLease(self.BATCH_LEASE_TIME)
 
         batch = list(batch)
         num_processed += len(batch)
 
-        for plugin_name, plugin in used_plugins.iteritems():
-          logging.info("Processing hunt %s with %s, batch %d", session_id,
-                       plugin_name, batch_index)
-
-          try:
-            plugin.ProcessResponses(batch)
-          except Exception as e:  # pylint: disable=broad-except
-            logging.exception("Error processing hunt results: hunt %s, "
-                              "plugin %s, batch %d", session_id, plugin_name,
-                              batch_index)
-            self.Log("Error processing hunt results (hunt %s, "
-                     "plugin %s, batch %d): %s" %
-                     (session_id, plugin_name, batch_index, e))
-            last_exception = e
-        self.HeartBeat()
+        error = self._ProcessBatch(used_plugins, batch, batch_index,
+                                   session_id)
+        if error is not None:
+          last_exception = error
 
+      metadata_obj.UpdateLease(self.BATCH_LEASE_TIME)
       for plugin in used_plugins.itervalues():
         try:
           plugin.Flush()
         except Exception as e:  # pylint: disable=broad-except
           logging.exception("Error flushing hunt results: hunt %s, "
                             "plugin %s", session_id, str(plugin))
-          self.Log("Error processing hunt results (hunt %s, "
-                   "plugin %s): %s" % (session_id, str(plugin), e))
+          self._Log("Error processing hunt results (hunt %s, "
+                    "plugin %s): %s" % (session_id, str(plugin), e))
           last_exception = e
 
       metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(output_plugins))
@@ -695,6 +927,46 @@ class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
       if last_exception:
         raise last_exception  # pylint: disable=raising-bad-type
 
+    return finished
+
+  def _ProcessHuntInto(self, session_id, timestamp, results):
+    """Processes a hunt and puts the outcome on the results queue."""
+    finished = True
+    error = None
+    try:
+      finished = self.ProcessHunt(rdfvalue.RDFURN(session_id))
+    except aff4.LockError as e:
+      # Another run may be processing the hunt now, it owns the notification.
+      logging.warning("Lost the lease on the results of hunt %s: %s",
+                      session_id, e)
+      finished = False
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error processing results of hunt %s", session_id)
+      error = e
+
+    results.put((session_id, timestamp, finished, error))
+
+  def _DeleteNotification(self, session_id, timestamp):
+    """Deletes the results notification of a hunt unless it was renewed."""
+    results = data_store.DB.ResolveRegex(
+        GenericHunt.RESULTS_QUEUE, session_id, token=self.token)
+    if results and len(results) == 1:
+      _, latest_timestamp, _ = results[0]
+    else:
+      logging.warning("Inconsistent state in hunt results queue for "
+                      "hunt %s", session_id)
+      latest_timestamp = None
+
+    # We don't want to delete notification that was written after we
+    # started processing.
+    if latest_timestamp and latest_timestamp > timestamp:
+      logging.info("Not deleting results notification: it was written "
+                   "after processing has started.")
+    else:
+      data_store.DB.DeleteAttributes(GenericHunt.RESULTS_QUEUE,
+                                     [session_id], sync=True,
+                                     token=self.token)
+
   @flow.StateHandler()
   def Start(self):
     """Start state of the flow."""
@@ -704,40 +976,61 @@ class ProcessHuntResultsCronFlow(cronjobs.SystemCronFlow):
       self.state.args.max_running_time = rdfvalue.Duration(
           "%ds" % int(ProcessHuntResultsCronFlow.lifetime.seconds * 0.6))
 
-    last_exception = None
     self.start_time = rdfvalue.RDFDatetime().Now()
-    for session_id, timestamp, _ in data_store.DB.ResolveRegex(
-        GenericHunt.RESULTS_QUEUE, ".*", token=self.token):
+    notifications = data_store.DB.ResolveRegex(
+        GenericHunt.RESULTS_QUEUE, ".*", token=self.token)
+
+    num_threads = self._GetNumThreads()
+    pool = threadpool.ThreadPool.Factory("hunt_results_processor",
+                                         num_threads)
+    pool.Start()
+
+    # We only hand the pool as many hunts as it has threads, so hunts never
+    # run inline in this thread and we keep extending our lease while waiting,
+    # but never past max_running_time. Hunts stop between batches once we are
+    # overdue, and a hunt stuck in a batch must not hold the lease forever.
+    notifications = iter(notifications)
+    results = Queue.Queue()
+    in_flight = 0
+    last_exception = None
+    while True:
+      overdue = self._IsPastMaxRunningTime()
+      if not overdue:
+        for session_id, timestamp, _ in itertools.islice(
+            notifications, num_threads - in_flight):
+          logging.info("Found new results for hunt %s.", session_id)
+          pool.AddTask(target=self._ProcessHuntInto,
+                       args=(session_id, timestamp, results),
+                       name="ProcessHunt")
+          in_flight += 1
+
+      if not in_flight:
+        break
 
-      logging.info("Found new results for hunt %s.", session_id)
       try:
-        self.ProcessHunt(rdfvalue.RDFURN(session_id))
+        session_id, timestamp, finished, error = results.get(
+            timeout=self.HEARTBEAT_INTERVAL)
+      except Queue.Empty:
+        if overdue:
+          # The notifications of these hunts are kept for the next run.
+          self._Log("Running for too long, not waiting for %d hunts.",
+                    in_flight)
+          break
+
+        self.HeartBeat()
+        continue
+
+      in_flight -= 1
+      if not overdue:
         self.HeartBeat()
 
-      except Exception as e:  # pylint: disable=broad-except
-        last_exception = e
+      if error is not None:
+        last_exception = error
 
       # We will delete hunt's results notification even if ProcessHunt has
-      # failed
-      finally:
-        results = data_store.DB.ResolveRegex(
-            GenericHunt.RESULTS_QUEUE, session_id, token=self.token)
-        if results and len(results) == 1:
-          _, latest_timestamp, _ = results[0]
-        else:
-          logging.warning("Inconsistent state in hunt results queue for "
-                          "hunt %s", session_id)
-          latest_timestamp = None
-
-        # We don't want to delete notification that was written after we
-        # started processing.
-        if latest_timestamp and latest_timestamp > timestamp:
-          logging.info("Not deleting results notification: it was written "
-                       "after processing has started.")
-        else:
-          data_store.DB.DeleteAttributes(GenericHunt.RESULTS_QUEUE,
-                                         [session_id], sync=True,
-                                         token=self.token)
+      # failed, but keep it if results are left for the next run.
+      if finished:
+        self._DeleteNotification(session_id, timestamp)
 
     # TODO(user): throw proper exception which will contain all the
     # exceptions that were raised while processing the hunts.
@@ -771,6 +1064,15 @@ class GenericHunt(implementation.GRRHunt):
 
   RESULTS_QUEUE = rdfvalue.RDFURN("HR")
 
+  result_aggregators = [
+      aggregates.CountAggregator(
+          "result_type", key=lambda result: result.__class__.__name__,
+          description="Number of results by type."),
+      aggregates.CountAggregator(
+          "process_name", rdf_type="Process", key="name",
+          description="Number of processes by name."),
+      ]
+
   def Initialize(self):
     super(GenericHunt, self).Initialize()
     self.processed_responses = False
@@ -826,16 +1128,12 @@ class GenericHunt(implementation.GRRHunt):
       A list of flow URNs.
     """
     result = None
-    all_clients = set(self.GetValuesForAttribute(self.Schema.CLIENTS))
-    finished_clients = set(self.GetValuesForAttribute(self.Schema.FINISHED))
-    outstanding_clients = all_clients - finished_clients
-
     if flow_type == "all":
-      result = all_clients
+      result = self.GetClients()
     elif flow_type == "finished":
-      result = finished_clients
+      result = self.GetCompletedClients()
     elif flow_type == "outstanding":
-      result = outstanding_clients
+      result = self.GetOutstandingClients()
 
     # Now get the flows for all these clients.
     flows = aff4.FACTORY.MultiListChildren(
@@ -843,6 +1141,13 @@ class GenericHunt(implementation.GRRHunt):
 
     return [x[0] for _, x in flows]
 
+  def NumResults(self):
+    results_collection = self.state.context.get("results_collection")
+    if results_collection is None:
+      return 0
+
+    return len(results_collection)
+
   def Save(self):
     if self.state and self.processed_responses:
       with self.lock:
@@ -879,6 +1184,7 @@ class GenericHunt(implementation.GRRHunt):
         msgs = [rdfvalue.GrrMessage(payload=response, source=client_id)
                 for response in responses]
         self.state.context.results_collection.AddAll(msgs)
+        self.AggregateResults(responses)
 
     else:
       self.LogClientError(client_id, log_message=utils.SmartStr(
@@ -130,8 +130,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
 
     with aff4.FACTORY.Open(hunt_urn, age=aff4.ALL_TIMES,
                            token=self.token) as hunt_obj:
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 10)
@@ -298,6 +298,33 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       # In normal conditions, there should be 10 results generated.
       self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 10)
 
+  def testProcessHuntResultsCronFlowResumesHuntsRunningTooLong(self):
+    self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 0)
+
+    test = [0]
+    def TimeStub():
+      test[0] += 1e-6
+      return test[0]
+
+    with test_lib.Stubber(time, "time", TimeStub):
+      self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
+          plugin_name="LongRunningDummyHuntOutputPlugin")])
+      self.AssignTasksToClients()
+      self.RunHunt(failrate=-1)
+
+      # The hunt runs out of time after the first batch even though the flow
+      # itself does not.
+      self.ProcessHuntOutputPlugins(
+          batch_size=1, max_running_time=rdfvalue.Duration("1000s"),
+          max_hunt_running_time=rdfvalue.Duration("50s"))
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 1)
+
+      # The hunt is still queued so the next run processes the rest.
+      self.ProcessHuntOutputPlugins(
+          batch_size=1, max_running_time=rdfvalue.Duration("1000s"),
+          max_hunt_running_time=rdfvalue.Duration("50s"))
+      self.assertEqual(LongRunningDummyHuntOutputPlugin.num_calls, 10)
+
   def testHuntResultsArrivingWhileOldResultsAreProcessedAreHandled(self):
     self.StartHunt(output_plugins=[rdfvalue.OutputPlugin(
         plugin_name="DummyHuntOutputPlugin")])
@@ -370,8 +397,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt.session_id, age=aff4.ALL_TIMES,
                                  token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-    finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+    started = hunt_obj.GetClients()
+    finished = hunt_obj.GetCompletedClients()
     errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
     self.assertEqual(len(set(started)), 2)
@@ -410,8 +437,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       hunt_obj = aff4.FACTORY.Open(hunt.session_id, age=aff4.ALL_TIMES,
                                    token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       self.assertEqual(len(set(started)), 5)
@@ -462,8 +489,8 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
       test_lib.TestHuntHelper(client_mock, self.client_ids,
                               check_flow_errors=False, token=self.token)
 
-      started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
-      finished = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.FINISHED)
+      started = hunt_obj.GetClients()
+      finished = hunt_obj.GetCompletedClients()
       errors = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.ERRORS)
 
       # No client should be processed since the hunt is expired.
@@ -514,7 +541,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     hunt_obj = aff4.FACTORY.Open(hunt_session_id, age=aff4.ALL_TIMES,
                                  ignore_cache=True, token=self.token)
 
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
+    started = hunt_obj.GetClients()
 
     # There should be only one client, due to the limit
     self.assertEqual(len(set(started)), 1)
@@ -539,7 +566,7 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
 
     hunt_obj = aff4.FACTORY.Open(hunt_session_id, age=aff4.ALL_TIMES,
                                  token=self.token)
-    started = hunt_obj.GetValuesForAttribute(hunt_obj.Schema.CLIENTS)
+    started = hunt_obj.GetClients()
     # There should be only one client, due to the limit
     self.assertEqual(len(set(started)), 10)
 
@@ -633,6 +660,13 @@ class StandardHuntTest(test_lib.FlowTestsBaseclass):
     data = mbr.read(100000)
     self.assertEqual(len(data), 3333)
 
+    hunt = aff4.FACTORY.Open(hunt.urn, token=self.token)
+    self.assertEqual(hunt.MBRHistogram(length=16), [("01" * 16, 1)])
+
+    # Hunts which ran before results were aggregated read the MBRs instead.
+    with test_lib.Stubber(hunt, "GetResultsAggregate", lambda name: None):
+      self.assertEqual(hunt.MBRHistogram(length=16), [("01" * 16, 1)])
+
 
 class FlowTestLoader(test_lib.GRRTestLoader):
   base_class = test_lib.FlowTestsBaseclass
@@ -304,3 +304,11 @@ def RebuildClientIndexes(token=None):
   RebuildIndex("/index/client",
                primary_attribute=aff4.VFSGRRClient.SchemaCls.HOSTNAME,
                indexed_attributes=indexed_attributes, token=token)
+
+
+def RebuildHuntSummaryIndex(token=None):
+  """Adds every existing hunt to the HuntSummaryIndex."""
+  with aff4.FACTORY.Create(aff4.AFF4Object.HuntSummaryIndex.URN,
+                           "HuntSummaryIndex", mode="w", token=token,
+                           force_new_version=False) as index:
+    return index.Rebuild()
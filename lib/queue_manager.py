@@ -24,6 +24,89 @@ class MoreDataException(Error):
   """Raised when there is more data available."""
 
 
+class ResponsePager(object):
+  """A lazy sequence of the responses to a single completed request.
+
+  Large replies (e.g. from Find, Grep or ListDirectory) are not read into memory
+  in one go. Instead, responses are paged from the data store in fixed size
+  windows as the sequence is iterated, so memory use is bounded by the window
+  size regardless of how many responses the client sent.
+  """
+
+  def __init__(self, manager, session_id, request, status, window_size=1000,
+               timestamp=None):
+    """Constructor.
+
+    Args:
+      manager: The QueueManager used to read the responses.
+      session_id: The session id of the flow the request belongs to.
+      request: The RequestState this pager returns responses for.
+      status: The status GrrMessage sent for this request. Its response_id is
+              the total number of responses including the status itself.
+      window_size: How many responses to fetch from the data store at once.
+      timestamp: Tuple (start, end) limiting the responses to fetch.
+    """
+    self.manager = manager
+    self.session_id = session_id
+    self.request = request
+    self.status = status
+    self.window_size = window_size
+    self.timestamp = timestamp
+    self.subject = manager.GetFlowResponseSubject(session_id, request.id)
+
+  def _ResolveWindow(self, start, end):
+    """Yields (predicate, serialized) for response ids in [start, end)."""
+    predicates = [QueueManager.FLOW_RESPONSE_TEMPLATE % (self.request.id, i)
+                  for i in xrange(start, end)]
+
+    for predicate, serialized, _ in self.manager.data_store.ResolveMulti(
+        self.subject, predicates, token=self.manager.token,
+        timestamp=self.timestamp):
+      yield predicate, serialized
+
+  def _Windows(self):
+    total = self.status.response_id
+    for start in xrange(1, total + 1, self.window_size):
+      yield start, min(start + self.window_size, total + 1)
+
+  def GetResponse(self, response_id):
+    """Returns a single response by id, or None if it is not stored."""
+    for _, serialized in self._ResolveWindow(response_id, response_id + 1):
+      return rdfvalue.GrrMessage(serialized)
+
+  def IsComplete(self):
+    """Checks that all the responses up to the status have been received.
+
+    Only the predicate names are retained, so this check uses a bounded amount
+    of memory too.
+
+    Returns:
+      True if no responses are missing.
+    """
+    for start, end in self._Windows():
+      received = set(predicate for predicate, _ in
+                     self._ResolveWindow(start, end))
+      if len(received) != end - start:
+        return False
+
+    return True
+
+  def __iter__(self):
+    """Yields GrrMessages in response_id order, one window at a time."""
+    for start, end in self._Windows():
+      window = [rdfvalue.GrrMessage(serialized)
+                for _, serialized in self._ResolveWindow(start, end)]
+
+      for message in sorted(window, key=lambda msg: msg.response_id):
+        yield message
+
+  def __len__(self):
+    return self.status.response_id
+
+  def __nonzero__(self):
+    return self.status.response_id > 0
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -83,6 +166,10 @@ class QueueManager(object):
   request_limit = 1000000
   response_limit = 1000000
 
+  # Requests with more responses than this are not read into memory at once but
+  # are returned as a ResponsePager which fetches windows of this size.
+  response_window_size = 1000
+
   def __init__(self, store=None, sync=True, token=None):
     self.sync = sync
     self.token = token
@@ -187,8 +274,29 @@ class QueueManager(object):
                rdfvalue.GrrMessage(status[request_id]))
 
   def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
-    """Fetch only completed requests and responses up to a limit."""
+    """Fetch only completed requests and responses up to a limit.
+
+    Requests with more than response_window_size responses are returned as a
+    ResponsePager which reads the responses lazily while they are iterated.
+    These only account for a single window towards the limit since at most one
+    window is held in memory at any time.
+
+    Args:
+      session_id: The session_id to get the requests/responses for.
+      timestamp: Tuple (start, end) with a time range. Fetched responses will
+                 have timestamp in this range.
+      limit: The maximum number of responses to read into memory.
+
+    Yields:
+      A tuple (request, responses) in ascending order of request ids. The
+      responses are either a sorted list of GrrMessages or a ResponsePager.
+
+    Raises:
+      MoreDataException: When there are more completed requests available than
+                         were returned because of the limit.
+    """
     response_subjects = {}
+    pagers = {}
 
     if timestamp is None:
       timestamp = (0,
@@ -200,23 +308,38 @@ class QueueManager(object):
     for request, status in self.FetchCompletedRequests(session_id):
       # Make sure at least one response is fetched.
       response_subject = self.GetFlowResponseSubject(session_id, request.id)
-      response_subjects[response_subject] = request
+
+      if status.response_id > self.response_window_size:
+        pagers[response_subject] = ResponsePager(
+            self, session_id, request, status,
+            window_size=self.response_window_size, timestamp=timestamp)
+        total_size += self.response_window_size
+      else:
+        response_subjects[response_subject] = request
+        total_size += status.response_id
 
       # Quit if there are too many responses.
-      total_size += status.response_id
       if total_size > limit:
         break
 
-    response_data = dict(self.data_store.MultiResolveRegex(
-        response_subjects, self.FLOW_RESPONSE_REGEX, token=self.token,
-        timestamp=timestamp))
+    response_data = {}
+    if response_subjects:
+      response_data = dict(self.data_store.MultiResolveRegex(
+          response_subjects, self.FLOW_RESPONSE_REGEX, token=self.token,
+          timestamp=timestamp))
+
+    for response_urn in sorted(set(response_subjects) | set(pagers)):
+      if response_urn in pagers:
+        pager = pagers[response_urn]
+        yield (pager.request, pager)
+        continue
 
-    for response_urn, request in sorted(response_subjects.items()):
       responses = []
       for _, serialized, _ in response_data.get(response_urn, []):
         responses.append(rdfvalue.GrrMessage(serialized))
 
-      yield (request, sorted(responses, key=lambda msg: msg.response_id))
+      yield (response_subjects[response_urn],
+             sorted(responses, key=lambda msg: msg.response_id))
 
     # Indicate to the caller that there are more messages.
     if total_size > limit:
@@ -11,6 +11,7 @@ from grr.lib import server_plugins
 
 from grr.lib import data_store
 from grr.lib import flags
+from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
 from grr.lib import stats
@@ -114,6 +115,58 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     # Make sure the manager told us that more data is available.
     self.assertTrue(more_data)
 
+  def testLargeRepliesAreStreamed(self):
+    """Requests with many responses are paged from the data store."""
+    session_id = rdfvalue.SessionID("aff4:/flows/test_stream")
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.response_window_size = 4
+
+      request = rdfvalue.RequestState(
+          id=1, client_id=self.client_id,
+          next_state="TestState", session_id=session_id)
+      manager.QueueRequest(session_id, request)
+
+      for response_id in range(1, 10):
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=1, response_id=response_id))
+
+      manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+          request_id=1, response_id=10,
+          type=rdfvalue.GrrMessage.Type.STATUS))
+
+    completed = list(manager.FetchCompletedResponses(session_id))
+    self.assertEqual(len(completed), 1)
+
+    request, responses = completed[0]
+    self.assertEqual(request.id, 1)
+    self.assertTrue(isinstance(responses, queue_manager.ResponsePager))
+    self.assertEqual(len(responses), 10)
+    self.assertTrue(responses.IsComplete())
+    self.assertEqual([x.response_id for x in responses], range(1, 11))
+
+    # The status message is not one of the responses.
+    self.assertEqual(len(flow.Responses(request=request, responses=responses,
+                                        auth_required=False)), 9)
+
+    # Checking for any responses only reads the first window.
+    streamed = flow.Responses(request=request, responses=responses,
+                              auth_required=False)
+    with test_lib.Instrument(queue_manager.ResponsePager,
+                             "_ResolveWindow") as instrument:
+      self.assertTrue(streamed)
+    self.assertEqual(len(instrument.args), 1)
+
+    # A streamed request only accounts for a single window towards the limit.
+    self.assertEqual(len(list(manager.FetchCompletedResponses(
+        session_id, limit=5))), 1)
+
+    # Losing a response is detected without reading everything into memory.
+    data_store.DB.DeleteAttributes(
+        manager.GetFlowResponseSubject(session_id, 1),
+        [manager.FLOW_RESPONSE_TEMPLATE % (1, 5)], sync=True, token=self.token)
+    self.assertFalse(responses.IsComplete())
+
   def testDeleteFlowRequestStates(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID("aff4:/flows/test3")
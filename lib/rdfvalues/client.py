@@ -394,6 +394,40 @@ class BufferReference(rdfvalue.RDFProtoStruct):
     return self.data == other
 
 
+class HashFileChunksRequest(rdfvalue.RDFProtoStruct):
+  """A request to hash a range of a file on the client chunk by chunk."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoEmbedded(
+          name="pathspec", field_number=1, nested="PathSpec",
+          description="The file to hash."),
+
+      type_info.ProtoUnsignedInteger(
+          name="offset", field_number=2, default=0,
+          description="The offset where hashing starts."),
+
+      type_info.ProtoUnsignedInteger(
+          name="length", field_number=3, default=0,
+          description="The number of bytes to hash. If 0, the file is hashed "
+          "to its end."),
+
+      type_info.ProtoUnsignedInteger(
+          name="chunk_size", field_number=4, default=512 * 1024,
+          description="Each chunk of this size is hashed separately."),
+
+      type_info.ProtoUnsignedInteger(
+          name="max_chunks_per_response", field_number=5, default=1024,
+          description="The chunk digests are packed into responses of at most "
+          "this many digests."),
+
+      type_info.ProtoBoolean(
+          name="content_defined", field_number=6, default=False,
+          description="If set, the chunk boundaries are chosen by the content "
+          "and chunks are at most chunk_size long. Every digest is then "
+          "preceded by the chunk length as a little endian uint64."),
+      )
+
+
 class Process(rdfvalue.RDFProtoStruct):
   """Represent a process on the client."""
   protobuf = sysinfo_pb2.Process
@@ -477,6 +511,19 @@ class FindSpec(rdfvalue.RDFProtoStruct):
 
   dependencies = dict(RegularExpression=standard.RegularExpression)
 
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoUnsignedInteger(
+          name="prefetch_threads", field_number=14, default=0,
+          description="If set, list upcoming subdirectories with this many "
+          "threads while results are returned. The results are returned in "
+          "the same order either way."),
+
+      type_info.ProtoUnsignedInteger(
+          name="prefetch_max_entries", field_number=15, default=10000,
+          description="The most directory entries prefetched but not yet "
+          "returned that are held in memory."),
+      )
+
   def Validate(self):
     """Ensure the pathspec is valid."""
     self.pathspec.Validate()
@@ -572,8 +619,24 @@ class FingerprintResponse(rdfvalue.RDFProtoStruct):
 
 
 class GrepSpec(rdfvalue.RDFProtoStruct):
+  """A grep request.
+
+  Besides the single literal or regex, any number of literals and regexes can
+  be given. They are all searched for in a single pass over the target.
+  """
   protobuf = jobs_pb2.GrepSpec
 
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoList(type_info.ProtoBinary(
+          name="literals", field_number=11,
+          description="Search for all of these literal strings. They are "
+          "encoded with xor_in_key just like literal.")),
+
+      type_info.ProtoList(type_info.ProtoString(
+          name="regexes", field_number=12,
+          description="Search for all of these regular expressions.")),
+      )
+
   def Validate(self):
     self.target.Validate()
 
@@ -582,6 +645,16 @@ class BareGrepSpec(rdfvalue.RDFProtoStruct):
   """A GrepSpec without a target."""
   protobuf = flows_pb2.BareGrepSpec
 
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoList(type_info.ProtoBinary(
+          name="literals", field_number=11,
+          description="Search for all of these literal strings.")),
+
+      type_info.ProtoList(type_info.ProtoString(
+          name="regexes", field_number=12,
+          description="Search for all of these regular expressions.")),
+      )
+
 
 class WMIRequest(rdfvalue.RDFProtoStruct):
   protobuf = jobs_pb2.WmiRequest
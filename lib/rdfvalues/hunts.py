@@ -6,8 +6,128 @@
 
 
 from grr.lib import rdfvalue
+from grr.lib import type_info
 from grr.proto import jobs_pb2
 
 
 class HuntNotification(rdfvalue.RDFProtoStruct):
   protobuf = jobs_pb2.HuntNotification
+
+
+class HuntSummary(rdfvalue.RDFProtoStruct):
+  """A compact summary of a hunt, as shown in the list of hunts."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoRDFValue(
+          name="hunt_urn", field_number=1, rdf_type="RDFURN",
+          description="The hunt this summary is for."),
+
+      type_info.ProtoString(
+          name="name", field_number=2,
+          description="The name of the hunt class."),
+
+      type_info.ProtoString(
+          name="state", field_number=3,
+          description="The state of the hunt."),
+
+      type_info.ProtoString(
+          name="creator", field_number=4,
+          description="The user who created the hunt."),
+
+      type_info.ProtoString(
+          name="description", field_number=5,
+          description="The description of the hunt."),
+
+      type_info.ProtoRDFValue(
+          name="create_time", field_number=6, rdf_type="RDFDatetime",
+          description="When the hunt was created."),
+
+      type_info.ProtoRDFValue(
+          name="start_time", field_number=7, rdf_type="RDFDatetime",
+          description="When the hunt was started."),
+
+      type_info.ProtoRDFValue(
+          name="expires", field_number=8, rdf_type="RDFDatetime",
+          description="When the hunt expires."),
+
+      type_info.ProtoUnsignedInteger(
+          name="client_limit", field_number=9,
+          description="The maximum number of clients the hunt runs on."),
+
+      type_info.ProtoUnsignedInteger(
+          name="client_count", field_number=10,
+          description="The number of clients scheduled."),
+
+      type_info.ProtoUnsignedInteger(
+          name="completed_count", field_number=11,
+          description="The number of clients the hunt completed on."),
+
+      type_info.ProtoUnsignedInteger(
+          name="result_count", field_number=12,
+          description="The number of results collected."),
+      )
+
+
+class HuntResultAggregateCount(rdfvalue.RDFProtoStruct):
+  """The number of times a value was seen among a hunt's results."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoString(
+          name="key", field_number=1,
+          description="The value counted."),
+
+      type_info.ProtoUnsignedInteger(
+          name="count", field_number=2, default=0,
+          description="The number of times the value was seen."),
+
+      type_info.ProtoUnsignedInteger(
+          name="error", field_number=3, default=0,
+          description="The maximum amount by which count may overestimate "
+          "the true count."),
+      )
+
+
+class HuntResultAggregate(rdfvalue.RDFProtoStruct):
+  """The current value of a single aggregate over a hunt's results."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoString(
+          name="name", field_number=1,
+          description="The name of the aggregate."),
+
+      type_info.ProtoString(
+          name="description", field_number=2,
+          description="A description of the aggregate."),
+
+      type_info.ProtoUnsignedInteger(
+          name="num_values", field_number=3, default=0,
+          description="The number of values aggregated so far."),
+
+      type_info.ProtoList(type_info.ProtoEmbedded(
+          name="counts", field_number=4,
+          nested=HuntResultAggregateCount,
+          description="Counts of the most common values, most common first.")),
+
+      type_info.ProtoEmbedded(
+          name="distribution", field_number=5, nested="RunningStats",
+          description="The distribution of numeric values."),
+      )
+
+  def GetTop(self, count=None):
+    """Returns a list of (key, count) of the most common values."""
+    return [(c.key, c.count) for c in list(self.counts)[:count]]
+
+
+class HuntResultAggregates(rdfvalue.RDFProtoStruct):
+  """All the aggregates over a hunt's results."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoList(type_info.ProtoEmbedded(
+          name="aggregates", field_number=1, nested=HuntResultAggregate)),
+      )
+
+  def GetAggregate(self, name):
+    """Returns the aggregate with the given name, None if there is none."""
+    for aggregate in self.aggregates:
+      if aggregate.name == name:
+        return aggregate
@@ -3,6 +3,9 @@
 
 
 import re
+import sre_constants
+import sre_parse
+
 from grr.lib import config_lib
 from grr.lib import rdfvalue
 from grr.lib import type_info
@@ -21,15 +24,30 @@ class RegularExpression(rdfvalue.RDFString):
     except re.error:
       raise type_info.TypeValueError("Not a valid regular expression.")
 
-  def Search(self, text):
+  def Search(self, text, pos=0, endpos=None):
     """Search the text for our value."""
-    return self._regex.search(text)
+    if endpos is None:
+      endpos = len(text)
+    return self._regex.search(text, pos, endpos)
 
   def Match(self, text):
     return self._regex.match(text)
 
-  def FindIter(self, text):
-    return self._regex.finditer(text)
+  def FindIter(self, text, pos=0, endpos=None):
+    if endpos is None:
+      endpos = len(text)
+    return self._regex.finditer(text, pos, endpos)
+
+  def HasGroups(self):
+    return self._regex.groups > 0
+
+  def MaxMatchLength(self):
+    """Returns the length of the longest possible match, None if unbounded."""
+    _, max_width = sre_parse.parse(self._value, self._regex.flags).getwidth()
+    if max_width >= sre_constants.MAXREPEAT:
+      return None
+
+    return max_width
 
   def __str__(self):
     return "<RegularExpression: %r/>" % self._value
@@ -67,3 +85,29 @@ class AuthenticodeSignedData(rdfvalue.RDFProtoStruct):
 
 class PersistenceFile(rdfvalue.RDFProtoStruct):
   protobuf = jobs_pb2.PersistenceFile
+
+
+class AFF4ObjectSummary(rdfvalue.RDFProtoStruct):
+  """A compact summary of an AFF4 object kept in its parent's index."""
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoString(
+          name="name", field_number=1,
+          description="The basename of the object."),
+
+      type_info.ProtoString(
+          name="aff4_type", field_number=2,
+          description="The AFF4 type of the object."),
+
+      type_info.ProtoUnsignedInteger(
+          name="size", field_number=3,
+          description="The size of the object if known."),
+
+      type_info.ProtoRDFValue(
+          name="mtime", field_number=4, rdf_type="RDFDatetimeSeconds",
+          description="The modification time of the object if known."),
+
+      type_info.ProtoBoolean(
+          name="has_children", field_number=5, default=False,
+          description="True if the object is a container."),
+      )
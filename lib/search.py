@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 """Functions for searching."""
+import heapq
 import itertools
 import re
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import utils
 
 
 CLIENT_SCHEMA = aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls
@@ -14,79 +17,312 @@ INDEX_PREFIX_MAP = {"host": CLIENT_SCHEMA.HOSTNAME,
                     "label": CLIENT_SCHEMA.LABEL,
                     "user": CLIENT_SCHEMA.USERNAMES}
 
+# The prefix of terms constraining the last time a client was seen, e.g.
+# "seen:<7d" (seen within the last week) or "seen:>30d" (not seen for a month).
+LAST_SEEN_PREFIX = "seen"
 
-def SearchClients(query_string, start=0, max_results=1000, token=None):
-  """Take a query string and interpret it as a search, returning ClientURNs."""
-  query_string = query_string.strip()
-  mac_addr_re = r"^([0-9a-f]{2}[:-]){5}([0-9a-f]{2})$"
-  result_iterators = []
-
-  try:
-    # If someone specified a client_id we use that.
-    result_iterators.append([rdfvalue.ClientURN(query_string.strip())])
-  except ValueError:
-    pass
-
-  if not result_iterators:
-    # Search via the indexes.
-    query_string = query_string.lower()
-    client_schema = aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls
-    index_urn = client_schema.client_index
-    index = aff4.FACTORY.Create(index_urn, aff4_type="AFF4Index",
-                                mode="rw", token=token)
-    label_index_urn = rdfvalue.RDFURN("aff4:/index/label")
-    label_index = aff4.FACTORY.Create(label_index_urn, aff4_type="AFF4Index",
-                                      mode="rw", token=token)
-
-    indexed_attrs = []
+MAC_ADDR_RE = re.compile(r"^([0-9a-f]{2}[:-]){5}([0-9a-f]{2})$")
+CLIENT_ID_RE = re.compile(r"^C\.[0-9a-fA-F]{16}$")
+
+# Terms are separated by whitespace unless it is inside double quotes.
+TERM_RE = re.compile(r'(?:[^\s"]|"[^"]*")+')
+
+# The number of clients whose last seen time is read at a time.
+LAST_SEEN_BATCH_SIZE = 1000
+
+
+class IndexScan(object):
+  """A scan of an index row for the clients with matching values."""
+
+  def __init__(self, index_urn, attribute, value_regex):
+    self.index_urn = index_urn
+    # The values are followed by the urn of the object they belong to.
+    self.regex = "index:%s:%s:aff4:/" % (attribute.predicate, value_regex)
+    self.compiled_regex = re.compile(self.regex)
+
+
+class LastSeenFilter(object):
+  """Only passes clients seen (or not seen) within a duration."""
+
+  def __init__(self, spec):
+    """Constructor.
+
+    Args:
+      spec: A duration prefixed with < (seen within the duration) or > (not
+            seen within the duration), e.g. <7d.
+
+    Raises:
+      IOError: If the spec is invalid.
+    """
+    if len(spec) < 2 or spec[0] not in "<>":
+      raise IOError("Invalid %s constraint %s, use e.g. %s:<7d or %s:>30d" % (
+          LAST_SEEN_PREFIX, spec, LAST_SEEN_PREFIX, LAST_SEEN_PREFIX))
+
+    self.seen_within = spec[0] == "<"
+    try:
+      duration = rdfvalue.Duration(spec[1:])
+    except (RuntimeError, rdfvalue.InitializeError) as e:
+      raise IOError("Invalid %s constraint %s: %s" % (LAST_SEEN_PREFIX, spec,
+                                                      e))
+
+    self.cutoff = int(rdfvalue.RDFDatetime().Now()) - int(duration) * 1000000
+
+  def Filter(self, client_ids, token=None):
+    """Yields the clients from the sorted client_ids which pass the filter."""
+    predicate = CLIENT_SCHEMA.PING.predicate
+    while True:
+      batch = list(itertools.islice(client_ids, LAST_SEEN_BATCH_SIZE))
+      if not batch:
+        return
+
+      pings = {}
+      for subject, values in data_store.DB.MultiResolveRegex(
+          ["aff4:/%s" % client_id for client_id in batch], predicate,
+          token=token, timestamp=data_store.DB.NEWEST_TIMESTAMP):
+        for _, value, _ in values:
+          pings[utils.SmartStr(subject)] = int(value)
+
+      for client_id in batch:
+        seen = pings.get("aff4:/%s" % client_id, 0) >= self.cutoff
+        if seen == self.seen_within:
+          yield client_id
+
+
+class Conjunction(object):
+  """Clients matching all of a list of terms.
+
+  Each term which selects clients from the indexes is a list of IndexScans
+  (matching any of them) or a list of client ids. Clients are further limited
+  by the filters.
+  """
+
+  def __init__(self):
+    self.terms = []
+    self.filters = []
+
+
+def _UnionSorted(iterables):
+  """Merges sorted iterables into a sorted iterable without duplicates."""
+  last = None
+  for item in heapq.merge(*iterables):
+    if item != last:
+      yield item
+      last = item
+
+
+def _IntersectSorted(first, second):
+  """Yields the items found in both sorted lists."""
+  i = j = 0
+  while i < len(first) and j < len(second):
+    if first[i] < second[j]:
+      i += 1
+    elif first[i] > second[j]:
+      j += 1
+    else:
+      yield first[i]
+      i += 1
+      j += 1
+
+
+class ClientSearchQuery(object):
+  """A client search query compiled into a plan of index scans.
+
+  A query is a list of terms which must all match, optionally separated by OR
+  into alternatives. AND may be used between terms for readability. Terms are:
+
+    C.1234567890abcdef - A client id.
+    prefix:value - A value of one index, e.g. host:web01 or label:prod. Values
+      of label terms must match exactly, other values are searched as
+      substrings.
+    prefix:value* - Only values starting with value, e.g. host:web*. This is
+      still a regex matched against every column of the index row, like
+      substring terms, it is only more selective.
+    value - A substring of any indexed value, or an exact label.
+    seen:<duration, seen:>duration - Clients seen (or not seen) within the
+      duration, e.g. seen:<7d. Last seen times are not indexed, so these must
+      be combined with a term selecting the clients to check, e.g.
+      host:* seen:>30d to check every client.
+
+  Values containing whitespace must be quoted, e.g. user:"john smith" or
+  "windows 7". An empty query matches all clients with any indexed value.
+
+  All index scans of a query are read with a single request per index, and the
+  results of the terms are intersected and merged in sorted order. Results are
+  therefore returned ordered by client id and can be paged. Every page runs
+  the whole query again though: all matching index entries are read and only
+  then is the page cut out, so the cost of a page grows with the number of
+  matching clients rather than with the size of the page.
+  """
+
+  def __init__(self, query_string):
+    self.query_string = query_string
+    self.conjunctions = []
+    self.scans = []
+    self._Compile(query_string)
+
+  def _Compile(self, query_string):
+    """Compiles the query string into conjunctions.
+
+    Args:
+      query_string: The query.
+
+    Raises:
+      IOError: If the query is invalid.
+    """
+    tokens = TERM_RE.findall(query_string)
+    if not tokens:
+      # The empty value matches everything.
+      tokens = ['""']
+
+    conjunction = Conjunction()
+    for token in tokens:
+      if token == "OR":
+        if conjunction.terms or conjunction.filters:
+          self.conjunctions.append(conjunction)
+        conjunction = Conjunction()
+      elif token != "AND":
+        self._CompileTerm(token.replace('"', ""), conjunction)
+
+    if conjunction.terms or conjunction.filters:
+      self.conjunctions.append(conjunction)
+
+    for conjunction in self.conjunctions:
+      if not conjunction.terms:
+        raise IOError("%s constraints must be combined with a search term, "
+                      "use e.g. host:* %s:>30d to check all clients." % (
+                          LAST_SEEN_PREFIX, LAST_SEEN_PREFIX))
+
+  def _CompileTerm(self, term, conjunction):
+    """Adds the scans or filters for a single term to the conjunction."""
+    if rdfvalue.ClientURN.Validate(term):
+      conjunction.terms.append([rdfvalue.ClientURN(term).Basename()])
+      return
+
+    term = term.lower()
 
     prefix = ""
-    if ":" in query_string:
-      prefix = query_string.split(":", 1)[0]
-      if re.match(r"^[0-9a-f]{2}$", prefix):
-        # Handle the special MAC wierd case e.g. mac:DE:AD:BE:EF:AA:AA.
-        prefix = ""
-      if prefix:
-        if prefix not in INDEX_PREFIX_MAP:
-          raise IOError("Invalid prefix %s. Choose from %s" % (
-              prefix, INDEX_PREFIX_MAP.keys()))
-        else:
-          query_string = query_string.split(":", 1)[1]
+    value = term
+    if ":" in term and not MAC_ADDR_RE.match(term):
+      prefix, value = term.split(":", 1)
+
+    if prefix == LAST_SEEN_PREFIX:
+      conjunction.filters.append(LastSeenFilter(value))
+      return
+
+    if prefix and prefix not in INDEX_PREFIX_MAP:
+      raise IOError("Invalid prefix %s. Choose from %s" % (
+          prefix, INDEX_PREFIX_MAP.keys() + [LAST_SEEN_PREFIX]))
+
+    # Fixup MAC addresses to match the MAC index format.
+    if MAC_ADDR_RE.match(value):
+      value = value.replace(":", "").replace("-", "")
+
+    if value.endswith("*"):
+      value_regex = utils.EscapeRegex(value[:-1]) + ".*"
+      exact_regex = value_regex
+    else:
+      value_regex = ".*%s.*" % utils.EscapeRegex(value)
+      # Labels need to be exact matches.
+      exact_regex = utils.EscapeRegex(value)
 
     if prefix:
-      # Search a specific index.
-      indexed_attrs = [INDEX_PREFIX_MAP[prefix]]
+      attributes = [INDEX_PREFIX_MAP[prefix]]
     else:
       # Search all indexes.
-      indexed_attrs = [a for a in client_schema().ListAttributes() if a.index]
-      indexed_attrs.append(client_schema.LABEL)
+      attributes = [a for a in CLIENT_SCHEMA().ListAttributes() if a.index]
+      attributes.append(CLIENT_SCHEMA.LABEL)
 
-    # Fixup MAC addresses to match the MAC index format.
-    match = re.search(mac_addr_re, query_string)
-    if match:
-      query_string = query_string.replace(":", "").replace("-", "")
-
-    # Get the main results using wildcard matches.
-    if indexed_attrs != [client_schema.LABEL]:
-      search_results = index.Query(
-          indexed_attrs, ".*%s.*" % query_string, limit=(start, max_results))
-      search_results = [rdfvalue.ClientURN(r) for r in search_results]
-      result_iterators.append(search_results)
-
-    if client_schema.LABEL in indexed_attrs:
-      label_matches = []
-      # Labels need to be exact matches.
-      label_results = label_index.Query(
-          [client_schema.LABEL], query_string, limit=(start, max_results))
-
-      # The above returns all labels, not all of which will be clients, we need
-      # to filter for those that are clients.
-      for result in label_results:
-        try:
-          result = rdfvalue.ClientURN(result)
-          label_matches.append(result)
-        except ValueError:
-          pass
-      result_iterators.append(label_matches)
-
-  return itertools.chain(*result_iterators)
+    scans = []
+    for attribute in attributes:
+      if attribute == CLIENT_SCHEMA.LABEL:
+        scans.append(IndexScan(CLIENT_SCHEMA.label_index, attribute,
+                               exact_regex))
+      else:
+        scans.append(IndexScan(attribute.index, attribute, value_regex))
+
+    self.scans.extend(scans)
+    conjunction.terms.append(scans)
+
+  def _RunScans(self, token):
+    """Reads all the index scans, one request per index.
+
+    The data store matches the regexes of the scans against all the columns of
+    the index row and returns every match, the results are not limited to a
+    page.
+
+    Args:
+      token: The security token.
+
+    Returns:
+      A dict of sets of client ids, keyed by IndexScan.
+    """
+    aff4.FACTORY.FlushIndexes()
+
+    scans_by_index = {}
+    for scan in self.scans:
+      scans_by_index.setdefault(scan.index_urn, []).append(scan)
+
+    results = dict((scan, set()) for scan in self.scans)
+    for index_urn, scans in scans_by_index.iteritems():
+      for column, _, _ in data_store.DB.ResolveRegex(
+          index_urn, [scan.regex for scan in scans], token=token,
+          timestamp=data_store.DB.ALL_TIMESTAMPS, limit=None):
+        # Extract the client id from the column name. The label index also
+        # holds objects which are not clients.
+        client_id = column.rsplit("aff4:/", 1)[1]
+        if not CLIENT_ID_RE.match(client_id):
+          continue
+
+        for scan in scans:
+          if scan.compiled_regex.match(column):
+            results[scan].add(client_id)
+
+    return results
+
+  def _RunConjunction(self, conjunction, scan_results, token):
+    """Yields the sorted client ids matching a conjunction."""
+    postings = []
+    for term in conjunction.terms:
+      if term and isinstance(term[0], IndexScan):
+        postings.append(list(_UnionSorted(
+            sorted(scan_results[scan]) for scan in term)))
+      else:
+        postings.append(sorted(term))
+
+    # Start with the smallest posting list to keep the intersections small.
+    postings.sort(key=len)
+    client_ids = postings[0]
+    for posting in postings[1:]:
+      client_ids = list(_IntersectSorted(client_ids, posting))
+
+    client_ids = iter(client_ids)
+    for query_filter in conjunction.filters:
+      client_ids = query_filter.Filter(client_ids, token=token)
+
+    return client_ids
+
+  def Execute(self, start=0, max_results=1000, token=None):
+    """Runs the query.
+
+    Args:
+      start: The number of results to skip.
+      max_results: The maximum number of results to return.
+      token: The security token.
+
+    Returns:
+      A generator of ClientURNs sorted by client id.
+    """
+    scan_results = self._RunScans(token)
+
+    client_ids = _UnionSorted(
+        self._RunConjunction(conjunction, scan_results, token)
+        for conjunction in self.conjunctions)
+
+    return (rdfvalue.ClientURN(client_id) for client_id in itertools.islice(
+        client_ids, start, start + max_results))
+
+
+def SearchClients(query_string, start=0, max_results=1000, token=None):
+  """Take a query string and interpret it as a search, returning ClientURNs."""
+  return ClientSearchQuery(query_string.strip()).Execute(
+      start=start, max_results=max_results, token=token)
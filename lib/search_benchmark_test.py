@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Benchmarks for client searches over a large fleet."""
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import search
+from grr.lib import test_lib
+
+
+class SearchBenchmark(test_lib.MicroBenchmarks):
+  """Measure how fast clients are searched in a synthetic fleet."""
+
+  REPEATS = 5
+  units = "ms"
+
+  # The number of clients in the fleet.
+  NUM_CLIENTS = 100000
+
+  ROLES = ["web", "db", "mail", "build"]
+  LABELS = ["prod", "dev", "test"]
+
+  def _MakeFleet(self):
+    """Writes the index rows and last seen times of the fleet."""
+    schema = search.CLIENT_SCHEMA
+    now = int(rdfvalue.RDFDatetime().Now())
+    # Every tenth client has not been seen for a month.
+    month = 30 * 24 * 60 * 60 * 1000000
+
+    client_index = {}
+    label_index = {}
+    for i in xrange(self.NUM_CLIENTS):
+      urn = "aff4:/C.%016x" % i
+      hostname = "%s%05d" % (self.ROLES[i % len(self.ROLES)], i)
+      label = self.LABELS[i % len(self.LABELS)]
+
+      client_index["index:%s:%s:%s" % (
+          schema.HOSTNAME.predicate, hostname, urn)] = "X"
+      client_index["index:%s:%s.example.com:%s" % (
+          schema.FQDN.predicate, hostname, urn)] = "X"
+      label_index["index:%s:%s:%s" % (
+          schema.LABEL.predicate, label, urn)] = "X"
+
+      data_store.DB.MultiSet(
+          urn, {schema.PING.predicate: now - month if i % 10 == 0 else now},
+          token=self.token)
+
+    data_store.DB.MultiSet(schema.HOSTNAME.index, client_index,
+                           token=self.token)
+    data_store.DB.MultiSet(schema.label_index, label_index, token=self.token)
+
+  @test_lib.SetLabel("benchmark", "large")
+  def testSearchClients(self):
+    """Search a fleet of clients with multi term queries."""
+    self._MakeFleet()
+
+    def Search(query_string, start=0, max_results=1000):
+      return len(list(search.SearchClients(
+          query_string, start=start, max_results=max_results,
+          token=self.token)))
+
+    for query_string in ["label:prod",
+                         "host:web1*",
+                         "host:web1* AND label:prod",
+                         "label:prod OR label:dev",
+                         "label:prod seen:<7d",
+                         "host:web1* seen:>7d",
+                         "example.com"]:
+      self.TimeIt(Search, name="Query %s" % query_string,
+                  query_string=query_string)
+
+    # Later pages are found by skipping over the sorted results.
+    for start in [0, 10000, 30000]:
+      self.TimeIt(Search, name="Page of label:prod at %d" % start,
+                  query_string="label:prod", start=start, max_results=100)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -104,6 +104,70 @@ class SearchTest(test_lib.FlowTestsBaseclass):
     results = list(search.SearchClients("label:label1", token=self.token))
     self.assertEqual(len(results), 1)
 
+  def testSearchQueryPlan(self):
+    """Test queries combining several terms."""
+    client_ids = self.SetupClients(12)
+    for i, client_id in enumerate(client_ids):
+      with aff4.FACTORY.Open(client_id, token=self.token, mode="rw") as fd:
+        fd.AddLabels(["odd" if i % 2 else "even"])
+
+    # Prefix searches only match the start of values and results are sorted.
+    results = list(search.SearchClients("host:host-1*", token=self.token))
+    self.assertEqual(results, [client_ids[1], client_ids[10], client_ids[11]])
+
+    results = list(search.SearchClients("host:host-1* label:odd",
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[1], client_ids[11]])
+    results = list(search.SearchClients("label:odd AND host:host-1*",
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[1], client_ids[11]])
+
+    results = list(search.SearchClients("host:host-3 OR host:host-2",
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[2], client_ids[3]])
+
+    # Results can be paged.
+    results = list(search.SearchClients("label:even", start=2, max_results=2,
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[4], client_ids[6]])
+
+    # All the clients have just been seen.
+    results = list(search.SearchClients("label:odd seen:<1d",
+                                        token=self.token))
+    self.assertEqual(len(results), 6)
+    results = list(search.SearchClients("host:* seen:>1d", token=self.token))
+    self.assertEqual(results, [])
+
+    # Last seen constraints alone would have to check every client.
+    self.assertRaises(IOError, search.SearchClients, "seen:>1d",
+                      token=self.token)
+    self.assertRaises(IOError, search.SearchClients, "seen:7d",
+                      token=self.token)
+    self.assertRaises(IOError, search.SearchClients, "foo:bar",
+                      token=self.token)
+
+  def testSearchValuesWithSpaces(self):
+    """Test that quoted values may contain whitespace."""
+    client_ids = self.SetupClients(2)
+    with aff4.FACTORY.Open(client_ids[0], token=self.token, mode="rw") as fd:
+      fd.Set(fd.Schema.FQDN("lmao example"))
+
+    results = list(search.SearchClients('fqdn:"lmao example"',
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[0]])
+
+    # Unquoted, these are two terms which must both match.
+    results = list(search.SearchClients("fqdn:lmao fqdn:example",
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[0]])
+    results = list(search.SearchClients("fqdn:lmao example",
+                                        token=self.token))
+    self.assertEqual(results, [client_ids[0]])
+
+  def testEmptySearchFindsAllClients(self):
+    results = list(search.SearchClients("", token=self.token))
+    self.assertEqual(sorted(results), sorted(self.clients))
+
 
 def main(argv):
   test_lib.main(argv)
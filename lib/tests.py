@@ -11,6 +11,7 @@ from grr.lib import aff4_test
 from grr.lib import artifact_lib_test
 from grr.lib import artifact_test
 from grr.lib import build_test
+from grr.lib import columnar_test
 from grr.lib import communicator_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
@@ -25,6 +26,7 @@ from grr.lib import lexer_test
 from grr.lib import objectfilter_test
 from grr.lib import parsers_test
 from grr.lib import queue_manager_test
+from grr.lib import search_benchmark_test
 from grr.lib import search_test
 from grr.lib import stats_store_test
 from grr.lib import stats_test
@@ -28,7 +28,9 @@ Fingerprinter, as exemplified in main.
 import collections
 import hashlib
 import os
+import Queue
 import struct
+import threading
 
 
 # pylint: disable=g-bad-name
@@ -100,15 +102,45 @@ class Finger(object):
     for hasher in self.hashers:
       hasher.update(block)
 
+  def HashRanges(self, block, start):
+    """Hashes the parts of a block which fall into our ranges.
+
+    Blocks must be given in increasing order of offsets. Ranges are consumed
+    as they are hashed.
+
+    Args:
+      block: The data block.
+      start: Offset of the block in the file.
+    """
+    end = start + len(block)
+    view = memoryview(block)
+    while self.ranges:
+      current = self.ranges[0]
+      if current.start >= end:
+        break
+
+      low = max(current.start, start)
+      high = min(current.end, end)
+      if low < high:
+        self.HashBlock(view[low - start:high - start])
+
+      if current.end > end:
+        # The rest of this range is in the next block.
+        break
+
+      del self.ranges[0]
+
 
 class Fingerprinter(object):
   """Compute different types of cryptographic hashes over a file.
 
   Depending on type of file and mode of invocation, filetype-specific or
   generic hashes get computed over a file. Different hashes can cover
-  different ranges of the file. The file is read only once. Memory
-  use of class objects is dominated by min(file size, block size),
-  as defined below.
+  different ranges of the file. The file is read only once, in large
+  aligned blocks, and all hashers are fed from the same block. Large
+  files are hashed on a separate thread while the next blocks are
+  read. Memory use of class objects is dominated by
+  min(file size, (READ_AHEAD + 2) * BLOCK_SIZE), as defined below.
 
   The class delivers an array with dicts of hashes by file type. Where
   appropriate, embedded signature data is also returned from the file.
@@ -119,7 +151,10 @@ class Fingerprinter(object):
   - Call HashIt and take from the resulting dict what you need.
   """
 
-  BLOCK_SIZE = 1000000
+  # Reads are this large and aligned to this size.
+  BLOCK_SIZE = 4 * 1024 * 1024
+  # How many blocks may be read ahead of the hashing thread.
+  READ_AHEAD = 2
   GENERIC_HASH_CLASSES = (hashlib.md5, hashlib.sha1, hashlib.sha256,
                           hashlib.sha512)
   AUTHENTICODE_HASH_CLASSES = (hashlib.md5, hashlib.sha1)
@@ -130,60 +165,98 @@ class Fingerprinter(object):
     self.file.seek(0, os.SEEK_END)
     self.filelength = self.file.tell()
 
-  def _GetNextInterval(self):
-    """Returns the next Range of the file that is to be hashed.
+  def _GetNextOffset(self, finger_ranges, offset):
+    """Returns the first offset from offset on which any finger hashes."""
+    result = None
+    for ranges in finger_ranges:
+      for current in ranges:
+        if current.end > offset and current.start < current.end:
+          start = max(current.start, offset)
+          if result is None or start < result:
+            result = start
+          break
 
-    For all fingers, inspect their next expected range, and return the
-    lowest uninterrupted range of interest. If the range is larger than
-    BLOCK_SIZE, truncate it.
+    return result
 
-    Returns:
-      Next range of interest in a Range namedtuple.
+  def _ReadBlocks(self):
+    """Yields (offset, block) for all the data the fingers need.
+
+    The file is read in order, once, in blocks of BLOCK_SIZE aligned to
+    BLOCK_SIZE. Gaps no finger is interested in are skipped.
+
+    Yields:
+      Tuples of the offset and the data of each block.
+
+    Raises:
+      RuntimeError: On a short read.
     """
-    starts = set([x.CurrentRange().start for x in self.fingers if x.ranges])
-    ends = set([x.CurrentRange().end for x in self.fingers if x.ranges])
-    if not starts:
-      return None
-    min_start = min(starts)
-    starts.remove(min_start)
-    ends |= starts
-    min_end = min(ends)
-    if min_end - min_start > self.BLOCK_SIZE:
-      min_end = min_start + self.BLOCK_SIZE
-    return Range(min_start, min_end)
-
-  def _AdjustIntervals(self, start, end):
-    for finger in self.fingers:
-      finger.ConsumeRange(start, end)
+    # The hashing thread consumes the fingers' ranges while we read, so we
+    # plan the reads on our own copy of them.
+    finger_ranges = [list(finger.ranges) for finger in self.fingers]
+
+    offset = 0
+    while True:
+      offset = self._GetNextOffset(finger_ranges, offset)
+      if offset is None:
+        return
+
+      end = min(offset - offset % self.BLOCK_SIZE + self.BLOCK_SIZE,
+                self.filelength)
 
-  def _HashBlock(self, block, start, end):
-    """_HashBlock feeds data blocks into the hashers of fingers.
+      self.file.seek(offset, os.SEEK_SET)
+      block = self.file.read(end - offset)
+      if len(block) != end - offset:
+        raise RuntimeError('Short read on file.')
+
+      yield offset, block
+      offset = end
+
+  def _HashBlock(self, block, start):
+    for finger in self.fingers:
+      finger.HashRanges(block, start)
 
-    This function must be called before adjusting fingers for next
-    interval, otherwise the lack of remaining ranges will cause the
-    block not to be hashed for a specific finger.
+  def _HashBlocksInThread(self, blocks):
+    """Hashes the blocks on a separate thread while the next are read.
 
-    Start and end are used to validate the expected ranges, to catch
-    unexpected use of that logic.
+    Most hashlib functions release the GIL on large updates, so reading and
+    hashing run concurrently.
 
     Args:
-      block: The data block.
-      start: Beginning offset of this block.
-      end: Offset of the next byte after the block.
+      blocks: An iterator of (offset, block) tuples.
 
     Raises:
-      RuntimeError: If the provided and expected ranges don't match.
+      RuntimeError: If hashing failed.
     """
-    for finger in self.fingers:
-      expected_range = finger.CurrentRange()
-      if expected_range is None:
-        continue
-      if (start > expected_range.start or
-          (start == expected_range.start and end > expected_range.end) or
-          (start < expected_range.start and end > expected_range.start)):
-        raise RuntimeError('Cutting across fingers.')
-      if start == expected_range.start:
-        finger.HashBlock(block)
+    queue = Queue.Queue(maxsize=self.READ_AHEAD)
+    errors = []
+
+    def HashBlocks():
+      while True:
+        item = queue.get()
+        if item is None:
+          return
+
+        # Keep draining the queue after an error so the reader never blocks.
+        if not errors:
+          try:
+            self._HashBlock(item[1], item[0])
+          except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+
+    worker = threading.Thread(target=HashBlocks, name='Fingerprinter')
+    worker.daemon = True
+    worker.start()
+    try:
+      for item in blocks:
+        if errors:
+          break
+        queue.put(item)
+    finally:
+      queue.put(None)
+      worker.join()
+
+    if errors:
+      raise errors[0]
 
   def HashIt(self):
     """Finalizing function for the Fingerprint class.
@@ -204,16 +277,11 @@ class Fingerprinter(object):
     Raises:
        RuntimeError: when internal inconsistencies occur.
     """
-    while True:
-      interval = self._GetNextInterval()
-      if interval is None:
-        break
-      self.file.seek(interval.start, os.SEEK_SET)
-      block = self.file.read(interval.end - interval.start)
-      if len(block) != interval.end - interval.start:
-        raise RuntimeError('Short read on file.')
-      self._HashBlock(block, interval.start, interval.end)
-      self._AdjustIntervals(interval.start, interval.end)
+    if self.filelength > self.BLOCK_SIZE:
+      self._HashBlocksInThread(self._ReadBlocks())
+    else:
+      for start, block in self._ReadBlocks():
+        self._HashBlock(block, start)
 
     results = []
     for finger in self.fingers:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Benchmarks for the throughput of the Fingerprinter."""
+
+
+import os
+
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.parsers import fingerprint
+
+
+class FingerprinterBenchmark(test_lib.MicroBenchmarks):
+  """Measure how fast large files are fingerprinted."""
+
+  REPEATS = 1
+  units = "s"
+
+  # The size of the files we fingerprint.
+  FILE_SIZES = [256 * 1024 * 1024, 2 * 1024 * 1024 * 1024]
+
+  def _MakeFile(self, size):
+    """Creates a sparse file of the given size."""
+    path = os.path.join(self.temp_dir, "file_%d" % size)
+    with open(path, "wb") as fd:
+      fd.truncate(size)
+
+    return path
+
+  def _Fingerprint(self, path, pecoff=False):
+    with open(path, "rb") as fd:
+      fingerprinter = fingerprint.Fingerprinter(fd)
+      fingerprinter.EvalGeneric()
+      if pecoff:
+        fingerprinter.EvalPecoff()
+
+      return fingerprinter.HashIt()
+
+  def _TimeFingerprint(self, name, path, size, **kwargs):
+    self.TimeIt(self._Fingerprint, name=name, path=path, **kwargs)
+
+    # Replace the result with the throughput.
+    time_taken = self.benchmark_scratchpad[-1][1]
+    self.benchmark_scratchpad[-1][3] = "%.1f MB/s" % (
+        size / time_taken / 1024 / 1024)
+
+  @test_lib.SetLabel("benchmark", "large")
+  def testFingerprintThroughput(self):
+    """Fingerprint large files with and without a hashing thread."""
+    for size in self.FILE_SIZES:
+      path = self._MakeFile(size)
+      name = "%d MB" % (size / 1024 / 1024)
+
+      self._TimeFingerprint("Generic %s" % name, path, size)
+      self._TimeFingerprint("Generic and PE/COFF %s" % name, path, size,
+                            pecoff=True)
+
+      # Hashing on the reading thread, as for files smaller than a block.
+      def HashInline(fingerprinter, blocks):
+        for start, block in blocks:
+          fingerprinter._HashBlock(block, start)  # pylint: disable=protected-access
+
+      with test_lib.Stubber(fingerprint.Fingerprinter, "_HashBlocksInThread",
+                            HashInline):
+        self._TimeFingerprint("Generic %s, single thread" % name, path, size)
+
+      # The old default of 1MB blocks.
+      with test_lib.Stubber(fingerprint.Fingerprinter, "BLOCK_SIZE", 1000000):
+        self._TimeFingerprint("Generic %s, 1MB blocks" % name, path, size)
+
+      os.unlink(path)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)